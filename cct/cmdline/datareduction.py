@@ -15,16 +15,17 @@ logger.setLevel(logging.INFO)
 @click.option('--config', '-c', default='config/cct.pickle', help='Config file',
               type=click.Path(exists=True, file_okay=True, dir_okay=False, writable=False, readable=True,
                               allow_dash=False, ))
-def datareduction(firstfsn: int, lastfsn: int, config):
+@click.option('--readers', '-j', default=0, help='Number of threads for loading images (0: all CPUs)',
+              type=click.IntRange(0))
+def datareduction(firstfsn: int, lastfsn: int, config, readers: int):
     """Command-line data reduction routine"""
     config = Config(dicorfile=config)
     config.filename = None  # inhibit autosave
     io = IO(config=config, instrument=None)
     pipeline = DataReductionPipeLine(config.asdict())
-    for fsn in range(firstfsn, lastfsn + 1):
-        try:
-            ex = io.loadExposure(config['path']['prefixes']['crd'], fsn, raw=True, check_local=True)
-        except FileNotFoundError:
+    for fsn, ex in io.loadExposures(config['path']['prefixes']['crd'], range(firstfsn, lastfsn + 1),
+                                    check_local=True, nworkers=readers):
+        if ex is None:
             logger.warning(f'Cannot load exposure #{fsn}')
             continue
         pipeline.process(ex)
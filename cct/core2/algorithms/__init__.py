@@ -1 +1 @@
-from . import radavg, readcbf, peakfit, centering, orderforleastmotormovement, correlmatrix, schilling, matrixaverager, capillarytransmission
\ No newline at end of file
+from . import radavg, readcbf, peakfit, centering, orderforleastmotormovement, correlmatrix, schilling, matrixaverager, capillarytransmission, integrationplan, sparseintegration
\ No newline at end of file
@@ -1,12 +1,65 @@
 # cython: cdivision=True, wraparound=False, boundscheck=False, language_level=3, embedsignature=True
+import numpy as np
 cimport numpy as np
 ctypedef np.uint8_t uint8_t
 ctypedef np.int32_t int32_t
 ctypedef np.int8_t int8_t
 ctypedef np.int16_t int16_t
+ctypedef np.int64_t int64_t
+ctypedef np.uint64_t uint64_t
 ctypedef np.double_t double_t
 
-def cbfdecompress(const uint8_t [:] inarray, double_t[:] outarray):
+ctypedef fused output_t:
+    double_t
+    int32_t
+
+
+cdef int _decompress(const uint8_t [:] inarray, output_t[:] outarray) noexcept nogil:
+    """Byte-offset decompression. Returns 0 on success, -1 if the input is truncated and -3 if the input has less
+    values than needed."""
+    cdef:
+        Py_ssize_t nbytes = inarray.shape[0], iin = 0, iout = 0, nout = outarray.shape[0]
+        int64_t lastvalue = 0
+
+    while iin < nbytes:
+        if inarray[iin] != 0x80:
+            # difference stored on one byte
+            lastvalue = lastvalue + <int8_t>(inarray[iin])
+            iin += 1
+        elif iin + 2 >= nbytes:
+            return -1
+        elif not ((inarray[iin+1] == 0x00) and (inarray[iin+2] == 0x80)):
+            # difference stored on two bytes
+            lastvalue = lastvalue + <int16_t>(inarray[iin+1] + 0x100*inarray[iin+2])
+            iin += 3
+        elif iin + 6 >= nbytes:
+            return -1
+        elif not ((inarray[iin+3] == 0x00)
+                  and (inarray[iin+4] == 0x00) and (inarray[iin+5] == 0x00) and (inarray[iin+6] == 0x80)):
+            # difference stored on four bytes
+            lastvalue = lastvalue + <int32_t>(
+                inarray[iin+3] + 0x100*inarray[iin+4] + 0x10000*inarray[iin+5] + 0x1000000*inarray[iin+6])
+            iin += 7
+        elif iin + 14 >= nbytes:
+            return -1
+        else:
+            # difference stored on eight bytes
+            lastvalue = lastvalue + <int64_t>(
+                (<uint64_t>inarray[iin+7]) | (<uint64_t>inarray[iin+8]) << 8 | (<uint64_t>inarray[iin+9]) << 16 |
+                (<uint64_t>inarray[iin+10]) << 24 | (<uint64_t>inarray[iin+11]) << 32 |
+                (<uint64_t>inarray[iin+12]) << 40 | (<uint64_t>inarray[iin+13]) << 48 |
+                (<uint64_t>inarray[iin+14]) << 56)
+            iin += 15
+        outarray[iout] = <output_t>lastvalue
+        iout +=1
+        if iout >= nout:
+            break
+    if iout != nout:
+        return -3
+    return 0
+
+
+def cbfdecompress(const uint8_t [:] inarray, output_t[:] outarray):
     """Citation from http://www.bernstein-plus-sons.com/software/CBF/doc/CBFLIB.html#3.3
 
         The "byte_offset" compression algorithm is the following:
@@ -47,32 +100,84 @@ def cbfdecompress(const uint8_t [:] inarray, double_t[:] outarray):
 
      (4)        (6)              (8)
     <0x80>|<0x00><0x80>|<0x00><0x00><0x00><0x80>
-    """
-    cdef:
-        Py_ssize_t nbytes = inarray.size, iin = 0, iout = 0, nout = outarray.size
-        double lastvalue = 0
 
-    while iin < nbytes:
-        if inarray[iin] != 0x80:
-            # difference stored on one byte
-            outarray[iout] = lastvalue + <int8_t>(inarray[iin])
-            iin += 1
-        elif not ((inarray[iin+1] == 0x00) and (inarray[iin+2] == 0x80)):
-            # difference stored on two bytes
-            outarray[iout] = lastvalue + <int16_t>(inarray[iin+1] + 0x100*inarray[iin+2])
-            iin += 3
-        elif not ((inarray[iin+3] == 0x00)
-                  and (inarray[iin+4] == 0x00) and (inarray[iin+5] == 0x00) and (inarray[iin+6] == 0x80)):
-            # difference stored on four bytes
-            outarray[iout] = lastvalue + <int32_t>(
-                inarray[iin+3] + 0x100*inarray[iin+4] + 0x10000*inarray[iin+5] + 0x1000000*inarray[iin+6])
-            iin += 7
-        else:
-            raise ValueError('Cannot load 64-bit data')
-        lastvalue=outarray[iout]
-        iout +=1
-        if iout >= nout:
-            break
-    if iout != nout:
+    The output array can be of double or int32 type. The decompression runs without holding the GIL.
+    """
+    cdef int result
+    with nogil:
+        result = _decompress(inarray, outarray)
+    if result == -1:
+        raise ValueError('Truncated binary data')
+    elif result == -3:
         raise ValueError('Binary data does not have enough points.')
     return outarray
+
+
+cdef Py_ssize_t _compress(const int32_t[:] inarray, uint8_t *out) noexcept nogil:
+    """Byte-offset compression. If `out` is NULL, only the length of the compressed data is calculated."""
+    cdef:
+        Py_ssize_t iin, iout = 0, i
+        int64_t lastvalue = 0, delta
+    for iin in range(inarray.shape[0]):
+        delta = <int64_t>inarray[iin] - lastvalue
+        lastvalue = inarray[iin]
+        if -127 <= delta <= 127:
+            if out != NULL:
+                out[iout] = <uint8_t>(<int8_t>delta)
+            iout += 1
+            continue
+        if out != NULL:
+            out[iout] = 0x80
+        iout += 1
+        if -32767 <= delta <= 32767:
+            if out != NULL:
+                out[iout] = <uint8_t>(delta & 0xff)
+                out[iout+1] = <uint8_t>((delta >> 8) & 0xff)
+            iout += 2
+            continue
+        if out != NULL:
+            out[iout] = 0x00
+            out[iout+1] = 0x80
+        iout += 2
+        if -2147483647 <= delta <= 2147483647:
+            if out != NULL:
+                for i in range(4):
+                    out[iout+i] = <uint8_t>((delta >> (8*i)) & 0xff)
+            iout += 4
+            continue
+        if out != NULL:
+            out[iout] = 0x00
+            out[iout+1] = 0x00
+            out[iout+2] = 0x00
+            out[iout+3] = 0x80
+        iout += 4
+        if out != NULL:
+            for i in range(8):
+                out[iout+i] = <uint8_t>((delta >> (8*i)) & 0xff)
+        iout += 8
+    return iout
+
+
+def cbfcompress(const int32_t[:] inarray):
+    """Compress data with the "byte_offset" algorithm (see `cbfdecompress()`)
+
+    Inputs:
+        inarray (np.ndarray, one dimension, dtype: int32): the data
+
+    Returns:
+        the compressed data (np.ndarray, one dimension, dtype: uint8)
+
+    Notes:
+        The length of the output is calculated in a first pass, then the data are compressed in a second one. Both
+        run without holding the GIL.
+    """
+    cdef:
+        Py_ssize_t nbytes
+        uint8_t[:] outarray
+    with nogil:
+        nbytes = _compress(inarray, NULL)
+    outarray = np.empty(nbytes, np.uint8)
+    if nbytes > 0:
+        with nogil:
+            _compress(inarray, &outarray[0])
+    return np.asarray(outarray)
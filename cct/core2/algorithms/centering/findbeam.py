@@ -1,10 +1,14 @@
+import concurrent.futures
 import logging
-from typing import Tuple
+import os
+from typing import Tuple, Optional
 
 import numpy as np
 import scipy.optimize
 
-from .targetfunctions import peakheight, peakwidth, slices, azimuthal, azimuthal_fold, momentofinertia
+from ..radavg import getnthreads
+from .targetfunctions import peakheight, peakwidth, slices, azimuthal, azimuthal_fold, momentofinertia, powerlaw, \
+    momentofinertia_batch, momentofinertia_jac, azimuthal_jac, slices_jac
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -18,34 +22,171 @@ centeringalgorithms = {
     'Moment of inertia': momentofinertia, }
 
 
-def findbeam_crude(targetfunc, exposure, rmin, rmax, d=30, N=10, numabscissa=None) -> Tuple[float, float]:
+# target functions which evaluate several candidate beam centers in one multi-threaded pass
+batchtargetfunctions = {momentofinertia: momentofinertia_batch}
+
+# smoothed versions of target functions, returning the value and the gradient with respect to the beam position
+gradienttargetfunctions = {momentofinertia: momentofinertia_jac, azimuthal: azimuthal_jac, slices: slices_jac}
+
+
+def _workercount(workers: int) -> int:
+    """The number of threads for evaluating target functions
+
+    Nonpositive `workers` means all CPUs. The target functions are based on averaging routines which may run in
+    several threads themselves (see `radavg.setnthreads()`): the number of workers is capped so that the total
+    number of threads does not exceed the number of CPUs.
+    """
+    cpus = os.cpu_count() or 1
+    if workers <= 0:
+        workers = cpus
+    return max(1, min(workers, cpus // max(1, getnthreads())))
+
+
+def evaluate_candidates(targetfunc, beamrows, beamcols, matrix, mask, rmin, rmax, numabscissa=None,
+                        workers=0, executor: Optional[concurrent.futures.ThreadPoolExecutor] = None) -> np.ndarray:
+    """Evaluate a target function at several candidate beam centers
+
+    `workers` is the number of threads, nonpositive means all CPUs (see `_workercount()`). The candidates are
+    evaluated in the threads of `executor` if given, otherwise in a new thread pool. The values are the same as if
+    `targetfunc` was called for each candidate one after the other.
+    """
+    if targetfunc in batchtargetfunctions:
+        # a single multi-threaded pass over the image
+        return batchtargetfunctions[targetfunc](beamrows, beamcols, matrix, mask, rmin, rmax, numabscissa,
+                                                workers if workers > 0 else (os.cpu_count() or 1))
+
+    def evaluate(beampos):
+        return targetfunc(beampos, matrix, mask, rmin, rmax, numabscissa)
+
+    candidates = list(zip(beamrows, beamcols))
+    if executor is not None:
+        return np.array(list(executor.map(evaluate, candidates)), dtype=np.double)
+    workers = min(_workercount(workers), len(candidates))
+    if workers <= 1:
+        return np.array([evaluate(beampos) for beampos in candidates], dtype=np.double)
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        return np.array(list(executor.map(evaluate, candidates)), dtype=np.double)
+
+
+def _gridsearch(targetfunc, matrix, mask, center, rmin, rmax, d, N, numabscissa, workers,
+                refinementlevels, executor=None) -> Optional[Tuple[float, float]]:
     bestvalue = np.inf
     bestposition = None
-    for irow, beamrow in enumerate(
-            np.linspace(exposure.header.beamposrow[0] - d, exposure.header.beamposrow[0] + d, N)):
-        for icol, beamcol in enumerate(
-                np.linspace(exposure.header.beamposcol[0] - d, exposure.header.beamposcol[0] + d, N)):
-            value = targetfunc((beamrow, beamcol), exposure.intensity, exposure.mask, rmin, rmax, numabscissa)
-            if value < bestvalue:
-                bestvalue = value
-                bestposition = (beamrow, beamcol)
+    for level in range(refinementlevels + 1):
+        beamrows, beamcols = np.meshgrid(np.linspace(center[0] - d, center[0] + d, N),
+                                         np.linspace(center[1] - d, center[1] + d, N), indexing='ij')
+        beamrows = beamrows.ravel()
+        beamcols = beamcols.ravel()
+        values = evaluate_candidates(targetfunc, beamrows, beamcols, matrix, mask, rmin, rmax, numabscissa, workers,
+                                     executor)
+        values[np.isnan(values)] = np.inf
+        ibest = np.argmin(values)
+        if values[ibest] < bestvalue:
+            bestvalue = values[ibest]
+            bestposition = (beamrows[ibest], beamcols[ibest])
+        if bestposition is None:
+            break
+        logger.debug(f'Crude beam search level {level}: best position {bestposition}, value {bestvalue}')
+        center = bestposition
+        d = 2 * d / (N - 1)
     return bestposition
 
 
-def findbeam(algorithm, exposure, rmin, rmax, dcrude=30, Ncrude=10, eps=0.01, numabscissa=None):
-    if dcrude > 0 and Ncrude > 2:
-        crudeposition = findbeam_crude(algorithm, exposure, rmin, rmax, dcrude, Ncrude, numabscissa=numabscissa)
+def findbeam_crude(targetfunc, exposure, rmin, rmax, d=30, N=10, numabscissa=None, workers=0,
+                   refinementlevels=0, executor=None) -> Optional[Tuple[float, float]]:
+    """Grid search for the beam center on an N x N grid of half-width `d` around the beam position in the header
+
+    All grid points are evaluated in a batch, see `evaluate_candidates()` (also for `executor`). If
+    `refinementlevels` is positive, the search is repeated that many times on an N x N grid around the best point
+    found so far, the half-width of the new grid being the step size of the previous one.
+    """
+    return _gridsearch(targetfunc, exposure.intensity, exposure.mask,
+                       (exposure.header.beamposrow[0], exposure.header.beamposcol[0]), rmin, rmax, d, N,
+                       numabscissa, workers, refinementlevels, executor)
+
+
+def binimage(matrix: np.ndarray, mask: np.ndarray, factor: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Bin an image by `factor` x `factor` pixel blocks, taking the mask into account
+
+    Each binned pixel is the mean of the valid (unmasked and finite) pixels in its block. A binned pixel is masked
+    if all the pixels in its block are invalid. Incomplete blocks at the bottom and right edges are discarded.
+
+    The center of the binned pixel (row, col) is at (factor * row + (factor - 1) / 2, factor * col + (factor - 1) / 2)
+    in the original pixel coordinates.
+    """
+    nrows, ncols = matrix.shape[0] // factor, matrix.shape[1] // factor
+    matrix = matrix[:nrows * factor, :ncols * factor]
+    valid = np.logical_and(mask[:nrows * factor, :ncols * factor] != 0, np.isfinite(matrix))
+    sums = np.where(valid, matrix, 0.0).reshape(nrows, factor, ncols, factor).sum(axis=(1, 3))
+    counts = valid.reshape(nrows, factor, ncols, factor).sum(axis=(1, 3))
+    binned = np.zeros((nrows, ncols), dtype=np.double)
+    np.divide(sums, counts, out=binned, where=counts > 0)
+    return binned, (counts > 0).astype(np.uint8)
+
+
+def _minimize(algorithm, matrix, mask, startposition, rmin, rmax, eps, numabscissa, analyticgradient,
+              bounds=None) -> scipy.optimize.OptimizeResult:
+    if analyticgradient and (algorithm in gradienttargetfunctions):
+        targetfunc, jac = gradienttargetfunctions[algorithm], True
     else:
-        crudeposition = exposure.header.beamposrow[0], exposure.header.beamposcol[0]
-    result = scipy.optimize.minimize(
-        algorithm,
-        np.array(crudeposition),
-        args=(exposure.intensity, exposure.mask, rmin, rmax, numabscissa),
+        targetfunc, jac = algorithm, None
+    return scipy.optimize.minimize(
+        targetfunc,
+        np.array(startposition),
+        args=(matrix, mask, rmin, rmax, numabscissa),
         method='L-BFGS-B',
+        jac=jac,
+        bounds=bounds,
         options={'ftol': 1e7 * np.finfo(float).eps,
                  'eps': eps,  # finite step size for approximating the jacobian
                  },
     )
-    ftol = 1e7 * np.finfo(float).eps  # L-BFGS-B default factr value is 1e7
-    covar = max(1, np.abs(result.fun)) * ftol * result.hess_inv.todense()
-    return (result.x[0], covar[0, 0] ** 0.5), (result.x[1], covar[1, 1] ** 0.5)
+
+
+def findbeam(algorithm, exposure, rmin, rmax, dcrude=30, Ncrude=10, eps=0.01, numabscissa=None, workers=0,
+             crudelevels=0, analyticgradient=False, pyramidlevels=0, refinementwindow=2.0):
+    """Find the beam center
+
+    The optional crude grid search (see `findbeam_crude()`) is followed by a local L-BFGS-B minimization of the
+    target function, the gradient being approximated by finite differences of step `eps`. If `analyticgradient` is
+    True and a smoothed version of the target function with known gradient exists (see `gradienttargetfunctions`),
+    that one is minimized instead.
+
+    With `pyramidlevels` > 0, the search starts on the image binned by 2**pyramidlevels (see `binimage()`), where the
+    crude grid search is done, if requested. The result is refined on successively finer binnings by factors of two,
+    and finally at full resolution, restricted to a window of +/- `refinementwindow` pixels in both directions.
+
+    Returns: (beamrow, uncertainty), (beamcol, uncertainty)
+    """
+    # the threads for the crude grid searches are started only once
+    with concurrent.futures.ThreadPoolExecutor(_workercount(workers), thread_name_prefix='findbeam') as executor:
+        position = exposure.header.beamposrow[0], exposure.header.beamposcol[0]
+        for level in range(pyramidlevels, 0, -1):
+            factor = 2 ** level
+            matrix, mask = binimage(exposure.intensity, exposure.mask, factor)
+            # pixel coordinates on the binned image
+            position = (position[0] - (factor - 1) / 2) / factor, (position[1] - (factor - 1) / 2) / factor
+            coarsenumabscissa = None if numabscissa is None else max(3, int(numabscissa / factor))
+            if (level == pyramidlevels) and (dcrude > 0) and (Ncrude > 2):
+                crudeposition = _gridsearch(algorithm, matrix, mask, position, rmin / factor, rmax / factor,
+                                            dcrude / factor, Ncrude, coarsenumabscissa, workers, crudelevels,
+                                            executor)
+                position = position if crudeposition is None else crudeposition
+            result = _minimize(algorithm, matrix, mask, position, rmin / factor, rmax / factor, eps, coarsenumabscissa,
+                               analyticgradient)
+            position = result.x[0] * factor + (factor - 1) / 2, result.x[1] * factor + (factor - 1) / 2
+            logger.debug(f'Beam position found at pyramid level {level}: {position}')
+        if pyramidlevels > 0:
+            bounds = [(position[0] - refinementwindow, position[0] + refinementwindow),
+                      (position[1] - refinementwindow, position[1] + refinementwindow)]
+        elif dcrude > 0 and Ncrude > 2:
+            position = findbeam_crude(algorithm, exposure, rmin, rmax, dcrude, Ncrude, numabscissa=numabscissa,
+                                      workers=workers, refinementlevels=crudelevels, executor=executor)
+            bounds = None
+        else:
+            bounds = None
+        result = _minimize(algorithm, exposure.intensity, exposure.mask, position, rmin, rmax, eps, numabscissa,
+                           analyticgradient, bounds)
+        ftol = 1e7 * np.finfo(float).eps  # L-BFGS-B default factr value is 1e7
+        covar = max(1, np.abs(result.fun)) * ftol * result.hess_inv.todense()
+        return (result.x[0], covar[0, 0] ** 0.5), (result.x[1], covar[1, 1] ** 0.5)
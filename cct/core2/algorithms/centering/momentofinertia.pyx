@@ -1,14 +1,18 @@
 # cython: cdivision=True, wraparound=False, boundscheck=False, language_level=3, embedsignature=True
+import numpy as np
+from cython.parallel cimport prange
 from numpy cimport uint8_t
 from libc.math cimport isfinite
 
-def _momentofinertia(double [:, :] matrix, uint8_t [:,:] mask, double beamrow, double beamcol, double rmin, double rmax):
+from ..radavg import getnthreads
+
+
+cdef double _moment(double [:, :] matrix, uint8_t [:,:] mask, double beamrow, double beamcol,
+                    double rmin2, double rmax2) noexcept nogil:
     cdef:
         Py_ssize_t irow, icol
         double moment= 0.0
         double radius2 = 0.0
-        double rmin2 = rmin*rmin
-        double rmax2 = rmax*rmax
     for irow in range(matrix.shape[0]):
         for icol in range(matrix.shape[1]):
             if mask[irow, icol] == 0:
@@ -19,4 +23,45 @@ def _momentofinertia(double [:, :] matrix, uint8_t [:,:] mask, double beamrow, d
             if (radius2 < rmin2) or (radius2 > rmax2):
                 continue
             moment += radius2*matrix[irow, icol]
-    return moment
\ No newline at end of file
+    return moment
+
+
+def _momentofinertia(double [:, :] matrix, uint8_t [:,:] mask, double beamrow, double beamcol, double rmin, double rmax):
+    return _moment(matrix, mask, beamrow, beamcol, rmin*rmin, rmax*rmax)
+
+
+def _momentofinertia_batch(double [:, :] matrix, uint8_t [:,:] mask, double[:] beamrows, double[:] beamcols,
+                           double rmin, double rmax, int nthreads=0):
+    """
+    Moment of inertia for several candidate beam centers at once
+
+    Inputs:
+        matrix (np.ndarray, two dimensions, dtype: double): scattering pattern
+        mask (np.ndarray, two dimensions, dtype: uint8): mask matrix
+        beamrows (np.ndarray, one dimension, dtype: double): row coordinates of the candidate beam centers
+        beamcols (np.ndarray, one dimension, dtype: double): column coordinates of the candidate beam centers
+        rmin (double): inner radius of the annulus
+        rmax (double): outer radius of the annulus
+        nthreads (int): number of threads. If nonpositive, the default set by `radavg.setnthreads()` is used.
+
+    Returns:
+        the moments of inertia (np.ndarray, one dimension, dtype: double), one for each candidate
+
+    Notes:
+        The candidates are distributed among the threads, each value is calculated exactly as by
+        `_momentofinertia()`.
+    """
+    cdef:
+        Py_ssize_t i
+        double[:] moments
+        double rmin2 = rmin*rmin
+        double rmax2 = rmax*rmax
+    if beamrows.shape[0] != beamcols.shape[0]:
+        raise ValueError('Shape mismatch')
+    if nthreads <= 0:
+        nthreads = getnthreads()
+    moments = np.empty(beamrows.shape[0], np.double)
+    with nogil:
+        for i in prange(beamrows.shape[0], schedule='dynamic', num_threads=nthreads):
+            moments[i] = _moment(matrix, mask, beamrows[i], beamcols[i], rmin2, rmax2)
+    return np.array(moments)
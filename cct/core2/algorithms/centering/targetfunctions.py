@@ -1,7 +1,8 @@
 import numpy as np
 import scipy.optimize
 
-from .momentofinertia import _momentofinertia
+from .momentofinertia import _momentofinertia, _momentofinertia_batch
+from .targetgradients import _momentofinertia_jac, _azimuthal_jac, _slices_jac
 from ..radavg import fastradavg, fastazimavg, maskforannulus, maskforsectors
 
 
@@ -67,6 +68,22 @@ def slices(beampos, matrix, mask, rmin, rmax, numabscissa=None):
                 intensities[valid, 1] - intensities[valid, 3]) ** 2).mean()
 
 
+def slices_jac(beampos, matrix, mask, rmin, rmax, numabscissa=None):
+    """Smoothed version of `slices()`, returning the value and the gradient with respect to the beam position"""
+    N = int(rmax - rmin) if numabscissa is None else numabscissa
+    intensities, areas, dintensities, dareas = _slices_jac(matrix, mask, beampos[0], beampos[1], rmin, rmax, N)
+    valid = areas.prod(axis=1) > 0
+    intensities, areas, dintensities, dareas = intensities[valid], areas[valid], dintensities[valid], dareas[valid]
+    means = intensities / areas
+    dmeans = (dintensities - means[:, :, np.newaxis] * dareas) / areas[:, :, np.newaxis]
+    diff02 = means[:, 0] - means[:, 2]
+    diff13 = means[:, 1] - means[:, 3]
+    value = (diff02 ** 2 + diff13 ** 2).mean()
+    gradient = (2 * diff02[:, np.newaxis] * (dmeans[:, 0, :] - dmeans[:, 2, :]) +
+                2 * diff13[:, np.newaxis] * (dmeans[:, 1, :] - dmeans[:, 3, :])).mean(axis=0)
+    return value, gradient
+
+
 def powerlaw(beampos, matrix, mask, rmin, rmax, numabscissa= None):
     pixel, intensity, area = fastradavg(matrix, mask, beampos[0], beampos[1], rmin, rmax, 20 if numabscissa is None else numabscissa)
     valid = np.logical_and(np.isfinite(pixel), np.isfinite(intensity))
@@ -87,6 +104,18 @@ def momentofinertia(beampos, matrix, mask, rmin, rmax, numabscissa=None):
     return -_momentofinertia(matrix, mask, beampos[0], beampos[1], rmin, rmax)
 
 
+def momentofinertia_batch(beamrows, beamcols, matrix, mask, rmin, rmax, numabscissa=None, nthreads=0):
+    return -_momentofinertia_batch(matrix, mask, np.ascontiguousarray(beamrows, dtype=np.double),
+                                   np.ascontiguousarray(beamcols, dtype=np.double), rmin, rmax, nthreads)
+
+
+def momentofinertia_jac(beampos, matrix, mask, rmin, rmax, numabscissa=None):
+    """Smoothed version of `momentofinertia()`, returning the value and the gradient with respect to the beam
+    position"""
+    moment, dmoment_drow, dmoment_dcol = _momentofinertia_jac(matrix, mask, beampos[0], beampos[1], rmin, rmax)
+    return -moment, -np.array([dmoment_drow, dmoment_dcol])
+
+
 def azimuthal(beampos, matrix, mask, rmin, rmax, numabscissa=None):
     msk = maskforannulus(mask, beampos[0], beampos[1], rmin, rmax)
     phi, intensity, area = fastazimavg(matrix, msk, beampos[0], beampos[1], int((rmin + rmax) * np.pi / 2))
@@ -96,6 +125,24 @@ def azimuthal(beampos, matrix, mask, rmin, rmax, numabscissa=None):
     return intensity[np.logical_and(binok, area > 0)].std()
 
 
+def azimuthal_jac(beampos, matrix, mask, rmin, rmax, numabscissa=None):
+    """Smoothed version of `azimuthal()`, returning the value and the gradient with respect to the beam position"""
+    intensity, area, dintensity, darea = _azimuthal_jac(
+        matrix, mask, beampos[0], beampos[1], rmin, rmax, int((rmin + rmax) * np.pi / 2))
+    binarea_q1, binarea_q3 = np.percentile(area, [25, 75])
+    binok = np.logical_and(area >= binarea_q1 - (binarea_q3 - binarea_q1)*1.5,
+                           area <= binarea_q3 + (binarea_q3 - binarea_q1)*1.5)
+    binok = np.logical_and(binok, area > 0)
+    means = intensity[binok] / area[binok]
+    dmeans = (dintensity[binok] - means[:, np.newaxis] * darea[binok]) / area[binok, np.newaxis]
+    value = means.std()
+    if value == 0:
+        return value, np.zeros(2)
+    # d(std)/dx = sum((mean_i - <mean>) * dmean_i/dx) / (N * std)
+    gradient = ((means - means.mean())[:, np.newaxis] * dmeans).sum(axis=0) / (len(means) * value)
+    return value, gradient
+
+
 def azimuthal_fold(beampos, matrix, mask, rmin, rmax, numabscissa=None):
     msk = maskforannulus(mask, beampos[0], beampos[1], rmin, rmax)
     phi, intensity, area = fastazimavg(matrix, msk, beampos[0], beampos[1], int((rmin + rmax) * np.pi / 4) * 2)
@@ -0,0 +1,284 @@
+# cython: cdivision=True, wraparound=False, boundscheck=False, language_level=3, embedsignature=True
+"""Beam center target functions with their gradients with respect to the beam position
+
+The hard-binned target functions are discontinuous in the beam position: they jump whenever a pixel crosses the
+border of the annulus (or of a sector), and the binned ones also when a pixel moves to another bin. Between these
+jumps, the moment of inertia changes smoothly, while the azimuthal and slices targets are piecewise constant. Finite
+difference derivatives of them are therefore unreliable. The kernels here use a smoothed version: pixels are
+distributed among the two neighbouring bins by linear interpolation and the borders of the annulus (or the sectors)
+are softened to a linear ramp of one pixel width. The gradients are exact, but the values differ from those of the
+hard-binned counterparts (the interpolation also smooths the binned curves), and so can the location of the minimum.
+"""
+import numpy as np
+from numpy cimport uint8_t
+from libc.math cimport isfinite, sqrt, atan2, floor, M_PI
+
+
+cdef struct _Ramp:
+    double value
+    double derivative
+
+
+cdef inline _Ramp _annulusweight(double r, double rmin, double rmax) noexcept nogil:
+    """Weight of a pixel at radius `r` for the annulus [rmin, rmax]: 1 inside, 0 outside, with a linear ramp of one
+    pixel width centered on the borders. The derivative is with respect to `r`."""
+    cdef:
+        _Ramp result
+        double lo = r - rmin + 0.5
+        double hi = rmax - r + 0.5
+        double wlo = 1.0, whi = 1.0, dwlo = 0.0, dwhi = 0.0
+    if lo <= 0 or hi <= 0:
+        result.value = 0.0
+        result.derivative = 0.0
+        return result
+    if lo < 1:
+        wlo = lo
+        dwlo = 1.0
+    if hi < 1:
+        whi = hi
+        dwhi = -1.0
+    result.value = wlo * whi
+    result.derivative = dwlo * whi + wlo * dwhi
+    return result
+
+
+def _momentofinertia_jac(double [:, :] matrix, uint8_t [:,:] mask, double beamrow, double beamcol,
+                         double rmin, double rmax):
+    """
+    Moment of inertia of the annulus and its gradient
+
+    Inputs:
+        matrix (np.ndarray, two dimensions, dtype: double): scattering pattern
+        mask (np.ndarray, two dimensions, dtype: uint8): mask matrix
+        beamrow (double): row coordinate of the beam center
+        beamcol (double): column coordinate of the beam center
+        rmin (double): inner radius of the annulus
+        rmax (double): outer radius of the annulus
+
+    Returns: moment, dmoment_drow, dmoment_dcol
+    """
+    cdef:
+        Py_ssize_t irow, icol
+        double moment = 0.0, dmoment_drow = 0.0, dmoment_dcol = 0.0
+        double drow, dcol, r, radius2
+        _Ramp weight
+    with nogil:
+        for irow in range(matrix.shape[0]):
+            for icol in range(matrix.shape[1]):
+                if mask[irow, icol] == 0:
+                    continue
+                if not isfinite(matrix[irow, icol]):
+                    continue
+                drow = irow - beamrow
+                dcol = icol - beamcol
+                radius2 = drow * drow + dcol * dcol
+                r = sqrt(radius2)
+                weight = _annulusweight(r, rmin, rmax)
+                if weight.value == 0:
+                    continue
+                moment += weight.value * radius2 * matrix[irow, icol]
+                # d(radius2)/d(beamrow) = -2 drow, dr/d(beamrow) = -drow / r
+                dmoment_drow += matrix[irow, icol] * (-2 * drow * weight.value - weight.derivative * drow * r)
+                dmoment_dcol += matrix[irow, icol] * (-2 * dcol * weight.value - weight.derivative * dcol * r)
+    return moment, dmoment_drow, dmoment_dcol
+
+
+def _azimuthal_jac(double [:, :] matrix, uint8_t [:,:] mask, double beamrow, double beamcol,
+                   double rmin, double rmax, Py_ssize_t N):
+    """
+    Smoothed azimuthal binning of an annulus, with derivatives
+
+    Inputs:
+        matrix (np.ndarray, two dimensions, dtype: double): scattering pattern
+        mask (np.ndarray, two dimensions, dtype: uint8): mask matrix
+        beamrow (double): row coordinate of the beam center
+        beamcol (double): column coordinate of the beam center
+        rmin (double): inner radius of the annulus
+        rmax (double): outer radius of the annulus
+        N (Py_ssize_t): number of azimuthal bins, the k-th centered on 2*pi*k/N
+
+    Returns: Intensity, Area, dIntensity, dArea
+        Intensity (np.ndarray, shape (N,)): weighted sum of the intensities in each bin (not normalized)
+        Area (np.ndarray, shape (N,)): sum of the weights in each bin
+        dIntensity, dArea (np.ndarray, shape (N, 2)): derivatives of the former two with respect to the row and
+            column coordinate of the beam center
+    """
+    cdef:
+        Py_ssize_t irow, icol, k0, k1
+        double drow, dcol, r, phi, t, frac
+        double dr_drow, dr_dcol, dphi_drow, dphi_dcol
+        double w0, w1, dw0_drow, dw0_dcol, dw1_drow, dw1_dcol
+        double value
+        double[:] Intensity = np.zeros(N, np.double)
+        double[:] Area = np.zeros(N, np.double)
+        double[:, :] dIntensity = np.zeros((N, 2), np.double)
+        double[:, :] dArea = np.zeros((N, 2), np.double)
+        _Ramp weight
+    with nogil:
+        for irow in range(matrix.shape[0]):
+            for icol in range(matrix.shape[1]):
+                if mask[irow, icol] == 0:
+                    continue
+                value = matrix[irow, icol]
+                if not isfinite(value):
+                    continue
+                drow = irow - beamrow
+                dcol = icol - beamcol
+                r = sqrt(drow * drow + dcol * dcol)
+                weight = _annulusweight(r, rmin, rmax)
+                if (weight.value == 0) or (r == 0):
+                    continue
+                dr_drow = -drow / r
+                dr_dcol = -dcol / r
+                phi = atan2(-drow, dcol)
+                if phi < 0:
+                    phi = phi + 2 * M_PI
+                dphi_drow = dcol / (r * r)
+                dphi_dcol = -drow / (r * r)
+                t = phi / (2 * M_PI) * N
+                k0 = <Py_ssize_t>floor(t)
+                frac = t - k0
+                k0 = k0 % N
+                k1 = (k0 + 1) % N
+                # interpolation weight of the two neighbouring bins times the radial weight
+                w0 = (1 - frac) * weight.value
+                w1 = frac * weight.value
+                dw0_drow = (1 - frac) * weight.derivative * dr_drow - weight.value * dphi_drow * N / (2 * M_PI)
+                dw0_dcol = (1 - frac) * weight.derivative * dr_dcol - weight.value * dphi_dcol * N / (2 * M_PI)
+                dw1_drow = frac * weight.derivative * dr_drow + weight.value * dphi_drow * N / (2 * M_PI)
+                dw1_dcol = frac * weight.derivative * dr_dcol + weight.value * dphi_dcol * N / (2 * M_PI)
+                Intensity[k0] += w0 * value
+                Intensity[k1] += w1 * value
+                Area[k0] += w0
+                Area[k1] += w1
+                dIntensity[k0, 0] += dw0_drow * value
+                dIntensity[k0, 1] += dw0_dcol * value
+                dIntensity[k1, 0] += dw1_drow * value
+                dIntensity[k1, 1] += dw1_dcol * value
+                dArea[k0, 0] += dw0_drow
+                dArea[k0, 1] += dw0_dcol
+                dArea[k1, 0] += dw1_drow
+                dArea[k1, 1] += dw1_dcol
+    return np.array(Intensity), np.array(Area), np.array(dIntensity), np.array(dArea)
+
+
+def _slices_jac(double [:, :] matrix, uint8_t [:,:] mask, double beamrow, double beamcol,
+                double rmin, double rmax, Py_ssize_t N):
+    """
+    Smoothed radial binning in the four quadrants, with derivatives
+
+    Inputs:
+        matrix (np.ndarray, two dimensions, dtype: double): scattering pattern
+        mask (np.ndarray, two dimensions, dtype: uint8): mask matrix
+        beamrow (double): row coordinate of the beam center
+        beamcol (double): column coordinate of the beam center
+        rmin (double): smallest radius
+        rmax (double): largest radius
+        N (Py_ssize_t): number of radial bins, the k-th centered on rmin + (k + 0.5) * (rmax - rmin) / N
+
+    Returns: Intensity, Area, dIntensity, dArea
+        Intensity (np.ndarray, shape (N, 4)): weighted sum of the intensities in each bin (not normalized)
+        Area (np.ndarray, shape (N, 4)): sum of the weights in each bin
+        dIntensity, dArea (np.ndarray, shape (N, 4, 2)): derivatives of the former two with respect to the row and
+            column coordinate of the beam center
+
+    Notes:
+        The i-th quadrant is the sector between azimuth angles i*pi/2 and (i+1)*pi/2, the same as obtained by
+        `maskforsectors()` with phicenter=pi/4 + i*pi/2 and phihalfwidth=pi/4.
+    """
+    cdef:
+        Py_ssize_t irow, icol, k0, isector, ibin, isec
+        double drow, dcol, r, phi, psi, t, frac, binwidth
+        double arclength = 0.0, darc_drow = 0.0, darc_dcol = 0.0
+        double dr_drow, dr_dcol, dphi_drow, dphi_dcol
+        double value
+        double rw[2]
+        double drw_drow[2]
+        double drw_dcol[2]
+        Py_ssize_t rbin[2]
+        double sw[2]
+        double dsw_drow[2]
+        double dsw_dcol[2]
+        Py_ssize_t sbin[2]
+        double[:, :] Intensity = np.zeros((N, 4), np.double)
+        double[:, :] Area = np.zeros((N, 4), np.double)
+        double[:, :, :] dIntensity = np.zeros((N, 4, 2), np.double)
+        double[:, :, :] dArea = np.zeros((N, 4, 2), np.double)
+    binwidth = (rmax - rmin) / N
+    with nogil:
+        for irow in range(matrix.shape[0]):
+            for icol in range(matrix.shape[1]):
+                if mask[irow, icol] == 0:
+                    continue
+                value = matrix[irow, icol]
+                if not isfinite(value):
+                    continue
+                drow = irow - beamrow
+                dcol = icol - beamcol
+                r = sqrt(drow * drow + dcol * dcol)
+                t = (r - rmin) / binwidth - 0.5
+                if (r == 0) or (t <= -1) or (t >= N):
+                    continue
+                dr_drow = -drow / r
+                dr_dcol = -dcol / r
+                # radial interpolation weights
+                k0 = <Py_ssize_t>floor(t)
+                frac = t - k0
+                rbin[0] = k0
+                rbin[1] = k0 + 1
+                rw[0] = 1 - frac
+                rw[1] = frac
+                drw_drow[0] = -dr_drow / binwidth
+                drw_dcol[0] = -dr_dcol / binwidth
+                drw_drow[1] = dr_drow / binwidth
+                drw_dcol[1] = dr_dcol / binwidth
+                # quadrant weights: linear ramp of one pixel arc length across the quadrant borders
+                phi = atan2(-drow, dcol)
+                if phi < 0:
+                    phi = phi + 2 * M_PI
+                dphi_drow = dcol / (r * r)
+                dphi_dcol = -drow / (r * r)
+                isector = (<Py_ssize_t>floor(phi / (M_PI / 2))) % 4
+                psi = phi - isector * M_PI / 2
+                sbin[0] = isector
+                sw[0] = 1.0
+                dsw_drow[0] = 0.0
+                dsw_dcol[0] = 0.0
+                sbin[1] = isector
+                sw[1] = 0.0
+                dsw_drow[1] = 0.0
+                dsw_dcol[1] = 0.0
+                if r * psi < 0.5:
+                    # near the lower border
+                    arclength = r * psi
+                    darc_drow = dr_drow * psi + r * dphi_drow
+                    darc_dcol = dr_dcol * psi + r * dphi_dcol
+                    sbin[1] = (isector + 3) % 4
+                elif r * (M_PI / 2 - psi) < 0.5:
+                    # near the upper border
+                    arclength = r * (M_PI / 2 - psi)
+                    darc_drow = dr_drow * (M_PI / 2 - psi) - r * dphi_drow
+                    darc_dcol = dr_dcol * (M_PI / 2 - psi) - r * dphi_dcol
+                    sbin[1] = (isector + 1) % 4
+                if sbin[1] != isector:
+                    sw[0] = 0.5 + arclength
+                    sw[1] = 0.5 - arclength
+                    dsw_drow[0] = darc_drow
+                    dsw_dcol[0] = darc_dcol
+                    dsw_drow[1] = -darc_drow
+                    dsw_dcol[1] = -darc_dcol
+                for ibin in range(2):
+                    if (rbin[ibin] < 0) or (rbin[ibin] >= N):
+                        continue
+                    for isec in range(2):
+                        if sw[isec] == 0:
+                            continue
+                        Intensity[rbin[ibin], sbin[isec]] += rw[ibin] * sw[isec] * value
+                        Area[rbin[ibin], sbin[isec]] += rw[ibin] * sw[isec]
+                        dArea[rbin[ibin], sbin[isec], 0] += drw_drow[ibin] * sw[isec] + rw[ibin] * dsw_drow[isec]
+                        dArea[rbin[ibin], sbin[isec], 1] += drw_dcol[ibin] * sw[isec] + rw[ibin] * dsw_dcol[isec]
+                        dIntensity[rbin[ibin], sbin[isec], 0] += (
+                                drw_drow[ibin] * sw[isec] + rw[ibin] * dsw_drow[isec]) * value
+                        dIntensity[rbin[ibin], sbin[isec], 1] += (
+                                drw_dcol[ibin] * sw[isec] + rw[ibin] * dsw_dcol[isec]) * value
+    return np.array(Intensity), np.array(Area), np.array(dIntensity), np.array(dArea)
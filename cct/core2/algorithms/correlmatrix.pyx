@@ -5,6 +5,58 @@ from cython.parallel import prange
 from libc.math cimport log, nan, isfinite
 np.import_array()
 
+cdef unsigned char[:,:] _validpoints(double[:,:] intensities, double[:,:] errors, bint logarithmic):
+    cdef:
+        Py_ssize_t icurves, ipoints
+        unsigned char[:,:] mymask = np.empty((intensities.shape[0], intensities.shape[1]), np.uint8)
+    for icurves in range(intensities.shape[1]):
+        for ipoints in range(intensities.shape[0]):
+            mymask[ipoints, icurves] = (((intensities[ipoints, icurves])>0) or (not logarithmic)) and (errors[ipoints, icurves]>0)
+    return mymask
+
+
+cdef double _discrepancy(double[:,:] intensities1, double[:,:] errors1, unsigned char[:,:] mask1, Py_ssize_t icurves,
+                         double[:,:] intensities2, double[:,:] errors2, unsigned char[:,:] mask2, Py_ssize_t jcurves,
+                         bint logarithmic) noexcept nogil:
+    """The off-diagonal element c_ij of the correlation matrix, between the i-th curve of the first and the j-th curve
+    of the second set"""
+    cdef:
+        Py_ssize_t ipoints
+        double cmpoint = 0, weight = 0, w
+    for ipoints in range(intensities1.shape[0]):
+        if (not mask1[ipoints, icurves]) or (not mask2[ipoints, jcurves]):
+            continue
+        if logarithmic:
+            w = (errors1[ipoints, icurves]/intensities1[ipoints,icurves])**2+ (errors2[ipoints,jcurves]/intensities2[ipoints,jcurves])**2
+            cmpoint=cmpoint+(log(intensities1[ipoints, icurves])-log(intensities2[ipoints,jcurves]))**2/w
+        else:
+            w = errors1[ipoints, icurves]**2+errors2[ipoints,jcurves]**2
+            cmpoint=cmpoint +(intensities1[ipoints,icurves]-intensities2[ipoints,jcurves])**2/w
+        weight=weight+1/w
+    if weight>0:
+        return cmpoint/weight
+    else:
+        return nan('NaN')
+
+
+cdef void _fillDiagonal(double[:,:] cm) noexcept nogil:
+    """Set the diagonal elements to the mean of the finite off-diagonal elements in the same row"""
+    cdef:
+        Py_ssize_t icurves, jcurves, npoints
+        double cmpoint
+    for icurves in range(cm.shape[0]):
+        cmpoint = 0
+        npoints = 0
+        for jcurves in range(cm.shape[0]):
+            if (jcurves != icurves) and isfinite(cm[icurves,jcurves]):
+                cmpoint = cmpoint + cm[icurves,jcurves]
+                npoints = npoints+1
+        if npoints>0:
+            cm[icurves,icurves] = cmpoint / npoints
+        else:
+            cm[icurves, icurves] = nan('NaN')
+
+
 def correlmatrix_cython(double[:,:] intensities not None, double[:,:] errors not None, bint logarithmic=False):
     """Calculate the correlation matrix of scattering curves
 
@@ -35,52 +87,175 @@ def correlmatrix_cython(double[:,:] intensities not None, double[:,:] errors not
     :return: the correlation matrix
     :rtype: NxN np.ndarray, double dtype
     """
-    cdef Py_ssize_t Ncurves, Npoints, icurves, ipoints, jcurves, npoints
+    cdef Py_ssize_t Ncurves, icurves, jcurves
     cdef double[:,:] cm
-    cdef double weight
-    cdef double cmpoint, w
     cdef unsigned char[:,:] mymask
-    cdef double NaN = nan('NaN')
     Ncurves=intensities.shape[1]
-    Npoints=intensities.shape[0]
-    if (errors.shape[1] != Ncurves) or (errors.shape[0] != Npoints):
+    if (errors.shape[1] != Ncurves) or (errors.shape[0] != intensities.shape[0]):
         raise ValueError('Invalid shape of errors')
-    mymask = np.empty((Npoints, Ncurves), np.uint8)
+    mymask = _validpoints(intensities, errors, logarithmic)
     cm = np.empty((Ncurves, Ncurves), np.double)
-    for icurves in range(Ncurves):
-        for ipoints in range(Npoints):
-            mymask[ipoints, icurves] = (((intensities[ipoints, icurves])>0) or (not logarithmic)) and (errors[ipoints, icurves]>0)
     for icurves in prange(Ncurves, nogil=True, schedule='guided'):
         for jcurves in range(icurves+1, Ncurves):
-            cmpoint=0
-            weight = 0
-            for ipoints in range(Npoints):
-                if (not mymask[ipoints, icurves]) or (not mymask[ipoints, jcurves]):
-                    continue
-                if logarithmic:
-                    w = (errors[ipoints, icurves]/intensities[ipoints,icurves])**2+ (errors[ipoints,jcurves]/intensities[ipoints,jcurves])**2
-                    cmpoint=cmpoint+(log(intensities[ipoints, icurves])-log(intensities[ipoints,jcurves]))**2/w
-                else:
-                    w = errors[ipoints, icurves]**2+errors[ipoints,jcurves]**2
-                    cmpoint=cmpoint +(intensities[ipoints,icurves]-intensities[ipoints,jcurves])**2/w
-                weight=weight+1/w
-            if weight>0:
-                cm[icurves,jcurves]=cm[jcurves,icurves]=cmpoint/weight
+            cm[icurves,jcurves]=cm[jcurves,icurves]=_discrepancy(intensities, errors, mymask, icurves,
+                                                                 intensities, errors, mymask, jcurves, logarithmic)
+    _fillDiagonal(cm)
+    del mymask
+    return cm
+
+
+def correlmatrix_update(double[:,:] intensities not None, double[:,:] errors not None, double[:,:] cm not None,
+                        unsigned char[:] known not None, bint logarithmic=False):
+    """Complete a partially known correlation matrix of scattering curves, in place
+
+    The off-diagonal element c_ij is calculated as in `correlmatrix_cython()`, unless both the i-th and the j-th
+    curves are marked as known: then the value already in `cm` is kept. The diagonal is always recalculated.
+
+    If only a few curves are new, this needs only O(N * N_new) instead of O(N^2) curve comparisons.
+
+    :param intensities: an array containing the intensities of independent measurements in columns
+    :type intensities: MxN np.ndarray, double dtype
+    :param errors: an array containing the absolute errors of independent measurements in columns
+    :type errors: MxN np.ndarray, double dtype
+    :param cm: the correlation matrix, with the elements between known curves already filled in
+    :type cm: NxN np.ndarray, double dtype
+    :param known: nonzero for curves whose mutual correlation matrix elements are already known
+    :type known: N np.ndarray, uint8 dtype
+    :param logarithmic: if logarithmic distances are to be used
+    :type logarithmic: bool
+    :return: the correlation matrix (the same object as `cm`)
+    :rtype: NxN np.ndarray, double dtype
+    """
+    cdef Py_ssize_t Ncurves, icurves, jcurves
+    cdef unsigned char[:,:] mymask
+    Ncurves=intensities.shape[1]
+    if (errors.shape[1] != Ncurves) or (errors.shape[0] != intensities.shape[0]):
+        raise ValueError('Invalid shape of errors')
+    if (cm.shape[0] != Ncurves) or (cm.shape[1] != Ncurves) or (known.shape[0] != Ncurves):
+        raise ValueError('Invalid shape of the correlation matrix')
+    mymask = _validpoints(intensities, errors, logarithmic)
+    for icurves in prange(Ncurves, nogil=True, schedule='guided'):
+        for jcurves in range(icurves+1, Ncurves):
+            if known[icurves] and known[jcurves]:
+                continue
+            cm[icurves,jcurves]=cm[jcurves,icurves]=_discrepancy(intensities, errors, mymask, icurves,
+                                                                 intensities, errors, mymask, jcurves, logarithmic)
+    _fillDiagonal(cm)
+    del mymask
+    return np.asarray(cm)
+
+
+cdef tuple _loadblock(object loadblock, Py_ssize_t start, Py_ssize_t stop):
+    """Get the intensities and the errors of curves [start, stop) from the user-supplied callback"""
+    intensities, errors = loadblock(start, stop)
+    intensities = np.ascontiguousarray(intensities, dtype=np.double)
+    errors = np.ascontiguousarray(errors, dtype=np.double)
+    if (intensities.ndim != 2) or (intensities.shape[1] != stop - start) or (errors.shape != intensities.shape):
+        raise ValueError(f'Invalid shape of the block of curves {start}:{stop}')
+    return intensities, errors
+
+
+def correlmatrix_blocked(object loadblock not None, Py_ssize_t Ncurves, Py_ssize_t blocksize=1024,
+                         bint logarithmic=False, bint fullmatrix=False):
+    """Calculate the diagonal of the correlation matrix of scattering curves, loading the curves in blocks
+
+    The elements are calculated as in `correlmatrix_cython()`, but only two blocks of curves are needed in the memory
+    at the same time, and the full NxN matrix is only constructed if requested. This makes it possible to find
+    outliers in very long series of measurements, e.g. by streaming the curves from a HDF5 file. Each block is loaded
+    (N / blocksize + 1) / 2 times on average.
+
+    The diagonal (the average discrepancy of each curve from all others) is bit-identical to that of
+    `correlmatrix_cython()`.
+
+    :param loadblock: a callable of two arguments, `start` and `stop`. It must return the intensities and the
+        absolute errors of the curves `start`, `start+1`, ..., `stop-1` in the columns of two MxK arrays, where
+        K = stop - start.
+    :type loadblock: callable
+    :param Ncurves: the total number of curves
+    :type Ncurves: int
+    :param blocksize: the number of curves in a block
+    :type blocksize: int
+    :param logarithmic: if logarithmic distances are to be used
+    :type logarithmic: bool
+    :param fullmatrix: if the full correlation matrix is to be returned as well
+    :type fullmatrix: bool
+    :return: the diagonal of the correlation matrix and the full correlation matrix (None if not requested)
+    :rtype: tuple of an N np.ndarray and an NxN np.ndarray or None, double dtype
+    """
+    cdef:
+        Py_ssize_t istart, istop, jstart, jstop, icurves, jcurves, Ni, Nj
+        double[:,:] intensities1, errors1, intensities2, errors2, blk, cm
+        unsigned char[:,:] mask1, mask2
+        double[:] rowsum, score
+        Py_ssize_t[:] rowcount
+        double value
+        bint diagonalblock
+    if blocksize < 1:
+        raise ValueError('Block size must be positive')
+    rowsum = np.zeros(Ncurves, np.double)
+    rowcount = np.zeros(Ncurves, np.intp)
+    cmarray = np.empty((Ncurves, Ncurves), np.double) if fullmatrix else None
+    if fullmatrix:
+        cm = cmarray
+    for istart in range(0, Ncurves, blocksize):
+        istop = min(istart + blocksize, Ncurves)
+        Ni = istop - istart
+        intensities1, errors1 = _loadblock(loadblock, istart, istop)
+        mask1 = _validpoints(intensities1, errors1, logarithmic)
+        for jstart in range(istart, Ncurves, blocksize):
+            jstop = min(jstart + blocksize, Ncurves)
+            Nj = jstop - jstart
+            diagonalblock = (jstart == istart)
+            if diagonalblock:
+                intensities2, errors2, mask2 = intensities1, errors1, mask1
             else:
-                cm[icurves, jcurves]=cm[jcurves,icurves]=NaN
+                intensities2, errors2 = _loadblock(loadblock, jstart, jstop)
+                if intensities2.shape[0] != intensities1.shape[0]:
+                    raise ValueError('All curves must have the same number of points')
+                mask2 = _validpoints(intensities2, errors2, logarithmic)
+            blk = np.empty((Ni, Nj), np.double)
+            for icurves in prange(Ni, nogil=True, schedule='guided'):
+                for jcurves in range(Nj):
+                    if diagonalblock and (jcurves <= icurves):
+                        continue
+                    blk[icurves, jcurves] = _discrepancy(intensities1, errors1, mask1, icurves,
+                                                         intensities2, errors2, mask2, jcurves, logarithmic)
+            if diagonalblock:
+                for icurves in range(Ni):
+                    blk[icurves, icurves] = nan('NaN')
+                    for jcurves in range(icurves):
+                        blk[icurves, jcurves] = blk[jcurves, icurves]
+            # Accumulate the row sums. Every row receives the elements in ascending column order, as in
+            # `_fillDiagonal()`, thus the result is the same to the last bit.
+            for icurves in range(Ni):
+                for jcurves in range(Nj):
+                    value = blk[icurves, jcurves]
+                    if fullmatrix:
+                        cm[istart + icurves, jstart + jcurves] = value
+                    if (diagonalblock and (icurves == jcurves)) or (not isfinite(value)):
+                        continue
+                    rowsum[istart + icurves] += value
+                    rowcount[istart + icurves] += 1
+            if not diagonalblock:
+                # the transposed block contributes to the rows of the second block
+                for jcurves in range(Nj):
+                    for icurves in range(Ni):
+                        value = blk[icurves, jcurves]
+                        if fullmatrix:
+                            cm[jstart + jcurves, istart + icurves] = value
+                        if not isfinite(value):
+                            continue
+                        rowsum[jstart + jcurves] += value
+                        rowcount[jstart + jcurves] += 1
+    score = np.empty(Ncurves, np.double)
     for icurves in range(Ncurves):
-        cmpoint = 0
-        npoints = 0
-        for jcurves in range(Ncurves):
-            if (jcurves != icurves) and isfinite(cm[icurves,jcurves]):
-                cmpoint = cmpoint + cm[icurves,jcurves]
-                npoints = npoints+1
-        if npoints>0:
-            cm[icurves,icurves] = cmpoint / npoints
+        if rowcount[icurves] > 0:
+            score[icurves] = rowsum[icurves] / rowcount[icurves]
         else:
-            cm[icurves, icurves] = NaN
-    del mymask
-    return cm
+            score[icurves] = nan('NaN')
+        if fullmatrix:
+            cm[icurves, icurves] = score[icurves]
+    return np.asarray(score), cmarray
 
 
 def correlmatrix2d_cython(double[:,:,:] intensities not None,
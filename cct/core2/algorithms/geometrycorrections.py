@@ -1,5 +1,16 @@
+"""Geometrical corrections for two-dimensional scattering patterns"""
+import collections
+import logging
+import threading
+from typing import Tuple, Optional, Callable, Hashable
+
 import numpy as np
 
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+ValueAndUncertaintyType = Tuple[float, float]
+
 
 def solidangle(twotheta, dtwotheta, sd, dsd, pixelsize, dpixelsize):
     """Solid-angle correction for two-dimensional SAS images with error propagation
@@ -20,21 +31,24 @@ def solidangle(twotheta, dtwotheta, sd, dsd, pixelsize, dpixelsize):
                 twotheta) ** 2) ** 0.5)
 
 
-def _angledependentabsorption_value(twotheta: np.ndarray, transmission: float):
+def _angledependentabsorption_value(twotheta: np.ndarray, transmission: float,
+                                    costth: Optional[np.ndarray] = None):
     cor = np.ones_like(twotheta)
     if transmission == 1:
         return cor
     mud = -np.log(transmission)
-
-    cor[twotheta > 0] = transmission * mud * (1 - 1 / np.cos(twotheta[twotheta > 0])) / (
-            np.exp(-mud / np.cos(twotheta[twotheta > 0])) - transmission)
+    positive = twotheta > 0
+    costth = np.cos(twotheta[positive]) if costth is None else costth[positive]
+    cor[positive] = transmission * mud * (1 - 1 / costth) / (
+            np.exp(-mud / costth) - transmission)
     return cor
 
 
-def _angledependentabsorption_error(twotheta, dtwotheta, transmission, dtransmission):
+def _angledependentabsorption_error(twotheta, dtwotheta, transmission, dtransmission,
+                                    costth: Optional[np.ndarray] = None, sintth: Optional[np.ndarray] = None):
     # calculated using sympy
-    costth = np.cos(twotheta)
-    sintth = np.sin(twotheta)
+    costth = np.cos(twotheta) if costth is None else costth
+    sintth = np.sin(twotheta) if sintth is None else sintth
     lntrans = np.log(transmission)
     exp1 = np.exp(lntrans / costth)
     return ((transmission * costth - exp1 *
@@ -101,3 +115,112 @@ def angledependentairtransmission(twotheta, dtwotheta,
                     np.exp(2 * mu_air * sampletodetectordistance / costth)
                     * sintth ** 2 / costth ** 4)
             )
+
+
+class GeometryCorrectionMatrices:
+    """Correction matrices for exposures of the same shape and geometry (distance, pixel size, beam center)
+
+    The scattering angle, its trigonometric functions and the solid angle correction are calculated once. Only the
+    sample self-absorption correction depends on the exposure (through the transmission); it is calculated from the
+    precomputed cos(2theta) and sin(2theta) maps. Air transmission matrices of the last few pressure values are kept.
+
+    All matrices are read-only.
+    """
+    twotheta: np.ndarray
+    dtwotheta: np.ndarray
+    costth: np.ndarray
+    sintth: np.ndarray
+    solidangle: np.ndarray
+    dsolidangle: np.ndarray
+    distance: ValueAndUncertaintyType
+    maxairtransmissions: int = 4
+    _airtransmission: "collections.OrderedDict[Tuple[float, float, float], Tuple[np.ndarray, np.ndarray]]"
+    _lock: threading.Lock
+
+    def __init__(self, twotheta: np.ndarray, dtwotheta: np.ndarray, distance: ValueAndUncertaintyType,
+                 pixelsize: ValueAndUncertaintyType):
+        self.twotheta = twotheta
+        self.dtwotheta = dtwotheta
+        self.distance = distance
+        self.costth = np.cos(twotheta)
+        self.sintth = np.sin(twotheta)
+        self.solidangle, self.dsolidangle = solidangle(
+            twotheta, dtwotheta, distance[0], distance[1], pixelsize[0], pixelsize[1])
+        for matrix in [self.twotheta, self.dtwotheta, self.costth, self.sintth, self.solidangle, self.dsolidangle]:
+            matrix.setflags(write=False)
+        self._airtransmission = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def absorption(self, transmission: float, dtransmission: float) -> Tuple[np.ndarray, np.ndarray]:
+        """Angle-dependent sample self-absorption correction, see `angledependentabsorption()`"""
+        return (_angledependentabsorption_value(self.twotheta, transmission, self.costth),
+                _angledependentabsorption_error(self.twotheta, self.dtwotheta, transmission, dtransmission,
+                                                self.costth, self.sintth))
+
+    def airtransmission(self, pressure: float, mu0_air: float = 1 / 883.49,
+                        dmu0_air: float = 0) -> Tuple[np.ndarray, np.ndarray]:
+        """Angle-dependent air transmission correction, see `angledependentairtransmission()`"""
+        key = (float(pressure), float(mu0_air), float(dmu0_air))
+        with self._lock:
+            try:
+                self._airtransmission.move_to_end(key)
+                return self._airtransmission[key]
+            except KeyError:
+                pass
+        aaa, daaa = angledependentairtransmission(
+            self.twotheta, self.dtwotheta, pressure, self.distance[0], self.distance[1], mu0_air, dmu0_air)
+        aaa.setflags(write=False)
+        daaa.setflags(write=False)
+        with self._lock:
+            self._airtransmission[key] = aaa, daaa
+            while len(self._airtransmission) > self.maxairtransmissions:
+                self._airtransmission.popitem(last=False)
+        return aaa, daaa
+
+
+class GeometryCorrectionCache:
+    """A least-recently-used cache of geometry correction matrices, keyed by shape and geometry"""
+    maxsize: int
+    _matrices: "collections.OrderedDict[Hashable, GeometryCorrectionMatrices]"
+    _lock: threading.Lock
+
+    def __init__(self, maxsize: int = 4):
+        self.maxsize = maxsize
+        self._matrices = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(shape: Tuple[int, ...], distance: ValueAndUncertaintyType, pixelsize: ValueAndUncertaintyType,
+            beamposrow: ValueAndUncertaintyType, beamposcol: ValueAndUncertaintyType) -> Hashable:
+        return (tuple(shape),) + tuple(float(x) for x in (distance + pixelsize + beamposrow + beamposcol))
+
+    def get(self, shape: Tuple[int, ...], distance: ValueAndUncertaintyType, pixelsize: ValueAndUncertaintyType,
+            beamposrow: ValueAndUncertaintyType, beamposcol: ValueAndUncertaintyType,
+            twotheta: Callable[[], Tuple[np.ndarray, np.ndarray]]) -> GeometryCorrectionMatrices:
+        """Get the correction matrices from the cache or calculate them.
+
+        `twotheta` is only called on a cache miss: it must return the scattering angle matrix and its uncertainty,
+        e.g. `Exposure.twotheta`.
+        """
+        key = self.key(shape, distance, pixelsize, beamposrow, beamposcol)
+        with self._lock:
+            try:
+                self._matrices.move_to_end(key)
+                return self._matrices[key]
+            except KeyError:
+                pass
+        matrices = GeometryCorrectionMatrices(*twotheta(), distance, pixelsize)
+        logger.debug(f'New geometry correction matrices for shape {shape}.')
+        with self._lock:
+            if self.maxsize > 0:
+                self._matrices[key] = matrices
+                while len(self._matrices) > self.maxsize:
+                    self._matrices.popitem(last=False)
+        return matrices
+
+    def clear(self):
+        with self._lock:
+            self._matrices.clear()
+
+
+geometrycorrectioncache = GeometryCorrectionCache()
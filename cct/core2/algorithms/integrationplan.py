@@ -0,0 +1,154 @@
+"""Precomputed pixel-to-q-bin assignments for radial averaging
+
+Series of exposures are usually taken with the same geometry and mask. The geometry-dependent part of radial
+averaging (pixel radius, scattering angle, q and its uncertainty, bin index) is calculated only once for them and
+stored in a RadialAveragingPlan. Subsequent exposures only need a gather-and-accumulate pass.
+"""
+import collections
+import hashlib
+import logging
+import threading
+from typing import Tuple, Union, Hashable, Iterable, Type
+
+import numpy as np
+
+from .radavg import radavgplan, radavg_planned, radavg_planned_stack, autoq
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+ValueAndUncertaintyType = Tuple[float, float]
+
+# q-bins can be given explicitly or as a (spacing, count) tuple, which is then forwarded to `autoq()`
+QBinSpecification = Union[np.ndarray, Tuple[int, int]]
+
+
+class RadialAveragingPlan:
+    """Precomputed geometry-dependent data for radial averaging of exposures with the same geometry and mask"""
+    shape: Tuple[int, int]
+    qbincenters: np.ndarray
+    rowindex: np.ndarray
+    columnindex: np.ndarray
+    binindex: np.ndarray
+    pixelq: np.ndarray
+    pixelq_unc2: np.ndarray
+    pixelradius: np.ndarray
+
+    def __init__(self, mask: np.ndarray, wavelength: ValueAndUncertaintyType, distance: ValueAndUncertaintyType,
+                 pixelsize: ValueAndUncertaintyType, beamposrow: ValueAndUncertaintyType,
+                 beamposcol: ValueAndUncertaintyType, qbincenters: np.ndarray):
+        self.shape = mask.shape
+        self.qbincenters = np.array(qbincenters, dtype=np.double)
+        (self.rowindex, self.columnindex, self.binindex,
+         self.pixelq, self.pixelq_unc2, self.pixelradius) = radavgplan(
+            mask, wavelength[0], wavelength[1], distance[0], distance[1], pixelsize[0], pixelsize[1],
+            beamposrow[0], beamposrow[1], beamposcol[0], beamposcol[1], self.qbincenters)
+
+    def radavg(self, intensity: np.ndarray, uncertainty: np.ndarray, errorprop: int = 3, qerrorprop: int = 3,
+               nthreads: int = 0) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Radial averaging of a scattering pattern. The return value is the same as that of `radavg()`"""
+        if (intensity.shape != self.shape) or (uncertainty.shape != self.shape):
+            raise ValueError('Shape mismatch')
+        return radavg_planned(intensity, uncertainty, self.rowindex, self.columnindex, self.binindex, self.pixelq,
+                              self.pixelq_unc2, self.pixelradius, len(self.qbincenters), errorprop, qerrorprop,
+                              nthreads)
+
+    def radavg_stack(self, intensity: np.ndarray, uncertainty: np.ndarray, errorprop: int = 3, qerrorprop: int = 3,
+                     nthreads: int = 0) -> np.ndarray:
+        """Radial averaging of a stack of scattering patterns (the last index is the frame index).
+
+        Returns an array of shape (Nq, 6, Nframes), each [:, :, i] slice is like `Curve.asArray()`
+        """
+        if (intensity.shape[:2] != self.shape) or (uncertainty.shape != intensity.shape) or (intensity.ndim != 3):
+            raise ValueError('Shape mismatch')
+        return radavg_planned_stack(intensity, uncertainty, self.rowindex, self.columnindex, self.binindex,
+                                    self.pixelq, self.pixelq_unc2, self.pixelradius, len(self.qbincenters),
+                                    errorprop, qerrorprop, nthreads)
+
+    def radavg_frames(self, frames: Iterable[Tuple[np.ndarray, np.ndarray]], errorprop: int = 3,
+                      qerrorprop: int = 3, nthreads: int = 0, chunksize: int = 8) -> np.ndarray:
+        """Radial averaging of (intensity, uncertainty) pairs coming from an iterator.
+
+        At most `chunksize` frames are held in memory at the same time. The return value is the same as that of
+        `radavg_stack()`.
+        """
+        curves = []
+        # frame-major buffers, transposed to put the frame index last: each frame is contiguous in memory
+        intensities = np.empty((chunksize,) + self.shape, dtype=np.double).transpose(1, 2, 0)
+        uncertainties = np.empty((chunksize,) + self.shape, dtype=np.double).transpose(1, 2, 0)
+        count = 0
+        for intensity, uncertainty in frames:
+            if (intensity.shape != self.shape) or (uncertainty.shape != self.shape):
+                raise ValueError('Shape mismatch')
+            intensities[:, :, count] = intensity
+            uncertainties[:, :, count] = uncertainty
+            count += 1
+            if count == chunksize:
+                curves.append(self.radavg_stack(intensities, uncertainties, errorprop, qerrorprop, nthreads))
+                count = 0
+        if count or not curves:
+            curves.append(self.radavg_stack(
+                intensities[:, :, :count], uncertainties[:, :, :count], errorprop, qerrorprop, nthreads))
+        return np.concatenate(curves, axis=2)
+
+
+class RadialAveragingPlanCache:
+    """A least-recently-used cache of averaging plans, keyed by geometry, mask and bins
+
+    By default, `RadialAveragingPlan` instances are cached. Other plan classes with the same constructor signature
+    can be given in `planclass`.
+    """
+    maxsize: int
+    planclass: Type
+    _plans: "collections.OrderedDict[Hashable, RadialAveragingPlan]"
+    _lock: threading.Lock
+
+    def __init__(self, maxsize: int = 4, planclass: Type = RadialAveragingPlan):
+        self.maxsize = maxsize
+        self.planclass = planclass
+        self._plans = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(mask: np.ndarray, wavelength: ValueAndUncertaintyType, distance: ValueAndUncertaintyType,
+            pixelsize: ValueAndUncertaintyType, beamposrow: ValueAndUncertaintyType,
+            beamposcol: ValueAndUncertaintyType, qbins: QBinSpecification) -> Hashable:
+        if isinstance(qbins, np.ndarray):
+            qkey = ('explicit', hashlib.sha1(np.ascontiguousarray(qbins, dtype=np.double).tobytes()).hexdigest())
+        else:
+            qkey = ('auto', int(qbins[0]), int(qbins[1]))
+        return (mask.shape, hashlib.sha1(np.ascontiguousarray(mask, dtype=np.uint8).tobytes()).hexdigest(), qkey) + \
+               tuple(float(x) for x in (wavelength + distance + pixelsize + beamposrow + beamposcol))
+
+    def get(self, mask: np.ndarray, wavelength: ValueAndUncertaintyType, distance: ValueAndUncertaintyType,
+            pixelsize: ValueAndUncertaintyType, beamposrow: ValueAndUncertaintyType,
+            beamposcol: ValueAndUncertaintyType, qbins: QBinSpecification) -> RadialAveragingPlan:
+        """Get a plan from the cache or make a new one.
+
+        `qbins` is either the array of q-bin centers or a (spacing, count) tuple for `autoq()`.
+        """
+        key = self.key(mask, wavelength, distance, pixelsize, beamposrow, beamposcol, qbins)
+        with self._lock:
+            try:
+                self._plans.move_to_end(key)
+                return self._plans[key]
+            except KeyError:
+                pass
+        if not isinstance(qbins, np.ndarray):
+            qbins = autoq(mask, wavelength[0], distance[0], pixelsize[0], beamposrow[0], beamposcol[0],
+                          linspacing=qbins[0], N=qbins[1])
+        plan = self.planclass(mask, wavelength, distance, pixelsize, beamposrow, beamposcol, qbins)
+        logger.debug(f'New {self.planclass.__name__} with {len(qbins)} bins.')
+        with self._lock:
+            if self.maxsize > 0:
+                self._plans[key] = plan
+                while len(self._plans) > self.maxsize:
+                    self._plans.popitem(last=False)
+        return plan
+
+    def clear(self):
+        with self._lock:
+            self._plans.clear()
+
+
+radavgplancache = RadialAveragingPlanCache()
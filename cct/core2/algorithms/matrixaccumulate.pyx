@@ -0,0 +1,87 @@
+# cython: cdivision=True, wraparound=False, boundscheck=False, language_level=3, embedsignature=True
+from libc.math cimport isfinite, HUGE_VAL
+
+# values of ErrorPropagationMethod
+cdef enum:
+    WEIGHTED = 0
+    LINEAR = 1
+    GAUSSIAN = 2
+    CONSERVATIVE = 3
+    STANDARDERROROFTHEMEAN = 4
+
+
+cdef double _badvaluereplacement(const double[:] error) noexcept nogil:
+    """The value bad (nonfinite or nonpositive) uncertainties are replaced with: the smallest good one, or 1 if all
+    are bad. Zero is returned if there are no bad values."""
+    cdef:
+        Py_ssize_t i
+        Py_ssize_t nbad = 0
+        double smallest = HUGE_VAL
+    for i in range(error.shape[0]):
+        if isfinite(error[i]) and (error[i] > 0):
+            if error[i] < smallest:
+                smallest = error[i]
+        else:
+            nbad += 1
+    if nbad == 0:
+        return 0.0
+    elif nbad == error.shape[0]:
+        return 1.0
+    else:
+        return smallest
+
+
+def accumulate(const double[:] value, const double[:] error, double[:] sumvalue, double[:] sumvalue2,
+               double[:] sumerror, int method):
+    """
+    Add a matrix with its uncertainty to the sums of `MatrixAverager`, in place
+
+    Inputs:
+        value (np.ndarray, one dimension, dtype: double): the values (flattened matrix)
+        error (np.ndarray, one dimension, dtype: double): the uncertainties
+        sumvalue (np.ndarray, one dimension, dtype: double): sum of the values (of the value/error**2 for weighted
+            error propagation), updated in place
+        sumvalue2 (np.ndarray, one dimension, dtype: double): sum of squared values, updated in place. Only used for
+            conservative and standard error of the mean error propagation, can be None otherwise.
+        sumerror (np.ndarray, one dimension, dtype: double): sum of the uncertainties (Linear), their squares
+            (Gaussian, Conservative) or their inverse squares (Weighted), updated in place.
+        method (int): value of the ErrorPropagationMethod
+
+    Notes:
+        Bad uncertainties (nonfinite or nonpositive) are replaced like in `MatrixAverager.fixBadValues()`. The sums
+        are updated in a single pass without temporary arrays; the results are exactly the same as those of the
+        equivalent numpy expressions.
+    """
+    cdef:
+        Py_ssize_t i, N = value.shape[0]
+        double replacement, e, v
+    if (error.shape[0] != N) or (sumvalue.shape[0] != N) or (sumerror.shape[0] != N):
+        raise ValueError('Shape mismatch')
+    if (method == CONSERVATIVE) or (method == STANDARDERROROFTHEMEAN):
+        if (sumvalue2 is None) or (sumvalue2.shape[0] != N):
+            raise ValueError('Shape mismatch')
+    elif method not in (WEIGHTED, LINEAR, GAUSSIAN):
+        raise ValueError(f'Invalid error propagation method: {method}')
+    with nogil:
+        replacement = _badvaluereplacement(error)
+        for i in range(N):
+            v = value[i]
+            e = error[i]
+            if (replacement > 0) and not (isfinite(e) and (e > 0)):
+                e = replacement
+            if method == WEIGHTED:
+                sumvalue[i] += v / (e * e)
+                sumerror[i] += 1 / (e * e)
+            elif method == LINEAR:
+                sumvalue[i] += v
+                sumerror[i] += e
+            elif method == GAUSSIAN:
+                sumvalue[i] += v
+                sumerror[i] += e * e
+            elif method == CONSERVATIVE:
+                sumvalue[i] += v
+                sumerror[i] += e * e
+                sumvalue2[i] += v * v
+            else:
+                sumvalue[i] += v
+                sumvalue2[i] += v * v
@@ -1,9 +1,11 @@
 import enum
 import logging
-from typing import Tuple, Optional
+from typing import Tuple, Optional, Dict, Any
 
 import numpy as np
 
+from .matrixaccumulate import accumulate
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
@@ -42,45 +44,68 @@ class MatrixAverager:
         self.count = 0
 
     def add(self, value: np.ndarray, error: np.ndarray):
-        error = self.fixBadValues(error)
+        """Add a matrix and its uncertainty.
+
+        The sums are updated in place by a fused kernel, without making temporary copies of the matrices.
+        """
+        value = np.ascontiguousarray(value, dtype=np.double)
+        error = np.ascontiguousarray(error, dtype=np.double)
+        if error.shape != value.shape:
+            raise ValueError('Shape mismatch')
         if self.value is None:
             assert (self.value2 is None) and (self.error is None)
-            if self.method == ErrorPropagationMethod.Weighted:
-                self.value = value / error ** 2
-                self.error = 1 / error ** 2
-            elif self.method == ErrorPropagationMethod.Linear:
-                self.error = error * 1  # Multiplication by 1: make a copy
-                self.value = value * 1  # Multiplication by 1: make a copy
-            elif self.method == ErrorPropagationMethod.Gaussian:
-                self.error = error ** 2
-                self.value = value * 1  # Multiplication by 1: make a copy
-            elif self.method == ErrorPropagationMethod.Conservative:
-                self.error = error ** 2
-                self.value = value * 1  # Multiplication by 1: make a copy
-                self.value2 = value ** 2
-            elif self.method == ErrorPropagationMethod.StandardErrorOfTheMean:
-                self.error = error  # don't use it
-                self.value = value * 1
-                self.value2 = value ** 2
-        else:
-            if self.method == ErrorPropagationMethod.Weighted:
-                self.value += value / error ** 2
-                self.error += 1 / error ** 2
-            elif self.method == ErrorPropagationMethod.Linear:
-                self.error += error
-                self.value += value
-            elif self.method == ErrorPropagationMethod.Gaussian:
-                self.error += error ** 2
-                self.value += value
-            elif self.method == ErrorPropagationMethod.Conservative:
-                self.value += value
-                self.error += error ** 2
-                self.value2 += value ** 2
-            elif self.method == ErrorPropagationMethod.StandardErrorOfTheMean:
-                self.value += value
-                self.value2 += value ** 2
+            self.value = np.zeros_like(value)
+            self.error = np.zeros_like(value)
+            if self.method in [ErrorPropagationMethod.Conservative, ErrorPropagationMethod.StandardErrorOfTheMean]:
+                self.value2 = np.zeros_like(value)
+        elif self.value.shape != value.shape:
+            raise ValueError('Shape mismatch')
+        accumulate(value.reshape(-1), error.reshape(-1), self.value.reshape(-1),
+                   None if self.value2 is None else self.value2.reshape(-1), self.error.reshape(-1),
+                   self.method.value)
         self.count += 1
 
+    def merge(self, other: "MatrixAverager") -> "MatrixAverager":
+        """Add the sums of another averager (e.g. one filled with a different chunk of the data) to this one.
+
+        The result is the same as if all the matrices were added to a single averager, apart from floating point
+        rounding due to the different order of summation.
+        """
+        if other.method != self.method:
+            raise ValueError(f'Cannot merge averagers with different error propagation methods '
+                             f'({self.method} and {other.method})')
+        if not other.count:
+            return self
+        if self.value is None:
+            self.value = other.value.copy()
+            self.error = other.error.copy()
+            self.value2 = None if other.value2 is None else other.value2.copy()
+        elif self.value.shape != other.value.shape:
+            raise ValueError('Shape mismatch')
+        else:
+            self.value += other.value
+            self.error += other.error
+            if self.value2 is not None:
+                self.value2 += other.value2
+        self.count += other.count
+        return self
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """The complete state of the accumulator: can be pickled, sent to other processes and merged there."""
+        return {'method': self.method.value,
+                'count': self.count,
+                'value': self.value,
+                'value2': self.value2,
+                'error': self.error,
+                }
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.method = ErrorPropagationMethod(state['method'])
+        self.count = state['count']
+        self.value = state['value']
+        self.value2 = state['value2']
+        self.error = state['error']
+
     def get(self) -> Tuple[np.ndarray, np.ndarray]:
         if not self.count:
             raise ValueError('Cannot get average: no data given yet.')
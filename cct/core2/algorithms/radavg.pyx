@@ -1,8 +1,63 @@
 # cython: cdivision=True, wraparound=False, boundscheck=False, language_level=3, embedsignature=True
+import os
+
 import numpy as np
-from libc.math cimport sqrt, atan, sin, cos, M_PI, NAN, floor, HUGE_VAL, atan2, fabs, isfinite
+from cython.parallel cimport parallel, prange, threadid
+from libc.math cimport sqrt, atan, sin, cos, log, M_PI, NAN, floor, HUGE_VAL, atan2, fabs, isfinite
 from libc.stdint cimport uint32_t, uint8_t
 
+# default number of threads for the averaging routines. Nonpositive: use all CPUs.
+cdef int _nthreads = 1
+
+
+def setnthreads(int nthreads):
+    """Set the default number of threads used by the averaging routines.
+
+    Inputs:
+        nthreads (int): the number of threads. If nonpositive, all CPUs are used.
+
+    Notes:
+        The routines are parallelized by rows (pixels). Each thread accumulates its own partial bin sums, which are
+        added up in thread order at the end. Pixel counts are always exact. With a single thread the results are
+        bit-identical to the serial algorithm, with more threads the sums differ only by floating point rounding
+        due to the different order of summation (relative differences of the order of 1e-14, somewhat more for the
+        conservative error propagation).
+    """
+    global _nthreads
+    _nthreads = nthreads
+
+
+def getnthreads():
+    """Get the default number of threads used by the averaging routines"""
+    return _resolventhreads(0)
+
+
+cdef int _resolventhreads(int nthreads):
+    """Resolve the requested number of threads: nonpositive values mean the default set by `setnthreads()`"""
+    if nthreads > 0:
+        return nthreads
+    elif _nthreads > 0:
+        return _nthreads
+    else:
+        return os.cpu_count() or 1
+
+
+cdef void _reducethreads(double[:, :] accumulator) noexcept nogil:
+    """Add up the per-thread partial sums into the first row, in thread order"""
+    cdef Py_ssize_t ithread, ibin
+    for ithread in range(1, accumulator.shape[0]):
+        for ibin in range(accumulator.shape[1]):
+            accumulator[0, ibin] += accumulator[ithread, ibin]
+
+
+cdef void _reducethreads_uint32(uint32_t[:, :] accumulator) noexcept nogil:
+    """Add up the per-thread partial counts into the first row"""
+    cdef Py_ssize_t ithread, ibin
+    for ithread in range(1, accumulator.shape[0]):
+        for ibin in range(accumulator.shape[1]):
+            accumulator[0, ibin] += accumulator[ithread, ibin]
+
+
 def autoq(uint8_t[:,:] mask, double wavelength, double distance, double pixelsize, double center_row, double center_col,
           int linspacing=True, Py_ssize_t N=-1):
     """Determine q-scale automatically
@@ -70,6 +125,263 @@ def validpixelrange(uint8_t[:,:] mask, double center_row, double center_col):
     return r2min**0.5, r2max**0.5
 
 
+cdef struct _PixelQ:
+    double q  # scattering variable
+    double q_unc2  # squared uncertainty of the scattering variable
+    double radius  # distance from the beam center, in pixels
+
+
+cdef inline _PixelQ _pixelq(double row, double col,
+                            double qfac, double qfac_unc2, double row_unc2, double col_unc2,
+                            double pixelsize, double distance, double dist_relunc2,
+                            double pixelsize_relunc2) noexcept nogil:
+    """Calculate the scattering variable, its squared uncertainty and the distance from the beam center of a pixel.
+
+    `row` and `col` are the pixel coordinates relative to the beam center.
+    """
+    cdef:
+        _PixelQ result
+        double pixelradius2, pixelradius_unc2, tgtwotheta2, tgtwotheta_unc2, sinth, sinth_unc2
+    # using sqrt(x**2+y**2) was faster than hypot(x,y)
+    pixelradius2 = row**2 + col**2
+    # propagated squared uncertainty of (irow-center_row) is 0.25 + dcenter_row**2
+    # propagated squared uncertainty of sqrt(A**2+B**2) is (A**2*dA**2 + B**2+dB**)/(A**2+B**2).
+    #
+    pixelradius_unc2 = (row_unc2*row**2 + col_unc2*col**2)/pixelradius2
+    tgtwotheta2 = pixelradius2*pixelsize**2/distance**2
+    tgtwotheta_unc2 = tgtwotheta2 * (pixelradius_unc2/pixelradius2 +
+                                       dist_relunc2 +
+                                       pixelsize_relunc2
+                                      )
+    # by employing trigonometric identities we get an algebraic form for tg(2theta) -> sin(theta).
+    # While this is faster than the obvious sin(0.5*arctan(tg2theta)), it only works for 0 < 2theta < pi/2.
+    # This is usually true in SAXS.
+    sinth = (0.5*(1-1/(tgtwotheta2+1)**0.5))**0.5
+    sinth_unc2 = 1/16. * tgtwotheta2 / (tgtwotheta2+1)**3 / (1-1/(tgtwotheta2+1)**0.5)*tgtwotheta_unc2**2
+    result.q = qfac * sinth
+    result.q_unc2 = result.q**2 * (qfac_unc2 / qfac**2 + sinth_unc2 / sinth**2)
+    result.radius = sqrt(pixelradius2)
+    return result
+
+
+cdef struct _QBinLookup:
+    # q-bin lookup table. If the bin centers are evenly spaced in some function of q (see `spacing`), the bin
+    # index is calculated directly, otherwise binary search is used.
+    const double *qbincenters
+    const double *qmax  # upper bin limits
+    Py_ssize_t Nbins
+    int spacing  # -1: arbitrary, 0: logarithmic, 1: linear, 2: square, 3: square root (the same as in `autoq()`)
+    double f0  # f(qbincenters[0]), where f is the function in which the bin centers are evenly spaced
+    double fstep  # f(qbincenters[i+1]) - f(qbincenters[i])
+
+
+cdef int _qbinspacing(double[:] qbincenters, double *f0, double *fstep):
+    """Find out if the bin centers are evenly spaced in q, log(q), q^2 or sqrt(q).
+
+    Returns the spacing code as used by `autoq()` or -1 if the spacing is arbitrary. `f0` and `fstep` are set to the
+    first transformed bin center and the step size, respectively.
+    """
+    cdef:
+        int spacing
+    if qbincenters.shape[0] < 2:
+        return -1
+    q = np.asarray(qbincenters)
+    if not np.isfinite(q).all():
+        return -1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for spacing, f in [(1, q), (0, np.log(q)), (2, q ** 2), (3, q ** 0.5)]:
+            if not np.isfinite(f).all():
+                continue
+            df = np.diff(f)
+            if (df > 0).all() and np.allclose(df, df.mean(), rtol=1e-6, atol=0):
+                f0[0] = f[0]
+                fstep[0] = df.mean()
+                return spacing
+    return -1
+
+
+cdef _QBinLookup _qbinlookup(double[:] qbincenters, double[:] qmax):
+    """Set the upper bin limits and prepare the lookup table for `_qbin()`"""
+    cdef:
+        _QBinLookup lookup
+        Py_ssize_t ibin, Nbins = qbincenters.shape[0]
+    for ibin in range(Nbins-1):
+        qmax[ibin] = 0.5*(qbincenters[ibin] + qbincenters[ibin+1])
+    qmax[Nbins-1] = qbincenters[Nbins-1]
+    lookup.qbincenters = &qbincenters[0]
+    lookup.qmax = &qmax[0]
+    lookup.Nbins = Nbins
+    lookup.f0 = 0
+    lookup.fstep = 0
+    lookup.spacing = _qbinspacing(qbincenters, &lookup.f0, &lookup.fstep)
+    return lookup
+
+
+cdef inline Py_ssize_t _qbin(double currentq, const _QBinLookup *lookup) noexcept nogil:
+    """Find the index of the q-bin a pixel belongs to. Returns -1 on underflow or overflow.
+
+    The bin index is the lowest `ibin` where qmax[ibin] > currentq. An initial guess is calculated from the spacing
+    of the bin centers, which is then corrected by comparing to the actual bin limits. This way the bin index is
+    exactly the same as with a linear search.
+    """
+    cdef:
+        Py_ssize_t ibin, lo, hi
+        double fq
+    if currentq < lookup.qbincenters[0]:
+        # underflow
+        return -1
+    if currentq > lookup.qmax[lookup.Nbins-1]:
+        # overflow
+        return -1
+    if lookup.spacing == 1:
+        fq = currentq
+    elif lookup.spacing == 0:
+        fq = log(currentq)
+    elif lookup.spacing == 2:
+        fq = currentq * currentq
+    elif lookup.spacing == 3:
+        fq = sqrt(currentq)
+    else:
+        fq = NAN
+    fq = (fq - lookup.f0) / lookup.fstep + 0.5
+    if isfinite(fq):
+        # the bin centers are evenly spaced in f(q): f(q) directly gives the bin index, give or take one.
+        ibin = <Py_ssize_t>floor(fq)
+        if ibin < 0:
+            ibin = 0
+        elif ibin > lookup.Nbins-1:
+            ibin = lookup.Nbins-1
+        while (ibin > 0) and (lookup.qmax[ibin-1] > currentq):
+            ibin -= 1
+        while (ibin < lookup.Nbins-1) and not (lookup.qmax[ibin] > currentq):
+            ibin += 1
+        return ibin
+    # binary search
+    lo = 0
+    hi = lookup.Nbins-1
+    while lo < hi:
+        ibin = (lo + hi) // 2
+        if lookup.qmax[ibin] > currentq:
+            hi = ibin
+        else:
+            lo = ibin + 1
+    return lo
+
+
+cdef inline void _radavg_binpixel(Py_ssize_t ibin, double value, double uncertainty,
+                                  double currentq, double currentq_unc2, double pixelradius,
+                                  int errorprop, int qerrorprop,
+                                  double *Intensity, double *Intensity2, double *Error,
+                                  double *q, double *q2, double *qError,
+                                  uint32_t *Area, double *pixel) noexcept nogil:
+    """Add a single pixel to the accumulators of the `ibin`-th bin"""
+    if errorprop > 0: # 1,2,3
+        Intensity[ibin] += value
+        if errorprop == 1:
+            Error[ibin] += uncertainty
+        else:
+            Error[ibin] += uncertainty**2
+        if errorprop == 3:
+            Intensity2[ibin] += value**2
+    else: # 0
+        Intensity[ibin] += value / uncertainty**2
+        Error[ibin] += 1/uncertainty**2
+    if qerrorprop > 0: # 1, 2 or 3
+        q[ibin] += currentq
+        if qerrorprop == 1:
+            qError[ibin] += sqrt(currentq_unc2)
+        else:
+            qError[ibin] += currentq_unc2
+        if qerrorprop == 3:
+            q2[ibin] += currentq**2
+    else: # 0
+        q[ibin] += currentq / currentq_unc2
+        qError[ibin] += currentq_unc2
+    Area[ibin] += 1
+    pixel[ibin] += pixelradius
+
+
+cdef void _radavg_normalize(Py_ssize_t Nbins, int errorprop, int qerrorprop,
+                            double *Intensity, double *Intensity2, double *Error,
+                            double *q, double *q2, double *qError,
+                            uint32_t *Area, double *pixel) noexcept nogil:
+    """Calculate the bin averages and their uncertainties from the accumulated sums"""
+    cdef:
+        Py_ssize_t ibin
+        double error_propagated
+        double error_statistics
+    for ibin in range(Nbins):
+        if not Area[ibin]:
+            # no pixels in this bin: set everything to NaN
+            Intensity[ibin] = NAN
+            Error[ibin] = NAN
+            q[ibin] = NAN
+            qError[ibin] = NAN
+            pixel[ibin] = NAN
+            continue
+        if errorprop >0:
+            if errorprop == 1:
+                Error[ibin] /= Area[ibin]
+            elif errorprop == 2:
+                Error[ibin] = sqrt(Error[ibin])/Area[ibin]
+            else: # errorprop == 3
+                error_propagated = sqrt(Error[ibin]/Area[ibin])
+                if Area[ibin] < 2:
+                    error_statistics = 0
+                else:
+                    # sample standard deviation: sqrt((sum(I**2) - N*mean(I)**2)/(N-1))
+                    # in our case, sum(I**2) is simply Intensity2[ibin].
+                    # mean(I) = Intensity[ibin] / Area[ibin], thus N*mean(I)**2 is Intensity[ibin]**2/Area[ibin]
+                    error_statistics = sqrt(
+                        (Intensity2[ibin] - Intensity[ibin]**2/Area[ibin])/(Area[ibin]-1))
+                Error[ibin] = max(error_propagated, error_statistics)
+            Intensity[ibin] /= Area[ibin]
+        else:
+            Intensity[ibin] /= Error[ibin]
+            Error[ibin] = 1/sqrt(Error[ibin])
+        if qerrorprop >0:
+            if qerrorprop == 1:
+                qError[ibin] /= Area[ibin]
+            elif qerrorprop == 2:
+                qError[ibin] = sqrt(qError[ibin])/Area[ibin]
+            else: # qerrorprop == 3
+                error_propagated = sqrt(qError[ibin]/Area[ibin])
+                if Area[ibin] < 2:
+                    error_statistics = 0
+                else:
+                    # sample standard deviation: sqrt((sum(q**2) - N*mean(q)**2)/(N-1))
+                    # in our case, sum(q**2) is simply q2[ibin].
+                    # mean(q) = q[ibin] / Area[ibin], thus N*mean(q)**2 is q[ibin]**2/Area[ibin]
+                    error_statistics = sqrt(
+                        (q2[ibin] - q[ibin]**2/Area[ibin])/(Area[ibin]-1))
+                qError[ibin] = max(error_propagated, error_statistics)
+            q[ibin] /= Area[ibin]
+        else:
+            q[ibin] /= qError[ibin]
+            qError[ibin] = 1/sqrt(qError[ibin])
+        pixel[ibin] /= Area[ibin]
+
+
+cdef tuple _radavg_finalize(Py_ssize_t Nbins, int errorprop, int qerrorprop,
+                            double[:, :] Intensity, double[:, :] Intensity2, double[:, :] Error,
+                            double[:, :] q, double[:, :] q2, double[:, :] qError,
+                            uint32_t[:, :] Area, double[:, :] pixel):
+    """Reduce the per-thread accumulators, normalize the bins and return the results of the radial averaging"""
+    with nogil:
+        _reducethreads(Intensity)
+        _reducethreads(Intensity2)
+        _reducethreads(Error)
+        _reducethreads(q)
+        _reducethreads(q2)
+        _reducethreads(qError)
+        _reducethreads(pixel)
+        _reducethreads_uint32(Area)
+        _radavg_normalize(Nbins, errorprop, qerrorprop, &Intensity[0, 0], &Intensity2[0, 0], &Error[0, 0],
+                          &q[0, 0], &q2[0, 0], &qError[0, 0], &Area[0, 0], &pixel[0, 0])
+    return (np.array(q[0, :]), np.array(Intensity[0, :]), np.array(Error[0, :]), np.array(qError[0, :]),
+            np.array(Area[0, :]), np.array(pixel[0, :]))
+
+
 def radavg(double[:,:] data, double[:,:] error, uint8_t[:,:] mask,
            double wavelength, double wavelength_unc,
            double distance, double distance_unc,
@@ -77,7 +389,7 @@ def radavg(double[:,:] data, double[:,:] error, uint8_t[:,:] mask,
            double center_row, double center_row_unc,
            double center_col, double center_col_unc,
            double[:] qbincenters,
-           int errorprop=3, int qerrorprop=3
+           int errorprop=3, int qerrorprop=3, int nthreads=0
           ):
     """
     Perform radial averaging on a scattering pattern.
@@ -99,6 +411,7 @@ def radavg(double[:,:] data, double[:,:] error, uint8_t[:,:] mask,
         qbincenters (np.ndarray, one dimensions, double dtype): centers of the q-bins, 1/nm
         errorprop (int, 0-3 inclusive): error propagation type for intensities (see below)
         qerrorprop (int, 0-3 inclusive): error propagation type for q (see below)
+        nthreads (int): number of threads. If nonpositive, the default set by `setnthreads()` is used.
 
     Returns: q, Intensity, Error, qError, Area, pixel
         (all one-dimensional np.ndarrays, length of `qbincenters`)
@@ -134,24 +447,26 @@ def radavg(double[:,:] data, double[:,:] error, uint8_t[:,:] mask,
         - The right edge of the last bin is the  last element in `qbincenters`.
     """
     cdef:
-        double[:] Intensity, Intensity2, Error, q, q2, qError, qmax, pixel
-        uint32_t[:] Area
-        Py_ssize_t irow, icolumn, ibin=0
-        double currentq, pixelradius2, tgtwotheta2, qfac, row, col, sinth
-        double currentq_unc, pixelradius_unc2, tgtwotheta_unc2, qfac_unc2, row_unc2, col_unc2, sinth_unc2
+        double[:, :] Intensity, Intensity2, Error, q, q2, qError, pixel
+        double[:] qmax
+        uint32_t[:, :] Area
+        _QBinLookup lookup
+        Py_ssize_t irow, icolumn, ibin=0, Nbins = len(qbincenters)
+        int ithread
+        _PixelQ pq
+        double qfac, qfac_unc2, row_unc2, col_unc2
         double dist_relunc2, pixelsize_relunc2
-        double error_propagated
-        double error_statistics
-    # initialize output arrays
-    Intensity = np.zeros(len(qbincenters), dtype=np.double)
-    Intensity2 = np.zeros(len(qbincenters), dtype=np.double)
-    Error = np.zeros(len(qbincenters), dtype=np.double)
-    q = np.zeros(len(qbincenters), dtype=np.double)
-    q2 = np.zeros(len(qbincenters), dtype=np.double)
-    qError = np.zeros(len(qbincenters), dtype=np.double)
-    Area = np.zeros(len(qbincenters), dtype=np.uint32)
-    pixel = np.zeros(len(qbincenters), dtype=np.double)
-    qmax = np.zeros(len(qbincenters), dtype=np.double)
+    nthreads = _resolventhreads(nthreads)
+    # initialize output arrays: one row for each thread
+    Intensity = np.zeros((nthreads, Nbins), dtype=np.double)
+    Intensity2 = np.zeros((nthreads, Nbins), dtype=np.double)
+    Error = np.zeros((nthreads, Nbins), dtype=np.double)
+    q = np.zeros((nthreads, Nbins), dtype=np.double)
+    q2 = np.zeros((nthreads, Nbins), dtype=np.double)
+    qError = np.zeros((nthreads, Nbins), dtype=np.double)
+    Area = np.zeros((nthreads, Nbins), dtype=np.uint32)
+    pixel = np.zeros((nthreads, Nbins), dtype=np.double)
+    qmax = np.zeros(Nbins, dtype=np.double)
     # the prefactor of "q": speed things up.
     qfac = 4*M_PI/wavelength
     qfac_unc2 = 16*M_PI*M_PI*wavelength_unc**2/wavelength**4
@@ -162,133 +477,398 @@ def radavg(double[:,:] data, double[:,:] error, uint8_t[:,:] mask,
     dist_relunc2 = distance_unc**2/distance**2
     pixelsize_relunc2 = pixelsize_unc**2/pixelsize**2
     # set upper bin limits
-    for ibin in range(len(qbincenters)-1):
-        qmax[ibin] = 0.5*(qbincenters[ibin] + qbincenters[ibin+1])
-    qmax[len(qbincenters)-1] = qbincenters[len(qbincenters)-1]
+    lookup = _qbinlookup(qbincenters, qmax)
+
+    # categorize pixels into q bins. Static scheduling: each thread gets a contiguous block of rows.
+    with nogil, parallel(num_threads=nthreads):
+        ithread = threadid()
+        for irow in prange(data.shape[0], schedule='static'):
+            for icolumn in range(data.shape[1]):
+                if mask[irow, icolumn] == 0:
+                    # this pixel is masked
+                    continue
+                if not isfinite(data[irow, icolumn]) or not isfinite(error[irow, icolumn]):
+                    continue
+                pq = _pixelq(irow-center_row, icolumn-center_col, qfac, qfac_unc2, row_unc2, col_unc2,
+                             pixelsize, distance, dist_relunc2, pixelsize_relunc2)
+                # Now find the q-bin
+                ibin = _qbin(pq.q, &lookup)
+                if ibin < 0:
+                    continue
+                # now bin the pixel
+                _radavg_binpixel(ibin, data[irow, icolumn], error[irow, icolumn], pq.q, pq.q_unc2, pq.radius,
+                                 errorprop, qerrorprop,
+                                 &Intensity[ithread, 0], &Intensity2[ithread, 0], &Error[ithread, 0],
+                                 &q[ithread, 0], &q2[ithread, 0], &qError[ithread, 0],
+                                 &Area[ithread, 0], &pixel[ithread, 0])
+
+    # add up the partial sums of the threads and normalize the bins
+    return _radavg_finalize(Nbins, errorprop, qerrorprop, Intensity, Intensity2, Error, q, q2, qError, Area, pixel)
+
+
+def radavgplan(uint8_t[:,:] mask,
+               double wavelength, double wavelength_unc,
+               double distance, double distance_unc,
+               double pixelsize, double pixelsize_unc,
+               double center_row, double center_row_unc,
+               double center_col, double center_col_unc,
+               double[:] qbincenters):
+    """
+    Precompute the geometry-dependent part of radial averaging.
+
+    For each valid pixel falling into one of the q-bins, the bin index, the scattering variable, its squared
+    uncertainty and the distance from the beam center (in pixels) are calculated. Exposures with the same geometry,
+    mask and q-bins can then be averaged by `radavg_planned()` without repeating these calculations.
+
+    Inputs: the same as for `radavg()`, without `data`, `error`, `errorprop` and `qerrorprop`.
 
-    # categorize pixels into q bins.
-    for irow in range(data.shape[0]):
-        for icolumn in range(data.shape[1]):
-            #print(irow, icolumn)
+    Returns: rowindex, columnindex, binindex, pixelq, pixelq_unc2, pixelradius
+        (all one-dimensional np.ndarrays, one element for each valid pixel in row-major order)
+        rowindex, columnindex (dtype: uint32): pixel coordinates
+        binindex (dtype: uint32): index of the q-bin the pixel falls into
+        pixelq (dtype: double): scattering variable of the pixel
+        pixelq_unc2 (dtype: double): squared uncertainty of the scattering variable of the pixel
+        pixelradius (dtype: double): distance of the pixel from the beam center, in pixel units
+    """
+    cdef:
+        double[:] qmax, pixelq, pixelq_unc2, pixelradius
+        uint32_t[:] rowindex, columnindex, binindex
+        _QBinLookup lookup
+        Py_ssize_t irow, icolumn, ibin=0, ipixel=0, Nbins = len(qbincenters)
+        _PixelQ pq
+        double qfac, qfac_unc2, row_unc2, col_unc2
+        double dist_relunc2, pixelsize_relunc2
+    qfac = 4*M_PI/wavelength
+    qfac_unc2 = 16*M_PI*M_PI*wavelength_unc**2/wavelength**4
+    row_unc2 = 0.25 + center_row_unc**2
+    col_unc2 = 0.25 + center_col_unc**2
+    dist_relunc2 = distance_unc**2/distance**2
+    pixelsize_relunc2 = pixelsize_unc**2/pixelsize**2
+    qmax = np.zeros(Nbins, dtype=np.double)
+    lookup = _qbinlookup(qbincenters, qmax)
+    # allocate for the worst case, the arrays will be truncated at the end
+    rowindex = np.empty(mask.shape[0]*mask.shape[1], dtype=np.uint32)
+    columnindex = np.empty(mask.shape[0]*mask.shape[1], dtype=np.uint32)
+    binindex = np.empty(mask.shape[0]*mask.shape[1], dtype=np.uint32)
+    pixelq = np.empty(mask.shape[0]*mask.shape[1], dtype=np.double)
+    pixelq_unc2 = np.empty(mask.shape[0]*mask.shape[1], dtype=np.double)
+    pixelradius = np.empty(mask.shape[0]*mask.shape[1], dtype=np.double)
+    for irow in range(mask.shape[0]):
+        for icolumn in range(mask.shape[1]):
             if mask[irow, icolumn] == 0:
-                # this pixel is masked
                 continue
-            if not isfinite(data[irow, icolumn]) or not isfinite(error[irow, icolumn]):
+            pq = _pixelq(irow-center_row, icolumn-center_col, qfac, qfac_unc2, row_unc2, col_unc2,
+                         pixelsize, distance, dist_relunc2, pixelsize_relunc2)
+            ibin = _qbin(pq.q, &lookup)
+            if ibin < 0:
                 continue
-            row = irow-center_row
-            col = icolumn-center_col
-            # using sqrt(x**2+y**2) was faster than hypot(x,y)
-            pixelradius2 = row**2 + col**2
-            # propagated squared uncertainty of (irow-center_row) is 0.25 + dcenter_row**2
-            # propagated squared uncertainty of sqrt(A**2+B**2) is (A**2*dA**2 + B**2+dB**)/(A**2+B**2).
-            #
-            pixelradius_unc2 = (row_unc2*row**2 + col_unc2*col**2)/pixelradius2
-            tgtwotheta2 = pixelradius2*pixelsize**2/distance**2
-            tgtwotheta_unc2 = tgtwotheta2 * (pixelradius_unc2/pixelradius2 +
-                                               dist_relunc2 +
-                                               pixelsize_relunc2
-                                              )
-            # by employing trigonometric identities we get an algebraic form for tg(2theta) -> sin(theta).
-            # While this is faster than the obvious sin(0.5*arctan(tg2theta)), it only works for 0 < 2theta < pi/2.
-            # This is usually true in SAXS.
-            sinth = (0.5*(1-1/(tgtwotheta2+1)**0.5))**0.5
-            sinth_unc2 = 1/16. * tgtwotheta2 / (tgtwotheta2+1)**3 / (1-1/(tgtwotheta2+1)**0.5)*tgtwotheta_unc2**2
-            currentq = qfac * sinth
-            currentq_unc2 = currentq**2 * (qfac_unc2 / qfac**2 + sinth_unc2 / sinth**2)
-            # Now find the q-bin
-            if currentq<qbincenters[0]:
-                # underflow
-                continue
-            if currentq > qmax[len(qbincenters)-1]:
-                # overflow
+            rowindex[ipixel] = irow
+            columnindex[ipixel] = icolumn
+            binindex[ipixel] = ibin
+            pixelq[ipixel] = pq.q
+            pixelq_unc2[ipixel] = pq.q_unc2
+            pixelradius[ipixel] = pq.radius
+            ipixel += 1
+    return (np.array(rowindex[:ipixel]), np.array(columnindex[:ipixel]), np.array(binindex[:ipixel]),
+            np.array(pixelq[:ipixel]), np.array(pixelq_unc2[:ipixel]), np.array(pixelradius[:ipixel]))
+
+
+def radavg_planned(double[:,:] data, double[:,:] error,
+                   const uint32_t[:] rowindex, const uint32_t[:] columnindex, const uint32_t[:] binindex,
+                   const double[:] pixelq, const double[:] pixelq_unc2, const double[:] pixelradius,
+                   Py_ssize_t Nbins, int errorprop=3, int qerrorprop=3, int nthreads=0):
+    """
+    Perform radial averaging on a scattering pattern using the precomputed results of `radavgplan()`.
+
+    Inputs:
+        data (np.ndarray, two dimensions, double dtype): scattering pattern
+        error (np.ndarray, two dimensions, double dtype): uncertainties of the scattering pattern
+        rowindex, columnindex, binindex, pixelq, pixelq_unc2, pixelradius: as returned by `radavgplan()`
+        Nbins (Py_ssize_t): the number of q-bins, i.e. the length of `qbincenters` given to `radavgplan()`
+        errorprop (int, 0-3 inclusive): error propagation type for intensities (see `radavg()`)
+        qerrorprop (int, 0-3 inclusive): error propagation type for q (see `radavg()`)
+        nthreads (int): number of threads. If nonpositive, the default set by `setnthreads()` is used.
+
+    Returns: q, Intensity, Error, qError, Area, pixel, exactly as `radavg()` would.
+    """
+    cdef:
+        double[:, :] Intensity, Intensity2, Error, q, q2, qError, pixel
+        uint32_t[:, :] Area
+        Py_ssize_t ipixel
+        uint32_t irow, icolumn
+        int ithread
+    nthreads = _resolventhreads(nthreads)
+    Intensity = np.zeros((nthreads, Nbins), dtype=np.double)
+    Intensity2 = np.zeros((nthreads, Nbins), dtype=np.double)
+    Error = np.zeros((nthreads, Nbins), dtype=np.double)
+    q = np.zeros((nthreads, Nbins), dtype=np.double)
+    q2 = np.zeros((nthreads, Nbins), dtype=np.double)
+    qError = np.zeros((nthreads, Nbins), dtype=np.double)
+    Area = np.zeros((nthreads, Nbins), dtype=np.uint32)
+    pixel = np.zeros((nthreads, Nbins), dtype=np.double)
+    with nogil, parallel(num_threads=nthreads):
+        ithread = threadid()
+        for ipixel in prange(rowindex.shape[0], schedule='static'):
+            irow = rowindex[ipixel]
+            icolumn = columnindex[ipixel]
+            if not isfinite(data[irow, icolumn]) or not isfinite(error[irow, icolumn]):
                 continue
-            ibin = 0
-            for ibin in range(len(qbincenters)):
-                if qmax[ibin] > currentq:
-                    # this pixel belongs to the current q-bin
-                    break
-            # now bin the pixel
-            if errorprop > 0: # 1,2,3
-                Intensity[ibin] += data[irow, icolumn]
-                if errorprop == 1:
-                    Error[ibin] += error[irow, icolumn]
-                else:
-                    Error[ibin] += error[irow, icolumn]**2
-                if errorprop == 3:
-                    Intensity2[ibin] += data[irow, icolumn]**2
-            else: # 0
-                Intensity[ibin] += data[irow, icolumn] / error[irow, icolumn]**2
-                Error[ibin] += 1/error[irow, icolumn]**2
-            if qerrorprop > 0: # 1, 2 or 3
-                q[ibin] += currentq
-                if qerrorprop == 1:
-                    qError[ibin] += sqrt(currentq_unc2)
-                else:
-                    qError[ibin] += currentq_unc2
-                if qerrorprop == 3:
-                    q2[ibin] += currentq**2
-            else: # 0
-                q[ibin] += currentq / currentq_unc2
-                qError[ibin] += currentq_unc2
-            Area[ibin] += 1
-            pixel[ibin] += sqrt(pixelradius2)
-
-    # normalize the bins
-    for ibin in range(len(qbincenters)):
-        if not Area[ibin]:
-            # no pixels in this bin: set everything to NaN
-            Intensity[ibin] = NAN
-            Error[ibin] = NAN
-            q[ibin] = NAN
-            qError[ibin] = NAN
-            pixel[ibin] = NAN
-            continue
-        if errorprop >0:
-            if errorprop == 1:
-                Error[ibin] /= Area[ibin]
-            elif errorprop == 2:
-                Error[ibin] = sqrt(Error[ibin])/Area[ibin]
-            else: # errorprop == 3
-                error_propagated = sqrt(Error[ibin]/Area[ibin])
-                if Area[ibin] < 2:
-                    error_statistics = 0
-                else:
-                    # sample standard deviation: sqrt((sum(I**2) - N*mean(I)**2)/(N-1))
-                    # in our case, sum(I**2) is simply Intensity2[ibin].
-                    # mean(I) = Intensity[ibin] / Area[ibin], thus N*mean(I)**2 is Intensity[ibin]**2/Area[ibin]
-                    error_statistics = sqrt(
-                        (Intensity2[ibin] - Intensity[ibin]**2/Area[ibin])/(Area[ibin]-1))
-                Error[ibin] = max(error_propagated, error_statistics)
-            Intensity[ibin] /= Area[ibin]
-        else:
-            Intensity[ibin] /= Error[ibin]
-            Error[ibin] = 1/sqrt(Error[ibin])
-        if qerrorprop >0:
-            if qerrorprop == 1:
-                qError[ibin] /= Area[ibin]
-            elif qerrorprop == 2:
-                qError[ibin] = sqrt(qError[ibin])/Area[ibin]
-            else: # qerrorprop == 3
-                error_propagated = sqrt(qError[ibin]/Area[ibin])
-                if Area[ibin] < 2:
-                    error_statistics = 0
-                else:
-                    # sample standard deviation: sqrt((sum(q**2) - N*mean(q)**2)/(N-1))
-                    # in our case, sum(q**2) is simply q2[ibin].
-                    # mean(q) = q[ibin] / Area[ibin], thus N*mean(q)**2 is q[ibin]**2/Area[ibin]
-                    error_statistics = sqrt(
-                        (q2[ibin] - q[ibin]**2/Area[ibin])/(Area[ibin]-1))
-                qError[ibin] = max(error_propagated, error_statistics)
-            q[ibin] /= Area[ibin]
-        else:
-            q[ibin] /= qError[ibin]
-            qError[ibin] = 1/sqrt(qError[ibin])
-        pixel[ibin] /= Area[ibin]
-    return np.array(q), np.array(Intensity), np.array(Error), np.array(qError), np.array(Area), np.array(pixel)
+            _radavg_binpixel(binindex[ipixel], data[irow, icolumn], error[irow, icolumn],
+                             pixelq[ipixel], pixelq_unc2[ipixel], pixelradius[ipixel], errorprop, qerrorprop,
+                             &Intensity[ithread, 0], &Intensity2[ithread, 0], &Error[ithread, 0],
+                             &q[ithread, 0], &q2[ithread, 0], &qError[ithread, 0],
+                             &Area[ithread, 0], &pixel[ithread, 0])
+    return _radavg_finalize(Nbins, errorprop, qerrorprop, Intensity, Intensity2, Error, q, q2, qError, Area, pixel)
+
+
+def radavg_planned_stack(double[:,:,:] data, double[:,:,:] error,
+                         const uint32_t[:] rowindex, const uint32_t[:] columnindex, const uint32_t[:] binindex,
+                         const double[:] pixelq, const double[:] pixelq_unc2, const double[:] pixelradius,
+                         Py_ssize_t Nbins, int errorprop=3, int qerrorprop=3, int nthreads=0):
+    """
+    Perform radial averaging on a stack of scattering patterns sharing the same geometry and mask, using the
+    precomputed results of `radavgplan()`.
+
+    Inputs:
+        data (np.ndarray, three dimensions, double dtype): scattering patterns, the last index is the frame index
+        error (np.ndarray, three dimensions, double dtype): uncertainties of the scattering patterns
+        rowindex, columnindex, binindex, pixelq, pixelq_unc2, pixelradius: as returned by `radavgplan()`
+        Nbins (Py_ssize_t): the number of q-bins, i.e. the length of `qbincenters` given to `radavgplan()`
+        errorprop (int, 0-3 inclusive): error propagation type for intensities (see `radavg()`)
+        qerrorprop (int, 0-3 inclusive): error propagation type for q (see `radavg()`)
+        nthreads (int): number of threads. If nonpositive, the default set by `setnthreads()` is used.
+
+    Returns: curves
+        curves (np.ndarray of shape (Nbins, 6, Nframes)): the columns along the second axis are q, Intensity,
+            Error, qError, Area and pixel, i.e. the same as `Curve.asArray()`.
+
+    Notes:
+        The frames are distributed among the threads, each frame is averaged by a single thread. The results
+        are therefore bit-identical to those of `radavg_planned()` with a single thread, for any thread count.
+    """
+    cdef:
+        double[:, :] Intensity, Intensity2, Error, q, q2, qError, pixel
+        uint32_t[:, :] Area
+        double[:, :, :] curves
+        Py_ssize_t ipixel, iframe, ibin
+        Py_ssize_t Nframes = data.shape[2]
+        uint32_t irow, icolumn
+    if (error.shape[0] != data.shape[0]) or (error.shape[1] != data.shape[1]) or (error.shape[2] != data.shape[2]):
+        raise ValueError('Shape mismatch')
+    nthreads = _resolventhreads(nthreads)
+    Intensity = np.zeros((Nframes, Nbins), dtype=np.double)
+    Intensity2 = np.zeros((Nframes, Nbins), dtype=np.double)
+    Error = np.zeros((Nframes, Nbins), dtype=np.double)
+    q = np.zeros((Nframes, Nbins), dtype=np.double)
+    q2 = np.zeros((Nframes, Nbins), dtype=np.double)
+    qError = np.zeros((Nframes, Nbins), dtype=np.double)
+    Area = np.zeros((Nframes, Nbins), dtype=np.uint32)
+    pixel = np.zeros((Nframes, Nbins), dtype=np.double)
+    curves = np.empty((Nbins, 6, Nframes), dtype=np.double)
+    if (Nframes == 0) or (Nbins == 0):
+        return np.asarray(curves)
+    with nogil:
+        for iframe in prange(Nframes, schedule='static', num_threads=nthreads):
+            for ipixel in range(rowindex.shape[0]):
+                irow = rowindex[ipixel]
+                icolumn = columnindex[ipixel]
+                if not isfinite(data[irow, icolumn, iframe]) or not isfinite(error[irow, icolumn, iframe]):
+                    continue
+                _radavg_binpixel(binindex[ipixel], data[irow, icolumn, iframe], error[irow, icolumn, iframe],
+                                 pixelq[ipixel], pixelq_unc2[ipixel], pixelradius[ipixel], errorprop, qerrorprop,
+                                 &Intensity[iframe, 0], &Intensity2[iframe, 0], &Error[iframe, 0],
+                                 &q[iframe, 0], &q2[iframe, 0], &qError[iframe, 0],
+                                 &Area[iframe, 0], &pixel[iframe, 0])
+            _radavg_normalize(Nbins, errorprop, qerrorprop, &Intensity[iframe, 0], &Intensity2[iframe, 0],
+                              &Error[iframe, 0], &q[iframe, 0], &q2[iframe, 0], &qError[iframe, 0],
+                              &Area[iframe, 0], &pixel[iframe, 0])
+            for ibin in range(Nbins):
+                curves[ibin, 0, iframe] = q[iframe, ibin]
+                curves[ibin, 1, iframe] = Intensity[iframe, ibin]
+                curves[ibin, 2, iframe] = Error[iframe, ibin]
+                curves[ibin, 3, iframe] = qError[iframe, ibin]
+                curves[ibin, 4, iframe] = Area[iframe, ibin]
+                curves[ibin, 5, iframe] = pixel[iframe, ibin]
+    return np.asarray(curves)
+
+
+def cakeavg(double[:,:] data, double[:,:] error, uint8_t[:,:] mask,
+            double wavelength, double wavelength_unc,
+            double distance, double distance_unc,
+            double pixelsize, double pixelsize_unc,
+            double center_row, double center_row_unc,
+            double center_col, double center_col_unc,
+            double[:] qbincenters, Py_ssize_t Nphi=360,
+            int errorprop=3, int qerrorprop=3, int nthreads=0
+            ):
+    """
+    Rebin a scattering pattern into a two-dimensional (q, phi) map ("cake") in a single pass.
+
+    Inputs:
+        data, error, mask, wavelength, wavelength_unc, distance, distance_unc, pixelsize, pixelsize_unc,
+        center_row, center_row_unc, center_col, center_col_unc, qbincenters: the same as for `radavg()`
+        Nphi (Py_ssize_t): number of azimuthal bins
+        errorprop (int, 0-3 inclusive): error propagation type for intensities (see `radavg()`)
+        qerrorprop (int, 0-3 inclusive): error propagation type for q (see `radavg()`)
+        nthreads (int): number of threads. If nonpositive, the default set by `setnthreads()` is used.
+
+    Returns: Intensity, Intensity2, Error, q, q2, qError, Area, pixel, phi, phi2, phiError
+        (all two-dimensional np.ndarrays of shape (len(qbincenters), Nphi))
+        the accumulated, not yet normalized sums of each bin. Their meaning depends on `errorprop` and `qerrorprop`,
+        except for `q2`, which is always the sum of the squared q values. `phi`, `phi2` and `phiError` are the sums
+        for the azimuth angle, accumulated like in `azimavg()` with `qerrorprop` as the error propagation type.
+        Use `cakenormalize()` to get the bin averages and their uncertainties: the first eight arrays give those of
+        q, the first three, `phi`, `phi2`, `phiError`, `Area` and `pixel` those of phi.
+
+    Notes:
+        The sums are kept instead of the averages because cakes can be reduced further without loss: summing the
+        accumulators along either axis and normalizing gives the same result as a sector-limited radial average
+        or an annulus-limited azimuthal average with the same bins, for every error propagation type.
+
+    Binning:
+        - q-bins are the same as in `radavg()`.
+        - azimuthal bins are the same as in `azimavg()`: the first bin is centered on 0 rad, the bin width is
+          2*pi/Nphi.
+    """
+    cdef:
+        double[:, :] Intensity, Intensity2, Error, q, q2, qError, pixel, phi, phi2, phiError
+        double[:] qmax
+        uint32_t[:, :] Area
+        _QBinLookup lookup
+        Py_ssize_t irow, icolumn, iq=0, iphi=0, ibin=0, Nq = len(qbincenters)
+        int ithread
+        _PixelQ pq
+        double qfac, qfac_unc2, row_unc2, col_unc2
+        double dist_relunc2, pixelsize_relunc2
+        double currentphi, currentphi_unc, halfbinwidth, row, col
+    nthreads = _resolventhreads(nthreads)
+    # initialize output arrays: one row for each thread, the (q, phi) bins are flattened
+    Intensity = np.zeros((nthreads, Nq * Nphi), dtype=np.double)
+    Intensity2 = np.zeros((nthreads, Nq * Nphi), dtype=np.double)
+    Error = np.zeros((nthreads, Nq * Nphi), dtype=np.double)
+    q = np.zeros((nthreads, Nq * Nphi), dtype=np.double)
+    q2 = np.zeros((nthreads, Nq * Nphi), dtype=np.double)
+    qError = np.zeros((nthreads, Nq * Nphi), dtype=np.double)
+    Area = np.zeros((nthreads, Nq * Nphi), dtype=np.uint32)
+    pixel = np.zeros((nthreads, Nq * Nphi), dtype=np.double)
+    phi = np.zeros((nthreads, Nq * Nphi), dtype=np.double)
+    phi2 = np.zeros((nthreads, Nq * Nphi), dtype=np.double)
+    phiError = np.zeros((nthreads, Nq * Nphi), dtype=np.double)
+    if (Nq == 0) or (Nphi == 0):
+        return tuple(np.zeros((Nq, Nphi), dtype=np.uint32 if i == 6 else np.double) for i in range(11))
+    qmax = np.zeros(Nq, dtype=np.double)
+    qfac = 4*M_PI/wavelength
+    qfac_unc2 = 16*M_PI*M_PI*wavelength_unc**2/wavelength**4
+    row_unc2 = 0.25 + center_row_unc**2  # the uncertainty of the pixel coordinate is assumed to be 0.5 pixel
+    col_unc2 = 0.25 + center_col_unc**2
+    dist_relunc2 = distance_unc**2/distance**2
+    pixelsize_relunc2 = pixelsize_unc**2/pixelsize**2
+    lookup = _qbinlookup(qbincenters, qmax)
+    halfbinwidth = M_PI/Nphi
+
+    with nogil, parallel(num_threads=nthreads):
+        ithread = threadid()
+        for irow in prange(data.shape[0], schedule='static'):
+            for icolumn in range(data.shape[1]):
+                if mask[irow, icolumn] == 0:
+                    continue
+                if not isfinite(data[irow, icolumn]) or not isfinite(error[irow, icolumn]):
+                    continue
+                pq = _pixelq(irow-center_row, icolumn-center_col, qfac, qfac_unc2, row_unc2, col_unc2,
+                             pixelsize, distance, dist_relunc2, pixelsize_relunc2)
+                iq = _qbin(pq.q, &lookup)
+                if iq < 0:
+                    continue
+                row = irow-center_row
+                col = icolumn-center_col
+                currentphi = atan2(-row, col)  # -pi <= currentphi <= pi
+                if currentphi < -halfbinwidth:
+                    currentphi = currentphi + 2*M_PI
+                iphi = <Py_ssize_t>((currentphi + halfbinwidth)/(2*M_PI) * Nphi)
+                if iphi > Nphi-1:
+                    continue
+                ibin = iq * Nphi + iphi
+                _radavg_binpixel(ibin, data[irow, icolumn], error[irow, icolumn],
+                                 pq.q, pq.q_unc2, pq.radius, errorprop, qerrorprop,
+                                 &Intensity[ithread, 0], &Intensity2[ithread, 0], &Error[ithread, 0],
+                                 &q[ithread, 0], &q2[ithread, 0], &qError[ithread, 0],
+                                 &Area[ithread, 0], &pixel[ithread, 0])
+                if qerrorprop != 3:
+                    # the sum of squared q values is always needed for the spread of q in azimuthal slices
+                    q2[ithread, ibin] += pq.q**2
+                # the azimuth angle, the same way as in azimavg()
+                currentphi_unc = fabs(row/col)/fabs(1+(row/col)**2) * sqrt(row_unc2/row**2 + col_unc2/col**2)
+                if qerrorprop > 0: # 1, 2 or 3
+                    phi[ithread, ibin] += currentphi
+                    if qerrorprop == 1:
+                        phiError[ithread, ibin] += currentphi_unc
+                    else:
+                        phiError[ithread, ibin] += currentphi_unc**2
+                    if qerrorprop == 3:
+                        phi2[ithread, ibin] += currentphi**2
+                else: # 0
+                    phi[ithread, ibin] += currentphi / currentphi_unc**2
+                    phiError[ithread, ibin] += currentphi_unc**2
+    with nogil:
+        _reducethreads(Intensity)
+        _reducethreads(Intensity2)
+        _reducethreads(Error)
+        _reducethreads(q)
+        _reducethreads(q2)
+        _reducethreads(qError)
+        _reducethreads(pixel)
+        _reducethreads(phi)
+        _reducethreads(phi2)
+        _reducethreads(phiError)
+        _reducethreads_uint32(Area)
+    return (np.array(Intensity[0, :]).reshape(Nq, Nphi), np.array(Intensity2[0, :]).reshape(Nq, Nphi),
+            np.array(Error[0, :]).reshape(Nq, Nphi), np.array(q[0, :]).reshape(Nq, Nphi),
+            np.array(q2[0, :]).reshape(Nq, Nphi), np.array(qError[0, :]).reshape(Nq, Nphi),
+            np.array(Area[0, :]).reshape(Nq, Nphi), np.array(pixel[0, :]).reshape(Nq, Nphi),
+            np.array(phi[0, :]).reshape(Nq, Nphi), np.array(phi2[0, :]).reshape(Nq, Nphi),
+            np.array(phiError[0, :]).reshape(Nq, Nphi))
+
+
+def cakenormalize(Intensity, Intensity2, Error, q, q2, qError, Area, pixel, int errorprop=3, int qerrorprop=3):
+    """
+    Calculate bin averages and uncertainties from the accumulated sums returned by `cakeavg()`.
+
+    Inputs:
+        Intensity, Intensity2, Error, q, q2, qError, Area, pixel (np.ndarrays of the same shape): accumulated sums,
+            either directly from `cakeavg()` or summed along some axes.
+        errorprop (int, 0-3 inclusive): error propagation type for intensities, as given to `cakeavg()`
+        qerrorprop (int, 0-3 inclusive): error propagation type for q, as given to `cakeavg()`
+
+    Returns: q, Intensity, Error, qError, Area, pixel
+        (np.ndarrays of the same shape as the inputs). Empty bins are NaN.
+    """
+    cdef:
+        double[::1] Intensity_, Intensity2_, Error_, q_, q2_, qError_, pixel_
+        uint32_t[::1] Area_
+        Py_ssize_t Nbins
+    shape = np.shape(Intensity)
+    if any(np.shape(x) != shape for x in (Intensity2, Error, q, q2, qError, Area, pixel)):
+        raise ValueError('Shape mismatch')
+    Intensity_ = np.array(Intensity, dtype=np.double).ravel()
+    Intensity2_ = np.array(Intensity2, dtype=np.double).ravel()
+    Error_ = np.array(Error, dtype=np.double).ravel()
+    q_ = np.array(q, dtype=np.double).ravel()
+    q2_ = np.array(q2, dtype=np.double).ravel()
+    qError_ = np.array(qError, dtype=np.double).ravel()
+    Area_ = np.array(Area, dtype=np.uint32).ravel()
+    pixel_ = np.array(pixel, dtype=np.double).ravel()
+    Nbins = Intensity_.shape[0]
+    if Nbins > 0:
+        with nogil:
+            _radavg_normalize(Nbins, errorprop, qerrorprop, &Intensity_[0], &Intensity2_[0], &Error_[0],
+                              &q_[0], &q2_[0], &qError_[0], &Area_[0], &pixel_[0])
+    return (np.asarray(q_).reshape(shape), np.asarray(Intensity_).reshape(shape), np.asarray(Error_).reshape(shape),
+            np.asarray(qError_).reshape(shape), np.asarray(Area_).reshape(shape), np.asarray(pixel_).reshape(shape))
+
 
 def fastradavg(double[:,:] data, uint8_t[:,:] mask,
                double center_row, double center_col,
-               double dmin, double dmax, Py_ssize_t N):
+               double dmin, double dmax, Py_ssize_t N, int nthreads=0):
     """
     Fast radial averaging
 
@@ -300,6 +880,7 @@ def fastradavg(double[:,:] data, uint8_t[:,:] mask,
         dmin (double): smallest pixel for the abscissa
         dmax (double): largest pixel for the abscissa
         N (Py_ssize_t): number of pixels
+        nthreads (int): number of threads. If nonpositive, the default set by `setnthreads()` is used.
 
     Outputs: pixel, Intensity, Area
         (all one-dimensional np.ndarrays of length `N`)
@@ -309,35 +890,42 @@ def fastradavg(double[:,:] data, uint8_t[:,:] mask,
     """
     cdef:
         Py_ssize_t i, j, ibin
-        double[:] pixel
-        double[:] Intensity
-        uint32_t[:] Area
+        double[:, :] pixel
+        double[:, :] Intensity
+        uint32_t[:, :] Area
         double r
+        int ithread
 
-    pixel = np.zeros(N, np.double)
-    Intensity = np.zeros(N, np.double)
-    Area = np.zeros(N, np.uint32)
+    nthreads = _resolventhreads(nthreads)
+    pixel = np.zeros((nthreads, N), np.double)
+    Intensity = np.zeros((nthreads, N), np.double)
+    Area = np.zeros((nthreads, N), np.uint32)
 
-    for i in range(data.shape[0]):
-        for j in range(data.shape[1]):
-            if mask[i,j] ==0:
-                continue
-            if not isfinite(data[i,j]):
-                continue
-            r = sqrt((i-center_row)**2 + (j-center_col)**2)
-            ibin = <Py_ssize_t>(floor((r-dmin)/(dmax-dmin)*N))
-            if ibin>=0 and ibin < N:
-                pixel[ibin] += r
-                Intensity[ibin] += data[i,j]
-                Area[ibin] += 1
+    with nogil, parallel(num_threads=nthreads):
+        ithread = threadid()
+        for i in prange(data.shape[0], schedule='static'):
+            for j in range(data.shape[1]):
+                if mask[i,j] ==0:
+                    continue
+                if not isfinite(data[i,j]):
+                    continue
+                r = sqrt((i-center_row)**2 + (j-center_col)**2)
+                ibin = <Py_ssize_t>(floor((r-dmin)/(dmax-dmin)*N))
+                if ibin>=0 and ibin < N:
+                    pixel[ithread, ibin] += r
+                    Intensity[ithread, ibin] += data[i,j]
+                    Area[ithread, ibin] += 1
+    _reducethreads(pixel)
+    _reducethreads(Intensity)
+    _reducethreads_uint32(Area)
     for ibin in range(N):
-        if Area[ibin] == 0:
-            pixel[ibin] = NAN
-            Intensity[ibin] = NAN
+        if Area[0, ibin] == 0:
+            pixel[0, ibin] = NAN
+            Intensity[0, ibin] = NAN
         else:
-            pixel[ibin] /= Area[ibin]
-            Intensity[ibin] /= Area[ibin]
-    return np.array(pixel), np.array(Intensity), np.array(Area)
+            pixel[0, ibin] /= Area[0, ibin]
+            Intensity[0, ibin] /= Area[0, ibin]
+    return np.array(pixel[0, :]), np.array(Intensity[0, :]), np.array(Area[0, :])
 
 def maskforsectors(uint8_t[:,:] mask, double center_row, double center_col, double phicenter, double phihalfwidth, bint symmetric=False):
     """
@@ -364,30 +952,31 @@ def maskforsectors(uint8_t[:,:] mask, double center_row, double center_col, doub
         uint8_t[:,:] maskout
         double row, col, r
         double rowref, colref
-        double sindeltaphi, cosdeltaphi
+        double sindeltaphi, cosdeltaphi, deltaphi
 
     # row and column coordinates of the direction vector of the sector center
     rowref = -sin(phicenter)
     colref = cos(phicenter)
 
     maskout = np.empty_like(mask)
-    for irow in range(mask.shape[0]):
-        row = irow-center_row
-        for icol in range(mask.shape[1]):
-            if mask[irow, icol] == 0:
-                maskout[irow, icol] = 0
-                continue
-            col = icol-center_col
-            r = sqrt(row**2+col**2)
-            sindeltaphi = (rowref*col - row*colref) / r
-            cosdeltaphi = (rowref*row + colref*col) / r
-            deltaphi = atan2(sindeltaphi, cosdeltaphi)
-            if fabs(deltaphi) <= phihalfwidth:
-                maskout[irow, icol] = 1
-            elif symmetric and (fabs(deltaphi) >= (np.pi - phihalfwidth)):
-                maskout[irow, icol] = 1
-            else:
-                maskout[irow, icol] = 0
+    with nogil:
+        for irow in range(mask.shape[0]):
+            row = irow-center_row
+            for icol in range(mask.shape[1]):
+                if mask[irow, icol] == 0:
+                    maskout[irow, icol] = 0
+                    continue
+                col = icol-center_col
+                r = sqrt(row**2+col**2)
+                sindeltaphi = (rowref*col - row*colref) / r
+                cosdeltaphi = (rowref*row + colref*col) / r
+                deltaphi = atan2(sindeltaphi, cosdeltaphi)
+                if fabs(deltaphi) <= phihalfwidth:
+                    maskout[irow, icol] = 1
+                elif symmetric and (fabs(deltaphi) >= (M_PI - phihalfwidth)):
+                    maskout[irow, icol] = 1
+                else:
+                    maskout[irow, icol] = 0
     return np.array(maskout)
 
 def maskforannulus(uint8_t[:,:] mask, double center_row, double center_col, double pixmin, double pixmax):
@@ -412,15 +1001,16 @@ def maskforannulus(uint8_t[:,:] mask, double center_row, double center_col, doub
 
 
     maskout = np.empty_like(mask)
-    for irow in range(mask.shape[0]):
-        row = irow-center_row
-        for icol in range(mask.shape[1]):
-            if mask[irow, icol] == 0:
-                maskout[irow, icol] = 0
-                continue
-            col = icol-center_col
-            r = sqrt(row**2+col**2)
-            maskout[irow, icol] = (r>=pixmin) & (r<=pixmax)
+    with nogil:
+        for irow in range(mask.shape[0]):
+            row = irow-center_row
+            for icol in range(mask.shape[1]):
+                if mask[irow, icol] == 0:
+                    maskout[irow, icol] = 0
+                    continue
+                col = icol-center_col
+                r = sqrt(row**2+col**2)
+                maskout[irow, icol] = (r>=pixmin) & (r<=pixmax)
     return np.array(maskout)
 
 def azimavg(double[:,:] data, double[:,:] error, uint8_t[:,:] mask,
@@ -430,7 +1020,7 @@ def azimavg(double[:,:] data, double[:,:] error, uint8_t[:,:] mask,
             double center_row, double center_row_unc,
             double center_col, double center_col_unc,
             Py_ssize_t N=100,
-            int errorprop=3, int phierrorprop=3
+            int errorprop=3, int phierrorprop=3, int nthreads=0
             ):
     """
     Perform azimuthal averaging on a scattering pattern.
@@ -449,6 +1039,7 @@ def azimavg(double[:,:] data, double[:,:] error, uint8_t[:,:] mask,
         N (Py_ssize_t): number of points in the output
         errorprop (int, 0-3 inclusive): error propagation type for intensities (see below)
         phierrorprop (int, 0-3 inclusive): error propagation type for the azimuth angle (see below)
+        nthreads (int): number of threads. If nonpositive, the default set by `setnthreads()` is used.
 
     Returns: phi, Intensity, Error, phiError, Area, qmean, qstd
         (all one-dimensional np.ndarrays, length of `qbincenters`)
@@ -482,38 +1073,38 @@ def azimavg(double[:,:] data, double[:,:] error, uint8_t[:,:] mask,
         - the bin width is 2*pi/N.
     """
     cdef:
-        double[:] Intensity
-        double[:] Intensity2
-        double[:] Error
-        double[:] phi
-        double[:] phi2
-        double[:] phiError
-        double[:] q
-        double[:] q2
+        double[:, :] Intensity
+        double[:, :] Intensity2
+        double[:, :] Error
+        double[:, :] phi
+        double[:, :] phi2
+        double[:, :] phiError
+        double[:, :] q
+        double[:, :] q2
         double[:] qmean
         double[:] qstd
-        uint32_t[:] Area
-        double[:] pixel
+        uint32_t[:, :] Area
         Py_ssize_t irow, icolumn, ibin
+        int ithread
         double currentphi, currentphi_unc, pixelradius, halfbinwidth
 
         double currentq, tgtwotheta2, qfac, row, col, sinth
         double row_unc2, col_unc2, sinth_unc2
         double error_propagated
         double error_statistics
-    # initialize output arrays
-    Intensity = np.zeros(N, dtype=np.double)
-    Intensity2 = np.zeros(N, dtype=np.double)
-    Error = np.zeros(N, dtype=np.double)
-    phi = np.zeros(N, dtype=np.double)
-    phi2 = np.zeros(N, dtype=np.double)
-    phiError = np.zeros(N, dtype=np.double)
-    q = np.zeros(N, dtype=np.double)
-    q2 = np.zeros(N, dtype=np.double)
+    nthreads = _resolventhreads(nthreads)
+    # initialize output arrays: one row for each thread
+    Intensity = np.zeros((nthreads, N), dtype=np.double)
+    Intensity2 = np.zeros((nthreads, N), dtype=np.double)
+    Error = np.zeros((nthreads, N), dtype=np.double)
+    phi = np.zeros((nthreads, N), dtype=np.double)
+    phi2 = np.zeros((nthreads, N), dtype=np.double)
+    phiError = np.zeros((nthreads, N), dtype=np.double)
+    q = np.zeros((nthreads, N), dtype=np.double)
+    q2 = np.zeros((nthreads, N), dtype=np.double)
     qmean = np.zeros(N, dtype=np.double)
     qstd = np.zeros(N, dtype=np.double)
-    Area = np.zeros(N, dtype=np.uint32)
-    pixel = np.zeros(N, dtype=np.double)
+    Area = np.zeros((nthreads, N), dtype=np.uint32)
     # the prefactor of "q": speed things up.
     qfac = 4*M_PI/wavelength
     # the uncertainty of the center-corrected row and column coordinate does not change
@@ -522,119 +1113,130 @@ def azimavg(double[:,:] data, double[:,:] error, uint8_t[:,:] mask,
 
 
     halfbinwidth = M_PI/N
-    # categorize pixels into phi bins.
-    for irow in range(data.shape[0]):
-        for icolumn in range(data.shape[1]):
-            #print(irow, icolumn)
-            if mask[irow, icolumn] == 0:
-                # this pixel is masked
-                continue
-            if not isfinite(data[irow, icolumn]) or not isfinite(error[irow, icolumn]):
-                continue
-            row = irow-center_row
-            col = icolumn-center_col
-            currentphi = atan2(-row, col)  # -pi <= currentphi <= pi
-            if currentphi < -halfbinwidth:
-                currentphi += 2* M_PI
-            # now (-binwidth/2 <= currentphi < 2*M_PI-binwidth/2
-            ibin = <Py_ssize_t>((currentphi + halfbinwidth)/(2*M_PI) * N)
-            if ibin > N-1:
-                continue
-            currentphi_unc = fabs(row/col)/fabs(1+(row/col)**2) * sqrt(row_unc2/row**2 + col_unc2/col**2)
-            tgtwotheta2 = (row**2+col**2)*pixelsize**2/distance**2
-            # by employing trigonometric identities we get an algebraic form for tg(2theta) -> sin(theta).
-            # While this is faster than the obvious sin(0.5*arctan(tg2theta)), it only works for 0 < 2theta < pi/2.
-            # This is usually true in SAXS.
-            sinth = (0.5*(1-1/(tgtwotheta2+1)**0.5))**0.5
-            currentq = qfac * sinth
-            # now bin the pixel
-            if errorprop > 0: # 1,2,3
-                Intensity[ibin] += data[irow, icolumn]
-                if errorprop == 1:
-                    Error[ibin] += error[irow, icolumn]
-                else:
-                    Error[ibin] += error[irow, icolumn]**2
-                if errorprop == 3:
-                    Intensity2[ibin] += data[irow, icolumn]**2
-            else: # 0
-                Intensity[ibin] += data[irow, icolumn] / error[irow, icolumn]**2
-                Error[ibin] += 1/error[irow, icolumn]**2
-            if phierrorprop > 0: # 1, 2 or 3
-                phi[ibin] += currentphi
-                if phierrorprop == 1:
-                    phiError[ibin] += currentphi_unc
-                else:
-                    phiError[ibin] += currentphi_unc**2
-                if phierrorprop == 3:
-                    phi2[ibin] += currentphi**2
-            else: # 0
-                phi[ibin] += currentphi / currentphi_unc**2
-                phiError[ibin] += currentphi_unc**2
-            Area[ibin] += 1
-            q[ibin] += currentq
-            q2[ibin] += currentq**2
+    # categorize pixels into phi bins. Static scheduling: each thread gets a contiguous block of rows.
+    with nogil, parallel(num_threads=nthreads):
+        ithread = threadid()
+        for irow in prange(data.shape[0], schedule='static'):
+            for icolumn in range(data.shape[1]):
+                if mask[irow, icolumn] == 0:
+                    # this pixel is masked
+                    continue
+                if not isfinite(data[irow, icolumn]) or not isfinite(error[irow, icolumn]):
+                    continue
+                row = irow-center_row
+                col = icolumn-center_col
+                currentphi = atan2(-row, col)  # -pi <= currentphi <= pi
+                if currentphi < -halfbinwidth:
+                    currentphi = currentphi + 2* M_PI
+                # now (-binwidth/2 <= currentphi < 2*M_PI-binwidth/2
+                ibin = <Py_ssize_t>((currentphi + halfbinwidth)/(2*M_PI) * N)
+                if ibin > N-1:
+                    continue
+                currentphi_unc = fabs(row/col)/fabs(1+(row/col)**2) * sqrt(row_unc2/row**2 + col_unc2/col**2)
+                tgtwotheta2 = (row**2+col**2)*pixelsize**2/distance**2
+                # by employing trigonometric identities we get an algebraic form for tg(2theta) -> sin(theta).
+                # While this is faster than the obvious sin(0.5*arctan(tg2theta)), it only works for 0 < 2theta < pi/2.
+                # This is usually true in SAXS.
+                sinth = (0.5*(1-1/(tgtwotheta2+1)**0.5))**0.5
+                currentq = qfac * sinth
+                # now bin the pixel
+                if errorprop > 0: # 1,2,3
+                    Intensity[ithread, ibin] += data[irow, icolumn]
+                    if errorprop == 1:
+                        Error[ithread, ibin] += error[irow, icolumn]
+                    else:
+                        Error[ithread, ibin] += error[irow, icolumn]**2
+                    if errorprop == 3:
+                        Intensity2[ithread, ibin] += data[irow, icolumn]**2
+                else: # 0
+                    Intensity[ithread, ibin] += data[irow, icolumn] / error[irow, icolumn]**2
+                    Error[ithread, ibin] += 1/error[irow, icolumn]**2
+                if phierrorprop > 0: # 1, 2 or 3
+                    phi[ithread, ibin] += currentphi
+                    if phierrorprop == 1:
+                        phiError[ithread, ibin] += currentphi_unc
+                    else:
+                        phiError[ithread, ibin] += currentphi_unc**2
+                    if phierrorprop == 3:
+                        phi2[ithread, ibin] += currentphi**2
+                else: # 0
+                    phi[ithread, ibin] += currentphi / currentphi_unc**2
+                    phiError[ithread, ibin] += currentphi_unc**2
+                Area[ithread, ibin] += 1
+                q[ithread, ibin] += currentq
+                q2[ithread, ibin] += currentq**2
 
-    # normalize the bins
+    # add up the partial sums of the threads and normalize the bins
+    _reducethreads(Intensity)
+    _reducethreads(Intensity2)
+    _reducethreads(Error)
+    _reducethreads(phi)
+    _reducethreads(phi2)
+    _reducethreads(phiError)
+    _reducethreads(q)
+    _reducethreads(q2)
+    _reducethreads_uint32(Area)
     for ibin in range(N):
-        if not Area[ibin]:
+        if not Area[0, ibin]:
             # no pixels in this bin: set everything to NaN
-            Intensity[ibin] = NAN
-            Error[ibin] = NAN
-            phi[ibin] = NAN
-            phiError[ibin] = NAN
+            Intensity[0, ibin] = NAN
+            Error[0, ibin] = NAN
+            phi[0, ibin] = NAN
+            phiError[0, ibin] = NAN
             qmean[ibin] = NAN
             qstd[ibin] = NAN
             continue
         if errorprop >0:
             if errorprop == 1:
-                Error[ibin] /= Area[ibin]
+                Error[0, ibin] /= Area[0, ibin]
             elif errorprop == 2:
-                Error[ibin] = sqrt(Error[ibin])/Area[ibin]
+                Error[0, ibin] = sqrt(Error[0, ibin])/Area[0, ibin]
             else: # errorprop == 3
-                error_propagated = sqrt(Error[ibin]/Area[ibin])
-                if Area[ibin] < 2:
+                error_propagated = sqrt(Error[0, ibin]/Area[0, ibin])
+                if Area[0, ibin] < 2:
                     error_statistics = 0
                 else:
                     # sample standard deviation: sqrt((sum(I**2) - N*mean(I)**2)/(N-1))
-                    # in our case, sum(I**2) is simply Intensity2[ibin].
-                    # mean(I) = Intensity[ibin] / Area[ibin], thus N*mean(I)**2 is Intensity[ibin]**2/Area[ibin]
+                    # in our case, sum(I**2) is simply Intensity2[0, ibin].
+                    # mean(I) = Intensity[0, ibin] / Area[0, ibin], thus N*mean(I)**2 is Intensity[0, ibin]**2/Area[0, ibin]
                     error_statistics = sqrt(
-                        (Intensity2[ibin] - Intensity[ibin]**2/Area[ibin])/(Area[ibin]-1))
-                Error[ibin] = max(error_propagated, error_statistics)
-            Intensity[ibin] /= Area[ibin]
+                        (Intensity2[0, ibin] - Intensity[0, ibin]**2/Area[0, ibin])/(Area[0, ibin]-1))
+                Error[0, ibin] = max(error_propagated, error_statistics)
+            Intensity[0, ibin] /= Area[0, ibin]
         else:
-            Intensity[ibin] /= Error[ibin]
-            Error[ibin] = 1/sqrt(Error[ibin])
+            Intensity[0, ibin] /= Error[0, ibin]
+            Error[0, ibin] = 1/sqrt(Error[0, ibin])
         if phierrorprop >0:
             if phierrorprop == 1:
-                phiError[ibin] /= Area[ibin]
+                phiError[0, ibin] /= Area[0, ibin]
             elif phierrorprop == 2:
-                phiError[ibin] = sqrt(phiError[ibin])/Area[ibin]
+                phiError[0, ibin] = sqrt(phiError[0, ibin])/Area[0, ibin]
             else: # phierrorprop == 3
-                error_propagated = sqrt(phiError[ibin]/Area[ibin])
-                if Area[ibin] < 2:
+                error_propagated = sqrt(phiError[0, ibin]/Area[0, ibin])
+                if Area[0, ibin] < 2:
                     error_statistics = 0
                 else:
                     # sample standard deviation: sqrt((sum(phi**2) - M*mean(phi)**2)/(M-1))
-                    # in our case, sum(phi**2) is simply phi2[ibin].
-                    # mean(phi) = phi[ibin] / Area[ibin], thus M*mean(phi)**2 is phi[ibin]**2/Area[ibin]
+                    # in our case, sum(phi**2) is simply phi2[0, ibin].
+                    # mean(phi) = phi[0, ibin] / Area[0, ibin], thus M*mean(phi)**2 is phi[0, ibin]**2/Area[0, ibin]
                     error_statistics = sqrt(
-                        (phi2[ibin] - phi[ibin]**2/Area[ibin])/(Area[ibin]-1))
-                phiError[ibin] = max(error_propagated, error_statistics)
-            phi[ibin] /= Area[ibin]
+                        (phi2[0, ibin] - phi[0, ibin]**2/Area[0, ibin])/(Area[0, ibin]-1))
+                phiError[0, ibin] = max(error_propagated, error_statistics)
+            phi[0, ibin] /= Area[0, ibin]
         else:
-            phi[ibin] /= phiError[ibin]
-            phiError[ibin] = 1/sqrt(phiError[ibin])
-        qmean[ibin] = q[ibin] / Area[ibin]
-        if Area[ibin] <2:
+            phi[0, ibin] /= phiError[0, ibin]
+            phiError[0, ibin] = 1/sqrt(phiError[0, ibin])
+        qmean[ibin] = q[0, ibin] / Area[0, ibin]
+        if Area[0, ibin] <2:
             qstd[ibin] = 0
         else:
-            qstd[ibin] = sqrt(q2[ibin] - q[ibin]**2/Area[ibin])/(Area[ibin]-1)
-    return np.array(phi), np.array(Intensity), np.array(Error), np.array(phiError), np.array(Area), np.array(qmean), np.array(qstd)
+            qstd[ibin] = sqrt(q2[0, ibin] - q[0, ibin]**2/Area[0, ibin])/(Area[0, ibin]-1)
+    return (np.array(phi[0, :]), np.array(Intensity[0, :]), np.array(Error[0, :]), np.array(phiError[0, :]),
+            np.array(Area[0, :]), np.array(qmean), np.array(qstd))
 
 def fastazimavg(double[:,:] data, uint8_t[:,:] mask,
                 double center_row, double center_col,
-                Py_ssize_t N):
+                Py_ssize_t N, int nthreads=0):
     """
     Fast azimuthal averaging
 
@@ -644,6 +1246,7 @@ def fastazimavg(double[:,:] data, uint8_t[:,:] mask,
         center_row (double): row coordinate of the beam center
         center_col (double): column coordinate of the beam center
         N (Py_ssize_t): number of bins
+        nthreads (int): number of threads. If nonpositive, the default set by `setnthreads()` is used.
 
     Outputs: phi, Intensity, Area
         (all one-dimensional np.ndarrays of length `N`)
@@ -653,41 +1256,48 @@ def fastazimavg(double[:,:] data, uint8_t[:,:] mask,
     """
     cdef:
         Py_ssize_t i, j, ibin
-        double[:] pixel
-        double[:] Intensity
-        uint32_t[:] Area
-        double r
+        double[:, :] phi
+        double[:, :] Intensity
+        uint32_t[:, :] Area
+        double row, col, currentphi
         double halfbinwidth
+        int ithread
 
     halfbinwidth= M_PI/N
 
-    phi = np.zeros(N, np.double)
-    Intensity = np.zeros(N, np.double)
-    Area = np.zeros(N, np.uint32)
+    nthreads = _resolventhreads(nthreads)
+    phi = np.zeros((nthreads, N), np.double)
+    Intensity = np.zeros((nthreads, N), np.double)
+    Area = np.zeros((nthreads, N), np.uint32)
 
-    for i in range(data.shape[0]):
-        for j in range(data.shape[1]):
-            if mask[i,j] ==0:
-                continue
-            if not isfinite(data[i,j]):
-                continue
-            row = i-center_row
-            col = j-center_col
-            currentphi = atan2(-row, col)  # -pi <= currentphi <= pi
-            if currentphi < - halfbinwidth:
-                currentphi += 2* M_PI
-            # now (-binwidth/2 <= currentphi < 2*M_PI-binwidth/2
-            ibin = <Py_ssize_t>((currentphi + halfbinwidth)/(2*M_PI) * N)
-            if ibin > N-1:
-                continue
-            phi[ibin] += currentphi
-            Intensity[ibin] += data[i,j]
-            Area[ibin] += 1
+    with nogil, parallel(num_threads=nthreads):
+        ithread = threadid()
+        for i in prange(data.shape[0], schedule='static'):
+            for j in range(data.shape[1]):
+                if mask[i,j] ==0:
+                    continue
+                if not isfinite(data[i,j]):
+                    continue
+                row = i-center_row
+                col = j-center_col
+                currentphi = atan2(-row, col)  # -pi <= currentphi <= pi
+                if currentphi < - halfbinwidth:
+                    currentphi = currentphi + 2* M_PI
+                # now (-binwidth/2 <= currentphi < 2*M_PI-binwidth/2
+                ibin = <Py_ssize_t>((currentphi + halfbinwidth)/(2*M_PI) * N)
+                if ibin > N-1:
+                    continue
+                phi[ithread, ibin] += currentphi
+                Intensity[ithread, ibin] += data[i,j]
+                Area[ithread, ibin] += 1
+    _reducethreads(phi)
+    _reducethreads(Intensity)
+    _reducethreads_uint32(Area)
     for ibin in range(N):
-        if Area[ibin] == 0:
-            phi[ibin] = NAN
-            Intensity[ibin] = NAN
+        if Area[0, ibin] == 0:
+            phi[0, ibin] = NAN
+            Intensity[0, ibin] = NAN
         else:
-            phi[ibin] /= Area[ibin]
-            Intensity[ibin] /= Area[ibin]
-    return np.array(phi), np.array(Intensity), np.array(Area)
+            phi[0, ibin] /= Area[0, ibin]
+            Intensity[0, ibin] /= Area[0, ibin]
+    return np.array(phi[0, :]), np.array(Intensity[0, :]), np.array(Area[0, :])
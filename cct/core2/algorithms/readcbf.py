@@ -1,34 +1,223 @@
+import base64
+import collections
+import concurrent.futures
+import hashlib
+import os
+from typing import Union, Tuple, Type, Optional, Iterable, Iterator, Sequence, List
+
 import numpy as np
 
-from .cbfdecompress import cbfdecompress
+from .cbfdecompress import cbfdecompress, cbfcompress
 
+BINARYSECTIONSTART = b'--CIF-BINARY-FORMAT-SECTION--'
+BINARYDATASTART = b'\x0c\x1a\x04\xd5'
+BINARYSECTIONEND = b'--CIF-BINARY-FORMAT-SECTION----'
+HEADERCONTENTS = b'_array_data.header_contents'
+PADDING = 4095
 
-def readcbf(filename: str) -> np.ndarray:
-    with open(filename, 'rb') as f:
-        dim1 = None
-        dim2 = None
-        while f.readline().strip() != b'--CIF-BINARY-FORMAT-SECTION--':
-            pass
-        while line := f.readline().strip():
-            if line.startswith(b'conversions=') and (line != b"conversions=\"x-CBF_BYTE_OFFSET\""):
-                raise RuntimeError('Unsupported CBF compression')
-            if line.startswith(b'Content-Transfer-Encoding:') and (line != b"Content-Transfer-Encoding: BINARY"):
-                raise RuntimeError('Unsupported content transfer encoding')
-            if line.startswith(b'X-Binary-Element-Type:') and (
-                    line != b"X-Binary-Element-Type: \"signed 32-bit integer\""):
-                raise RuntimeError('Unsupported binary element type')
-            if line.startswith(b'X-Binary-Element-Byte-Order:') and (
-                    line != b"X-Binary-Element-Byte-Order: LITTLE_ENDIAN"):
-                raise RuntimeError('Unsupported binary element byte order')
-            if line.startswith(b'X-Binary-Size-Fastest-Dimension:'):
-                dim1 = int(line.split()[-1])
-            elif line.startswith(b'X-Binary-Size-Second-Dimension:'):
-                dim2 = int(line.split()[-1])
+
+def parsecbfheader(buffer: bytes) -> Tuple[int, int, int]:
+    """Parse the MIME header of the binary section of a CBF file
+
+    Returns the fastest and the second image dimension and the offset of the compressed binary data in the buffer.
+    """
+    sectionstart = buffer.find(BINARYSECTIONSTART)
+    if sectionstart < 0:
+        raise RuntimeError('Binary section not found in file.')
+    datastart = buffer.find(BINARYDATASTART, sectionstart)
+    if datastart < 0:
+        raise RuntimeError('Binary data not found in file.')
+    dim1 = None
+    dim2 = None
+    for line in buffer[sectionstart + len(BINARYSECTIONSTART):datastart].splitlines()[1:]:
+        line = line.strip()
+        if not line:
+            break
+        if line.startswith(b'conversions=') and (line != b"conversions=\"x-CBF_BYTE_OFFSET\""):
+            raise RuntimeError('Unsupported CBF compression')
+        if line.startswith(b'Content-Transfer-Encoding:') and (line != b"Content-Transfer-Encoding: BINARY"):
+            raise RuntimeError('Unsupported content transfer encoding')
+        if line.startswith(b'X-Binary-Element-Type:') and (
+                line != b"X-Binary-Element-Type: \"signed 32-bit integer\""):
+            raise RuntimeError('Unsupported binary element type')
+        if line.startswith(b'X-Binary-Element-Byte-Order:') and (
+                line != b"X-Binary-Element-Byte-Order: LITTLE_ENDIAN"):
+            raise RuntimeError('Unsupported binary element byte order')
+        if line.startswith(b'X-Binary-Size-Fastest-Dimension:'):
+            dim1 = int(line.split()[-1])
+        elif line.startswith(b'X-Binary-Size-Second-Dimension:'):
+            dim2 = int(line.split()[-1])
     if dim1 is None or dim2 is None:
         raise RuntimeError('Image dimensions not found in file.')
+    return dim1, dim2, datastart + len(BINARYDATASTART)
+
+
+def decodecbf(buffer: bytes, output: Optional[np.ndarray] = None,
+              dtype: Type = np.double) -> np.ndarray:
+    """Decompress a CBF image from an in-memory buffer (e.g. the contents of a file)
+
+    If `output` is given, it must be a C-contiguous two-dimensional array of dtype double or int32 having the image
+    shape. Otherwise a new array of `dtype` is allocated.
+    """
+    dim1, dim2, offset = parsecbfheader(buffer)
+    if output is None:
+        output = np.empty((dim2, dim1), order='C', dtype=dtype)
+    elif output.shape != (dim2, dim1):
+        raise ValueError(f'Shape mismatch: image is {(dim2, dim1)}, output array is {output.shape}')
+    elif not output.flags.c_contiguous:
+        raise ValueError('Output array must be C-contiguous')
+    cbfdecompress(np.frombuffer(buffer, np.uint8, offset=offset), output.reshape(-1))
+    return output
+
+
+def _readfile(filename: str) -> bytes:
+    """Read a whole file in one go
+
+    The size of the file is known in advance, thus the contents are read into a single buffer with a single system
+    call (for local files). Memory maps are not used: if a mapped file is truncated or rewritten, e.g. while the
+    detector is writing the next image or on a network file system, accessing the map kills the process with SIGBUS.
+    """
+    with open(filename, 'rb', buffering=0) as f:
+        return f.read()
+
+
+def readcbf(filename: str, dtype: Type = np.double) -> np.ndarray:
+    """Load a CBF image
+
+    The file is read in one go, then decompressed without holding the GIL. `dtype` is either `np.double` or
+    `np.int32` (the latter is the native type of the detector counts).
+    """
+    return decodecbf(_readfile(filename), dtype=dtype)
+
+
+def cbfheadercontents(filename: str) -> str:
+    """Get the free-text header (`_array_data.header_contents`) of a CBF file, e.g. the Pilatus header
+
+    Only the beginning of the file, up to the binary section, is read.
+    """
+    buffer = b''
     with open(filename, 'rb') as f:
-        data = f.read()
-        data = np.frombuffer(data[data.find(b'\x0c\x1a\x04\xd5') + 4:], np.uint8)
-        output = np.empty(dim1 * dim2, order='C', dtype=np.double)
-        cbfdecompress(data, output)
-    return output.reshape(dim2, dim1)
+        while (end := buffer.find(BINARYSECTIONSTART)) < 0:
+            chunk = f.read(4096)
+            if not chunk:
+                break
+            buffer += chunk
+    start = buffer.find(HEADERCONTENTS, 0, end if end >= 0 else len(buffer))
+    if start < 0:
+        return ''
+    # the text field is delimited by lines consisting of a single semicolon
+    lines = buffer[start + len(HEADERCONTENTS):end].decode('ascii', errors='replace').splitlines()
+    textlines = []
+    intext = False
+    for line in lines:
+        if line.startswith(';'):
+            if intext:
+                break
+            intext = True
+        elif intext:
+            textlines.append(line)
+    return '\n'.join(textlines)
+
+
+def encodecbf(data: np.ndarray, headercontents: str = '', name: str = 'image') -> bytes:
+    """Make a byte-offset compressed CBF file from a two-dimensional array of integer counts
+
+    `headercontents` is written in the `_array_data.header_contents` field (see `cbfheadercontents()`). The
+    array must be of integer type or contain only integral values representable on 32 bits (e.g. raw images loaded as
+    double by `readcbf()`).
+    """
+    if data.ndim != 2:
+        raise ValueError('Only two-dimensional images are supported.')
+    counts = np.ascontiguousarray(data, dtype=np.int32)
+    if not np.array_equal(counts, data):
+        raise ValueError('The data cannot be represented as 32-bit signed integers.')
+    compressed = cbfcompress(counts.reshape(-1))
+    lines = [b'###CBF: VERSION 1.5, CBFlib v0.7.8', b'', b'data_' + name.encode('ascii'), b'']
+    if headercontents:
+        lines += [b'_array_data.header_convention "PILATUS_1.2"', HEADERCONTENTS, b';'] + \
+                 [line.encode('ascii') for line in headercontents.splitlines()] + [b';', b'']
+    lines += [
+        b'_array_data.data', b';', BINARYSECTIONSTART,
+        b'Content-Type: application/octet-stream;',
+        b'     conversions="x-CBF_BYTE_OFFSET"',
+        b'Content-Transfer-Encoding: BINARY',
+        b'X-Binary-Size: %d' % len(compressed),
+        b'X-Binary-ID: 1',
+        b'X-Binary-Element-Type: "signed 32-bit integer"',
+        b'X-Binary-Element-Byte-Order: LITTLE_ENDIAN',
+        b'Content-MD5: ' + base64.b64encode(hashlib.md5(compressed).digest()),
+        b'X-Binary-Number-of-Elements: %d' % counts.size,
+        b'X-Binary-Size-Fastest-Dimension: %d' % counts.shape[1],
+        b'X-Binary-Size-Second-Dimension: %d' % counts.shape[0],
+        b'X-Binary-Size-Padding: %d' % PADDING,
+        b'', BINARYDATASTART]
+    return b'\r\n'.join(lines) + compressed.tobytes() + b'\x00' * PADDING + \
+           b'\r\n' + BINARYSECTIONEND + b'\r\n;\r\n\r\n'
+
+
+def writecbf(filename: str, data: np.ndarray, headercontents: str = ''):
+    """Write a byte-offset compressed CBF file, readable by `readcbf()`. See `encodecbf()` for the arguments."""
+    encoded = encodecbf(data, headercontents, os.path.splitext(os.path.basename(filename))[0])
+    with open(filename, 'wb') as f:
+        f.write(encoded)
+
+
+def _readintoslot(candidates: Sequence[str], buffers: List[Optional[np.ndarray]], slot: int) -> Tuple[str, np.ndarray]:
+    """Load the first existing file of `candidates` into the int32 buffer `buffers[slot]`, which is (re)allocated if
+    it does not have the image shape."""
+    for filename in candidates:
+        try:
+            buffer = _readfile(filename)
+            dim1, dim2, offset = parsecbfheader(buffer)
+            if (buffers[slot] is None) or (buffers[slot].shape != (dim2, dim1)):
+                buffers[slot] = np.empty((dim2, dim1), dtype=np.int32)
+            return filename, decodecbf(buffer, buffers[slot])
+        except FileNotFoundError:
+            continue
+    raise FileNotFoundError(candidates[0] if candidates else '')
+
+
+def readcbf_bulk(candidates: Iterable[Union[str, Sequence[str]]], nworkers: int = 0, prefetch: int = 0,
+                 dtype: Type = np.double) -> Iterator[Tuple[Optional[str], Union[np.ndarray, Exception]]]:
+    """Load many CBF images in parallel, yielding them in the input order
+
+    Each element of `candidates` is a file name or a sequence of alternative file names, of which the first existing
+    one is loaded. For each element, a tuple of the file name and the image is yielded. If the element could not be
+    loaded, None and the exception (FileNotFoundError if none of the alternatives exist) are yielded instead.
+
+    Reading and decompression is done by `nworkers` threads (nonpositive: all CPUs). At most `prefetch` images
+    (default: twice the number of workers) are read ahead, each into its own preallocated int32 frame, which is
+    reused for later images. The memory usage is therefore bounded, however many files are loaded. The yielded images
+    are copies of these frames, converted to `dtype`.
+    """
+    if nworkers <= 0:
+        nworkers = os.cpu_count() or 1
+    if prefetch <= 0:
+        prefetch = 2 * nworkers
+    buffers: List[Optional[np.ndarray]] = [None] * prefetch
+    freeslots = collections.deque(range(prefetch))
+    pending = collections.deque()  # (future, slot) in the input order
+    candidates = iter(candidates)
+    exhausted = False
+    with concurrent.futures.ThreadPoolExecutor(nworkers) as executor:
+        while True:
+            while freeslots and not exhausted:
+                try:
+                    alternatives = next(candidates)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if isinstance(alternatives, (str, os.PathLike)):
+                    alternatives = [alternatives]
+                slot = freeslots.popleft()
+                pending.append((executor.submit(_readintoslot, list(alternatives), buffers, slot), slot))
+            if not pending:
+                break
+            future, slot = pending.popleft()
+            try:
+                filename, frame = future.result()
+                result = filename, frame.astype(dtype, copy=True)
+            except Exception as exc:
+                result = None, exc
+            freeslots.append(slot)
+            yield result
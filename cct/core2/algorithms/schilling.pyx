@@ -8,11 +8,14 @@
 
 See: M. F. Schilling: The Longest Run of Heads. Coll. Math. J 21(3) p196-207 (1990)
 """
+import collections
+
 import cython
 import numpy as np
 cimport numpy as np
 from libc.float cimport DBL_MAX_EXP
 from libc.stdlib cimport calloc, free
+from libc.string cimport memset
 np.import_array()
 
 cdef Py_ssize_t A_(Py_ssize_t n, Py_ssize_t x):
@@ -94,31 +97,116 @@ def pmatrix(Py_ssize_t N):
             result[n, x] = val
     return result
 
+
+# p-value tables of the cormap test, keyed by the sequence length n, the least recently used first. See
+# `cormap_pval_table()`.
+_pvaltables = collections.OrderedDict()
+_pvaltablesmaxsize = 32
+
+
 @cython.cdivision
+cdef double _cormap_pval(Py_ssize_t n, Py_ssize_t x, double *P) noexcept nogil:
+    """The p-value of the cormap test for 1 < x <= min(n, DBL_MAX_EXP). P is a scratch buffer of at least x
+    elements."""
+    cdef double half_pow_x = 2.0 ** (-x)
+    cdef Py_ssize_t i_x = 0, i = 0, im1_x = 0
+    memset(P, 0, x * sizeof(double))
+    P[0] = 2 * half_pow_x
+    for i in range(x + 1, n + 1):
+        im1_x = i_x
+        i_x = i % x
+        P[i_x] = P[im1_x] + half_pow_x * (1 - P[i_x])
+    return P[i_x]
+
+
+def cormap_pval_table(Py_ssize_t n):
+    """The p-values of the cormap test for all possible longest run lengths in a sequence of length n
+
+    The element x of the resulting array is the probability that the longest run of consecutive heads or tails
+    is not shorter than x, for 0 <= x <= max(n, 1) + 1. The tables of the last few sequence lengths are memoized:
+    further calls with the same n return the same (read-only) array.
+    """
+    cdef double *P = NULL
+    cdef double[:] table
+    cdef Py_ssize_t x
+    if n < 0:
+        raise ValueError('Sequence length must not be negative')
+    result = _cachedpvaltable(n)
+    if result is not None:
+        return result
+    result = np.zeros(max(n, 1) + 2, np.double)  # p = 0 for x > n and for x > DBL_MAX_EXP
+    table = result
+    table[0] = table[1] = 1.0
+    P = <double *> calloc(<size_t> DBL_MAX_EXP, sizeof(double))
+    if P == NULL:
+        raise MemoryError()
+    try:
+        with nogil:
+            for x in range(2, min(n, <Py_ssize_t> DBL_MAX_EXP) + 1):
+                table[x] = _cormap_pval(n, x, P)
+    finally:
+        free(P)
+    result.setflags(write=False)
+    _pvaltables[n] = result
+    while len(_pvaltables) > _pvaltablesmaxsize:
+        try:
+            _pvaltables.popitem(last=False)
+        except KeyError:  # emptied by another thread in the meantime
+            break
+    return result
+
+
+def _cachedpvaltable(Py_ssize_t n):
+    """Get the memoized p-value table for the sequence length n and mark it as the most recently used one, or None if
+    it is not (or no longer) available."""
+    try:
+        table = _pvaltables[n]
+        _pvaltables.move_to_end(n)
+    except KeyError:  # not calculated yet, or evicted (possibly by another thread)
+        return None
+    return table
+
+
 def cormap_pval(Py_ssize_t n, Py_ssize_t x):
     """Calculate the p-value for the cormap test, i.e. the probability that the
     longest run of consecutive heads or tails is not shorter than x.
+
+    If the table for n is memoized, the value is taken from there, otherwise only this single value is calculated.
     """
-    cdef double half_pow_x = 2.0 ** (-x)
     cdef double *P = NULL
-    cdef double result
-    cdef Py_ssize_t i_x = 0, i = 0, im1_x = 0
+    cdef double pval
     if x <= 1:
         return 1.0
-    elif x > n:
-        return 0.0
-    elif x > DBL_MAX_EXP:
+    elif (x > n) or (x > DBL_MAX_EXP):
         return 0.0
-    else:
-        P = <double *> calloc(<size_t> DBL_MAX_EXP, sizeof(double))
-        P[0] = 2 * half_pow_x
-        for i in range(x + 1, n + 1):
-            im1_x = i_x
-            i_x = i % x
-            P[i_x] = P[im1_x] + half_pow_x * (1 - P[i_x])
-        result = P[i_x]
+    table = _cachedpvaltable(n)
+    if table is not None:
+        return float(table[x])
+    P = <double *> calloc(<size_t> x, sizeof(double))
+    if P == NULL:
+        raise MemoryError()
+    try:
+        with nogil:
+            pval = _cormap_pval(n, x, P)
+    finally:
         free(P)
-        return result
+    return pval
+
+
+def cormap_pvals(Py_ssize_t n, x):
+    """Vectorized version of `cormap_pval()`: calculate the p-values of the cormap test for an array of longest run
+    lengths, all in sequences of length n.
+
+    :param n: the length of the sequences
+    :type n: int
+    :param x: the longest run lengths
+    :type x: np.ndarray of integers, any shape
+    :return: the p-values
+    :rtype: np.ndarray of the same shape as x, double dtype
+    """
+    table = cormap_pval_table(n)
+    return table[np.clip(np.asarray(x, dtype=np.intp), 0, table.size - 1)]
+
 
 def longest_edge(np.ndarray[np.double_t, ndim=2] cormap):
     """Calculate the longest edge length in a correlation map.
@@ -0,0 +1,398 @@
+"""Radial and azimuthal averaging as sparse matrix products, with pixel splitting
+
+Each valid pixel is distributed among the bins its footprint overlaps with: the range of q (or azimuth angle)
+spanned by the corners of the pixel is assumed to be uniformly covered, and the pixel is assigned to each bin with
+a weight equal to the covered fraction. The weights make up a sparse (Nbins x Npixels) matrix, thus averaging a
+scattering pattern is a sparse matrix-vector product, and averaging a stack of patterns is a sparse matrix-matrix
+product.
+
+Compared to the Cython routines in `radavg`, this gives smoother curves when the bins are narrower than a pixel,
+and it is faster for stacks of frames. Bin areas are not integers but sums of weights.
+
+The matrix products can run in several threads: the rows (bins) of the sparse matrices are split into blocks of
+similar numbers of nonzero elements, and the blocks are multiplied in parallel. Each bin is calculated in the same
+way as in a single thread, the results are therefore the same for any number of threads.
+"""
+import concurrent.futures
+import logging
+import operator
+from typing import Tuple, Optional, List, Callable
+
+import numpy as np
+import scipy.sparse
+
+from .integrationplan import RadialAveragingPlanCache
+from .radavg import getnthreads
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+ValueAndUncertaintyType = Tuple[float, float]
+MatMulType = Callable[[scipy.sparse.csr_matrix, np.ndarray], np.ndarray]
+
+
+def _pixelcoordinates(mask: np.ndarray, beamposrow: ValueAndUncertaintyType, beamposcol: ValueAndUncertaintyType
+                      ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Flat indices and coordinates relative to the beam center of the valid pixels"""
+    pixelindex = np.flatnonzero(mask)
+    row = pixelindex // mask.shape[1] - beamposrow[0]
+    col = pixelindex % mask.shape[1] - beamposcol[0]
+    return pixelindex, row, col
+
+
+def _pixelq(row: np.ndarray, col: np.ndarray, wavelength: ValueAndUncertaintyType,
+            distance: ValueAndUncertaintyType, pixelsize: ValueAndUncertaintyType,
+            beamposrow: ValueAndUncertaintyType, beamposcol: ValueAndUncertaintyType
+            ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """q, its squared uncertainty and the radius in pixels: the same as in `radavg()`"""
+    qfac = 4 * np.pi / wavelength[0]
+    qfac_unc2 = 16 * np.pi ** 2 * wavelength[1] ** 2 / wavelength[0] ** 4
+    row_unc2 = 0.25 + beamposrow[1] ** 2
+    col_unc2 = 0.25 + beamposcol[1] ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pixelradius2 = row ** 2 + col ** 2
+        pixelradius_unc2 = (row_unc2 * row ** 2 + col_unc2 * col ** 2) / pixelradius2
+        tgtwotheta2 = pixelradius2 * pixelsize[0] ** 2 / distance[0] ** 2
+        tgtwotheta_unc2 = tgtwotheta2 * (pixelradius_unc2 / pixelradius2 + distance[1] ** 2 / distance[0] ** 2 +
+                                         pixelsize[1] ** 2 / pixelsize[0] ** 2)
+        sinth = (0.5 * (1 - 1 / (tgtwotheta2 + 1) ** 0.5)) ** 0.5
+        sinth_unc2 = 1 / 16. * tgtwotheta2 / (tgtwotheta2 + 1) ** 3 / (1 - 1 / (tgtwotheta2 + 1) ** 0.5) * \
+                     tgtwotheta_unc2 ** 2
+        q = qfac * sinth
+        q_unc2 = q ** 2 * (qfac_unc2 / qfac ** 2 + sinth_unc2 / sinth ** 2)
+    return q, q_unc2, pixelradius2 ** 0.5
+
+
+def _radiustoq(radius: np.ndarray, wavelength: float, distance: float, pixelsize: float) -> np.ndarray:
+    return 4 * np.pi / wavelength * np.sin(0.5 * np.arctan(radius * pixelsize / distance))
+
+
+def _splitpixels(lo: np.ndarray, hi: np.ndarray, edges: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Distribute the intervals [lo, hi] among the bins [edges[k], edges[k+1]) according to their overlap.
+
+    Returns the bin indices, the interval indices and the weights of the nonzero overlaps.
+    """
+    nbins = len(edges) - 1
+    width = hi - lo
+    klo = np.clip(np.searchsorted(edges, lo, side='right') - 1, 0, None)
+    khi = np.clip(np.searchsorted(edges, hi, side='left') - 1, None, nbins - 1)
+    # zero-width intervals (pixels on the beam center at both ends) fall into a single bin
+    khi = np.where(width > 0, khi, klo)
+    count = np.clip(khi - klo + 1, 0, None)
+    interval = np.repeat(np.arange(len(lo)), count)
+    offset = np.cumsum(count) - count
+    binindex = klo[interval] + (np.arange(len(interval)) - offset[interval])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weight = np.where(
+            width[interval] > 0,
+            (np.minimum(hi[interval], edges[binindex + 1]) - np.maximum(lo[interval], edges[binindex])) /
+            width[interval],
+            1.0)
+    valid = weight > 0
+    return binindex[valid], interval[valid], weight[valid]
+
+
+def _rowblocks(matrix: scipy.sparse.csr_matrix, nblocks: int) -> List[scipy.sparse.csr_matrix]:
+    """Split a sparse matrix into at most `nblocks` blocks of consecutive rows with similar numbers of nonzero
+    elements. The blocks share the data of the original matrix."""
+    bounds = np.unique(np.hstack([0, np.searchsorted(matrix.indptr, np.linspace(0, matrix.nnz, nblocks + 1)[1:-1]),
+                                  matrix.shape[0]]).clip(0, matrix.shape[0]))
+    blocks = []
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        start, end = matrix.indptr[first], matrix.indptr[last]
+        blocks.append(scipy.sparse.csr_matrix(
+            (matrix.data[start:end], matrix.indices[start:end], matrix.indptr[first:last + 1] - start),
+            shape=(last - first, matrix.shape[1])))
+    return blocks
+
+
+class _MatrixProduct:
+    """Products of sparse and dense matrices, with the row blocks of the sparse matrix multiplied in several threads.
+
+    Nonpositive `nthreads` means the default number of threads of the averaging routines (see
+    `radavg.setnthreads()`). Use it as a context manager to shut down the threads.
+    """
+    nthreads: int
+    executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+    def __init__(self, nthreads: int = 1):
+        self.nthreads = nthreads if nthreads > 0 else getnthreads()
+        if self.nthreads > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.nthreads)
+
+    def __call__(self, matrix: scipy.sparse.csr_matrix, dense: np.ndarray) -> np.ndarray:
+        if (self.executor is None) or (matrix.shape[0] < 2):
+            return matrix @ dense
+        return np.concatenate(
+            list(self.executor.map(lambda block: block @ dense, _rowblocks(matrix, self.nthreads))), axis=0)
+
+    def __enter__(self) -> "_MatrixProduct":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def _normalize(errorprop: int, area: np.ndarray, sumvalue: np.ndarray, sumvalue2: Optional[np.ndarray],
+               sumerror: np.ndarray, sumweights: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """Bin averages and their uncertainties from the weighted sums, with the error propagation types of `radavg()`
+
+    The meaning of `sumerror` and `sumweights` depends on `errorprop`:
+        0: `sumvalue` is the sum of w*x/sigma^2, `sumweights` is the sum of w/sigma^2
+        1: `sumerror` is the sum of w*sigma
+        2: `sumerror` is the sum of w^2*sigma^2
+        3: `sumerror` is the sum of w*sigma^2, `sumvalue2` is the sum of w*x^2
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if errorprop == 0:
+            mean = sumvalue / sumweights
+            error = 1 / sumweights ** 0.5
+        else:
+            mean = sumvalue / area
+            if errorprop == 1:
+                error = sumerror / area
+            elif errorprop == 2:
+                error = sumerror ** 0.5 / area
+            else:
+                error_propagated = (sumerror / area) ** 0.5
+                error_statistics = np.where(
+                    area < 2, 0.0, np.clip((sumvalue2 - sumvalue ** 2 / area) / (area - 1), 0, None) ** 0.5)
+                error = np.maximum(error_propagated, error_statistics)
+    mean[area <= 0] = np.nan
+    error[area <= 0] = np.nan
+    return mean, error
+
+
+def _averageframes(weights: scipy.sparse.csr_matrix, weights2: scipy.sparse.csr_matrix, value: np.ndarray,
+                   uncertainty: np.ndarray, valid: Optional[np.ndarray], area: np.ndarray, errorprop: int,
+                   matmul: MatMulType = operator.matmul) -> Tuple[np.ndarray, np.ndarray]:
+    """Weighted bin averages of (Npixels, Nframes) matrices. Only elements where `valid` is True are taken into
+    account, `None` means all of them."""
+    if valid is not None:
+        value = np.where(valid, value, 0.0)
+        uncertainty = np.where(valid, uncertainty, np.inf if errorprop == 0 else 0.0)
+    if errorprop == 0:
+        inversevariance = 1 / uncertainty ** 2
+        return _normalize(errorprop, area, matmul(weights, value * inversevariance), None, None,
+                          matmul(weights, inversevariance))
+    return _normalize(errorprop, area, matmul(weights, value),
+                      matmul(weights, value ** 2) if errorprop == 3 else None,
+                      matmul(weights2 if errorprop == 2 else weights,
+                             uncertainty if errorprop == 1 else uncertainty ** 2),
+                      None)
+
+
+def _validity(valid: Optional[np.ndarray], npixels: int) -> np.ndarray:
+    """The validity matrix as floats. If all elements are valid, a single column is enough."""
+    return np.ones((npixels, 1), dtype=np.double) if valid is None else valid.astype(np.double)
+
+
+def _weightedsum(matrix: scipy.sparse.csr_matrix, vector: np.ndarray, valid: np.ndarray,
+                 matmul: MatMulType = operator.matmul) -> np.ndarray:
+    """Multiply the columns of the sparse matrix by a per-pixel quantity, then by the (Npixels, Nframes) validity
+    matrix. This is cheaper than scaling the dense validity matrix."""
+    return matmul(matrix.multiply(vector[np.newaxis, :]).tocsr(), valid)
+
+
+def _averagepixels(weights: scipy.sparse.csr_matrix, weights2: scipy.sparse.csr_matrix, value: np.ndarray,
+                   uncertainty2: np.ndarray, valid: np.ndarray, area: np.ndarray, errorprop: int,
+                   matmul: MatMulType = operator.matmul) -> Tuple[np.ndarray, np.ndarray]:
+    """Weighted bin averages of per-pixel quantities (e.g. q), taking only the `valid` elements of each frame into
+    account. `value` and `uncertainty2` (squared uncertainty) are vectors of length Npixels, `valid` is a
+    (Npixels, Nframes) matrix of zeros and ones."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if errorprop == 0:
+            return _normalize(errorprop, area, _weightedsum(weights, value / uncertainty2, valid, matmul), None, None,
+                              _weightedsum(weights, 1 / uncertainty2, valid, matmul))
+        return _normalize(errorprop, area, _weightedsum(weights, value, valid, matmul),
+                          _weightedsum(weights, value ** 2, valid, matmul) if errorprop == 3 else None,
+                          _weightedsum(weights2 if errorprop == 2 else weights,
+                                       uncertainty2 ** 0.5 if errorprop == 1 else uncertainty2, valid, matmul),
+                          None)
+
+
+def _gather(intensity: np.ndarray, uncertainty: np.ndarray, shape: Tuple[int, int], pixelindex: np.ndarray
+            ) -> Tuple[np.ndarray, np.ndarray, Optional[np.ndarray]]:
+    """Collect the pixels in `pixelindex` from a scattering pattern or a stack of them (frame index last).
+
+    Returns two (Npixels, Nframes) matrices and the validity matrix (finite values and uncertainties). The latter
+    is None if all elements are valid.
+    """
+    if (intensity.shape[:2] != shape) or (uncertainty.shape != intensity.shape) or (intensity.ndim not in [2, 3]):
+        raise ValueError('Shape mismatch')
+    nframes = 1 if intensity.ndim == 2 else intensity.shape[2]
+
+    def gather(matrix: np.ndarray) -> np.ndarray:
+        matrix = matrix.reshape(shape + (nframes,))
+        if matrix.flags.c_contiguous:
+            # pixel-major layout: the rows of the (Npixels, Nframes) matrix are contiguous
+            return np.asarray(matrix.reshape(-1, nframes)[pixelindex], dtype=np.double)
+        # frame-major layout (e.g. a transposed stack of contiguous frames): gather in each frame, then transpose
+        return np.ascontiguousarray(np.moveaxis(matrix, 2, 0).reshape(nframes, -1)[:, pixelindex].T, dtype=np.double)
+
+    intensity = gather(intensity)
+    uncertainty = gather(uncertainty)
+    valid = np.isfinite(intensity) & np.isfinite(uncertainty)
+    return intensity, uncertainty, (None if valid.all() else valid)
+
+
+class SparseRadialAveragingPlan:
+    """Radial averaging with pixel splitting, as a sparse matrix product.
+
+    The interface is the same as that of `RadialAveragingPlan`. The q-bins are the same as in `radavg()`: the edges
+    are halfway between neighbouring bin centers, the first and the last bin centers are the outer edges.
+    """
+    shape: Tuple[int, int]
+    qbincenters: np.ndarray
+    pixelindex: np.ndarray  # flat indices of the pixels contributing to at least one bin
+    weights: scipy.sparse.csr_matrix  # (Nbins, len(pixelindex))
+    weights2: scipy.sparse.csr_matrix  # squared weights
+    pixelq: np.ndarray
+    pixelq_unc2: np.ndarray
+    pixelradius: np.ndarray
+
+    def __init__(self, mask: np.ndarray, wavelength: ValueAndUncertaintyType, distance: ValueAndUncertaintyType,
+                 pixelsize: ValueAndUncertaintyType, beamposrow: ValueAndUncertaintyType,
+                 beamposcol: ValueAndUncertaintyType, qbincenters: np.ndarray):
+        self.shape = mask.shape
+        self.qbincenters = np.array(qbincenters, dtype=np.double)
+        pixelindex, row, col = _pixelcoordinates(mask, beamposrow, beamposcol)
+        # the radial extent of a pixel is determined by its corners, or the beam center if it is inside
+        cornerradius = np.stack([((row + drow) ** 2 + (col + dcol) ** 2) ** 0.5
+                                 for drow in [-0.5, 0.5] for dcol in [-0.5, 0.5]])
+        rmin = np.where((np.abs(row) <= 0.5) & (np.abs(col) <= 0.5), 0.0, cornerradius.min(axis=0))
+        rmax = cornerradius.max(axis=0)
+        edges = np.hstack([self.qbincenters[:1], 0.5 * (self.qbincenters[1:] + self.qbincenters[:-1]),
+                           self.qbincenters[-1:]])
+        binindex, interval, weight = _splitpixels(
+            _radiustoq(rmin, wavelength[0], distance[0], pixelsize[0]),
+            _radiustoq(rmax, wavelength[0], distance[0], pixelsize[0]), edges)
+        used, column = np.unique(interval, return_inverse=True)
+        self.pixelindex = pixelindex[used]
+        self.pixelq, self.pixelq_unc2, self.pixelradius = _pixelq(
+            row[used], col[used], wavelength, distance, pixelsize, beamposrow, beamposcol)
+        self.weights = scipy.sparse.csr_matrix(
+            (weight, (binindex, column)), shape=(len(self.qbincenters), len(self.pixelindex)))
+        self.weights2 = self.weights.multiply(self.weights).tocsr()
+
+    def _radavg(self, intensity: np.ndarray, uncertainty: np.ndarray, errorprop: int, qerrorprop: int, nthreads: int
+                ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        intensity, uncertainty, valid = _gather(intensity, uncertainty, self.shape, self.pixelindex)
+        validity = _validity(valid, len(self.pixelindex))
+        with _MatrixProduct(nthreads) as matmul:
+            area = matmul(self.weights, validity)
+            # the per-pixel quantities depend on the frame only through the validity: a single column if all are
+            # valid
+            q, dq = _averagepixels(self.weights, self.weights2, self.pixelq, self.pixelq_unc2, validity, area,
+                                   qerrorprop, matmul)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                pixel = _weightedsum(self.weights, self.pixelradius, validity, matmul) / area
+            pixel[area <= 0] = np.nan
+            q, dq, area, pixel = [np.broadcast_to(x, (x.shape[0], intensity.shape[1])) for x in [q, dq, area, pixel]]
+            i, di = _averageframes(self.weights, self.weights2, intensity, uncertainty, valid, area, errorprop,
+                                   matmul)
+        return q, i, di, dq, area, pixel
+
+    def radavg(self, intensity: np.ndarray, uncertainty: np.ndarray, errorprop: int = 3, qerrorprop: int = 3,
+               nthreads: int = 0) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Radial averaging of a scattering pattern. The return value is the same as that of `radavg()`, except
+        that the bin areas are not integers. Nonpositive `nthreads` means the default of `radavg.setnthreads()`."""
+        if intensity.ndim != 2:
+            raise ValueError('Shape mismatch')
+        return tuple(np.array(x[:, 0]) for x in self._radavg(intensity, uncertainty, errorprop, qerrorprop, nthreads))
+
+    def radavg_stack(self, intensity: np.ndarray, uncertainty: np.ndarray, errorprop: int = 3, qerrorprop: int = 3,
+                     nthreads: int = 0) -> np.ndarray:
+        """Radial averaging of a stack of scattering patterns (the last index is the frame index).
+
+        Returns an array of shape (Nq, 6, Nframes), each [:, :, i] slice is like `Curve.asArray()`
+        """
+        if intensity.ndim != 3:
+            raise ValueError('Shape mismatch')
+        return np.stack(self._radavg(intensity, uncertainty, errorprop, qerrorprop, nthreads), axis=1)
+
+
+class SparseAzimuthalAveragingPlan:
+    """Azimuthal averaging with pixel splitting, as a sparse matrix product.
+
+    The azimuthal bins are the same as in `azimavg()`: `phibincenters` must be equidistant from 0 to 2*pi, the first
+    bin being centered on 0. The q range can be limited by the mask, e.g. using `maskforannulus()`.
+    """
+    shape: Tuple[int, int]
+    phibincenters: np.ndarray
+    pixelindex: np.ndarray  # flat indices of the pixels contributing to at least one bin
+    weights: scipy.sparse.csr_matrix  # (Nbins, len(pixelindex))
+    weights2: scipy.sparse.csr_matrix  # squared weights
+    phioffset: scipy.sparse.csr_matrix  # weighted azimuth angles of the pixels relative to the bin center
+    phioffset2: scipy.sparse.csr_matrix  # weighted squared azimuth angles of the pixels relative to the bin center
+    pixelq: np.ndarray
+
+    def __init__(self, mask: np.ndarray, wavelength: ValueAndUncertaintyType, distance: ValueAndUncertaintyType,
+                 pixelsize: ValueAndUncertaintyType, beamposrow: ValueAndUncertaintyType,
+                 beamposcol: ValueAndUncertaintyType, phibincenters: np.ndarray):
+        self.shape = mask.shape
+        self.phibincenters = np.array(phibincenters, dtype=np.double)
+        nbins = len(self.phibincenters)
+        binwidth = 2 * np.pi / nbins
+        pixelindex, row, col = _pixelcoordinates(mask, beamposrow, beamposcol)
+        phi = np.arctan2(-row, col)
+        # the azimuthal extent of a pixel is determined by its corners, or it is a full circle if the beam center
+        # is inside it
+        cornerphi = np.stack([np.angle(np.exp(1j * (np.arctan2(-(row + drow), col + dcol) - phi)))
+                              for drow in [-0.5, 0.5] for dcol in [-0.5, 0.5]])
+        beamcenterinside = (np.abs(row) <= 0.5) & (np.abs(col) <= 0.5)
+        philo = np.where(beamcenterinside, -0.5 * binwidth, phi + cornerphi.min(axis=0))
+        phihi = np.where(beamcenterinside, 2 * np.pi - 0.5 * binwidth, phi + cornerphi.max(axis=0))
+        # unwrapped bins from -2*pi to 4*pi, folded back after the splitting
+        edges = (np.arange(-nbins, 2 * nbins + 1) - 0.5) * binwidth
+        binindex, interval, weight = _splitpixels(philo, phihi, edges)
+        offset = np.angle(np.exp(1j * (phi[interval] - (binindex - nbins) * binwidth)))
+        binindex = binindex % nbins
+        used, column = np.unique(interval, return_inverse=True)
+        self.pixelindex = pixelindex[used]
+        self.pixelq = _pixelq(row[used], col[used], wavelength, distance, pixelsize, beamposrow, beamposcol)[0]
+        self.weights = scipy.sparse.csr_matrix((weight, (binindex, column)), shape=(nbins, len(self.pixelindex)))
+        self.weights2 = self.weights.multiply(self.weights).tocsr()
+        self.phioffset = scipy.sparse.csr_matrix(
+            (weight * offset, (binindex, column)), shape=(nbins, len(self.pixelindex)))
+        self.phioffset2 = scipy.sparse.csr_matrix(
+            (weight * offset ** 2, (binindex, column)), shape=(nbins, len(self.pixelindex)))
+
+    def _azimavg(self, intensity: np.ndarray, uncertainty: np.ndarray, errorprop: int, nthreads: int
+                 ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        intensity, uncertainty, valid = _gather(intensity, uncertainty, self.shape, self.pixelindex)
+        validity = _validity(valid, len(self.pixelindex))
+        with _MatrixProduct(nthreads) as matmul:
+            area = matmul(self.weights, validity)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                phioffset = matmul(self.phioffset, validity) / area
+                phi = self.phibincenters[:, np.newaxis] + phioffset
+                dphi = np.clip(matmul(self.phioffset2, validity) / area - phioffset ** 2, 0, None) ** 0.5
+                qmean = _weightedsum(self.weights, self.pixelq, validity, matmul) / area
+                qstd = np.clip(_weightedsum(self.weights, self.pixelq ** 2, validity, matmul) / area - qmean ** 2,
+                               0, None) ** 0.5
+            for x in [phi, dphi, qmean, qstd]:
+                x[area <= 0] = np.nan
+            phi, dphi, area, qmean, qstd = [
+                np.broadcast_to(x, (x.shape[0], intensity.shape[1])) for x in [phi, dphi, area, qmean, qstd]]
+            i, di = _averageframes(self.weights, self.weights2, intensity, uncertainty, valid, area, errorprop,
+                                   matmul)
+        return phi, i, di, dphi, area, qmean, qstd
+
+    def azimavg(self, intensity: np.ndarray, uncertainty: np.ndarray, errorprop: int = 3, phierrorprop: int = 3,
+                nthreads: int = 0
+                ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Azimuthal averaging of a scattering pattern. The return value is the same as that of `azimavg()`.
+
+        The azimuth angle of a bin is the weighted mean of the pixel azimuths, its uncertainty is their weighted
+        standard deviation, independently of `phierrorprop`. Nonpositive `nthreads` means the default of
+        `radavg.setnthreads()`.
+        """
+        if intensity.ndim != 2:
+            raise ValueError('Shape mismatch')
+        return tuple(np.array(x[:, 0]) for x in self._azimavg(intensity, uncertainty, errorprop, nthreads))
+
+
+sparseradavgplancache = RadialAveragingPlanCache(planclass=SparseRadialAveragingPlan)
+sparseazimavgplancache = RadialAveragingPlanCache(planclass=SparseAzimuthalAveragingPlan)
@@ -0,0 +1,91 @@
+"""(q, phi) rebinning: slices of the cake must be the same as radial and azimuthal averages of the selected pixels"""
+import numpy as np
+import pytest
+
+from .test_radavg import GEOMETRY, exposure, qrange, assert_curves_equal
+from ..integrationplan import RadialAveragingPlan
+from ..matrixaverager import ErrorPropagationMethod
+from ..radavg import radavg, azimavg, cakeavg
+from ...dataclasses.cake import Cake
+
+NPHI = 36
+# the averaging kernels support these error propagation types
+ERRORPROPS = [ErrorPropagationMethod.Weighted, ErrorPropagationMethod.Linear, ErrorPropagationMethod.Gaussian,
+              ErrorPropagationMethod.Conservative]
+
+
+def makecake(data, error, mask, qbins, errorprop: ErrorPropagationMethod, qerrorprop: ErrorPropagationMethod) -> Cake:
+    sums = cakeavg(data, error, mask, *[x for pair in GEOMETRY for x in pair], qbins, NPHI, errorprop.value,
+                   qerrorprop.value, nthreads=1)
+    return Cake.fromSums(*sums, qbins, errorprop, qerrorprop)
+
+
+def pixelphibins(shape):
+    """Azimuthal bin index of each pixel, the same way as in `cakeavg()`"""
+    rows, cols = np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij')
+    phi = np.arctan2(-(rows - GEOMETRY[3][0]), cols - GEOMETRY[4][0])
+    phi[phi < -np.pi / NPHI] += 2 * np.pi
+    return ((phi + np.pi / NPHI) / (2 * np.pi) * NPHI).astype(int)
+
+
+def binnedmask(mask, plan: RadialAveragingPlan, qbinselection: np.ndarray) -> np.ndarray:
+    """Mask of the pixels falling into the selected q-bins"""
+    selected = np.zeros_like(mask)
+    pixels = qbinselection[plan.binindex]
+    selected[plan.rowindex[pixels], plan.columnindex[pixels]] = 1
+    return selected
+
+
+@pytest.mark.parametrize('errorprop', ERRORPROPS)
+def test_cake_radial_average(exposure, errorprop):
+    data, error, mask = exposure
+    qbins = qrange(mask, 1, 80)
+    cake = makecake(data, error, mask, qbins, errorprop, errorprop)
+    curve = cake.radial_average()
+    expected = radavg(data, error, mask, *[x for pair in GEOMETRY for x in pair], qbins, errorprop.value,
+                      errorprop.value, nthreads=1)
+    assert_curves_equal((curve.q, curve.intensity, curve.uncertainty, curve.quncertainty, curve.binarea,
+                         curve.pixel), expected, rtol=1e-9)
+
+
+@pytest.mark.parametrize('errorprop', ERRORPROPS)
+def test_cake_radial_slice(exposure, errorprop):
+    data, error, mask = exposure
+    qbins = qrange(mask, 1, 80)
+    cake = makecake(data, error, mask, qbins, errorprop, errorprop)
+    curve = cake.radial_slice(np.pi / 3, np.pi / 8, symmetric=True)
+    phibins = pixelphibins(data.shape)
+    sectormask = mask * np.isin(phibins, np.flatnonzero(cake._phiselection(np.pi / 3, np.pi / 8, True)))
+    expected = radavg(data, error, sectormask.astype(np.uint8), *[x for pair in GEOMETRY for x in pair], qbins,
+                      errorprop.value, errorprop.value, nthreads=1)
+    assert_curves_equal((curve.q, curve.intensity, curve.uncertainty, curve.quncertainty, curve.binarea,
+                         curve.pixel), expected, rtol=1e-9)
+
+
+@pytest.mark.parametrize('errorprop', ERRORPROPS)
+def test_cake_azimuthal_slice(exposure, errorprop):
+    data, error, mask = exposure
+    qbins = qrange(mask, 1, 80)
+    cake = makecake(data, error, mask, qbins, errorprop, errorprop)
+    qmin, qmax = qbins[20], qbins[45]
+    curve = cake.azimuthal_slice(qmin, qmax)
+    plan = RadialAveragingPlan(mask, *GEOMETRY, qbins)
+    annulus = binnedmask(mask, plan, (qbins >= qmin) & (qbins <= qmax))
+    phi, intensity, uncertainty, phiuncertainty, area, qmean, qstd = azimavg(
+        data, error, annulus, GEOMETRY[0][0], GEOMETRY[1][0], GEOMETRY[2][0], *GEOMETRY[3], *GEOMETRY[4], NPHI,
+        errorprop.value, errorprop.value, nthreads=1)
+    np.testing.assert_array_equal(curve.binarea, area)
+    for x, y in [(curve.phi, phi), (curve.intensity, intensity), (curve.uncertainty, uncertainty),
+                 (curve.phiuncertainty, phiuncertainty)]:
+        np.testing.assert_allclose(x, y, rtol=1e-9, equal_nan=True)
+    if errorprop == ErrorPropagationMethod.Weighted:
+        # q is averaged like phi: with the "weighted" method this is not the simple mean
+        return
+    np.testing.assert_allclose(curve.qmean, qmean, rtol=1e-9, equal_nan=True)
+    # sample standard deviation of the q values in each azimuthal bin
+    valid = (annulus != 0) & np.isfinite(data) & np.isfinite(error)
+    pixelq = np.zeros(data.shape)
+    pixelq[plan.rowindex, plan.columnindex] = plan.pixelq
+    phibins = pixelphibins(data.shape)
+    np.testing.assert_allclose(
+        curve.qstd, [np.std(pixelq[valid & (phibins == i)], ddof=1) for i in range(NPHI)], rtol=1e-6)
@@ -0,0 +1,104 @@
+"""Correlation matrix of scattering curves: incremental updates and the blocked calculation must give the same results
+as a full recalculation"""
+import types
+
+import numpy as np
+import pytest
+
+from ..correlmatrix import correlmatrix_cython, correlmatrix_update, correlmatrix_blocked
+from ...processing.calculations.outliertest import OutlierTest
+
+NPOINTS = 50
+
+
+def makecurves(ncurves: int, seed: int = 0) -> np.ndarray:
+    """Stack of curves like in `OutlierTest`: (q, intensity, uncertainty) along the second axis, curves along the
+    last one. Some points are invalid (nonpositive uncertainty or intensity)."""
+    rng = np.random.default_rng(seed)
+    q = np.linspace(0.1, 3, NPOINTS)
+    intensity = 100 * np.exp(-q[:, np.newaxis] ** 2) * rng.normal(1, 0.05, (NPOINTS, ncurves))
+    uncertainty = 0.05 * intensity * rng.uniform(0.5, 1.5, (NPOINTS, ncurves))
+    uncertainty[rng.uniform(size=uncertainty.shape) < 0.05] = 0
+    intensity[rng.uniform(size=intensity.shape) < 0.05] = -1
+    return np.stack([np.broadcast_to(q[:, np.newaxis], intensity.shape), intensity, uncertainty], axis=1)
+
+
+@pytest.mark.parametrize('logarithmic', [False, True])
+@pytest.mark.parametrize('nadded', [1, 5])
+def test_update_added_curves(logarithmic, nadded):
+    curves = makecurves(20 + nadded)
+    intensities, errors = curves[:, 1, :], curves[:, 2, :]
+    previous = correlmatrix_cython(intensities[:, :20].copy(), errors[:, :20].copy(), logarithmic)
+    cm = np.full((20 + nadded, 20 + nadded), np.nan)
+    cm[:20, :20] = previous
+    known = np.zeros(20 + nadded, np.uint8)
+    known[:20] = 1
+    updated = correlmatrix_update(intensities.copy(), errors.copy(), cm, known, logarithmic)
+    np.testing.assert_array_equal(updated, correlmatrix_cython(intensities.copy(), errors.copy(), logarithmic))
+    assert np.shares_memory(updated, cm)
+
+
+def test_update_nothing_known():
+    curves = makecurves(15)
+    intensities, errors = curves[:, 1, :].copy(), curves[:, 2, :].copy()
+    cm = np.full((15, 15), np.nan)
+    np.testing.assert_array_equal(correlmatrix_update(intensities, errors, cm, np.zeros(15, np.uint8)),
+                                  correlmatrix_cython(intensities, errors))
+
+
+def test_update_invalid_shape():
+    curves = makecurves(10)
+    intensities, errors = curves[:, 1, :].copy(), curves[:, 2, :].copy()
+    with pytest.raises(ValueError):
+        correlmatrix_update(intensities, errors, np.empty((9, 9)), np.zeros(10, np.uint8))
+    with pytest.raises(ValueError):
+        correlmatrix_update(intensities, errors, np.empty((10, 10)), np.zeros(9, np.uint8))
+
+
+def test_outliertest_reuse():
+    """Curves are added, removed and changed between the two outlier tests"""
+    curves = makecurves(30)
+    fsns = np.arange(100, 130)
+    previouscurves = curves[:, :, :24].copy()
+    previouscurves[:, 1, 7] *= 1.1  # changed since: must be recalculated
+    previous = types.SimpleNamespace(
+        correlmatrix=correlmatrix_cython(previouscurves[:, 1, :].copy(), previouscurves[:, 2, :].copy()),
+        fsns=fsns[:24], checksums=OutlierTest.curvechecksums(previouscurves))
+    # new curves are not necessarily appended at the end, and some of the former ones are missing
+    order = np.r_[25:30, 0:5, 24, 10:24, 6:10]
+    current = curves[:, :, order]
+    test = OutlierTest.__new__(OutlierTest)
+    test.checksums = OutlierTest.curvechecksums(current)
+    updated = test._updatedcorrelmatrix(current, fsns[order], previous)
+    np.testing.assert_array_equal(updated, correlmatrix_cython(current[:, 1, :].copy(), current[:, 2, :].copy()))
+
+
+@pytest.mark.parametrize('logarithmic', [False, True])
+@pytest.mark.parametrize('blocksize', [1, 4, 7, 23, 100])
+def test_blocked(logarithmic, blocksize):
+    curves = makecurves(23)
+    intensities, errors = curves[:, 1, :].copy(), curves[:, 2, :].copy()
+    loaded = []
+
+    def loadblock(start: int, stop: int):
+        loaded.append((start, stop))
+        return intensities[:, start:stop], errors[:, start:stop]
+
+    expected = correlmatrix_cython(intensities, errors, logarithmic)
+    score, cm = correlmatrix_blocked(loadblock, 23, blocksize, logarithmic, False)
+    assert cm is None
+    np.testing.assert_array_equal(score, np.diagonal(expected))
+    # no block is larger than requested
+    assert all(stop - start <= blocksize for start, stop in loaded)
+    score, cm = correlmatrix_blocked(loadblock, 23, blocksize, logarithmic, True)
+    np.testing.assert_array_equal(score, np.diagonal(expected))
+    np.testing.assert_array_equal(cm, expected)
+
+
+def test_blocked_invalid():
+    curves = makecurves(10)
+    with pytest.raises(ValueError):
+        correlmatrix_blocked(lambda start, stop: (curves[:, 1, start:stop], curves[:, 2, start:stop]), 10, 0)
+    with pytest.raises(ValueError):
+        # the callback returns the wrong number of curves
+        correlmatrix_blocked(lambda start, stop: (curves[:, 1, :], curves[:, 2, :]), 10, 4)
@@ -0,0 +1,105 @@
+"""Beam center finding: batched and multi-threaded evaluation must not change the results"""
+import os
+import types
+
+import numpy as np
+import pytest
+
+from ..centering.findbeam import evaluate_candidates, findbeam, findbeam_crude, _workercount, \
+    gradienttargetfunctions, binimage
+from ..centering.targetfunctions import peakheight, slices, azimuthal, momentofinertia
+from ..radavg import getnthreads
+
+BEAMPOS = (48.3, 61.7)
+
+
+@pytest.fixture
+def exposure():
+    """A ring on a flat background, with a detector gap"""
+    rows, cols = np.meshgrid(np.arange(110), np.arange(130), indexing='ij')
+    radius = ((rows - BEAMPOS[0]) ** 2 + (cols - BEAMPOS[1]) ** 2) ** 0.5
+    intensity = 10 + 1000 * np.exp(-(radius - 30) ** 2 / (2 * 3 ** 2))
+    mask = np.ones(intensity.shape, np.uint8)
+    mask[:, 90:95] = 0
+    header = types.SimpleNamespace(beamposrow=(BEAMPOS[0] + 3.2, 0), beamposcol=(BEAMPOS[1] - 2.1, 0))
+    return types.SimpleNamespace(intensity=intensity, mask=mask, header=header)
+
+
+@pytest.mark.parametrize('targetfunc', [peakheight, slices, azimuthal, momentofinertia])
+def test_evaluate_candidates_threads(exposure, targetfunc):
+    beamrows, beamcols = np.meshgrid(np.linspace(45, 52, 4), np.linspace(58, 65, 4), indexing='ij')
+    beamrows, beamcols = beamrows.ravel(), beamcols.ravel()
+    expected = [targetfunc((r, c), exposure.intensity, exposure.mask, 20, 40) for r, c in zip(beamrows, beamcols)]
+    for workers in [1, 4]:
+        np.testing.assert_allclose(
+            evaluate_candidates(targetfunc, beamrows, beamcols, exposure.intensity, exposure.mask, 20, 40,
+                                workers=workers),
+            expected, rtol=1e-12)
+
+
+def test_workercount():
+    assert 1 <= _workercount(0) * getnthreads() <= max(getnthreads(), os.cpu_count() or 1)
+    assert _workercount(1) == 1
+
+
+def test_findbeam_crude(exposure):
+    position = findbeam_crude(slices, exposure, 20, 40, d=6, N=13, workers=4)
+    assert abs(position[0] - BEAMPOS[0]) <= 0.5
+    assert abs(position[1] - BEAMPOS[1]) <= 0.5
+
+
+def test_findbeam(exposure):
+    (row, drow), (col, dcol) = findbeam(slices, exposure, 20, 40, dcrude=6, Ncrude=7, workers=4)
+    assert abs(row - BEAMPOS[0]) < 0.5
+    assert abs(col - BEAMPOS[1]) < 0.5
+
+
+@pytest.mark.parametrize('pyramidlevels', [1, 2])
+@pytest.mark.parametrize('analyticgradient', [False, True])
+def test_findbeam_pyramid(exposure, pyramidlevels, analyticgradient):
+    (row, drow), (col, dcol) = findbeam(slices, exposure, 20, 40, dcrude=6, Ncrude=7, workers=4,
+                                        pyramidlevels=pyramidlevels, analyticgradient=analyticgradient)
+    assert abs(row - BEAMPOS[0]) < 0.1
+    assert abs(col - BEAMPOS[1]) < 0.1
+
+
+def test_binimage():
+    rng = np.random.default_rng(5)
+    matrix = rng.uniform(0, 100, (13, 17))
+    mask = (rng.uniform(size=matrix.shape) > 0.2).astype(np.uint8)
+    mask[0:4, 0:4] = 0  # a completely masked block
+    matrix[5, 6] = np.nan
+    binned, binnedmask = binimage(matrix, mask, 4)
+    # incomplete blocks at the edges are discarded
+    assert binned.shape == binnedmask.shape == (3, 4)
+    for row in range(3):
+        for col in range(4):
+            block = matrix[4 * row:4 * row + 4, 4 * col:4 * col + 4]
+            valid = (mask[4 * row:4 * row + 4, 4 * col:4 * col + 4] != 0) & np.isfinite(block)
+            assert binnedmask[row, col] == int(valid.any())
+            if valid.any():
+                assert binned[row, col] == pytest.approx(block[valid].mean(), rel=1e-12)
+
+
+@pytest.mark.parametrize('targetfunc', [slices, azimuthal])
+def test_findbeam_analyticgradient(exposure, targetfunc):
+    (row, drow), (col, dcol) = findbeam(targetfunc, exposure, 20, 40, 0, 0, analyticgradient=True)
+    assert abs(row - BEAMPOS[0]) < 0.1
+    assert abs(col - BEAMPOS[1]) < 0.1
+
+
+@pytest.mark.parametrize('targetfunc', [momentofinertia, azimuthal, slices])
+def test_analytic_gradients(exposure, targetfunc):
+    smoothed = gradienttargetfunctions[targetfunc]
+    for beampos in [(47.1, 60.3), (50.6, 63.2)]:
+        value, gradient = smoothed(beampos, exposure.intensity, exposure.mask, 20, 40)
+        if targetfunc is momentofinertia:
+            # only the border of the annulus is smoothed
+            assert value == pytest.approx(targetfunc(beampos, exposure.intensity, exposure.mask, 20, 40), rel=0.01)
+        h = 1e-5
+        numerical = [
+            (smoothed((beampos[0] + h, beampos[1]), exposure.intensity, exposure.mask, 20, 40)[0] -
+             smoothed((beampos[0] - h, beampos[1]), exposure.intensity, exposure.mask, 20, 40)[0]) / (2 * h),
+            (smoothed((beampos[0], beampos[1] + h), exposure.intensity, exposure.mask, 20, 40)[0] -
+             smoothed((beampos[0], beampos[1] - h), exposure.intensity, exposure.mask, 20, 40)[0]) / (2 * h)]
+        np.testing.assert_allclose(gradient, numerical, rtol=1e-3, atol=1e-6 * abs(value))
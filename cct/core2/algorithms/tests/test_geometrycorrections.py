@@ -0,0 +1,99 @@
+"""Geometry corrections: the cached correction matrices must be the same as those calculated from scratch"""
+import types
+
+import numpy as np
+import pytest
+
+from ..geometrycorrections import GeometryCorrectionCache, GeometryCorrectionMatrices, solidangle, \
+    angledependentabsorption, angledependentairtransmission
+from ...dataclasses import Exposure
+
+SHAPE = (43, 57)
+DISTANCE = (1234.5, 0.7)
+PIXELSIZE = (0.172, 0.002)
+BEAMPOSROW = (20.3, 0.4)
+BEAMPOSCOL = (31.7, 0.3)
+
+
+def makeexposure(beamposrow=BEAMPOSROW, distance=DISTANCE) -> Exposure:
+    header = types.SimpleNamespace(distance=distance, pixelsize=PIXELSIZE, beamposrow=beamposrow,
+                                   beamposcol=BEAMPOSCOL, wavelength=(0.15418, 0.0003))
+    return Exposure(np.ones(SHAPE), header, np.ones(SHAPE))
+
+
+def getmatrices(cache: GeometryCorrectionCache, exposure: Exposure, calls: list) -> GeometryCorrectionMatrices:
+    def twotheta():
+        calls.append(exposure)
+        return exposure.twotheta()
+
+    return cache.get(exposure.shape, exposure.header.distance, exposure.header.pixelsize,
+                     exposure.header.beamposrow, exposure.header.beamposcol, twotheta)
+
+
+def test_matrices():
+    exposure = makeexposure()
+    twotheta, dtwotheta = exposure.twotheta()
+    matrices = GeometryCorrectionMatrices(twotheta, dtwotheta, DISTANCE, PIXELSIZE)
+    for cached, expected in zip((matrices.solidangle, matrices.dsolidangle),
+                                solidangle(twotheta, dtwotheta, *DISTANCE, *PIXELSIZE)):
+        np.testing.assert_array_equal(cached, expected)
+    for transmission in [(0.43, 0.01), (1.0, 0.0), (0.999, 0.002)]:
+        for cached, expected in zip(matrices.absorption(*transmission),
+                                    angledependentabsorption(twotheta, dtwotheta, *transmission)):
+            np.testing.assert_allclose(cached, expected, rtol=1e-14)
+    for pressure in [0.0, 0.13, 1000.0]:
+        for cached, expected in zip(matrices.airtransmission(pressure),
+                                    angledependentairtransmission(twotheta, dtwotheta, pressure, *DISTANCE)):
+            np.testing.assert_array_equal(cached, expected)
+    # the shared matrices cannot be changed by accident
+    for matrix in [matrices.twotheta, matrices.solidangle, matrices.dsolidangle, matrices.airtransmission(0.13)[0]]:
+        assert not matrix.flags.writeable
+        with pytest.raises(ValueError):
+            matrix[0, 0] = 0
+
+
+def test_airtransmission_eviction():
+    exposure = makeexposure()
+    matrices = GeometryCorrectionMatrices(*exposure.twotheta(), DISTANCE, PIXELSIZE)
+    matrices.maxairtransmissions = 2
+    first = matrices.airtransmission(0.1)[0]
+    assert matrices.airtransmission(0.1)[0] is first
+    second = matrices.airtransmission(0.2)[0]
+    assert matrices.airtransmission(0.1)[0] is first  # now 0.2 is the least recently used one
+    matrices.airtransmission(0.3)
+    assert matrices.airtransmission(0.1)[0] is first
+    recalculated = matrices.airtransmission(0.2)[0]
+    assert recalculated is not second
+    np.testing.assert_array_equal(recalculated, second)
+    # a different absorption coefficient of air needs a different matrix
+    assert matrices.airtransmission(0.2, mu0_air=1 / 800)[0] is not recalculated
+
+
+def test_cache():
+    cache = GeometryCorrectionCache(maxsize=2)
+    calls = []
+    exposure = makeexposure()
+    matrices = getmatrices(cache, exposure, calls)
+    assert getmatrices(cache, makeexposure(), calls) is matrices
+    # the scattering angles are only calculated on a cache miss
+    assert len(calls) == 1
+    np.testing.assert_array_equal(matrices.twotheta, exposure.twotheta()[0])
+    # a change in any of the geometry parameters or their uncertainties needs new matrices
+    moved = getmatrices(cache, makeexposure(beamposrow=(BEAMPOSROW[0], 0.5)), calls)
+    assert moved is not matrices
+    assert len(calls) == 2
+    np.testing.assert_array_equal(moved.dtwotheta, makeexposure(beamposrow=(BEAMPOSROW[0], 0.5)).twotheta()[1])
+    assert getmatrices(cache, exposure, calls) is matrices
+    # the least recently used one is evicted
+    getmatrices(cache, makeexposure(distance=(500.0, 0.1)), calls)
+    assert getmatrices(cache, exposure, calls) is matrices
+    assert getmatrices(cache, makeexposure(beamposrow=(BEAMPOSROW[0], 0.5)), calls) is not moved
+    cache.clear()
+    assert getmatrices(cache, exposure, calls) is not matrices
+
+
+def test_cache_disabled():
+    cache = GeometryCorrectionCache(maxsize=0)
+    calls = []
+    assert getmatrices(cache, makeexposure(), calls) is not getmatrices(cache, makeexposure(), calls)
+    assert len(calls) == 2
@@ -0,0 +1,178 @@
+"""Averaging matrices: the fused accumulation kernel must give the same results as the numpy expressions, and
+partial averagers merged together the same as a single one"""
+import pickle
+import types
+
+import numpy as np
+import pytest
+
+from ..matrixaverager import MatrixAverager, ErrorPropagationMethod
+from ...dataclasses import Curve, CurveAverager, Exposure, ExposureAverager
+
+SHAPE = (23, 31)
+
+
+def reference_sums(values, errors, method: ErrorPropagationMethod):
+    """Sums of the matrices, calculated with numpy expressions like in the original implementation of
+    `MatrixAverager.add()`"""
+    sumvalue = sumvalue2 = sumerror = 0
+    for value, error in zip(values, errors):
+        error = MatrixAverager.fixBadValues(error)
+        if method == ErrorPropagationMethod.Weighted:
+            sumvalue = sumvalue + value / error ** 2
+            sumerror = sumerror + 1 / error ** 2
+        elif method == ErrorPropagationMethod.Linear:
+            sumvalue = sumvalue + value
+            sumerror = sumerror + error
+        elif method == ErrorPropagationMethod.Gaussian:
+            sumvalue = sumvalue + value
+            sumerror = sumerror + error ** 2
+        elif method == ErrorPropagationMethod.Conservative:
+            sumvalue = sumvalue + value
+            sumerror = sumerror + error ** 2
+            sumvalue2 = sumvalue2 + value ** 2
+        elif method == ErrorPropagationMethod.StandardErrorOfTheMean:
+            sumvalue = sumvalue + value
+            sumvalue2 = sumvalue2 + value ** 2
+    return sumvalue, sumvalue2, sumerror
+
+
+def makematrices(count: int, seed: int = 0, badvalues: bool = True):
+    """Random matrices and uncertainties. Some uncertainties are NaN, infinite, zero or negative, and in one of the
+    matrices all of them are bad."""
+    rng = np.random.default_rng(seed)
+    values = [rng.normal(10, 3, SHAPE) for i in range(count)]
+    errors = [rng.uniform(0.1, 2, SHAPE) for i in range(count)]
+    if badvalues:
+        for error in errors[::2]:
+            error.flat[rng.choice(error.size, 40, replace=False)] = rng.choice([np.nan, np.inf, 0, -1], 40)
+        errors[-1][:] = np.nan
+    return values, errors
+
+
+@pytest.mark.parametrize('method', list(ErrorPropagationMethod))
+@pytest.mark.parametrize('badvalues', [False, True])
+def test_accumulate(method, badvalues):
+    values, errors = makematrices(5, badvalues=badvalues)
+    averager = MatrixAverager(method)
+    for value, error in zip(values, errors):
+        averager.add(value, error)
+    assert averager.count == len(values)
+    sumvalue, sumvalue2, sumerror = reference_sums(values, errors, method)
+    np.testing.assert_array_equal(averager.value, sumvalue)
+    if method in [ErrorPropagationMethod.Conservative, ErrorPropagationMethod.StandardErrorOfTheMean]:
+        np.testing.assert_array_equal(averager.value2, sumvalue2)
+    if method != ErrorPropagationMethod.StandardErrorOfTheMean:
+        np.testing.assert_array_equal(averager.error, sumerror)
+    value, error = averager.get()
+    assert value.shape == error.shape == SHAPE
+    assert np.isfinite(value).all() and np.isfinite(error).all()
+
+
+def test_inputs_unchanged():
+    values, errors = makematrices(2)
+    originalerrors = [e.copy() for e in errors]
+    averager = MatrixAverager(ErrorPropagationMethod.Conservative)
+    averager.add(values[0].astype(np.float32), errors[0])  # converted to double
+    averager.add(values[1], errors[1])
+    for error, original in zip(errors, originalerrors):
+        np.testing.assert_array_equal(error, original)
+
+
+def test_shape_mismatch():
+    averager = MatrixAverager(ErrorPropagationMethod.Gaussian)
+    with pytest.raises(ValueError):
+        averager.add(np.zeros(SHAPE), np.ones((3, 3)))
+    averager.add(np.zeros(SHAPE), np.ones(SHAPE))
+    with pytest.raises(ValueError):
+        averager.add(np.zeros((3, 3)), np.ones((3, 3)))
+    with pytest.raises(ValueError):
+        MatrixAverager(ErrorPropagationMethod.Gaussian).get()
+
+
+def assert_averagers_equal(averager: MatrixAverager, expected: MatrixAverager):
+    assert averager.method == expected.method
+    assert averager.count == expected.count
+    # the order of summation is different
+    for x, y in [(averager.value, expected.value), (averager.value2, expected.value2),
+                 (averager.error, expected.error)]:
+        if y is None:
+            assert x is None
+        else:
+            np.testing.assert_allclose(x, y, rtol=1e-13)
+    # the standard deviation from the sums of squares amplifies the rounding errors
+    for x, y in zip(averager.get(), expected.get()):
+        np.testing.assert_allclose(x, y, rtol=1e-8)
+
+
+@pytest.mark.parametrize('method', list(ErrorPropagationMethod))
+@pytest.mark.parametrize('split', [0, 1, 3, 7])
+def test_merge(method, split):
+    values, errors = makematrices(7)
+    expected = MatrixAverager(method)
+    for value, error in zip(values, errors):
+        expected.add(value, error)
+    first = MatrixAverager(method)
+    second = MatrixAverager(method)
+    for value, error in zip(values[:split], errors[:split]):
+        first.add(value, error)
+    for value, error in zip(values[split:], errors[split:]):
+        second.add(value, error)
+    # partial averagers are sent to other processes in pickled form
+    first, second = pickle.loads(pickle.dumps(first)), pickle.loads(pickle.dumps(second))
+    assert first.merge(second) is first
+    assert_averagers_equal(first, expected)
+    # merging does not change the other averager
+    assert second.count == len(values) - split
+
+
+def test_merge_different_methods():
+    first = MatrixAverager(ErrorPropagationMethod.Gaussian)
+    second = MatrixAverager(ErrorPropagationMethod.Linear)
+    with pytest.raises(ValueError):
+        first.merge(second)
+
+
+@pytest.mark.parametrize('method', list(ErrorPropagationMethod))
+def test_curveaverager_merge(method):
+    values, errors = makematrices(6)
+    curves = [Curve.fromVectors(q=np.linspace(0.1, 2, SHAPE[1]) + 0.001 * value[1], intensity=value[0],
+                                uncertainty=error[0], quncertainty=np.abs(error[1]) * 0.01,
+                                binarea=np.full(SHAPE[1], 10.0 + i), pixel=np.linspace(1, 100, SHAPE[1]) + i)
+              for i, (value, error) in enumerate(zip(values, errors))]
+    expected = CurveAverager(method, method)
+    for curve in curves:
+        expected.add(curve)
+    first = CurveAverager(method, method)
+    second = CurveAverager(method, method)
+    for curve in curves[:2]:
+        first.add(curve)
+    for curve in curves[2:]:
+        second.add(curve)
+    merged = pickle.loads(pickle.dumps(first)).merge(pickle.loads(pickle.dumps(second)))
+    assert merged.count == len(curves)
+    for name in ['qavg', 'iavg', 'aavg', 'pavg']:
+        assert_averagers_equal(getattr(merged, name), getattr(expected, name))
+
+
+@pytest.mark.parametrize('method', list(ErrorPropagationMethod))
+def test_exposureaverager_merge(method):
+    values, errors = makematrices(5)
+    rng = np.random.default_rng(1)
+    exposures = [Exposure(value, types.SimpleNamespace(fsn=i), error, (rng.uniform(size=SHAPE) > 0.1))
+                 for i, (value, error) in enumerate(zip(values, errors))]
+    expected = ExposureAverager(method)
+    for exposure in exposures:
+        expected.add(exposure)
+    first = ExposureAverager(method)
+    second = ExposureAverager(method)
+    for exposure in exposures[:3]:
+        first.add(exposure)
+    for exposure in exposures[3:]:
+        second.add(exposure)
+    merged = first.merge(second)
+    assert merged.count == len(exposures)
+    assert_averagers_equal(merged.intensity, expected.intensity)
+    np.testing.assert_array_equal(merged.mask, expected.mask)
+    np.testing.assert_array_equal(merged.mask, np.logical_and.reduce([ex.mask > 0 for ex in exposures]))
+    assert [h.fsn for h in merged.headers] == list(range(len(exposures)))
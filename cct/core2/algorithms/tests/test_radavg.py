@@ -0,0 +1,245 @@
+"""Radial averaging: compare the optimized code paths to a straightforward implementation of the original algorithm"""
+import numpy as np
+import pytest
+
+from ..integrationplan import RadialAveragingPlan, RadialAveragingPlanCache
+from ..radavg import radavg, autoq, azimavg, fastradavg, fastazimavg
+
+# wavelength, distance, pixel size, beam row, beam column: (value, uncertainty)
+GEOMETRY = ((0.15418, 0.0003), (500.0, 0.5), (0.172, 0.001), (41.3, 0.2), (57.8, 0.3))
+SHAPE = (97, 121)
+
+
+def reference_radavg(data, error, mask, wavelength, distance, pixelsize, beamrow, beamcol, qbincenters,
+                     errorprop=3, qerrorprop=3):
+    """The radial averaging algorithm as it was before the optimizations, with numpy"""
+    qbincenters = np.asarray(qbincenters, dtype=np.double)
+    Nbins = len(qbincenters)
+    rows, cols = np.meshgrid(np.arange(data.shape[0]), np.arange(data.shape[1]), indexing='ij')
+    valid = (mask != 0) & np.isfinite(data) & np.isfinite(error)
+    row = rows[valid] - beamrow[0]
+    col = cols[valid] - beamcol[0]
+    value = data[valid]
+    unc = error[valid]
+    qfac = 4 * np.pi / wavelength[0]
+    qfac_unc2 = 16 * np.pi ** 2 * wavelength[1] ** 2 / wavelength[0] ** 4
+    row_unc2 = 0.25 + beamrow[1] ** 2
+    col_unc2 = 0.25 + beamcol[1] ** 2
+    pixelradius2 = row ** 2 + col ** 2
+    pixelradius_unc2 = (row_unc2 * row ** 2 + col_unc2 * col ** 2) / pixelradius2
+    tgtwotheta2 = pixelradius2 * pixelsize[0] ** 2 / distance[0] ** 2
+    tgtwotheta_unc2 = tgtwotheta2 * (pixelradius_unc2 / pixelradius2 + distance[1] ** 2 / distance[0] ** 2 +
+                                     pixelsize[1] ** 2 / pixelsize[0] ** 2)
+    sinth = (0.5 * (1 - 1 / (tgtwotheta2 + 1) ** 0.5)) ** 0.5
+    sinth_unc2 = 1 / 16. * tgtwotheta2 / (tgtwotheta2 + 1) ** 3 / (1 - 1 / (tgtwotheta2 + 1) ** 0.5) * \
+                 tgtwotheta_unc2 ** 2
+    q = qfac * sinth
+    q_unc2 = q ** 2 * (qfac_unc2 / qfac ** 2 + sinth_unc2 / sinth ** 2)
+    qmax = np.empty(Nbins)
+    qmax[:-1] = 0.5 * (qbincenters[:-1] + qbincenters[1:])
+    qmax[-1] = qbincenters[-1]
+    inrange = (q >= qbincenters[0]) & (q <= qmax[-1])
+    # the first bin where qmax > q, or the last one
+    binindex = np.minimum(np.searchsorted(qmax, q[inrange], 'right'), Nbins - 1)
+    value, unc, q, q_unc2, radius = value[inrange], unc[inrange], q[inrange], q_unc2[inrange], \
+                                    pixelradius2[inrange] ** 0.5
+
+    def binsum(x):
+        return np.bincount(binindex, weights=x, minlength=Nbins)
+
+    area = np.bincount(binindex, minlength=Nbins)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if errorprop == 0:
+            intensity = binsum(value / unc ** 2) / binsum(1 / unc ** 2)
+            intensityerror = 1 / binsum(1 / unc ** 2) ** 0.5
+        else:
+            intensity = binsum(value) / area
+            if errorprop == 1:
+                intensityerror = binsum(unc) / area
+            elif errorprop == 2:
+                intensityerror = binsum(unc ** 2) ** 0.5 / area
+            else:
+                statistics = ((binsum(value ** 2) - binsum(value) ** 2 / area) / (area - 1)) ** 0.5
+                intensityerror = np.fmax((binsum(unc ** 2) / area) ** 0.5, np.where(area < 2, 0, statistics))
+        if qerrorprop == 0:
+            # sic: the original code adds up the squared uncertainties here, not their reciprocals
+            qmean = binsum(q / q_unc2) / binsum(q_unc2)
+            qerror = 1 / binsum(q_unc2) ** 0.5
+        else:
+            qmean = binsum(q) / area
+            if qerrorprop == 1:
+                qerror = binsum(q_unc2 ** 0.5) / area
+            elif qerrorprop == 2:
+                qerror = binsum(q_unc2) ** 0.5 / area
+            else:
+                statistics = ((binsum(q ** 2) - binsum(q) ** 2 / area) / (area - 1)) ** 0.5
+                qerror = np.fmax((binsum(q_unc2) / area) ** 0.5, np.where(area < 2, 0, statistics))
+        pixel = binsum(radius) / area
+    empty = area == 0
+    for x in (intensity, intensityerror, qmean, qerror, pixel):
+        x[empty] = np.nan
+    return qmean, intensity, intensityerror, qerror, area, pixel
+
+
+def assert_curves_equal(result, expected, rtol=1e-10):
+    q, intensity, error, qerror, area, pixel = result
+    np.testing.assert_array_equal(area, expected[4])
+    for name, x, y in zip(['q', 'intensity', 'error', 'qerror', 'pixel'],
+                          [q, intensity, error, qerror, pixel],
+                          [expected[i] for i in [0, 1, 2, 3, 5]]):
+        np.testing.assert_allclose(x, y, rtol=rtol, atol=0, equal_nan=True, err_msg=name)
+
+
+@pytest.fixture
+def exposure():
+    rng = np.random.default_rng(20211016)
+    data = rng.gamma(2.0, 100.0, SHAPE)
+    error = data ** 0.5 + 1
+    mask = np.ones(SHAPE, dtype=np.uint8)
+    mask[rng.random(SHAPE) < 0.05] = 0
+    mask[:, 60:64] = 0  # a gap between detector modules
+    data[3, 5] = np.nan
+    error[7, 11] = np.inf
+    return data, error, mask
+
+
+def qrange(mask, spacing, N):
+    return autoq(mask, GEOMETRY[0][0], GEOMETRY[1][0], GEOMETRY[2][0], GEOMETRY[3][0], GEOMETRY[4][0],
+                 linspacing=spacing, N=N)
+
+
+@pytest.mark.parametrize('errorprop', [0, 1, 2, 3])
+@pytest.mark.parametrize('qerrorprop', [0, 1, 2, 3])
+def test_radavg_matches_reference(exposure, errorprop, qerrorprop):
+    data, error, mask = exposure
+    qbins = qrange(mask, 1, 80)
+    result = radavg(data, error, mask, *[x for pair in GEOMETRY for x in pair], qbins, errorprop, qerrorprop,
+                    nthreads=1)
+    assert_curves_equal(result, reference_radavg(data, error, mask, *GEOMETRY, qbins, errorprop, qerrorprop))
+
+
+@pytest.mark.parametrize('errorprop', [0, 1, 2, 3])
+@pytest.mark.parametrize('qerrorprop', [0, 1, 2, 3])
+def test_plan_is_identical_to_radavg(exposure, errorprop, qerrorprop):
+    data, error, mask = exposure
+    qbins = qrange(mask, 1, 80)
+    plan = RadialAveragingPlan(mask, *GEOMETRY, qbins)
+    expected = radavg(data, error, mask, *[x for pair in GEOMETRY for x in pair], qbins, errorprop, qerrorprop,
+                      nthreads=1)
+    result = plan.radavg(data, error, errorprop, qerrorprop, nthreads=1)
+    for x, y in zip(result, expected):
+        np.testing.assert_array_equal(x, y)
+
+
+def test_plan_cache(exposure):
+    data, error, mask = exposure
+    cache = RadialAveragingPlanCache(maxsize=2)
+    plan = cache.get(mask, *GEOMETRY, (1, 80))
+    assert cache.get(mask, *GEOMETRY, (1, 80)) is plan
+    np.testing.assert_array_equal(plan.qbincenters, qrange(mask, 1, 80))
+    # a different mask needs a different plan
+    othermask = mask.copy()
+    othermask[0, 0] = 1 - othermask[0, 0]
+    assert cache.get(othermask, *GEOMETRY, (1, 80)) is not plan
+    assert cache.get(mask, *GEOMETRY, qrange(mask, 1, 80)) is not plan
+    # the least recently used one has been evicted
+    assert cache.get(mask, *GEOMETRY, (1, 80)) is not plan
+
+
+@pytest.mark.parametrize('spacing', [0, 1, 2, 3])
+@pytest.mark.parametrize('N', [1, 2, 13, 80, 500])
+def test_qbin_lookup_spacings(exposure, spacing, N):
+    data, error, mask = exposure
+    qbins = qrange(mask, spacing, N)
+    result = radavg(data, error, mask, *[x for pair in GEOMETRY for x in pair], qbins, nthreads=1)
+    assert_curves_equal(result, reference_radavg(data, error, mask, *GEOMETRY, qbins))
+
+
+def test_qbin_lookup_arbitrary_bins(exposure):
+    data, error, mask = exposure
+    rng = np.random.default_rng(12)
+    qbins = np.sort(rng.uniform(0.01, 1.5, 57))
+    result = radavg(data, error, mask, *[x for pair in GEOMETRY for x in pair], qbins, nthreads=1)
+    assert_curves_equal(result, reference_radavg(data, error, mask, *GEOMETRY, qbins))
+
+
+def test_qbin_lookup_at_bin_edges(exposure):
+    data, error, mask = exposure
+    # take the bin edges from the q values of actual pixels, so that some pixels fall exactly on them
+    plan = RadialAveragingPlan(mask, *GEOMETRY, qrange(mask, 1, 80))
+    pixelq = np.unique(plan.pixelq)
+    qbins = pixelq[::97]
+    result = radavg(data, error, mask, *[x for pair in GEOMETRY for x in pair], qbins, nthreads=1)
+    assert_curves_equal(result, reference_radavg(data, error, mask, *GEOMETRY, qbins))
+
+
+def assert_threaded_results_equal(result, expected, rtol=1e-9):
+    """Results with more threads differ only in the order of the summation"""
+    for x, y in zip(result, expected):
+        if np.issubdtype(np.asarray(y).dtype, np.integer):
+            np.testing.assert_array_equal(x, y)
+        else:
+            np.testing.assert_allclose(x, y, rtol=rtol, atol=0, equal_nan=True)
+
+
+@pytest.mark.parametrize('nthreads', [2, 3, 8])
+@pytest.mark.parametrize('errorprop', [0, 3])
+def test_radavg_threads(exposure, nthreads, errorprop):
+    data, error, mask = exposure
+    qbins = qrange(mask, 1, 80)
+    args = (data, error, mask) + tuple(x for pair in GEOMETRY for x in pair) + (qbins, errorprop, errorprop)
+    assert_threaded_results_equal(radavg(*args, nthreads=nthreads), radavg(*args, nthreads=1))
+    plan = RadialAveragingPlan(mask, *GEOMETRY, qbins)
+    assert_threaded_results_equal(plan.radavg(data, error, errorprop, errorprop, nthreads=nthreads),
+                                  radavg(*args, nthreads=1))
+
+
+@pytest.mark.parametrize('nthreads', [2, 3, 8])
+def test_azimavg_threads(exposure, nthreads):
+    data, error, mask = exposure
+    args = (data, error, mask, GEOMETRY[0][0], GEOMETRY[1][0], GEOMETRY[2][0]) + GEOMETRY[3] + GEOMETRY[4] + (50,)
+    assert_threaded_results_equal(azimavg(*args, nthreads=nthreads), azimavg(*args, nthreads=1))
+
+
+@pytest.mark.parametrize('nthreads', [2, 3, 8])
+def test_fastaveraging_threads(exposure, nthreads):
+    data, error, mask = exposure
+    data = np.nan_to_num(data)
+    assert_threaded_results_equal(
+        fastradavg(data, mask, GEOMETRY[3][0], GEOMETRY[4][0], 0, 100, 60, nthreads=nthreads),
+        fastradavg(data, mask, GEOMETRY[3][0], GEOMETRY[4][0], 0, 100, 60, nthreads=1))
+    assert_threaded_results_equal(
+        fastazimavg(data, mask, GEOMETRY[3][0], GEOMETRY[4][0], 36, nthreads=nthreads),
+        fastazimavg(data, mask, GEOMETRY[3][0], GEOMETRY[4][0], 36, nthreads=1))
+
+
+@pytest.fixture
+def exposurestack(exposure):
+    data, error, mask = exposure
+    rng = np.random.default_rng(4)
+    scales = rng.uniform(0.5, 2, 11)
+    intensities = np.stack([data * s for s in scales]).transpose(1, 2, 0)
+    uncertainties = np.stack([error * s for s in scales]).transpose(1, 2, 0)
+    return intensities, uncertainties, mask
+
+
+@pytest.mark.parametrize('errorprop', [0, 1, 2, 3])
+def test_radavg_stack(exposurestack, errorprop):
+    intensities, uncertainties, mask = exposurestack
+    plan = RadialAveragingPlan(mask, *GEOMETRY, qrange(mask, 1, 80))
+    curves = plan.radavg_stack(intensities, uncertainties, errorprop, errorprop, nthreads=1)
+    assert curves.shape == (80, 6, intensities.shape[2])
+    for i in range(intensities.shape[2]):
+        q, intensity, error, qerror, area, pixel = plan.radavg(
+            intensities[:, :, i], uncertainties[:, :, i], errorprop, errorprop, nthreads=1)
+        # the column order is that of Curve.asArray()
+        np.testing.assert_array_equal(curves[:, :, i], np.vstack([q, intensity, error, qerror, area, pixel]).T)
+
+
+@pytest.mark.parametrize('chunksize', [1, 4, 11, 64])
+def test_radavg_frames(exposurestack, chunksize):
+    intensities, uncertainties, mask = exposurestack
+    plan = RadialAveragingPlan(mask, *GEOMETRY, qrange(mask, 1, 80))
+    frames = ((intensities[:, :, i], uncertainties[:, :, i]) for i in range(intensities.shape[2]))
+    np.testing.assert_array_equal(plan.radavg_frames(frames, chunksize=chunksize, nthreads=1),
+                                  plan.radavg_stack(intensities, uncertainties, nthreads=1))
@@ -0,0 +1,146 @@
+"""Byte-offset CBF codec: images written by `writecbf()` must be read back unchanged"""
+import numpy as np
+import pytest
+
+from ..readcbf import readcbf, readcbf_bulk, writecbf, encodecbf, decodecbf, parsecbfheader, cbfheadercontents
+
+HEADER = '# Detector: PILATUS3 1M, S/N 10-0000\n# Exposure_time 1.0000000 s\n# Wavelength 1.5418 A'
+
+
+def makeimage(seed: int, shape=(61, 47)) -> np.ndarray:
+    """Counts with deltas needing each of the 8-, 16-, 32- and 64-bit forms of the byte-offset compression"""
+    rng = np.random.default_rng(seed)
+    image = rng.poisson(20, shape).astype(np.int32)
+    image[1, 5] = 1000  # 16-bit delta
+    image[2, 11] = -200
+    image[3, 20] = 2 ** 31 - 1  # 32-bit delta
+    image[3, 21] = -2 ** 31 + 1  # 64-bit delta
+    image[-1, -1] = -1  # masked pixel
+    return image
+
+
+@pytest.mark.parametrize('dtype', [np.int32, np.double])
+def test_roundtrip(tmp_path, dtype):
+    image = makeimage(0)
+    filename = str(tmp_path / 'crd_00001.cbf')
+    writecbf(filename, image, HEADER)
+    loaded = readcbf(filename, dtype=dtype)
+    assert loaded.dtype == dtype
+    np.testing.assert_array_equal(loaded, image)
+    assert cbfheadercontents(filename) == HEADER
+    # images loaded as double can be written again
+    writecbf(filename, loaded)
+    np.testing.assert_array_equal(readcbf(filename, dtype=np.int32), image)
+    assert cbfheadercontents(filename) == ''
+
+
+def test_decode_encoded():
+    image = makeimage(1, (7, 300))
+    encoded = encodecbf(image)
+    dim1, dim2, offset = parsecbfheader(encoded)
+    assert (dim2, dim1) == image.shape
+    output = np.empty(image.shape, np.int32)
+    assert decodecbf(encoded, output) is output
+    np.testing.assert_array_equal(output, image)
+
+
+def test_encode_invalid():
+    with pytest.raises(ValueError):
+        encodecbf(np.zeros(10, np.int32))
+    with pytest.raises(ValueError):
+        encodecbf(np.full((3, 3), 0.5))
+    with pytest.raises(ValueError):
+        encodecbf(np.full((3, 3), 2.0 ** 32))
+
+
+def test_readcbf_bulk(tmp_path):
+    images = [makeimage(i, (20 + i, 30)) for i in range(6)]
+    filenames = [str(tmp_path / f'crd_{i:05d}.cbf') for i in range(len(images))]
+    for filename, image in zip(filenames, images):
+        writecbf(filename, image)
+    missing = str(tmp_path / 'missing.cbf')
+    candidates = [filenames[0], [missing, filenames[1]], missing] + filenames[2:]
+    results = list(readcbf_bulk(candidates, nworkers=3, prefetch=2))
+    assert len(results) == len(candidates)
+    assert results[2][0] is None
+    assert isinstance(results[2][1], FileNotFoundError)
+    loaded = results[:2] + results[3:]
+    for (filename, data), expectedfilename, image in zip(loaded, filenames, images):
+        assert filename == expectedfilename
+        assert data.dtype == np.double
+        np.testing.assert_array_equal(data, image)
+
+
+@pytest.mark.parametrize('nworkers, prefetch', [(1, 1), (1, 3), (3, 2), (4, 7)])
+@pytest.mark.parametrize('dtype', [np.int32, np.double])
+def test_readcbf_bulk_sequential(tmp_path, nworkers, prefetch, dtype):
+    # many more files than slots, of different shapes: the frames are reused and reallocated
+    filenames = []
+    for i in range(17):
+        filenames.append(str(tmp_path / f'crd_{i:05d}.cbf'))
+        writecbf(filenames[-1], makeimage(i, (10 + i % 3, 30 + i % 2)))
+    fetched = []
+
+    def candidates():
+        for filename in filenames:
+            fetched.append(filename)
+            yield filename
+
+    results = []
+    for filename, data in readcbf_bulk(candidates(), nworkers=nworkers, prefetch=prefetch, dtype=dtype):
+        # not more files are read ahead than there are slots
+        assert len(fetched) - len(results) <= prefetch
+        results.append((filename, data))
+    assert [filename for filename, data in results] == filenames
+    # the yielded images are not overwritten when the frames are reused
+    for (filename, data), expectedfilename in zip(results, filenames):
+        expected = readcbf(expectedfilename, dtype=dtype)
+        assert data.dtype == expected.dtype
+        np.testing.assert_array_equal(data, expected)
+
+
+def test_readcbf_bulk_errors(tmp_path):
+    filenames = [str(tmp_path / f'crd_{i:05d}.cbf') for i in range(6)]
+    for i, filename in enumerate(filenames):
+        writecbf(filename, makeimage(i))
+    with open(filenames[2], 'rb') as f:
+        encoded = f.read()
+    with open(filenames[2], 'wb') as f:
+        f.write(encoded[:parsecbfheader(encoded)[2] + 100])  # truncated in the binary data
+    with open(filenames[4], 'wb') as f:
+        f.write(b'This is not a CBF file')
+    results = list(readcbf_bulk(filenames, nworkers=2, prefetch=2))
+    assert len(results) == len(filenames)
+    # the errors are reported for the broken files only, the others are loaded
+    assert results[2][0] is None
+    assert isinstance(results[2][1], ValueError)
+    assert results[4][0] is None
+    assert isinstance(results[4][1], RuntimeError)
+    for i in [0, 1, 3, 5]:
+        assert results[i][0] == filenames[i]
+        np.testing.assert_array_equal(results[i][1], makeimage(i))
+
+
+def test_truncated(tmp_path):
+    filename = str(tmp_path / 'crd_00001.cbf')
+    encoded = encodecbf(makeimage(2))
+    with open(filename, 'wb') as f:
+        f.write(encoded[:parsecbfheader(encoded)[2] + 100])
+    # reading a truncated file must raise an exception, not crash
+    with pytest.raises(ValueError):
+        readcbf(filename)
+
+
+def test_long_header(tmp_path):
+    # the header is read in chunks: it must be found even if it spans several of them
+    header = '\n'.join(f'# Line_{i} {i * 0.5:.6f}' for i in range(500))
+    image = makeimage(3)
+    filename = str(tmp_path / 'crd_00001.cbf')
+    writecbf(filename, image, header)
+    assert cbfheadercontents(filename) == header
+    # re-encoding a file written by `writecbf()` gives the same bytes
+    copyname = str(tmp_path / 'copy' / 'crd_00001.cbf')
+    (tmp_path / 'copy').mkdir()
+    writecbf(copyname, readcbf(filename), cbfheadercontents(filename))
+    with open(filename, 'rb') as f1, open(copyname, 'rb') as f2:
+        assert f1.read() == f2.read()
@@ -0,0 +1,75 @@
+"""Single-pass data reduction: the fused kernel must give the same results as the step-by-step reduction"""
+import numpy as np
+import pytest
+
+from ..reductionchain import reductionchain
+
+SHAPE = (37, 53)
+
+
+def stepbystep(intensity, uncertainty, exptime, dark, transmission, emptyintensity, emptyuncertainty, corrections,
+               thickness, absintfactor):
+    """The numpy expressions of the step-by-step reduction in `DataReductionPipeLine` (`normalize_by_monitor()`,
+    `subtract_dark_background()`, `normalize_by_transmission()`, `subtract_empty_background()`,
+    `correct_geometry()`, `divide_by_thickness()` and `absolute_intensity_scaling()`)"""
+    uncertainty = (exptime[1] ** 2 * intensity ** 2 / exptime[0] ** 4 + uncertainty ** 2 / exptime[0] ** 2) ** 0.5
+    intensity = intensity / exptime[0]
+    uncertainty = (uncertainty ** 2 + dark[1] ** 2) ** 0.5
+    intensity = intensity - dark[0]
+    uncertainty = (uncertainty ** 2 / transmission[0] ** 2 +
+                   transmission[1] ** 2 * intensity ** 2 / transmission[0] ** 4) ** 0.5
+    intensity = intensity / transmission[0]
+    uncertainty = (uncertainty ** 2 + emptyuncertainty ** 2) ** 0.5
+    intensity = intensity - emptyintensity
+    for corr, dcorr in corrections:
+        uncertainty = (uncertainty ** 2 * corr ** 2 + intensity ** 2 * dcorr ** 2) ** 0.5
+        intensity = intensity * corr
+    uncertainty = (uncertainty ** 2 / thickness[0] ** 2 +
+                   thickness[1] ** 2 * intensity ** 2 / thickness[0] ** 4) ** 0.5
+    intensity = intensity / thickness[0]
+    uncertainty = (uncertainty ** 2 * absintfactor[0] ** 2 + intensity ** 2 * absintfactor[1] ** 2) ** 0.5
+    intensity = intensity * absintfactor[0]
+    return intensity, uncertainty
+
+
+@pytest.fixture
+def inputs():
+    rng = np.random.default_rng(0)
+    intensity = rng.poisson(100, SHAPE).astype(np.double)
+    uncertainty = intensity ** 0.5
+    emptyintensity = rng.uniform(0, 0.1, SHAPE)
+    emptyuncertainty = rng.uniform(0, 0.01, SHAPE)
+    corrections = [(rng.uniform(0.8, 1.2, SHAPE), rng.uniform(0, 0.01, SHAPE)) for i in range(3)]
+    return dict(intensity=intensity, uncertainty=uncertainty, exptime=(300.0, 0.01), dark=(0.0012, 0.0003),
+                transmission=(0.43, 0.004), emptyintensity=emptyintensity, emptyuncertainty=emptyuncertainty,
+                corrections=corrections, thickness=(0.143, 0.002), absintfactor=(4.3e-5, 2e-7))
+
+
+def fused(inputs, nthreads: int = 1, inplace: bool = False):
+    intensity = inputs['intensity'].ravel().copy()
+    uncertainty = inputs['uncertainty'].ravel().copy()
+    if inplace:
+        intensityout, uncertaintyout = intensity, uncertainty
+    else:
+        intensityout, uncertaintyout = np.empty_like(intensity), np.empty_like(uncertainty)
+    reductionchain(intensity, uncertainty, *inputs['exptime'], *inputs['dark'], *inputs['transmission'],
+                   inputs['emptyintensity'].ravel(), inputs['emptyuncertainty'].ravel(),
+                   *[matrix.ravel() for pair in inputs['corrections'] for matrix in pair],
+                   *inputs['thickness'], *inputs['absintfactor'], intensityout, uncertaintyout, nthreads)
+    return intensityout.reshape(SHAPE), uncertaintyout.reshape(SHAPE)
+
+
+@pytest.mark.parametrize('nthreads', [1, 4])
+@pytest.mark.parametrize('inplace', [False, True])
+def test_fused(inputs, nthreads, inplace):
+    intensity, uncertainty = fused(inputs, nthreads, inplace)
+    expectedintensity, expecteduncertainty = stepbystep(**inputs)
+    # the operations are done in the same order
+    np.testing.assert_array_equal(intensity, expectedintensity)
+    np.testing.assert_array_equal(uncertainty, expecteduncertainty)
+
+
+def test_shape_mismatch(inputs):
+    inputs['emptyintensity'] = inputs['emptyintensity'][:-1, :]
+    with pytest.raises(ValueError):
+        fused(inputs)
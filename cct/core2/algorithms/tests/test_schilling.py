@@ -0,0 +1,90 @@
+"""P-values of the cormap test: the memoized tables must give the same values as the original recursion"""
+import itertools
+
+import numpy as np
+import pytest
+
+from .. import schilling
+from ..schilling import cormap_pval, cormap_pvals, cormap_pval_table, longest_run
+
+DBL_MAX_EXP = 1024
+
+
+def reference_pval(n: int, x: int) -> float:
+    """The original implementation of `cormap_pval()`, for a single x"""
+    if x <= 1:
+        return 1.0
+    elif x > n:
+        return 0.0
+    elif x > DBL_MAX_EXP:
+        return 0.0
+    half_pow_x = 2.0 ** (-x)
+    P = [0.0] * x
+    P[0] = 2 * half_pow_x
+    i_x = 0
+    for i in range(x + 1, n + 1):
+        im1_x = i_x
+        i_x = i % x
+        P[i_x] = P[im1_x] + half_pow_x * (1 - P[i_x])
+    return P[i_x]
+
+
+@pytest.mark.parametrize('n', [0, 1, 2, 3, 10, 57, 300, 1100])
+def test_table(n):
+    table = cormap_pval_table(n)
+    assert table.shape == (max(n, 1) + 2,)
+    for x in range(-2, n + 3):
+        assert cormap_pval(n, x) == reference_pval(n, x)
+        if 0 <= x < table.size:
+            assert table[x] == reference_pval(n, x)
+
+
+@pytest.mark.parametrize('n', range(2, 13))
+def test_enumeration(n):
+    """Compare with the frequencies of the longest runs in all possible sequences of n coin tosses"""
+    longestruns = np.array([longest_run(np.array(signs, dtype=np.double))
+                            for signs in itertools.product([-1, 1], repeat=n)])
+    for x in range(0, n + 2):
+        assert cormap_pval(n, x) == pytest.approx((longestruns >= x).mean(), rel=1e-12, abs=1e-15)
+
+
+def test_memoized():
+    table = cormap_pval_table(123)
+    assert cormap_pval_table(123) is table
+    assert not table.flags.writeable
+    with pytest.raises(ValueError):
+        table[3] = 0
+    with pytest.raises(ValueError):
+        cormap_pval_table(-1)
+
+
+def test_memo_bounded(monkeypatch):
+    monkeypatch.setattr(schilling, '_pvaltablesmaxsize', 3)
+    tables = {n: cormap_pval_table(n) for n in [1001, 1002, 1003]}
+    assert cormap_pval_table(1001) is tables[1001]  # now 1002 is the least recently used one
+    cormap_pval_table(1004)
+    assert cormap_pval_table(1001) is tables[1001]
+    assert cormap_pval_table(1003) is tables[1003]
+    recalculated = cormap_pval_table(1002)
+    assert recalculated is not tables[1002]
+    np.testing.assert_array_equal(recalculated, tables[1002])
+
+
+def test_single_value():
+    # a single p-value does not need the whole table
+    n = 2345
+    for x in [2, 11, 1024, 1025, 2345]:
+        assert cormap_pval(n, x) == reference_pval(n, x)
+    assert n not in schilling._pvaltables
+    # but it is taken from there if available
+    table = cormap_pval_table(n)
+    for x in [2, 11, 1024, 1025, 2345]:
+        assert cormap_pval(n, x) == table[x]
+
+
+def test_vectorized():
+    n = 200
+    x = np.array([[-1, 0, 1, 2], [5, 17, 200, 201], [1000, 3, 8, 9]])
+    pvals = cormap_pvals(n, x)
+    assert pvals.shape == x.shape
+    np.testing.assert_array_equal(pvals, [[reference_pval(n, xi) for xi in row] for row in x])
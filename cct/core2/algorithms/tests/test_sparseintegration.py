@@ -0,0 +1,115 @@
+"""Averaging with pixel splitting: with bins much wider than a pixel the results must be close to those of `radavg()`
+and `azimavg()`, the intensities must be conserved, and stacks must give the same as single frames"""
+import numpy as np
+import pytest
+import scipy.sparse
+
+from .test_radavg import GEOMETRY, exposure, exposurestack, qrange
+from ..radavg import radavg, azimavg
+from ..sparseintegration import SparseRadialAveragingPlan, SparseAzimuthalAveragingPlan, _rowblocks
+
+NPHI = 12
+
+
+def validpixels(data, error, mask):
+    return (mask != 0) & np.isfinite(data) & np.isfinite(error)
+
+
+@pytest.mark.parametrize('errorprop', [0, 1, 2, 3])
+def test_radavg_coarse_bins(exposure, errorprop):
+    data, error, mask = exposure
+    qbins = qrange(mask, 1, 12)
+    plan = SparseRadialAveragingPlan(mask, *GEOMETRY, qbins)
+    # the weighted q averaging of `radavg()` is different (see the reference implementation in test_radavg.py)
+    q, intensity, uncertainty, quncertainty, area, pixel = plan.radavg(data, error, errorprop, 3, nthreads=1)
+    expected = radavg(data, error, mask, *[x for pair in GEOMETRY for x in pair], qbins, errorprop, 3, nthreads=1)
+    # the first and the last bins are only half as wide: split pixels make a larger difference there
+    np.testing.assert_allclose(area[1:-1], expected[4][1:-1], rtol=0.05)
+    np.testing.assert_allclose(q[1:-1], expected[0][1:-1], rtol=0.01)
+    np.testing.assert_allclose(pixel[1:-1], expected[5][1:-1], rtol=0.01)
+    np.testing.assert_allclose(intensity[1:-1], expected[1][1:-1], rtol=0.05)
+    np.testing.assert_allclose(uncertainty[1:-1], expected[2][1:-1], rtol=0.1)
+
+
+@pytest.mark.parametrize('errorprop', [0, 1, 2, 3])
+def test_azimavg_coarse_bins(exposure, errorprop):
+    data, error, mask = exposure
+    plan = SparseAzimuthalAveragingPlan(mask, *GEOMETRY, np.arange(NPHI) * 2 * np.pi / NPHI)
+    phi, intensity, uncertainty, phiuncertainty, area, qmean, qstd = plan.azimavg(data, error, errorprop, nthreads=1)
+    # the azimuth angles of the pixels are averaged with the phi error propagation type in `azimavg()`
+    expected = azimavg(data, error, mask, GEOMETRY[0][0], GEOMETRY[1][0], GEOMETRY[2][0], *GEOMETRY[3], *GEOMETRY[4],
+                       NPHI, errorprop, 3, nthreads=1)
+    np.testing.assert_allclose(area, expected[4], rtol=0.05)
+    np.testing.assert_allclose(phi, expected[0], atol=0.02)
+    np.testing.assert_allclose(intensity, expected[1], rtol=0.05)
+    np.testing.assert_allclose(uncertainty, expected[2], rtol=0.1)
+    np.testing.assert_allclose(qmean, expected[5], rtol=0.02)
+    # the spread of q is not compared: `azimavg()` divides by (N-1) instead of its square root
+
+
+def test_radavg_conservation(exposure):
+    data, error, mask = exposure
+    valid = validpixels(data, error, mask)
+    # the bins cover the whole detector, with the corners of the farthest pixels
+    qmax = SparseRadialAveragingPlan(mask, *GEOMETRY, qrange(mask, 1, 10)).pixelq.max()
+    plan = SparseRadialAveragingPlan(mask, *GEOMETRY, np.linspace(0, 1.1 * qmax, 17))
+    # each pixel is distributed completely among the bins
+    np.testing.assert_allclose(np.asarray(plan.weights.sum(axis=0)).ravel(), 1, rtol=1e-12)
+    q, intensity, uncertainty, quncertainty, area, pixel = plan.radavg(data, error, 1, 1, nthreads=1)
+    assert np.nansum(area) == pytest.approx(valid.sum(), rel=1e-12)
+    assert np.nansum(intensity * area) == pytest.approx(data[valid].sum(), rel=1e-12)
+
+
+def test_azimavg_conservation(exposure):
+    data, error, mask = exposure
+    valid = validpixels(data, error, mask)
+    plan = SparseAzimuthalAveragingPlan(mask, *GEOMETRY, np.arange(NPHI) * 2 * np.pi / NPHI)
+    np.testing.assert_allclose(np.asarray(plan.weights.sum(axis=0)).ravel(), 1, rtol=1e-12)
+    phi, intensity, uncertainty, phiuncertainty, area, qmean, qstd = plan.azimavg(data, error, 1, 1, nthreads=1)
+    assert area.sum() == pytest.approx(valid.sum(), rel=1e-12)
+    assert (intensity * area).sum() == pytest.approx(data[valid].sum(), rel=1e-12)
+
+
+@pytest.mark.parametrize('errorprop', [0, 1, 2, 3])
+def test_radavg_stack(exposurestack, errorprop):
+    intensities, uncertainties, mask = exposurestack
+    # invalid pixels are different in each frame
+    intensities = intensities.copy()
+    intensities[10, 20, 3] = np.nan
+    uncertainties = uncertainties.copy()
+    uncertainties[50, 30, 5] = np.inf
+    plan = SparseRadialAveragingPlan(mask, *GEOMETRY, qrange(mask, 1, 80))
+    curves = plan.radavg_stack(intensities, uncertainties, errorprop, errorprop, nthreads=1)
+    assert curves.shape == (80, 6, intensities.shape[2])
+    for i in range(intensities.shape[2]):
+        curve = plan.radavg(intensities[:, :, i], uncertainties[:, :, i], errorprop, errorprop, nthreads=1)
+        np.testing.assert_allclose(curves[:, :, i], np.vstack(curve).T, rtol=1e-13, equal_nan=True)
+    # the layout of the stack in memory does not matter
+    np.testing.assert_array_equal(
+        plan.radavg_stack(np.ascontiguousarray(intensities), np.ascontiguousarray(uncertainties), errorprop,
+                          errorprop, nthreads=1), curves)
+
+
+@pytest.mark.parametrize('nthreads', [2, 3, 8])
+def test_threads(exposurestack, nthreads):
+    intensities, uncertainties, mask = exposurestack
+    radialplan = SparseRadialAveragingPlan(mask, *GEOMETRY, qrange(mask, 1, 80))
+    azimuthalplan = SparseAzimuthalAveragingPlan(mask, *GEOMETRY, np.arange(NPHI) * 2 * np.pi / NPHI)
+    # every bin is calculated in the same way as in a single thread
+    np.testing.assert_array_equal(radialplan.radavg_stack(intensities, uncertainties, nthreads=nthreads),
+                                  radialplan.radavg_stack(intensities, uncertainties, nthreads=1))
+    for x, y in zip(
+            azimuthalplan.azimavg(intensities[:, :, 0], uncertainties[:, :, 0], nthreads=nthreads),
+            azimuthalplan.azimavg(intensities[:, :, 0], uncertainties[:, :, 0], nthreads=1)):
+        np.testing.assert_array_equal(x, y)
+
+
+@pytest.mark.parametrize('nblocks', [1, 2, 5, 100])
+def test_rowblocks(nblocks):
+    # some rows are empty
+    matrix = scipy.sparse.diags(np.where((np.arange(37) >= 5) & (np.arange(37) < 9), 0.0, 1.0)) @ \
+             scipy.sparse.random(37, 50, density=0.1, format='csr', random_state=3)
+    matrix.eliminate_zeros()
+    blocks = _rowblocks(matrix, nblocks)
+    assert len(blocks) <= nblocks
+    np.testing.assert_array_equal(scipy.sparse.vstack(blocks).toarray(), matrix.toarray())
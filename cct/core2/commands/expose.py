@@ -61,10 +61,15 @@ class Expose(Command):
         self.waiting_for_images -= 1
         self.tryToFinalize()
 
+    def imagesToWaitFor(self, nimages: int) -> int:
+        """In pipelined mode, the command finishes when the exposure is done, the images are loaded in the background
+        while the next command runs."""
+        return 0 if self.instrument.exposer.isPipelined() else nimages
+
     def initialize(self, exptime: float, prefix: str):
         self.connectExposer()
         self.success = None
-        self.waiting_for_images = 1
+        self.waiting_for_images = self.imagesToWaitFor(1)
         try:
             fsn = self.instrument.exposer.startExposure(prefix, exptime, writenexus=True)
         except:
@@ -90,7 +95,7 @@ class ExposeMulti(Expose):
     def initialize(self, exptime: float, nimages: int, prefix: str, delay: float):
         self.connectExposer()
         self.success = None
-        self.waiting_for_images = nimages
+        self.waiting_for_images = self.imagesToWaitFor(nimages)
         try:
             fsn = self.instrument.exposer.startExposure(prefix, exptime, nimages, delay, writenexus=True)
         except:
@@ -1,5 +1,7 @@
-from .curve import Curve
-from .exposure import Exposure
+from .cake import Cake
+from .curve import Curve, CurveAverager
+from .exposure import Exposure, ExposureAverager
 from .header import Header
 from .scan import Scan
 from .sample import Sample
+from .sharedexposure import SharedExposureRing
@@ -37,7 +37,7 @@ class AzimuthalCurve:
 
     @property
     def qstd(self) -> np.ndarray:
-        return self._data[:, 5]
+        return self._data[:, 6]
 
     @classmethod
     def fromFile(cls, filename: str, *args, **kwargs) -> "AzimuthalCurve":
@@ -0,0 +1,125 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+from .azimuthalcurve import AzimuthalCurve
+from .curve import Curve
+from ..algorithms.matrixaverager import ErrorPropagationMethod
+from ..algorithms.radavg import cakenormalize
+
+
+class Cake:
+    """A scattering pattern rebinned in (q, phi)
+
+    The accumulated (not yet normalized) sums of each bin are stored, as returned by `cakeavg()`. Radial and
+    azimuthal slices are thus simple sums along either axis, without a new pass over the scattering pattern.
+    """
+    # shape (Nq, Nphi, 11): Intensity, Intensity2, Error, q, q2, qError, Area, pixel, phi, phi2, phiError
+    _sums: np.ndarray
+    qbincenters: np.ndarray
+    errorprop: ErrorPropagationMethod
+    qerrorprop: ErrorPropagationMethod
+    _normalized: Optional[Tuple[np.ndarray, ...]] = None
+
+    def __init__(self, sums: np.ndarray, qbincenters: np.ndarray, errorprop: ErrorPropagationMethod,
+                 qerrorprop: ErrorPropagationMethod):
+        if (sums.ndim != 3) or (sums.shape[2] != 11) or (sums.shape[0] != len(qbincenters)):
+            raise ValueError('Shape mismatch')
+        self._sums = sums
+        self.qbincenters = qbincenters
+        self.errorprop = errorprop
+        self.qerrorprop = qerrorprop
+
+    @classmethod
+    def fromSums(cls, Intensity: np.ndarray, Intensity2: np.ndarray, Error: np.ndarray, q: np.ndarray,
+                 q2: np.ndarray, qError: np.ndarray, Area: np.ndarray, pixel: np.ndarray, phi: np.ndarray,
+                 phi2: np.ndarray, phiError: np.ndarray, qbincenters: np.ndarray,
+                 errorprop: ErrorPropagationMethod, qerrorprop: ErrorPropagationMethod) -> "Cake":
+        return cls(np.stack([Intensity, Intensity2, Error, q, q2, qError, Area, pixel, phi, phi2, phiError],
+                            axis=2).astype(np.double),
+                   qbincenters, errorprop, qerrorprop)
+
+    def __array__(self) -> np.ndarray:
+        return self._sums
+
+    asArray = __array__
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self._sums.shape[:2]
+
+    @property
+    def phi(self) -> np.ndarray:
+        """Centers of the azimuthal bins, in radians. The first bin is centered on 0."""
+        return np.arange(self._sums.shape[1]) * 2 * np.pi / self._sums.shape[1]
+
+    def _normalize(self, sums: np.ndarray) -> Tuple[np.ndarray, ...]:
+        return cakenormalize(*[sums[..., i] for i in range(8)], self.errorprop.value, self.qerrorprop.value)
+
+    def _getnormalized(self, index: int) -> np.ndarray:
+        if self._normalized is None:
+            self._normalized = self._normalize(self._sums)
+        return self._normalized[index]
+
+    @property
+    def q(self) -> np.ndarray:
+        return self._getnormalized(0)
+
+    @property
+    def intensity(self) -> np.ndarray:
+        return self._getnormalized(1)
+
+    @property
+    def uncertainty(self) -> np.ndarray:
+        return self._getnormalized(2)
+
+    @property
+    def quncertainty(self) -> np.ndarray:
+        return self._getnormalized(3)
+
+    @property
+    def binarea(self) -> np.ndarray:
+        return self._getnormalized(4)
+
+    @property
+    def pixel(self) -> np.ndarray:
+        return self._getnormalized(5)
+
+    def _phiselection(self, phicenter: float, phihalfwidth: float, symmetric: bool = False) -> np.ndarray:
+        deltaphi = np.abs(np.angle(np.exp(1j * (self.phi - phicenter))))
+        # allow for rounding errors: bin centers exactly on the border of the sector must be included
+        tolerance = 1e-6 * np.pi / self._sums.shape[1]
+        if symmetric:
+            return np.logical_or(deltaphi <= phihalfwidth + tolerance, deltaphi >= np.pi - phihalfwidth - tolerance)
+        return deltaphi <= phihalfwidth + tolerance
+
+    def radial_average(self) -> Curve:
+        """Full radial average, the same as `Exposure.radial_average()` with the same q-bins"""
+        return Curve.fromVectors(*self._normalize(self._sums.sum(axis=1)))
+
+    def radial_slice(self, phicenter: float, phihalfwidth: float, symmetric: bool = False) -> Curve:
+        """Radial average of the azimuthal bins whose center is in a sector.
+
+        The arguments have the same meaning as for `maskforsectors()`: angles are in radians, `symmetric` includes
+        the opposite sector as well.
+        """
+        return Curve.fromVectors(
+            *self._normalize(self._sums[:, self._phiselection(phicenter, phihalfwidth, symmetric), :].sum(axis=1)))
+
+    def azimuthal_slice(self, qmin: float, qmax: float) -> AzimuthalCurve:
+        """Azimuthal average of the q-bins whose center is in the closed interval [qmin, qmax]
+
+        The azimuth angle and its uncertainty are averaged like in `azimavg()`, with the error propagation type of q.
+        The q spread of a bin is the sample standard deviation of the q values around their mean.
+        """
+        qselection = np.logical_and(self.qbincenters >= qmin, self.qbincenters <= qmax)
+        sums = self._sums[qselection, :, :].sum(axis=0)
+        qmean = self._normalize(sums)[0]
+        # the sums of phi are normalized in the same way as those of q
+        phi, intensity, uncertainty, phiuncertainty, binarea, pixel = self._normalize(
+            sums[..., [0, 1, 2, 8, 9, 10, 6, 7]])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            qstd = np.where(binarea < 2, 0,
+                            (np.clip(sums[..., 4] - binarea * qmean ** 2, 0, None) / (binarea - 1)) ** 0.5)
+        qstd[binarea == 0] = np.nan
+        return AzimuthalCurve.fromVectors(phi, intensity, uncertainty, phiuncertainty, binarea, qmean, qstd)
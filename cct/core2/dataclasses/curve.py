@@ -131,20 +131,10 @@ class Curve:
     @classmethod
     def average(cls, curves: Iterable["Curve"], ierrorpropagation: ErrorPropagationMethod,
                 qerrorpropagation: ErrorPropagationMethod) -> "Curve":
-        qavg = MatrixAverager(errorpropagationmethod=qerrorpropagation)
-        iavg = MatrixAverager(errorpropagationmethod=ierrorpropagation)
-        aavg = MatrixAverager(errorpropagationmethod=ierrorpropagation)
-        pavg = MatrixAverager(errorpropagationmethod=ierrorpropagation)
+        averager = CurveAverager(ierrorpropagation, qerrorpropagation)
         for c in curves:
-            qavg.add(c.q, c.quncertainty)
-            iavg.add(c.intensity, c.uncertainty)
-            aavg.add(c.binarea, c.binarea)
-            pavg.add(c.pixel, c.pixel)
-        q, dq = qavg.get()
-        i, di = iavg.get()
-        a = aavg.get()[0]
-        p = pavg.get()[0]
-        return Curve.fromVectors(q, i, di, dq, a, p)
+            averager.add(c)
+        return averager.get()
 
     def isfinite(self) -> np.ndarray:
         idx = np.logical_and(np.isfinite(self.q, np.isfinite(self.intensity)))
@@ -410,3 +400,45 @@ class Curve:
             )
         else:
             return NotImplemented
+
+
+class CurveAverager:
+    """Accumulator for averaging curves, see `Curve.average()`
+
+    Partial averagers (e.g. of different chunks of curves in different processes) can be pickled and combined with
+    `merge()`.
+    """
+    qavg: MatrixAverager
+    iavg: MatrixAverager
+    aavg: MatrixAverager
+    pavg: MatrixAverager
+
+    def __init__(self, ierrorpropagation: ErrorPropagationMethod, qerrorpropagation: ErrorPropagationMethod):
+        self.qavg = MatrixAverager(errorpropagationmethod=qerrorpropagation)
+        self.iavg = MatrixAverager(errorpropagationmethod=ierrorpropagation)
+        self.aavg = MatrixAverager(errorpropagationmethod=ierrorpropagation)
+        self.pavg = MatrixAverager(errorpropagationmethod=ierrorpropagation)
+
+    @property
+    def count(self) -> int:
+        return self.iavg.count
+
+    def add(self, curve: Curve):
+        self.qavg.add(curve.q, curve.quncertainty)
+        self.iavg.add(curve.intensity, curve.uncertainty)
+        self.aavg.add(curve.binarea, curve.binarea)
+        self.pavg.add(curve.pixel, curve.pixel)
+
+    def merge(self, other: "CurveAverager") -> "CurveAverager":
+        self.qavg.merge(other.qavg)
+        self.iavg.merge(other.iavg)
+        self.aavg.merge(other.aavg)
+        self.pavg.merge(other.pavg)
+        return self
+
+    def get(self) -> Curve:
+        q, dq = self.qavg.get()
+        i, di = self.iavg.get()
+        a = self.aavg.get()[0]
+        p = self.pavg.get()[0]
+        return Curve.fromVectors(q, i, di, dq, a, p)
@@ -1,14 +1,17 @@
 import enum
 import logging
-from typing import Optional, Union, Tuple, Iterable
+from typing import Optional, Union, Tuple, Iterable, List
 
 import numpy as np
 
 from .azimuthalcurve import AzimuthalCurve
+from .cake import Cake
 from .curve import Curve
 from .header import Header
 from ..algorithms.matrixaverager import ErrorPropagationMethod, MatrixAverager
-from ..algorithms.radavg import radavg, autoq, azimavg, validpixelrange
+from ..algorithms.integrationplan import radavgplancache, RadialAveragingPlan
+from ..algorithms.radavg import azimavg, cakeavg, validpixelrange
+from ..algorithms.sparseintegration import sparseradavgplancache, sparseazimavgplancache, SparseRadialAveragingPlan
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -22,6 +25,12 @@ class QRangeMethod(enum.Enum):
     Square_root = 3
 
 
+class IntegrationBackend(enum.Enum):
+    """Implementations of radial and azimuthal averaging"""
+    Cython = 'cython'  # each pixel falls into exactly one bin
+    SparseMatrix = 'sparse'  # pixels are split among bins, see `sparseintegration`
+
+
 class Exposure:
     intensity: np.ndarray
     mask: np.ndarray  # 1: valid: 0: invalid
@@ -43,36 +52,46 @@ class Exposure:
         self.uncertainty = uncertainty
         self.header = header
 
-    def radial_average(self, qbincenters: Optional[Union[np.ndarray, int, Tuple[QRangeMethod, int]]] = None,
-                       errorprop: ErrorPropagationMethod = ErrorPropagationMethod.Gaussian,
-                       qerrorprop: ErrorPropagationMethod = ErrorPropagationMethod.Gaussian) -> Curve:
+    def radial_averaging_plan(
+            self, qbincenters: Optional[Union[np.ndarray, int, Tuple[QRangeMethod, int]]] = None,
+            backend: IntegrationBackend = IntegrationBackend.Cython
+    ) -> Union[RadialAveragingPlan, SparseRadialAveragingPlan]:
+        """Get the precomputed geometry-dependent part of the radial averaging.
+
+        Exposures in a series share it: plans are cached by geometry, mask and q-bins.
+        """
         if (qbincenters is None) or isinstance(qbincenters, int):
-            qbincenters = autoq(
-                self.mask, self.header.wavelength[0], self.header.distance[0], self.header.pixelsize[0],
-                self.header.beamposrow[0], self.header.beamposcol[0], linspacing=1,
-                N=-1 if qbincenters is None else qbincenters)
+            qbins = (QRangeMethod.Linear.value, -1 if qbincenters is None else qbincenters)
         elif isinstance(qbincenters, tuple) and (len(qbincenters) == 2) and isinstance(qbincenters[0], QRangeMethod):
-            qbincenters = autoq(
-                self.mask, self.header.wavelength[0], self.header.distance[0], self.header.pixelsize[0],
-                self.header.beamposrow[0], self.header.beamposcol[0], linspacing=qbincenters[0].value,
-                N=-1 if (qbincenters[1]<1) else qbincenters[1])
+            qbins = (qbincenters[0].value, -1 if (qbincenters[1] < 1) else qbincenters[1])
         elif not isinstance(qbincenters, np.ndarray):
             raise TypeError(f'Invalid type for parameter `qbincenters`: {type(qbincenters)}')
-        q, intensity, uncertainty, quncertainty, binarea, pixel = radavg(
-            self.intensity, self.uncertainty, self.mask,
-            self.header.wavelength[0], self.header.wavelength[1],
-            self.header.distance[0], self.header.distance[1],
-            self.header.pixelsize[0], self.header.pixelsize[1],
-            self.header.beamposrow[0], self.header.beamposrow[1],
-            self.header.beamposcol[0], self.header.beamposcol[1],
-            qbincenters,
-            errorprop.value, qerrorprop.value
-        )
+        else:
+            qbins = qbincenters
+        cache = sparseradavgplancache if backend == IntegrationBackend.SparseMatrix else radavgplancache
+        return cache.get(
+            self.mask, self.header.wavelength, self.header.distance, self.header.pixelsize,
+            self.header.beamposrow, self.header.beamposcol, qbins)
+
+    def radial_average(self, qbincenters: Optional[Union[np.ndarray, int, Tuple[QRangeMethod, int]]] = None,
+                       errorprop: ErrorPropagationMethod = ErrorPropagationMethod.Gaussian,
+                       qerrorprop: ErrorPropagationMethod = ErrorPropagationMethod.Gaussian,
+                       nthreads: int = 0, backend: IntegrationBackend = IntegrationBackend.Cython) -> Curve:
+        q, intensity, uncertainty, quncertainty, binarea, pixel = self.radial_averaging_plan(
+            qbincenters, backend).radavg(
+            self.intensity, self.uncertainty, errorprop.value, qerrorprop.value, nthreads)
         return Curve.fromVectors(q, intensity, uncertainty, quncertainty, binarea, pixel)
 
     def azim_average(self, count=100,
                      errorprop: ErrorPropagationMethod = ErrorPropagationMethod.Conservative,
-                     qerrorprop: ErrorPropagationMethod = ErrorPropagationMethod.Conservative) -> AzimuthalCurve:
+                     qerrorprop: ErrorPropagationMethod = ErrorPropagationMethod.Conservative,
+                     nthreads: int = 0, backend: IntegrationBackend = IntegrationBackend.Cython) -> AzimuthalCurve:
+        if backend == IntegrationBackend.SparseMatrix:
+            plan = sparseazimavgplancache.get(
+                self.mask, self.header.wavelength, self.header.distance, self.header.pixelsize,
+                self.header.beamposrow, self.header.beamposcol, np.arange(count) * 2 * np.pi / count)
+            return AzimuthalCurve.fromVectors(
+                *plan.azimavg(self.intensity, self.uncertainty, errorprop.value, qerrorprop.value, nthreads))
         phi, intensity, uncertainty, phiuncertainty, binarea, qmean, qstd = azimavg(
             self.intensity, self.uncertainty, self.mask,
             self.header.wavelength[0],  # self.header.wavelength[1],
@@ -81,10 +100,27 @@ class Exposure:
             self.header.beamposrow[0], self.header.beamposrow[1],
             self.header.beamposcol[0], self.header.beamposcol[1],
             count,
-            errorprop.value, qerrorprop.value
+            errorprop.value, qerrorprop.value, nthreads
         )
         return AzimuthalCurve.fromVectors(phi, intensity, uncertainty, phiuncertainty, binarea, qmean, qstd)
 
+    def cake(self, qbincenters: Optional[Union[np.ndarray, int, Tuple[QRangeMethod, int]]] = None, phicount: int = 100,
+             errorprop: ErrorPropagationMethod = ErrorPropagationMethod.Gaussian,
+             qerrorprop: ErrorPropagationMethod = ErrorPropagationMethod.Gaussian,
+             nthreads: int = 0) -> Cake:
+        """Rebin the scattering pattern in (q, phi). The q-bins are the same as for `radial_average()`, the default
+        number of azimuthal bins is the same as for `azim_average()`."""
+        qbincenters = self.radial_averaging_plan(qbincenters).qbincenters
+        sums = cakeavg(
+            self.intensity, self.uncertainty, self.mask,
+            self.header.wavelength[0], self.header.wavelength[1],
+            self.header.distance[0], self.header.distance[1],
+            self.header.pixelsize[0], self.header.pixelsize[1],
+            self.header.beamposrow[0], self.header.beamposrow[1],
+            self.header.beamposcol[0], self.header.beamposcol[1],
+            qbincenters, phicount, errorprop.value, qerrorprop.value, nthreads)
+        return Cake.fromSums(*sums, qbincenters, errorprop, qerrorprop)
+
     @property
     def size(self) -> int:
         return self.intensity.size
@@ -131,20 +167,10 @@ class Exposure:
 
     @classmethod
     def average(cls, exposures: Iterable["Exposure"], errorpropagation: ErrorPropagationMethod) -> "Exposure":
-        avgintensity = MatrixAverager(errorpropagation)
-        mask = None
-        headers = []
+        averager = ExposureAverager(errorpropagation)
         for ex in exposures:
-            assert ex.intensity is not None
-            assert ex.uncertainty is not None
-            avgintensity.add(ex.intensity, ex.uncertainty)
-            if mask is None:
-                mask = ex.mask
-            else:
-                mask = np.logical_and(mask > 0, ex.mask > 0)
-            headers.append(ex.header)
-        intensity, uncertainty = avgintensity.get()
-        return Exposure(intensity, Header.average(*headers), uncertainty, mask)
+            averager.add(ex)
+        return averager.get()
 
     def qtopixel(self, q: Union[float, np.ndarray]) -> Union[float, np.ndarray]:
         return np.tan(2 * np.arcsin(q / 4 / np.pi * self.header.wavelength[0])) * self.header.distance[0] / \
@@ -157,4 +183,48 @@ class Exposure:
     def validpixelrange(self) -> Tuple[float, float]:
         """Return the valid pixel range, i.e. the lowest and highest distance from the origin of the
         valid pixels"""
-        return validpixelrange(self.mask, self.header.beamposrow[0], self.header.beamposcol[0])
\ No newline at end of file
+        return validpixelrange(self.mask, self.header.beamposrow[0], self.header.beamposcol[0])
+
+
+class ExposureAverager:
+    """Accumulator for averaging exposures, see `Exposure.average()`
+
+    Partial averagers (e.g. of different chunks of exposures in different processes) can be pickled and combined
+    with `merge()`. The mask of the average is the intersection of the masks, the header is averaged from all the
+    headers.
+    """
+    intensity: MatrixAverager
+    mask: Optional[np.ndarray] = None
+    headers: List[Header]
+
+    def __init__(self, errorpropagation: ErrorPropagationMethod):
+        self.intensity = MatrixAverager(errorpropagation)
+        self.mask = None
+        self.headers = []
+
+    @property
+    def count(self) -> int:
+        return self.intensity.count
+
+    def add(self, exposure: Exposure):
+        assert exposure.intensity is not None
+        assert exposure.uncertainty is not None
+        self.intensity.add(exposure.intensity, exposure.uncertainty)
+        self._mergemask(exposure.mask)
+        self.headers.append(exposure.header)
+
+    def _mergemask(self, mask: Optional[np.ndarray]):
+        if self.mask is None:
+            self.mask = mask
+        elif mask is not None:
+            self.mask = np.logical_and(self.mask > 0, mask > 0)
+
+    def merge(self, other: "ExposureAverager") -> "ExposureAverager":
+        self.intensity.merge(other.intensity)
+        self._mergemask(other.mask)
+        self.headers.extend(other.headers)
+        return self
+
+    def get(self) -> Exposure:
+        intensity, uncertainty = self.intensity.get()
+        return Exposure(intensity, Header.average(*self.headers), uncertainty, self.mask)
@@ -0,0 +1,137 @@
+"""Passing exposures between processes through shared memory
+
+Pickling an exposure through a multiprocessing queue copies the intensity, uncertainty and mask matrices twice (once
+when pickling, once when unpickling), per direction. A SharedExposureRing is a block of shared memory divided into
+preallocated slots of the same shape. The owner process reserves a slot, copies the matrices in it, and only sends the
+slot index and the header data through the queue. The receiving process sees the matrices without copying.
+
+The ring is created in the owner process. Pickling it only transfers the name of the shared memory block: it can be
+passed as an argument to `multiprocessing.Process` or to a pool task, and it is attached to on the other side.
+"""
+import logging
+import threading
+from multiprocessing.shared_memory import SharedMemory
+from typing import Tuple, Optional, List, Dict, Any
+
+import numpy as np
+
+from .exposure import Exposure
+from .header import Header
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# shared memory blocks attached to in this process, by name. Unpickling the same ring for every task reuses them.
+_attached: Dict[str, SharedMemory] = {}
+_attachedlock = threading.Lock()
+
+
+class SharedExposureRing:
+    """Preallocated shared memory slots for exposures of the same shape
+
+    Each slot holds the intensity and the uncertainty (double precision) and the mask (uint8) of an exposure. Slots
+    are reserved by `acquire()` and given back by `release()`, both only in the owner process.
+    """
+    shape: Tuple[int, int]
+    nslots: int
+    name: str
+    owner: bool
+    _shm: SharedMemory
+    _free: List[int]
+    _lock: threading.Lock
+
+    def __init__(self, shape: Tuple[int, int], nslots: int):
+        if nslots < 1:
+            raise ValueError('At least one slot is needed.')
+        self.shape = tuple(shape)
+        self.nslots = nslots
+        self.owner = True
+        self._shm = SharedMemory(create=True, size=self.slotsize() * nslots)
+        self.name = self._shm.name
+        self._free = list(range(nslots))
+        self._lock = threading.Lock()
+
+    def slotsize(self) -> int:
+        """Size of a slot in bytes"""
+        return int(np.prod(self.shape)) * (2 * np.dtype(np.double).itemsize + np.dtype(np.uint8).itemsize)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {'shape': self.shape, 'nslots': self.nslots, 'name': self.name}
+
+    def __setstate__(self, state: Dict[str, Any]):
+        self.shape = tuple(state['shape'])
+        self.nslots = state['nslots']
+        self.name = state['name']
+        self.owner = False
+        self._free = []
+        self._lock = threading.Lock()
+        with _attachedlock:
+            try:
+                self._shm = _attached[self.name]
+            except KeyError:
+                self._shm = _attached[self.name] = SharedMemory(name=self.name, create=False)
+
+    def arrays(self, slot: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Intensity, uncertainty and mask matrices in a slot, as views into the shared memory"""
+        if (slot < 0) or (slot >= self.nslots):
+            raise IndexError(f'Invalid slot index {slot}')
+        npix = int(np.prod(self.shape))
+        offset = slot * self.slotsize()
+        intensity = np.ndarray(self.shape, np.double, buffer=self._shm.buf, offset=offset)
+        uncertainty = np.ndarray(self.shape, np.double, buffer=self._shm.buf,
+                                 offset=offset + npix * np.dtype(np.double).itemsize)
+        mask = np.ndarray(self.shape, np.uint8, buffer=self._shm.buf,
+                          offset=offset + 2 * npix * np.dtype(np.double).itemsize)
+        return intensity, uncertainty, mask
+
+    def fits(self, exposure: Exposure) -> bool:
+        """Check if the exposure can be put in a slot"""
+        return tuple(exposure.intensity.shape) == self.shape
+
+    def acquire(self) -> Optional[int]:
+        """Reserve a free slot. Returns its index or None if all slots are in use."""
+        if not self.owner:
+            raise RuntimeError('Slots can only be reserved in the owner process.')
+        with self._lock:
+            return self._free.pop(0) if self._free else None
+
+    def release(self, slot: int):
+        """Give back a slot reserved by `acquire()`"""
+        with self._lock:
+            if (slot < 0) or (slot >= self.nslots) or (slot in self._free):
+                raise ValueError(f'Cannot release slot {slot}')
+            self._free.append(slot)
+
+    def put(self, slot: int, exposure: Exposure) -> Dict[str, Any]:
+        """Copy the matrices of an exposure in a slot. Returns the header data, to be sent along the slot index."""
+        if not self.fits(exposure):
+            raise ValueError('Shape mismatch')
+        intensity, uncertainty, mask = self.arrays(slot)
+        np.copyto(intensity, exposure.intensity, casting='unsafe')
+        np.copyto(uncertainty, exposure.uncertainty, casting='unsafe')
+        np.copyto(mask, exposure.mask, casting='unsafe')
+        return exposure.header._data
+
+    def get(self, slot: int, headerdata: Dict[str, Any], copy: bool = True) -> Exposure:
+        """Construct an exposure from the matrices in a slot.
+
+        If `copy` is False, the matrices of the exposure are views into the shared memory: the slot must not be
+        reused while the exposure is alive.
+        """
+        intensity, uncertainty, mask = self.arrays(slot)
+        if copy:
+            intensity, uncertainty, mask = intensity.copy(), uncertainty.copy(), mask.copy()
+        return Exposure(intensity, Header(datadict=headerdata), uncertainty, mask)
+
+    def close(self):
+        """Detach from the shared memory. The owner also frees it.
+
+        All views returned by `arrays()` and `get(copy=False)` must have been deleted before."""
+        with _attachedlock:
+            _attached.pop(self.name, None)
+        try:
+            self._shm.close()
+        except BufferError:
+            logger.warning(f'Shared exposure ring {self.name} is still in use, cannot close it.')
+        if self.owner:
+            self._shm.unlink()
@@ -0,0 +1,124 @@
+"""Shared memory exposure ring: exposures must come out of the slots as they were put in, in this process as well as
+in the others"""
+import multiprocessing
+import pickle
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import pytest
+
+from ..exposure import Exposure
+from ..header import Header
+from ..sharedexposure import SharedExposureRing
+
+SHAPE = (23, 31)
+
+
+def makeexposure(seed: int) -> Exposure:
+    rng = np.random.default_rng(seed)
+    intensity = rng.uniform(0, 100, SHAPE)
+    mask = (rng.uniform(size=SHAPE) > 0.1).astype(np.uint8)
+    return Exposure(intensity, Header(datadict={'fsn': seed, 'title': f'Sample{seed}'}), intensity ** 0.5, mask)
+
+
+def assert_exposures_equal(exposure: Exposure, expected: Exposure):
+    np.testing.assert_array_equal(exposure.intensity, expected.intensity)
+    np.testing.assert_array_equal(exposure.uncertainty, expected.uncertainty)
+    np.testing.assert_array_equal(exposure.mask, expected.mask)
+    assert exposure.header._data == expected.header._data
+
+
+@pytest.fixture
+def ring():
+    ring = SharedExposureRing(SHAPE, 3)
+    yield ring
+    ring.close()
+
+
+def readslot(ring: SharedExposureRing, slot: int, headerdata, resultqueue: multiprocessing.Queue):
+    """Run in a child process: read an exposure from a slot and write it back in the next one, scaled by 2"""
+    exposure = ring.get(slot, headerdata)
+    resultqueue.put((exposure.intensity, exposure.uncertainty, exposure.mask, exposure.header._data))
+    ring.put(slot + 1, Exposure(exposure.intensity * 2, exposure.header, exposure.uncertainty, exposure.mask))
+    ring.close()
+
+
+@pytest.mark.parametrize('copy', [True, False])
+def test_roundtrip(ring, copy):
+    exposures = [makeexposure(i) for i in range(3)]
+    slots = [ring.acquire() for exposure in exposures]
+    headerdata = [ring.put(slot, exposure) for slot, exposure in zip(slots, exposures)]
+    for slot, hd, expected in zip(slots, headerdata, exposures):
+        exposure = ring.get(slot, hd, copy=copy)
+        assert_exposures_equal(exposure, expected)
+        intensity = ring.arrays(slot)[0]
+        # without copying, the matrices of the exposure are the shared memory itself
+        assert np.shares_memory(exposure.intensity, intensity) != copy
+        del exposure, intensity
+
+
+def test_child_process(ring):
+    expected = makeexposure(5)
+    slot = ring.acquire()
+    headerdata = ring.put(slot, expected)
+    # spawned, not forked: the ring is pickled and attached to in the child
+    context = multiprocessing.get_context('spawn')
+    resultqueue = context.Queue()
+    process = context.Process(target=readslot, args=(ring, slot, headerdata, resultqueue))
+    process.start()
+    intensity, uncertainty, mask, headerdata = resultqueue.get(timeout=60)
+    process.join(timeout=60)
+    assert process.exitcode == 0
+    assert_exposures_equal(Exposure(intensity, Header(datadict=headerdata), uncertainty, mask), expected)
+    # the child has written in the next slot of the same memory block
+    np.testing.assert_array_equal(ring.get(slot + 1, headerdata).intensity, 2 * expected.intensity)
+
+
+def test_attached_copy(ring):
+    attached = pickle.loads(pickle.dumps(ring))
+    assert not attached.owner
+    slot = ring.acquire()
+    headerdata = ring.put(slot, makeexposure(1))
+    assert_exposures_equal(attached.get(slot, headerdata), makeexposure(1))
+    # only the owner reserves slots
+    with pytest.raises(RuntimeError):
+        attached.acquire()
+    # detaching does not free the shared memory
+    attached.close()
+    assert_exposures_equal(ring.get(slot, headerdata), makeexposure(1))
+
+
+def test_slots(ring):
+    slots = [ring.acquire() for i in range(ring.nslots)]
+    assert sorted(slots) == list(range(ring.nslots))
+    # all slots are in use
+    assert ring.acquire() is None
+    ring.release(slots[1])
+    assert ring.acquire() == slots[1]
+    ring.release(slots[0])
+    with pytest.raises(ValueError):
+        ring.release(slots[0])
+    for slot in [-1, ring.nslots]:
+        with pytest.raises(ValueError):
+            ring.release(slot)
+        with pytest.raises(IndexError):
+            ring.arrays(slot)
+
+
+def test_shape_mismatch(ring):
+    exposure = Exposure(np.ones((SHAPE[0], SHAPE[1] + 1)), Header(datadict={}))
+    assert not ring.fits(exposure)
+    with pytest.raises(ValueError):
+        ring.put(ring.acquire(), exposure)
+    with pytest.raises(ValueError):
+        SharedExposureRing(SHAPE, 0)
+
+
+def test_unlink():
+    ring = SharedExposureRing(SHAPE, 2)
+    # the shared memory exists until the owner closes the ring
+    other = SharedMemory(name=ring.name, create=False)
+    other.close()
+    ring.close()
+    with pytest.raises(FileNotFoundError):
+        SharedMemory(name=ring.name, create=False)
@@ -1,14 +1,15 @@
 import logging
 import multiprocessing
+import os
 import queue
-from typing import Optional
+from typing import Optional, List, Dict, Tuple
 
 from PyQt5 import QtCore
 from PyQt5.QtCore import pyqtSignal as Signal, pyqtSlot as Slot
 
 from .datareductionpipeline import DataReductionPipeLine
 from ..component import Component
-from ....dataclasses import Exposure
+from ....dataclasses import Exposure, SharedExposureRing
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -18,98 +19,283 @@ logger.setLevel(logging.INFO)
 
 
 class DataReduction(QtCore.QObject, Component):
-    backend: Optional[multiprocessing.Process] = None
-    queuetobackend: Optional[multiprocessing.Queue] = None
+    """Data reduction front-end: a pool of DataReductionPipeLine processes
+
+    The number of processes is set by the 'nworkers' setting in the 'datareduction' section of the config. Sample
+    exposures are distributed among the processes in a round-robin manner. Reference measurements (dark, empty beam,
+    absolute intensity reference), which change the state of the pipeline, are processed by all of them, before
+    the exposures submitted afterwards. Results are emitted in the order of submission.
+
+    A process which stops unexpectedly is replaced by a new one, the others are not disturbed. None is emitted for the
+    exposures submitted to the stopped process and not yet reduced, like for exposures which failed to be reduced.
+    The latest reference measurements are kept and passed to the new process before any exposure, thus it starts
+    with the same state as the others.
+
+    Sample exposures are passed to the processes in the slots of a shared memory ring ('sharedslots' in the
+    'datareduction' section of the config, 0 disables it), falling back to pickling through the queue if all slots
+    are busy or the shape of the exposure is different.
+    """
+    backends: List[multiprocessing.Process]
+    queuestobackend: List[multiprocessing.Queue]
     queuefrombackend: Optional[multiprocessing.Queue] = None
     datareductionresult= Signal(object)
     submitted: int = 0
     timerinterval: float = 0.1
     timer: Optional[int] = None
+    nextjobid: int = 0  # ID of the next submitted exposure
+    nextresultid: int = 0  # ID of the next result to be emitted
+    pendingresults: Dict[int, Optional[Exposure]]
+    outstandingjobs: Dict[int, Tuple[int, Optional[int]]]  # job ID -> (back-end index, shared memory slot)
+    nextbackend: int = 0  # round-robin index
+    finishedbackends: int = 0
+    ring: Optional[SharedExposureRing] = None
+    # reference kind ('dark', 'emptybeam', 'absintref') -> the reference measurements to be processed, in this order,
+    # to reproduce the latest one of this kind: the latest one itself and those it was reduced with
+    referencechains: Dict[str, List[Exposure]]
 
     def __init__(self, **kwargs):
+        self.backends = []
+        self.queuestobackend = []
+        self.pendingresults = {}
+        self.outstandingjobs = {}
+        self.referencechains = {}
         super().__init__(**kwargs)
 
+    def slotcount(self) -> int:
+        try:
+            return max(0, int(self.config['datareduction']['sharedslots']))
+        except KeyError:
+            return 4 * self.workercount()
+
+    def workercount(self) -> int:
+        try:
+            return max(1, int(self.config['datareduction']['nworkers']))
+        except KeyError:
+            return 1
+
     def _startbackend(self):
-        if self.backend is not None:
+        if self.backends:
             raise RuntimeError('Data reduction pipeline already running.')
-        self.queuetobackend = multiprocessing.Queue()
         self.queuefrombackend = multiprocessing.Queue()
-        self.backend = multiprocessing.Process(target=DataReductionPipeLine.run_in_background,
-                                               args=(self.config.asdict(), self.queuetobackend, self.queuefrombackend))
-        self.backend.start()
+        self.referencechains = {}
+        for i in range(self.workercount()):
+            backend, commandqueue = self._newbackend()
+            self.queuestobackend.append(commandqueue)
+            self.backends.append(backend)
+        self.finishedbackends = 0
+        self.nextbackend = 0
+        self.nextjobid = self.nextresultid = 0
+        self.pendingresults = {}
+        self.outstandingjobs = {}
+
+    def _newbackend(self) -> Tuple[multiprocessing.Process, multiprocessing.Queue]:
+        """Start a back-end process with its own command queue
+
+        The reference measurements encountered so far are replayed to it, before any exposure is submitted.
+        """
+        commandqueue = multiprocessing.Queue()
+        backend = multiprocessing.Process(target=DataReductionPipeLine.run_in_background,
+                                          args=(self.config.asdict(), commandqueue, self.queuefrombackend))
+        backend.start()
+        if self.ring is not None:
+            commandqueue.put_nowait(('ring', self.ring))
+        for exposure in self._referencereplay():
+            commandqueue.put_nowait(('reference', exposure))
+        return backend, commandqueue
+
+    def _addreference(self, kind: str, exposure: Exposure):
+        """Remember the latest reference measurement of a kind, with the earlier ones it is reduced with
+
+        The empty beam measurement is reduced with the current dark, the absolute intensity reference with the current
+        empty beam and dark (which may be newer than the dark the empty beam was reduced with).
+        """
+        if kind == 'dark':
+            self.referencechains['dark'] = [exposure]
+        elif kind == 'emptybeam':
+            self.referencechains['emptybeam'] = self.referencechains.get('dark', []) + [exposure]
+        else:
+            self.referencechains[kind] = (
+                    self.referencechains.get('emptybeam', []) + self.referencechains.get('dark', []) + [exposure])
+
+    def _referencereplay(self) -> List[Exposure]:
+        """The reference measurements to be processed by a new pipeline to reach the state of the running ones"""
+        return (self.referencechains.get('absintref', []) + self.referencechains.get('emptybeam', []) +
+                self.referencechains.get('dark', []))
 
     def _cleanupbackend(self):
-        if self.backend is None:
+        if not self.backends:
             return
-        self.queuetobackend.close()
+        for commandqueue in self.queuestobackend:
+            commandqueue.close()
         self.queuefrombackend.close()
-        self.backend.join()
-        self.queuetobackend = None
+        for backend in self.backends:
+            backend.join()
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+        self.queuestobackend = []
         self.queuefrombackend = None
-        self.backend = None
-        self.killTimer(self.timer)
+        self.backends = []
+        self.outstandingjobs = {}
+        if self.timer is not None:
+            self.killTimer(self.timer)
         self.timer = None
         self.stopping = False
 
+    def _restartbackend(self, index: int):
+        """Replace a back-end process which has stopped unexpectedly, without disturbing the others
+
+        The stopped process is not waited for. The jobs submitted to it are finished with None as their result,
+        thus the results of the later jobs can still be emitted in order.
+        """
+        logger.error(f'Data reduction process #{index} stopped unexpectedly, restarting it.')
+        # do not wait for the commands not yet read by the stopped process to be flushed
+        self.queuestobackend[index].cancel_join_thread()
+        self.queuestobackend[index].close()
+        self.backends[index], self.queuestobackend[index] = self._newbackend()
+        for jobid in sorted([j for j, (i, slot) in self.outstandingjobs.items() if i == index]):
+            slot = self.outstandingjobs[jobid][1]
+            if slot is not None:
+                self.ring.release(slot)
+            self._jobfinished(jobid, None)
+
+    def _checkbackends(self):
+        """Restart the back-end processes which have died without saying goodbye (e.g. crashed)"""
+        for index, backend in enumerate(self.backends):
+            if backend.exitcode is not None:
+                self._restartbackend(index)
+
+    def _jobfinished(self, jobid: int, exposure: Optional[Exposure]):
+        """Store the result of a job and emit the results which are due, in the order of submission"""
+        if self.outstandingjobs.pop(jobid, None) is None:
+            # late result of a job of a restarted process: None has already been emitted for it
+            return
+        self.pendingresults[jobid] = exposure
+        while self.nextresultid in self.pendingresults:
+            exposure = self.pendingresults.pop(self.nextresultid)
+            if (exposure is not None) and (self.instrument is not None):
+                self.instrument.io.indexFile('eval2d', os.path.join(
+                    self.instrument.io.getSubDir('eval2d'),
+                    self.instrument.io.formatFileName(exposure.header.prefix, exposure.header.fsn, '.npz')))
+            self.datareductionresult.emit(exposure)
+            self.nextresultid += 1
+            self.submitted -= 1
+
     def startComponent(self):
         self._startbackend()
         self.started.emit()
 
     def timerEvent(self, event: QtCore.QTimerEvent) -> None:
-        try:
-            cmd, arg = self.queuefrombackend.get_nowait()
-        except queue.Empty:
-            return
-        logger.debug(f'Message from backend: {cmd=}, {arg=}')
-        if cmd == 'finished' and self.stopping:
-            self._cleanupbackend()
-            self.stopped.emit()
-        elif cmd == 'finished':
-            # stopped for other reasons, try to restart.
-            self._cleanupbackend()
-            self._startbackend()
-        elif cmd == 'log':
-            logger_background.log(*arg)
-        elif cmd == 'result':
-            self.datareductionresult.emit(arg)
-            self.submitted -= 1
-        else:
-            assert False
-        if (self.submitted <= 0) and (cmd != 'log'):
-            self.submitted = 0
-            if self.timer is not None:
-                self.killTimer(self.timer)
-                self.timer = None
-            # keep the back-end running but we do not expect any message from it.
-            if self._panicking == self.PanicState.Panicking:
-                super().panichandler()
+        while self.queuefrombackend is not None:
+            try:
+                cmd, arg = self.queuefrombackend.get_nowait()
+                logger.debug(f'Message from backend: {cmd=}, {arg=}')
+            except queue.Empty:
+                if self.stopping:
+                    return
+                # look for dead processes only when no messages are waiting: their last results are not lost
+                self._checkbackends()
+                cmd, arg = None, None
+            if cmd == 'finished':
+                if self.stopping:
+                    self.finishedbackends += 1
+                    if self.finishedbackends >= len(self.backends):
+                        self._cleanupbackend()
+                        self.stopped.emit()
+                        return
+                    continue
+                elif arg in [backend.pid for backend in self.backends]:
+                    # stopped for other reasons, try to restart.
+                    self._restartbackend([backend.pid for backend in self.backends].index(arg))
+            elif cmd == 'log':
+                logger_background.log(*arg)
+                continue
+            elif cmd in ['jobresult', 'slotresult']:
+                if cmd == 'slotresult':
+                    jobid, slot, headerdata = arg
+                    if jobid not in self.outstandingjobs:
+                        # the slot has already been released when the process was restarted
+                        continue
+                    exposure = self.ring.get(slot, headerdata) if headerdata is not None else None
+                    self.ring.release(slot)
+                else:
+                    jobid, exposure = arg
+                self._jobfinished(jobid, exposure)
+            elif cmd is not None:
+                assert False
+            if self.submitted <= 0:
+                self.submitted = 0
+                if (self.timer is not None) and (not self.stopping):
+                    self.killTimer(self.timer)
+                    self.timer = None
+                # keep the back-end running but we do not expect any message from it.
+                if self._panicking == self.PanicState.Panicking:
+                    super().panichandler()
+                return
+            if cmd is None:
+                return
 
     def stopComponent(self):
         self.stopping = True
-        self.queuetobackend.put_nowait(('end', None))
+        for commandqueue in self.queuestobackend:
+            commandqueue.put_nowait(('end', None))
         if self.timer is None:
             self.timer = self.startTimer(10, QtCore.Qt.VeryCoarseTimer)
 
     def running(self) -> bool:
-        return self.backend is not None
+        return bool(self.backends)
 
     def submit(self, exposure: Exposure):
         if self._panicking != self.PanicState.NoPanic:
             raise RuntimeError('Cannot submit exposure: panic!')
         if not self.running():
             raise RuntimeError('Cannot submit exposure: data reduction component not running')
-        self.queuetobackend.put_nowait(('process', exposure))
+        jobid = self.nextjobid
+        self.nextjobid += 1
+        target = self.nextbackend
+        self.nextbackend = (self.nextbackend + 1) % len(self.backends)
+        try:
+            referencekind = DataReductionPipeLine.reference_kind(exposure)
+        except Exception:
+            # cannot decide, let the pipeline report the error
+            referencekind = None
+        isreference = referencekind is not None
+        if isreference:
+            # all pipelines must see the reference before the exposures submitted later, as well as the ones started
+            # later to replace a stopped one
+            self._addreference(referencekind, exposure)
+            for i, commandqueue in enumerate(self.queuestobackend):
+                if i != target:
+                    commandqueue.put_nowait(('reference', exposure))
+        slot = None if isreference else self._acquireslot(exposure)
+        self.outstandingjobs[jobid] = target, slot
+        if slot is not None:
+            headerdata = self.ring.put(slot, exposure)
+            self.queuestobackend[target].put_nowait(('processslot', (jobid, slot, headerdata)))
+        else:
+            self.queuestobackend[target].put_nowait(('processjob', (jobid, exposure)))
         if self.timer is None:
             self.timer = self.startTimer(int(self.timerinterval * 1000), QtCore.Qt.VeryCoarseTimer)
         self.submitted += 1
 
+    def _acquireslot(self, exposure: Exposure) -> Optional[int]:
+        """Reserve a slot in the shared memory ring for the exposure, making the ring if needed"""
+        if (self.ring is None) and (self.slotcount() > 0):
+            self.ring = SharedExposureRing(exposure.intensity.shape, self.slotcount())
+            for commandqueue in self.queuestobackend:
+                commandqueue.put_nowait(('ring', self.ring))
+        if (self.ring is None) or (not self.ring.fits(exposure)):
+            return None
+        return self.ring.acquire()
+
     def onConfigChanged(self, path, value):
         if self.running():
-            self.queuetobackend.put_nowait(('config', self.config.asdict()))
+            for commandqueue in self.queuestobackend:
+                commandqueue.put_nowait(('config', self.config.asdict()))
 
     def panichandler(self):
         self._panicking = self.PanicState.Panicking
         if self.submitted > 0:
             pass
         else:
-            super().panichandler()
\ No newline at end of file
+            super().panichandler()
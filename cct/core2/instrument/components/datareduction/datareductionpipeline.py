@@ -4,16 +4,18 @@ import multiprocessing
 import pickle
 import re
 import traceback
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple
 import os
 import queue
 
 import numpy as np
 import scipy.odr
 
-from ....algorithms.geometrycorrections import angledependentabsorption, angledependentairtransmission, solidangle
+from ....algorithms.geometrycorrections import geometrycorrectioncache
+from ....algorithms.radavg import setnthreads, getnthreads
+from ....algorithms.reductionchain import reductionchain
 from ....config import Config
-from ....dataclasses import Exposure, Sample
+from ....dataclasses import Exposure, Sample, SharedExposureRing
 from ..io import IO
 
 logger = logging.getLogger(__name__)
@@ -29,6 +31,7 @@ class DataReductionPipeLine:
     emptybeam: Optional[Exposure] = None
     absintref: Optional[Exposure] = None
     commandqueue: Optional[multiprocessing.Queue] = None
+    ring: Optional[SharedExposureRing] = None
     resultqueue: Optional[multiprocessing.Queue] = None
     config: Dict[str, Any]
     io: IO
@@ -36,6 +39,11 @@ class DataReductionPipeLine:
     def __init__(self, config: Dict[str, Any]):
         self.config = config
         self.io = IO(config=self.config, instrument=None)
+        self.applyThreadCount()
+
+    def applyThreadCount(self):
+        """Set the number of threads used for radial and azimuthal averaging. Nonpositive means all CPUs."""
+        setnthreads(self.config.get('datareduction', {}).get('nthreads', 1))
 
     @classmethod
     def run_in_background(cls, config: Dict, commandqueue: multiprocessing.Queue, resultqueue: multiprocessing.Queue, stopevent: Optional[multiprocessing.Event] = None):
@@ -49,6 +57,11 @@ class DataReductionPipeLine:
             if cmd == 'end':
                 obj.debug('Ending')
                 break
+            elif cmd == 'ring':
+                # shared memory slots for passing the exposures: see 'processslot'
+                if obj.ring is not None:
+                    obj.ring.close()
+                obj.ring = arg
             elif cmd == 'process':
                 try:
                     if isinstance(arg, Exposure):
@@ -64,8 +77,45 @@ class DataReductionPipeLine:
                 except Exception as exc:
                     obj.error(repr(exc) + '\n' + traceback.format_exc())
                     obj.resultqueue.put_nowait(('result', None))
+            elif cmd == 'processjob':
+                # numbered job in a pool of pipelines: the result is tagged with the job ID
+                jobid, exposure = arg
+                try:
+                    obj.debug(f'Processing job {jobid}')
+                    exposure = obj.process(exposure)
+                except ProcessingError as pe:
+                    obj.error(pe.args[0])
+                    exposure = None
+                except Exception as exc:
+                    obj.error(repr(exc) + '\n' + traceback.format_exc())
+                    exposure = None
+                obj.resultqueue.put_nowait(('jobresult', (jobid, exposure)))
+            elif cmd == 'processslot':
+                # numbered job, the exposure is in a slot of the shared memory ring. The result is written in the same
+                # slot, only the header data is sent back.
+                jobid, slot, headerdata = arg
+                try:
+                    obj.debug(f'Processing job {jobid} in slot {slot}')
+                    exposure = obj.process(obj.ring.get(slot, headerdata, copy=False))
+                    headerdata = obj.ring.put(slot, exposure)
+                except ProcessingError as pe:
+                    obj.error(pe.args[0])
+                    headerdata = None
+                except Exception as exc:
+                    obj.error(repr(exc) + '\n' + traceback.format_exc())
+                    headerdata = None
+                exposure = None  # do not keep a reference to the shared memory
+                obj.resultqueue.put_nowait(('slotresult', (jobid, slot, headerdata)))
+            elif cmd == 'reference':
+                # a reference measurement processed by another pipeline in the pool: only update the state, the
+                # other pipeline reports the result and saves the file.
+                try:
+                    obj.process(arg, save=False)
+                except Exception as exc:
+                    obj.debug(f'Error while processing reference exposure: {exc}')
             elif cmd == 'config':
                 obj.config = arg
+                obj.applyThreadCount()
                 #obj.debug('Config updated.')
             else:
                 obj.error(f'Unknown command: {cmd}')
@@ -75,20 +125,30 @@ class DataReductionPipeLine:
                 commandqueue.get_nowait()
             except queue.Empty:
                 break
+        if obj.ring is not None:
+            obj.ring.close()
         obj.debug('Finishing background thread.')
 
-        obj.resultqueue.put_nowait(('finished', None))
+        # the process ID tells the pool which of its processes has finished
+        obj.resultqueue.put_nowait(('finished', os.getpid()))
 
-    def process(self, exposure: Exposure) -> Exposure:
+    def process(self, exposure: Exposure, save: bool = True) -> Exposure:
         self.info(f'Starting data reduction on exposure #{exposure.header.fsn}: {exposure.header.title} @ {exposure.header.distance[0]:.2f} mm, category={exposure.header.sample_category}')
-        for operation in [self.sanitize_data, self.normalize_by_monitor, self.subtract_dark_background,
-                          self.normalize_by_transmission, self.subtract_empty_background, self.correct_geometry,
-                          self.divide_by_thickness, self.absolute_intensity_scaling]:
-            try:
-                exposure = operation(exposure)
-            except StopIteration as si:
-                exposure = si.args[0]
-                break
+        exposure = self.sanitize_data(exposure)
+        if self.config.get('datareduction', {}).get('fused', True) and self.is_fusable(exposure):
+            exposure = self.reduce_fused(exposure)
+        else:
+            # step-by-step reduction: needed for the reference measurements, also useful for debugging
+            for operation in [self.normalize_by_monitor, self.subtract_dark_background,
+                              self.normalize_by_transmission, self.subtract_empty_background, self.correct_geometry,
+                              self.divide_by_thickness, self.absolute_intensity_scaling]:
+                try:
+                    exposure = operation(exposure)
+                except StopIteration as si:
+                    exposure = si.args[0]
+                    break
+        if not save:
+            return exposure
         os.makedirs(self.config['path']['directories']['eval2d'], exist_ok=True)
         exposure.save(
             os.path.join(
@@ -102,6 +162,76 @@ class DataReductionPipeLine:
             pickle.dump(exposure.header._data, f)
         return exposure
 
+    @staticmethod
+    def reference_kind(exposure: Exposure) -> Optional[str]:
+        """Get which state of the pipeline the exposure can change: 'dark', 'emptybeam' or 'absintref' for dark,
+        empty beam and absolute intensity reference measurements, respectively, None for other exposures."""
+        sample = exposure.header.sample()
+        if (sample.category == Sample.Categories.Dark) or (sample.title == 'Dark'):
+            return 'dark'
+        elif (sample.category == Sample.Categories.Empty_beam) or (exposure.header.title == 'Empty_Beam'):
+            return 'emptybeam'
+        elif sample.category in [Sample.Categories.NormalizationSample, Sample.Categories.Calibrant]:
+            return 'absintref'
+        return None
+
+    @classmethod
+    def is_reference(cls, exposure: Exposure) -> bool:
+        """Check if the exposure can change the state of the pipeline: dark, empty beam and absolute intensity
+        reference measurements."""
+        return cls.reference_kind(exposure) is not None
+
+    def is_fusable(self, exposure: Exposure) -> bool:
+        """Check if the exposure can be reduced by `reduce_fused()`: it is neither a dark, an empty beam nor an
+        absolute intensity reference measurement, and all these references have already been encountered."""
+        if self.is_reference(exposure):
+            return False
+        elif (self.dark is None) or (self.emptybeam is None) or (self.absintref is None):
+            return False
+        return self.emptybeam.intensity.shape == exposure.intensity.shape
+
+    def reduce_fused(self, exposure: Exposure) -> Exposure:
+        """Do all the data reduction steps after sanitization in a single pass
+
+        Equivalent to `normalize_by_monitor()`, `subtract_dark_background()`, `normalize_by_transmission()`,
+        `subtract_empty_background()`, `correct_geometry()`, `divide_by_thickness()` and
+        `absolute_intensity_scaling()` for exposures accepted by `is_fusable()`, but without the intermediate arrays.
+        """
+        self.check_transmission(exposure)
+        sa, dsa, asa, dasa, aaa, daaa = self.geometry_corrections(exposure)
+        exposure.header.fsn_dark = self.dark.header.fsn
+        exposure.header.dark_cps = self.dark.header.dark_cps
+        exposure.header.fsn_emptybeam = self.emptybeam.header.fsn
+        self.take_absint_reference(exposure)
+        shape = exposure.intensity.shape
+        intensity = np.empty(shape, np.double)
+        uncertainty = np.empty(shape, np.double)
+        reductionchain(
+            np.ascontiguousarray(exposure.intensity, np.double).ravel(),
+            np.ascontiguousarray(exposure.uncertainty, np.double).ravel(),
+            exposure.header.exposuretime[0], exposure.header.exposuretime[1],
+            exposure.header.dark_cps[0], exposure.header.dark_cps[1],
+            exposure.header.transmission[0], exposure.header.transmission[1],
+            np.ascontiguousarray(self.emptybeam.intensity, np.double).ravel(),
+            np.ascontiguousarray(self.emptybeam.uncertainty, np.double).ravel(),
+            np.ascontiguousarray(sa, np.double).ravel(), np.ascontiguousarray(dsa, np.double).ravel(),
+            np.ascontiguousarray(asa, np.double).ravel(), np.ascontiguousarray(dasa, np.double).ravel(),
+            np.ascontiguousarray(aaa, np.double).ravel(), np.ascontiguousarray(daaa, np.double).ravel(),
+            exposure.header.thickness[0], exposure.header.thickness[1],
+            exposure.header.absintfactor[0], exposure.header.absintfactor[1],
+            intensity.ravel(), uncertainty.ravel(), getnthreads())
+        exposure.intensity = intensity
+        exposure.uncertainty = uncertainty
+        self.info(
+            f'FSN #{exposure.header.fsn} has been reduced in a single pass: normalized by exposure time '
+            f'{exposure.header.exposuretime[0]} s, corrected for dark background '
+            f'{exposure.header.dark_cps[0]:.4f} \xb1 {exposure.header.dark_cps[1]}, normalized by transmission '
+            f'{exposure.header.transmission[0]:g} \xb1 {exposure.header.transmission[1]:g}, corrected for '
+            f'instrumental background with image #{self.emptybeam.header.fsn} and for geometrical effects, '
+            f'divided by thickness {exposure.header.thickness[0]:g} \xb1 {exposure.header.thickness[1]:g} cm and '
+            f'calibrated into absolute units using exposure #{exposure.header.fsn_absintref}.')
+        return exposure
+
     def sanitize_data(self, exposure: Exposure) -> Exposure:
         exposure.mask[exposure.mask!=0] = 1  # set it to only 1 or 0.
         validbefore = exposure.mask.sum()
@@ -151,10 +281,14 @@ class DataReductionPipeLine:
             )
         return exposure
 
-    def normalize_by_transmission(self, exposure: Exposure) -> Exposure:
+    @staticmethod
+    def check_transmission(exposure: Exposure):
         if (exposure.header.transmission[0] > 1) or (exposure.header.transmission[0] < 0):
             raise ProcessingError(f'Invalid transmission value: '
                                   f'{exposure.header.transmission[0]:g} \xb1 {exposure.header.transmission[1]:g}.')
+
+    def normalize_by_transmission(self, exposure: Exposure) -> Exposure:
+        self.check_transmission(exposure)
         exposure.uncertainty = (exposure.uncertainty ** 2 / exposure.header.transmission[0] ** 2 +
                                 exposure.header.transmission[1] ** 2 * exposure.intensity ** 2 /
                                 exposure.header.transmission[0] ** 4) ** 0.5
@@ -183,19 +317,23 @@ class DataReductionPipeLine:
                      f'#{self.emptybeam.header.fsn}')
         return exposure
 
-    def correct_geometry(self, exposure: Exposure) -> Exposure:
-        twotheta = exposure.twotheta()
-        sa, dsa = solidangle(twotheta[0], twotheta[1], exposure.header.distance[0], exposure.header.distance[1],
-                             exposure.header.pixelsize[0], exposure.header.pixelsize[1])
-        asa, dasa = angledependentabsorption(twotheta[0], twotheta[1], exposure.header.transmission[0],
-                                             exposure.header.transmission[1])
+    def geometry_corrections(self, exposure: Exposure) -> Tuple[np.ndarray, ...]:
+        """Solid angle, sample self-absorption and air transmission correction matrices, with their uncertainties"""
+        # the scattering angle and the solid angle are only recalculated when the geometry changes
+        geometry = geometrycorrectioncache.get(
+            exposure.shape, exposure.header.distance, exposure.header.pixelsize, exposure.header.beamposrow,
+            exposure.header.beamposcol, exposure.twotheta)
+        sa, dsa = geometry.solidangle, geometry.dsolidangle
+        asa, dasa = geometry.absorption(exposure.header.transmission[0], exposure.header.transmission[1])
         try:
-            aaa, daaa = angledependentairtransmission(twotheta[0], twotheta[1], exposure.header.vacuum[0],
-                                                      exposure.header.distance[0],
-                                                      exposure.header.distance[1])  # ToDo: mu_air non-default value
+            aaa, daaa = geometry.airtransmission(exposure.header.vacuum[0])  # ToDo: mu_air non-default value
         except Exception as exc:
             self.warning(f'Error while getting angle dependent air transmission correction: {exc}. Traceback: {traceback.format_exc()}')
-            aaa, daaa = np.ones_like(twotheta[0]), np.zeros_like(twotheta[1])
+            aaa, daaa = np.ones_like(geometry.twotheta), np.zeros_like(geometry.dtwotheta)
+        return sa, dsa, asa, dasa, aaa, daaa
+
+    def correct_geometry(self, exposure: Exposure) -> Exposure:
+        sa, dsa, asa, dasa, aaa, daaa = self.geometry_corrections(exposure)
         exposure.uncertainty = (exposure.uncertainty ** 2 * sa ** 2 + exposure.intensity ** 2 * dsa ** 2) ** 0.5
         exposure.intensity = exposure.intensity * sa
         self.info(f'FSN #{exposure.header.fsn} has been corrected for detector flatness (pixel solid angle)')
@@ -276,13 +414,7 @@ class DataReductionPipeLine:
             raise ProcessingError('No absolute intensity reference measurement encountered up to now, cannot scale into'
                                   'absolute intensity units.')
         else:
-            exposure.header.absintdof = self.absintref.header.absintdof
-            exposure.header.absintchi2 = self.absintref.header.absintchi2
-            exposure.header.absintfactor = self.absintref.header.absintfactor
-            exposure.header.fsn_absintref = self.absintref.header.fsn
-            exposure.header.absintqmax = self.absintref.header.absintqmax
-            exposure.header.absintqmin = self.absintref.header.absintqmin
-            exposure.header.flux = self.absintref.header.flux
+            self.take_absint_reference(exposure)
             exposure.uncertainty = (exposure.uncertainty ** 2 * exposure.header.absintfactor[
                 0] ** 2 + exposure.intensity ** 2 * exposure.header.absintfactor[1] ** 2) ** 0.5
             exposure.intensity = exposure.intensity * exposure.header.absintfactor[0]
@@ -290,6 +422,16 @@ class DataReductionPipeLine:
                 f'FSN #{exposure.header.fsn} has been calibrated into absolute units using exposure #{exposure.header.fsn_absintref}. Absolute intensity factor: {exposure.header.absintfactor[0]:g} \xb1 {exposure.header.absintfactor[1]:g}, estimated beam flux {exposure.header.flux[0]:g} \xb1 {exposure.header.flux[1]:g}')
         return exposure
 
+    def take_absint_reference(self, exposure: Exposure):
+        """Copy the absolute intensity scaling parameters from the current reference measurement"""
+        exposure.header.absintdof = self.absintref.header.absintdof
+        exposure.header.absintchi2 = self.absintref.header.absintchi2
+        exposure.header.absintfactor = self.absintref.header.absintfactor
+        exposure.header.fsn_absintref = self.absintref.header.fsn
+        exposure.header.absintqmax = self.absintref.header.absintqmax
+        exposure.header.absintqmin = self.absintref.header.absintqmin
+        exposure.header.flux = self.absintref.header.flux
+
     @staticmethod
     def get_statistics(exposure: Exposure) -> Dict[str, float]:
         return {
@@ -1,18 +1,21 @@
+import concurrent.futures
 import datetime
 import enum
 import enum
 import logging
 import multiprocessing
 import time
-from typing import Dict, Optional, Any, List
+from typing import Dict, Optional, Any, List, Tuple
 
 import dateutil.parser
 from PyQt5 import QtCore
 from PyQt5.QtCore import pyqtSignal as Signal, pyqtSlot as Slot
 
 from .exposuredata import ExposureTask, ExposureState
+from .imagewatcher import ImageWatcher
 from ..component import Component
 from ..devicemanager import DeviceManager
+from ....devices.device.frontend import DeviceFrontend
 from ....dataclasses import Exposure
 from ....devices.detector.pilatus.backend import PilatusBackend
 from ....devices.detector.pilatus.frontend import PilatusDetector
@@ -57,17 +60,25 @@ class Exposer(QtCore.QObject, Component):
        with the detector computer or a panic situation), these may not be emitted at all.
 
     5. After the exposure time has elapsed, the ExposureTask starts looking for the image file on the disk / network
-       share. If found in a given interval (e.g. 2 seconds after the estimated end of the exposure), a metadata file
-       (pickle) is written, the image is loaded and an Exposure object is constructed, and returned to the Exposer via
-       the `finished` signal. If the waiting for the image times out, or the exposure has been stopped for some reason
-       (see above), None is returned instead of the Exposure object via the `finished` signal. The last signal emitted
-       by the ExposureTask is `finished`. It has two parameters: a bool (success or failure) and the Exposure object
-       (or None if the exposure failed for some reason). After it is emitted, the ExposureTask is removed.
+       share. Where possible, an ImageWatcher shared by all tasks notifies them as soon as the detector has finished
+       writing the file, otherwise the file is looked for periodically. If found in a given interval (e.g. 2 seconds
+       after the estimated end of the exposure), the image is loaded, a metadata file (pickle) is written and an
+       Exposure object is constructed in a background thread, and returned to the Exposer via the `finished` signal.
+       If the waiting for the image times out, or the exposure has been stopped for some reason (see above), None is
+       returned instead of the Exposure object via the `finished` signal. The last signal emitted by the ExposureTask
+       is `finished`. It has two parameters: a bool (success or failure) and the Exposure object (or None if the
+       exposure failed for some reason). After it is emitted, the ExposureTask is removed.
 
     6. The Exposer becomes idle when the detector becomes idle after the exposure AND all ExposureTasks have emitted
        their `exposureended` signals. At this time some ExposureTasks might still be waiting for the image file to
        become available in the file system, but this doesn't mean that a new exposure cannot be started.
 
+    Pipelined mode (config['exposer']['pipelined']): users of the Exposer (the `expose` commands, scans) are expected
+    to start the next exposure as soon as the previous one is finished, without waiting for the image to be loaded.
+    Also, if the detector is still prepared with the same parameters as requested, the prepare step (four commands and
+    replies) is skipped and the exposure is started right away. The dead time between the end of an exposure and the
+    start of the next one is reported through the `deadTime` signal.
+
     To the outside, interfacing with the Exposer is sufficient. This can be done with the following signals and methods:
 
     Signals:
@@ -82,6 +93,8 @@ class Exposer(QtCore.QObject, Component):
                 starttime: timestamp (time.monotonic()) of the (estimated) start of the exposure of the current image
                 endtime: timestamp (time.monotonic()) of the (estimated) end of the exposure of the current image
         imageReceived(Exposure): an image has been received.
+        deadTime(prefix: str, fsn: int, deadtime: float): an exposure has been started, `deadtime` seconds after the
+            end of the previous one.
 
     Methods:
          startExposure(...): request exposing one or more images
@@ -93,6 +106,7 @@ class Exposer(QtCore.QObject, Component):
                               float)  # prefix, fsn currently exposed, currenttime, starttime, endtime
     imageReceived = Signal(object)
     exposureStarted = Signal()
+    deadTime = Signal(str, int, float)  # prefix, fsn, time elapsed since the end of the previous exposure
 
     # List of ongoing exposure tasks
     exposuretasks: List[ExposureTask]
@@ -103,11 +117,20 @@ class Exposer(QtCore.QObject, Component):
     progresstimer: Optional[int] = None
     firstfilename: Optional[str] = None
     currentexposure: Optional[ExposureTask] = None
+    requestedparameters: Optional[Tuple[str, float, int, float]] = None  # prefix, exposure time, image count, delay
+    preparedparameters: Optional[Tuple[str, float, int, float, str]] = None  # the same + image path on the detector
+    lastexposureend: Optional[float] = None  # estimated end of the previous exposure (time.monotonic())
+    lastdeadtime: Optional[float] = None
+    imagewatcher: ImageWatcher
+    # loads the images and writes the metadata files in the background. A single worker keeps the order of the images.
+    imagefinalizer: concurrent.futures.ThreadPoolExecutor
 
     def __init__(self, **kwargs):
         self.state = ExposerState.Idle
         self.exposuretasks = []
         super().__init__(**kwargs)
+        self.imagewatcher = ImageWatcher(self)
+        self.imagefinalizer = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='imagefinalizer')
 
     def _connectDetector(self):
         """Connect signals to the Detector instance"""
@@ -174,18 +197,29 @@ class Exposer(QtCore.QObject, Component):
         # state: Idle -> Preparing
         # ##############################################
 
-        self.state = ExposerState.Preparing
-        logger.debug('Preparing the detector')
         nextfsn = self.instrument.io.nextfsn(prefix, checkout=imagecount)
         self.firstfilename = self.instrument.io.formatFileName(prefix, nextfsn, '.cbf')
-        self.detector.prepareexposure(
-            prefix,
-            exposuretime, imagecount, delay
-        )
+        self.requestedparameters = (prefix, exposuretime, imagecount, delay)
+        if self.isPrepared(prefix, exposuretime, imagecount, delay):
+            # ##############################################
+            # state: Idle -> Starting
+            # ##############################################
+            logger.debug('The detector is already prepared, instructing it to start the exposure')
+            self.detector.exposeprepared(self.firstfilename)
+            self.state = ExposerState.Starting
+        else:
+            self.state = ExposerState.Preparing
+            logger.debug('Preparing the detector')
+            self.preparedparameters = None
+            self.detector.prepareexposure(
+                prefix,
+                exposuretime, imagecount, delay
+            )
         logger.debug(f'Creating {imagecount} exposure tasks')
         for i in range(imagecount):
             task = ExposureTask(
-                self.instrument, self.detector, prefix, nextfsn + i, i, exposuretime, delay, maskoverride, writenexus)
+                self.instrument, self.detector, prefix, nextfsn + i, i, exposuretime, delay, maskoverride, writenexus,
+                self.imagewatcher, self.imagefinalizer)
             self.exposuretasks.append(task)
             task.exposurestarted.connect(self.onExposureTaskStarted)
             task.exposureended.connect(self.onExposureTaskEnded)
@@ -198,12 +232,36 @@ class Exposer(QtCore.QObject, Component):
         logger.debug('Waiting for the detector to finish preparing.')
         return nextfsn
 
+    def isPipelined(self) -> bool:
+        """Pipelined mode: do not wait for the images before starting the next exposure"""
+        try:
+            return bool(self.config['exposer']['pipelined'])
+        except KeyError:
+            return False
+
+    def isPrepared(self, prefix: str, exposuretime: float, imagecount: int, delay: float) -> bool:
+        """Check if the detector is still prepared for an exposure with the same parameters (only in pipelined mode)
+
+        The parameters of the last successful preparation are compared, as well as the current settings of the detector,
+        in case they have been changed by someone else in the meantime.
+        """
+        if (self.preparedparameters is None) or (not self.isPipelined()):
+            return False
+        try:
+            return ((self.preparedparameters == (prefix, exposuretime, imagecount, delay, self.detector['imgpath'])) and
+                    (abs(self.detector['exptime'] - exposuretime) < 0.00001) and
+                    (abs(self.detector['expperiod'] - exposuretime - delay) < 0.00001) and
+                    (self.detector['nimages'] == imagecount))
+        except (KeyError, DeviceFrontend.DeviceError):
+            return False
+
     @Slot()
     def onExposureTaskStarted(self):
         self.currentexposure = self.sender()
 
     @Slot()
     def onExposureTaskEnded(self):
+        self.lastexposureend = self.sender().endtime
         if self.currentexposure is self.sender():
             self.currentexposure = None
         else:
@@ -251,6 +309,10 @@ class Exposer(QtCore.QObject, Component):
             # state: Preparing -> Starting
             # ##############################################
             logger.debug('Instructing the detector to start the exposure')
+            try:
+                self.preparedparameters = self.requestedparameters + (self.detector['imgpath'],)
+            except DeviceFrontend.DeviceError:
+                self.preparedparameters = None
             self.detector.exposeprepared(self.firstfilename)
             self.state = ExposerState.Starting
         elif commandname == 'expose' and success:
@@ -271,9 +333,14 @@ class Exposer(QtCore.QObject, Component):
             date_with_timestamp = datetime.datetime.fromtimestamp(time.time()-time.monotonic()+timestamp_of_message_received)
 
             logger.debug(f'Exposure started by the detector at {date_reported_by_the_detector}, message received at {date_with_timestamp}, delta is {(date_with_timestamp-date_reported_by_the_detector).total_seconds():.6f} secs')
-            for task in self.exposuretasks:
-                if task.status == ExposureState.Initializing:
-                    task.onDetectorExposureStarted(timestamp_of_message_received)
+            starting = [task for task in self.exposuretasks if task.status == ExposureState.Initializing]
+            for task in starting:
+                task.onDetectorExposureStarted(timestamp_of_message_received)
+            if (self.lastexposureend is not None) and starting:
+                self.lastdeadtime = timestamp_of_message_received - self.lastexposureend
+                logger.debug(f'Dead time before exposure {starting[0].prefix}/{starting[0].fsn}: '
+                             f'{self.lastdeadtime:.3f} sec')
+                self.deadTime.emit(starting[0].prefix, starting[0].fsn, self.lastdeadtime)
 
             # also start the timer for emitting the progress signal periodically
             self.progresstimer = self.startTimer(int(1000 * self.progressinterval), QtCore.Qt.CoarseTimer)
@@ -288,6 +355,7 @@ class Exposer(QtCore.QObject, Component):
             # ##############################################
 
             logger.error(f'Error while starting exposure: {result}')
+            self.preparedparameters = None
             # remove to-be-started tasks
             self.exposuretasks = [t for t in self.exposuretasks if t.status != ExposureState.Initializing]
             if n := [t for t in self.exposuretasks if t.status in [ExposureState.Running, ExposureState.Pending]]:
@@ -315,6 +383,10 @@ class Exposer(QtCore.QObject, Component):
     def onDetectorVariableChanged(self, variable: str, value: Any, prevvalue: Any):
         if variable == '__status__':
             logger.debug(f'Detector status: {prevvalue} -> {value}')
+            if value not in [PilatusBackend.Status.Idle, PilatusBackend.Status.Exposing,
+                             PilatusBackend.Status.ExposingMulti]:
+                # trimming, stopping or preparing by someone else: do not rely on the previous preparation
+                self.preparedparameters = None
         if (variable == '__status__') and (self.state in [ExposerState.Exposing, ExposerState.Stopping]) and (
                 value in [PilatusBackend.Status.Idle]):
             # this means that exposing is done without error. Images are not necessarily read yet.
@@ -323,6 +395,8 @@ class Exposer(QtCore.QObject, Component):
             # ##############################################
 
             externalstop = self.state == ExposerState.Stopping
+            if externalstop:
+                self.lastexposureend = None
             logger.debug('Exposure stopped.' if externalstop else 'Exposure finished.')
             self.state = ExposerState.Idle
             self.exposureFinished.emit(not externalstop)
@@ -348,6 +422,11 @@ class Exposer(QtCore.QObject, Component):
     def imagesPending(self) -> int:
         return len([et for et in self.exposuretasks])
 
+    def stopComponent(self):
+        self.imagewatcher.close()
+        self.imagefinalizer.shutdown(wait=True)
+        super().stopComponent()
+
     def panichandler(self):
         """Handle a panic-shutdown request
 
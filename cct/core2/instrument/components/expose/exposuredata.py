@@ -1,17 +1,21 @@
 # coding: utf-8
 """ExposureTask: a class representing an ongoing exposure with the detector"""
+import concurrent.futures
 import datetime
 import enum
 import logging
 import os
 import pickle
 import time
-from typing import Optional
+from typing import Optional, List, Dict, Any
 
 import h5py
 import numpy as np
 from PyQt5 import QtCore
-from PyQt5.QtCore import pyqtSignal as Signal
+from PyQt5.QtCore import pyqtSignal as Signal, pyqtSlot as Slot
+
+from .imagewatcher import ImageWatcher
+from ....algorithms.readcbf import readcbf
 
 from ....dataclasses.exposure import Exposure
 from ....dataclasses.header import Header
@@ -28,8 +32,10 @@ class ExposureState(enum.Enum):
     Pending = enum.auto()  # another image is being collected, wait for our turn
     Running = enum.auto()  # this image is being collected
     WaitingForImage = enum.auto()  # collection done, trying to load the image file from disk
+    Finalizing = enum.auto()  # image file found, being loaded and saved in the background
     Finished = enum.auto()  # finished successfully, image have been loaded
     TimedOut = enum.auto()  # finished unsuccessfully, image file could not be found
+    Failed = enum.auto()  # finished unsuccessfully, image file could not be loaded or the metadata saved
     Stopped = enum.auto()  # finished, stopped on external request
 
 
@@ -45,10 +51,21 @@ class ExposureTask(QtCore.QObject):
           them are also elapsed. In this sense, the i-th exposure (i=1..) spends `exptime`*(i-1) + `expdelay`*(i-1) in
           the "Pending" state and finishes after i*`exptime` + (i-1)*`expdelay`.
         - When the exposure time has elapsed (on the clock of the computer, i.e. no interaction is needed with the
-          detector hardware), the state turns to "WaitingForImage". In this state the program tries periodically to load
-          the image file from the disk.
-        - If the image file is found in the preferred timeout interval, the status gets to "Finished". This is success.
-        - If the image file is not found even after the timeout has been elapsed, the status will be "TimedOut".
+          detector hardware), the metadata is collected from the current state of the instrument (in pipelined mode
+          the next exposure, or the next step of a script, may change it before the image file is found) and the
+          state turns to "WaitingForImage". In this state the program tries periodically to load
+          the image file from the disk. If an image watcher is available, the file is loaded as soon as the watcher
+          reports that it has been written. Polling is only a fallback then, done less frequently if the watcher has
+          already received events from the image directory.
+        - If the image file is found in the preferred timeout interval, the status gets to "Finalizing". The image is
+          loaded, the metadata and the NeXus file are written in a background thread (if a `finalizer` is given),
+          not to block the GUI.
+        - When finalization is done, the status gets to "Finished". This is success.
+        - If the image file cannot be read (e.g. it is not yet completely written), the status goes back to
+          "WaitingForImage" and loading is retried until the original timeout.
+        - If the image file is not found even after the timeout has been elapsed, the status will be "TimedOut". If
+          it has been found but could not be read until the timeout, or the metadata could not be saved, the status
+          will be "Failed".
 
     The following signals are defined:
 
@@ -74,6 +91,11 @@ class ExposureTask(QtCore.QObject):
     :type index: int
     :ivar maskoverride: use a different mask
     :type maskoverride: str or None
+    :ivar imagewatcher: notifies us when the image file has been written
+    :type imagewatcher: ImageWatcher or None
+    :ivar finalizer: executor for loading the image and writing the metadata. It must have a single worker, in order
+        that exposures are finished in the order their files were found. If None, this is done in the calling thread.
+    :type finalizer: concurrent.futures.Executor or None
     """
     # all times are from time.monotonic()
     prefix: str
@@ -87,19 +109,31 @@ class ExposureTask(QtCore.QObject):
     maskoverride: Optional[str] = None
     status: ExposureState = ExposureState.Initializing
     finished = Signal(bool, object)
+    imageFinalized = Signal(object, str)  # exposure or None, error message
+    imageReadFailed = Signal(str)  # error message
     exposurestarted = Signal()
     exposureended = Signal()
     pendingtimer: Optional[int] = None
     runningtimer: Optional[int] = None
     waitforimagetimer: Optional[int] = None
+    imagedeadline: Optional[float] = None  # when waitforimagetimer fires
     imageloadtimer: Optional[int] = None
     imageloadperiod: float = 0.1
+    imageloadperiod_watched: float = 0.5  # polling period if the image watcher is known to work
+    imagewatcher: Optional[ImageWatcher] = None
+    imagefilenames: List[str]  # possible locations of the image file
+    arrivedfilename: Optional[str] = None  # image file written before we expected it
+    finalizer: Optional[concurrent.futures.Executor] = None
+    imagefilename: Optional[str] = None  # the image file found
+    headerdata: Optional[Dict[str, Any]] = None  # the instrument state at the end of the exposure
+    headerfilename: Optional[str] = None  # the metadata file written
     instrument: "Instrument"
     detector: PilatusDetector
     h5filename: Optional[str] = None
 
     def __init__(self, instrument: "Instrument", detector: PilatusDetector, prefix: str, fsn: int, index: int,
-                 exptime: float, expdelay: float, maskoverride: Optional[str] = None, writenexus: bool = False):
+                 exptime: float, expdelay: float, maskoverride: Optional[str] = None, writenexus: bool = False,
+                 imagewatcher: Optional[ImageWatcher] = None, finalizer: Optional[concurrent.futures.Executor] = None):
         super().__init__()
         logger.debug(f'Initializing an exposure task for {prefix}/{fsn}')
         self.prefix = prefix
@@ -115,6 +149,14 @@ class ExposureTask(QtCore.QObject):
         self.instrument = instrument
         self.detector = detector
         self.writenexus = writenexus
+        self.imagefilenames = [os.path.abspath(f) for f in self.instrument.io.cbfFileNames(prefix, fsn)]
+        self.finalizer = finalizer
+        self.imageFinalized.connect(self.onImageFinalized)
+        self.imageReadFailed.connect(self.onImageReadFailed)
+        if (imagewatcher is not None) and imagewatcher.isActive():
+            self.imagewatcher = imagewatcher
+            self.imagewatcher.imageArrived.connect(self.onImageArrived)
+            self.imagewatcher.watch(self.imagefilenames)
         if writenexus:
             targetdir = os.path.join(self.instrument.io.getSubDir('nexus'), prefix)
             os.makedirs(targetdir, exist_ok=True)
@@ -154,42 +196,141 @@ class ExposureTask(QtCore.QObject):
             # image waiting timeout spent
             self.killTimer(self.waitforimagetimer)
             self.waitforimagetimer = None
+            if self.imageloadtimer is not None:
+                self.killTimer(self.imageloadtimer)
+                self.imageloadtimer = None
+            self.stopWatching()
             self.status = ExposureState.TimedOut
             self.finished.emit(False, None)
         elif (event.timerId() == self.imageloadtimer) and (self.status == ExposureState.WaitingForImage):
             # try to load the image
+            self.loadImage()
+
+    @Slot(str)
+    def onImageArrived(self, filename: str):
+        """Called by the image watcher when an image file has been written"""
+        if filename not in self.imagefilenames:
+            return
+        if self.status == ExposureState.WaitingForImage:
+            self.loadImage(filename)
+        elif self.status in [ExposureState.Initializing, ExposureState.Pending, ExposureState.Running]:
+            # the clock of the detector is somewhat ahead of ours: load the image when the exposure has ended
+            self.arrivedfilename = filename
+
+    def stopWatching(self):
+        if self.imagewatcher is None:
+            return
+        self.imagewatcher.imageArrived.disconnect(self.onImageArrived)
+        self.imagewatcher.unwatch(self.imagefilenames)
+        self.imagewatcher = None
+
+    def loadImage(self, filename: Optional[str] = None) -> bool:
+        """Start finishing the exposure if the image file is there.
+
+        The image is loaded and the metadata is saved by `finalizeImage()`, in the background if a finalizer has been
+        given. The metadata has already been collected at the end of the exposure, by `onExposureFinished()`.
+
+        :param filename: the full path of the image file. If None, all possible locations are tried.
+        :type filename: str or None
+        :return: True if the image file has been found, False if it is not there (yet?).
+        :rtype: bool
+        """
+        if filename is None:
             try:
-                image = self.instrument.io.loadCBF(self.prefix, self.fsn, check_local=False)
-            except FileNotFoundError:
+                filename = [f for f in self.imagefilenames if os.path.isfile(f)][0]
+            except IndexError:
                 # the file is not there (yet?). Wait until timeout
-                pass
-            else:
-                # the file has been found. Kill the timers
-                logger.debug(f'CBF file {self.prefix}/{self.fsn} has been found.')
-                self.killTimer(self.waitforimagetimer)
-                self.killTimer(self.imageloadtimer)
-                self.waitforimagetimer = None
-                self.imageloadtimer = None
-                self.status = ExposureState.Finished
-                # construct the metadata
-                logger.debug(f'Writing header for {self.prefix}/{self.fsn}')
-                header = self.createHeader()
-                self.instrument.io.imageReceived(self.prefix, self.fsn)
-                try:
-                    mask = self.instrument.io.loadMask(header.maskname)
-                except FileNotFoundError:
-                    logger.warning(f'Invalid mask file "{header.maskname}". You might have to create a mask yourself.')
-                    mask = np.ones_like(image, dtype=np.uint8)
-                uncertainty = np.empty_like(image)
-                uncertainty[image > 0] = image[image > 0] ** 0.5
-                uncertainty[image <= 0] = 1
-                logger.debug(f'Finalizing NeXus file for {self.prefix}/{self.fsn}')
-                self.writeNeXus(image, uncertainty, mask)
-                # emit the raw image.
-                exposure = Exposure(image, header, uncertainty, mask)
-                if self.prefix == self.instrument.config['path']['prefixes']['crd']:
-                    self.instrument.datareduction.submit(exposure)
-                self.finished.emit(True, exposure)
+                return False
+        # the file has been found. Kill the timers
+        logger.debug(f'CBF file {self.prefix}/{self.fsn} has been found.')
+        if self.waitforimagetimer is not None:
+            self.killTimer(self.waitforimagetimer)
+            self.waitforimagetimer = None
+        if self.imageloadtimer is not None:
+            self.killTimer(self.imageloadtimer)
+            self.imageloadtimer = None
+        self.stopWatching()
+        self.status = ExposureState.Finalizing
+        self.imagefilename = filename
+        self.headerfilename = self.headerdata['filename']
+        if self.finalizer is None:
+            self._finalize(filename, self.headerdata)
+        else:
+            self.finalizer.submit(self._finalize, filename, self.headerdata)
+        return True
+
+    def _finalize(self, filename: str, headerdata: Dict[str, Any]):
+        """Load the image, run `finalizeImage()` and report the result through the imageFinalized signal
+
+        If the image cannot be read, the imageReadFailed signal is emitted instead.
+        """
+        try:
+            image = readcbf(filename)
+        except Exception as exc:
+            # e.g. the file has not been written completely yet
+            self.imageReadFailed.emit(f'{exc.__class__.__name__}: {exc}')
+            return
+        try:
+            exposure = self.finalizeImage(image, headerdata)
+        except Exception as exc:
+            self.imageFinalized.emit(None, f'{exc.__class__.__name__}: {exc}')
+        else:
+            self.imageFinalized.emit(exposure, '')
+
+    def finalizeImage(self, image: np.ndarray, headerdata: Dict[str, Any]) -> Exposure:
+        """Save the metadata and the NeXus file and construct the exposure from the loaded image.
+
+        This does not touch the instrument state, so it can be run in a background thread.
+        """
+        logger.debug(f'Writing header for {self.prefix}/{self.fsn}')
+        header = self.writeHeader(headerdata)
+        try:
+            mask = self.instrument.io.loadMask(header.maskname)
+        except FileNotFoundError:
+            logger.warning(f'Invalid mask file "{header.maskname}". You might have to create a mask yourself.')
+            mask = np.ones_like(image, dtype=np.uint8)
+        uncertainty = np.empty_like(image)
+        uncertainty[image > 0] = image[image > 0] ** 0.5
+        uncertainty[image <= 0] = 1
+        logger.debug(f'Finalizing NeXus file for {self.prefix}/{self.fsn}')
+        self.writeNeXus(image, uncertainty, mask)
+        return Exposure(image, header, uncertainty, mask)
+
+    @Slot(object, str)
+    def onImageFinalized(self, exposure: Optional[Exposure], error: str):
+        if self.status != ExposureState.Finalizing:
+            return
+        if exposure is None:
+            logger.error(f'Error while finalizing exposure {self.prefix}/{self.fsn}: {error}')
+            self.status = ExposureState.Failed
+            self.finished.emit(False, None)
+            return
+        self.status = ExposureState.Finished
+        self.instrument.io.imageReceived(self.prefix, self.fsn)
+        self.instrument.io.indexFile('images', self.imagefilename)
+        self.instrument.io.indexFile('param', self.headerfilename)
+        # emit the raw image.
+        if self.prefix == self.instrument.config['path']['prefixes']['crd']:
+            self.instrument.datareduction.submit(exposure)
+        self.finished.emit(True, exposure)
+
+    @Slot(str)
+    def onImageReadFailed(self, error: str):
+        """The image file has been found but could not be read: try again until the timeout"""
+        if self.status != ExposureState.Finalizing:
+            return
+        remaining = self.imagedeadline - time.monotonic()
+        if remaining <= 0:
+            logger.error(f'Cannot read the image of exposure {self.prefix}/{self.fsn}: {error}')
+            self.status = ExposureState.Failed
+            self.finished.emit(False, None)
+            return
+        logger.debug(f'Cannot read the image of exposure {self.prefix}/{self.fsn} yet, retrying: {error}')
+        self.status = ExposureState.WaitingForImage
+        self.imagefilename = None
+        self.headerfilename = None
+        self.waitforimagetimer = self.startTimer(int(1000 * remaining), QtCore.Qt.PreciseTimer)
+        self.imageloadtimer = self.startTimer(int(1000 * self.imageloadperiod), QtCore.Qt.PreciseTimer)
 
     def onDetectorExposureStarted(self, starttime):
         """This method should be called when the detector has acknowledged the exposure command.
@@ -210,9 +351,9 @@ class ExposureTask(QtCore.QObject):
         self.runningtimer = self.startTimer(
             int(1000 * ((self.exptime + self.expdelay) * self.index + self.exptime)),
             QtCore.Qt.PreciseTimer)
-        self.waitforimagetimer = self.startTimer(
-            int(1000 * ((self.exptime + self.expdelay) * self.index + self.exptime + self.imagetimeout)),
-            QtCore.Qt.PreciseTimer)
+        waitforimage = (self.exptime + self.expdelay) * self.index + self.exptime + self.imagetimeout
+        self.imagedeadline = time.monotonic() + waitforimage
+        self.waitforimagetimer = self.startTimer(int(1000 * waitforimage), QtCore.Qt.PreciseTimer)
 
     def onExposureStarted(self):
         logger.debug(f'Exposure of {self.prefix}/{self.fsn} started')
@@ -223,9 +364,18 @@ class ExposureTask(QtCore.QObject):
     def onExposureFinished(self):
         logger.debug(f'Exposure of {self.prefix}/{self.fsn} finished')
         assert self.status == ExposureState.Running
-        self.imageloadtimer = self.startTimer(int(1000 * self.imageloadperiod), QtCore.Qt.PreciseTimer)
+        # collect the metadata now: the users of the exposer may change the instrument state (e.g. start the next
+        # exposure, move motors) as soon as the exposure has ended, without waiting for the image file
+        self.headerdata = self.headerData()
         self.status = ExposureState.WaitingForImage
         self.exposureended.emit()
+        if (self.arrivedfilename is not None) and self.loadImage(self.arrivedfilename):
+            return
+        # inotify does not see files written by other hosts on a network share: only relax the polling if events have
+        # already been received from the image directory
+        watched = (self.imagewatcher is not None) and any(self.imagewatcher.isReliable(f) for f in self.imagefilenames)
+        self.imageloadtimer = self.startTimer(
+            int(1000 * (self.imageloadperiod_watched if watched else self.imageloadperiod)), QtCore.Qt.PreciseTimer)
 
     def stopExposure(self):
         """Stop the ongoing exposure
@@ -244,10 +394,15 @@ class ExposureTask(QtCore.QObject):
         if self.imageloadtimer:
             self.killTimer(self.imageloadtimer)
             self.imageloadtimer = None
+        self.stopWatching()
         self.status = ExposureState.Stopped
         self.finished.emit(False, None)
 
     def createHeader(self) -> Header:
+        return self.writeHeader(self.headerData())
+
+    def headerData(self) -> Dict[str, Any]:
+        """Collect the metadata from the current state of the instrument"""
         sample: Optional[Sample] = self.instrument.samplestore.currentSample()
         data = {
             'fsn': self.fsn,
@@ -303,7 +458,11 @@ class ExposureTask(QtCore.QObject):
         if (self.maskoverride is not None) and self.maskoverride.strip():
             # global mask override takes precedence
             data['geometry']['mask'] = self.maskoverride
-        # Save the pickle file
+        return data
+
+    @staticmethod
+    def writeHeader(data: Dict[str, Any]) -> Header:
+        """Save the metadata in a pickle file"""
         folder, filename = os.path.split(data['filename'])
         os.makedirs(folder, exist_ok=True)
         with open(data['filename'], 'wb') as f:
@@ -0,0 +1,191 @@
+# coding: utf-8
+"""ImageWatcher: get notified when the detector has finished writing an image file
+
+On Linux, the inotify facility of the kernel is used (through ctypes, no extra dependencies needed): the directories
+where the detector puts its images are watched and a signal is emitted as soon as an expected file is closed after
+writing (or moved in place). The file descriptor is handled by a QSocketNotifier, no extra thread is needed.
+
+Inotify is not available on other operating systems and it does not see files written on another host to a network
+share. Users of this class must therefore still poll for the file, albeit less frequently when `isReliable()` is True,
+i.e. events have already been received from the directory of the file.
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import sys
+from typing import Optional, Dict, Iterable, Set
+
+from PyQt5 import QtCore
+from PyQt5.QtCore import pyqtSignal as Signal, pyqtSlot as Slot
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_IGNORED = 0x00008000
+IN_Q_OVERFLOW = 0x00004000
+IN_ONLYDIR = 0x01000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# struct inotify_event {int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[];}
+_eventheader = struct.Struct('iIII')
+
+
+def _loadlibc() -> Optional[ctypes.CDLL]:
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        return libc
+    except (OSError, AttributeError) as exc:
+        logger.warning(f'Inotify is not available: {exc}')
+        return None
+
+
+class ImageWatcher(QtCore.QObject):
+    """Watch for image files to be written
+
+    Files are registered by `watch()` and unregistered by `unwatch()`. Each directory containing at least one
+    registered file is watched. When a registered file is closed after writing or moved in its place, the
+    `imageArrived` signal is emitted with its full path.
+
+    Directories not existing at the time of registering a file are not watched.
+    """
+    imageArrived = Signal(str)
+
+    _libc: Optional[ctypes.CDLL] = None
+    _fd: Optional[int] = None
+    _notifier: Optional[QtCore.QSocketNotifier] = None
+    _watchdescriptors: Dict[str, int]  # directory -> watch descriptor
+    _directories: Dict[int, str]  # watch descriptor -> directory
+    _expected: Dict[str, int]  # file name -> reference count
+    _seen: Set[str]  # directories from which events have been received
+
+    def __init__(self, parent: Optional[QtCore.QObject] = None):
+        super().__init__(parent)
+        self._watchdescriptors = {}
+        self._directories = {}
+        self._expected = {}
+        self._seen = set()
+        self._libc = _loadlibc()
+        if self._libc is None:
+            return
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            logger.warning(f'Cannot initialize inotify: {os.strerror(ctypes.get_errno())}')
+            return
+        self._fd = fd
+        self._notifier = QtCore.QSocketNotifier(fd, QtCore.QSocketNotifier.Read, self)
+        self._notifier.activated.connect(self.onActivated)
+        logger.debug('Inotify-based image watcher initialized')
+
+    def isActive(self) -> bool:
+        """True if inotify is available, False if the user must rely on polling"""
+        return self._fd is not None
+
+    def isReliable(self, filename: str) -> bool:
+        """True if events have already been received from the directory of `filename`, i.e. inotify works there
+
+        On network shares written by other hosts no events arrive at all, thus polling cannot be relaxed.
+        """
+        return os.path.dirname(os.path.abspath(filename)) in self._seen
+
+    def watch(self, filenames: Iterable[str]):
+        """Start waiting for files"""
+        for filename in filenames:
+            filename = os.path.abspath(filename)
+            self._expected[filename] = self._expected.get(filename, 0) + 1
+            if self._expected[filename] == 1:
+                self._addwatch(os.path.dirname(filename))
+
+    def unwatch(self, filenames: Iterable[str]):
+        """Stop waiting for files previously registered by `watch()`"""
+        for filename in filenames:
+            filename = os.path.abspath(filename)
+            if filename not in self._expected:
+                continue
+            self._expected[filename] -= 1
+            if self._expected[filename] <= 0:
+                del self._expected[filename]
+        # remove watches on directories where no more files are expected
+        needed = {os.path.dirname(f) for f in self._expected}
+        for directory in [d for d in self._watchdescriptors if d not in needed]:
+            self._rmwatch(directory)
+
+    def _addwatch(self, directory: str):
+        if (self._fd is None) or (directory in self._watchdescriptors) or (not os.path.isdir(directory)):
+            return
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO | IN_ONLYDIR)
+        if wd < 0:
+            logger.warning(f'Cannot watch directory {directory}: {os.strerror(ctypes.get_errno())}')
+            return
+        logger.debug(f'Watching directory {directory}')
+        self._watchdescriptors[directory] = wd
+        self._directories[wd] = directory
+
+    def _rmwatch(self, directory: str):
+        wd = self._watchdescriptors.pop(directory)
+        del self._directories[wd]
+        if self._fd is not None:
+            self._libc.inotify_rm_watch(self._fd, wd)
+        logger.debug(f'Not watching directory {directory} any more')
+
+    @Slot(int)
+    def onActivated(self, fd: int):
+        arrived: Set[str] = set()
+        while True:
+            try:
+                buffer = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+            except OSError as exc:
+                logger.error(f'Error while reading inotify events: {exc}')
+                break
+            if not buffer:
+                break
+            offset = 0
+            while offset + _eventheader.size <= len(buffer):
+                wd, mask, cookie, namelength = _eventheader.unpack_from(buffer, offset)
+                offset += _eventheader.size
+                name = os.fsdecode(buffer[offset:offset + namelength].rstrip(b'\0'))
+                offset += namelength
+                if mask & IN_Q_OVERFLOW:
+                    logger.warning('Inotify event queue overflow, some images will only be found by polling.')
+                elif mask & IN_IGNORED:
+                    # the directory has been deleted or unmounted
+                    if wd in self._directories:
+                        directory = self._directories.pop(wd)
+                        del self._watchdescriptors[directory]
+                        self._seen.discard(directory)
+                elif (wd in self._directories) and name:
+                    self._seen.add(self._directories[wd])
+                    filename = os.path.join(self._directories[wd], name)
+                    if filename in self._expected:
+                        arrived.add(filename)
+        for filename in sorted(arrived):
+            logger.debug(f'Image file {filename} arrived.')
+            self.imageArrived.emit(filename)
+
+    def close(self):
+        """Release the inotify file descriptor"""
+        if self._notifier is not None:
+            self._notifier.setEnabled(False)
+            self._notifier.activated.disconnect(self.onActivated)
+            self._notifier.deleteLater()
+            self._notifier = None
+        if self._fd is not None:
+            os.close(self._fd)  # this also removes all watches
+            self._fd = None
+        self._watchdescriptors = {}
+        self._directories = {}
+        self._expected = {}
+        self._seen = set()
@@ -0,0 +1,101 @@
+"""Image watcher: the arrival of the expected image files must be signalled, and only that"""
+import os
+import sys
+import time
+from typing import List
+
+import pytest
+from PyQt5 import QtCore
+
+from ..imagewatcher import ImageWatcher
+
+pytestmark = pytest.mark.skipif(not sys.platform.startswith('linux'), reason='inotify is only available on Linux')
+
+
+@pytest.fixture(scope='module')
+def application():
+    return QtCore.QCoreApplication.instance() or QtCore.QCoreApplication([])
+
+
+@pytest.fixture
+def watcher(application):
+    watcher = ImageWatcher()
+    assert watcher.isActive()
+    watcher.arrived = []
+    watcher.imageArrived.connect(watcher.arrived.append)
+    yield watcher
+    watcher.close()
+    watcher.deleteLater()
+
+
+def processevents(application: QtCore.QCoreApplication, arrived: List[str], count: int, timeout: float = 2.0):
+    """Process the Qt events until `count` images have arrived or the timeout elapses"""
+    deadline = time.monotonic() + timeout
+    while (len(arrived) < count) and (time.monotonic() < deadline):
+        application.processEvents(QtCore.QEventLoop.AllEvents, 50)
+    # events arriving too late would be missed otherwise
+    application.processEvents(QtCore.QEventLoop.AllEvents, 50)
+
+
+def writefile(filename: str):
+    with open(filename, 'wb') as f:
+        f.write(b'\0' * 1000)
+
+
+def test_close_write(application, watcher, tmp_path):
+    expected = str(tmp_path / 'crd_00001.cbf')
+    watcher.watch([expected])
+    assert not watcher.isReliable(expected)
+    # not expected
+    writefile(str(tmp_path / 'crd_00002.cbf'))
+    processevents(application, watcher.arrived, 1, timeout=0.5)
+    assert watcher.arrived == []
+    # but events have already arrived from this directory
+    assert watcher.isReliable(expected)
+    writefile(expected)
+    processevents(application, watcher.arrived, 1)
+    assert watcher.arrived == [expected]
+
+
+def test_moved_to(application, watcher, tmp_path):
+    (tmp_path / 'images').mkdir()
+    expected = str(tmp_path / 'images' / 'crd_00001.cbf')
+    watcher.watch([expected])
+    # the detector writes in a temporary file, then renames it
+    writefile(str(tmp_path / 'crd_00001.cbf.tmp'))
+    os.rename(str(tmp_path / 'crd_00001.cbf.tmp'), expected)
+    processevents(application, watcher.arrived, 1)
+    assert watcher.arrived == [expected]
+    assert watcher.isReliable(expected)
+
+
+def test_unwatch(application, watcher, tmp_path):
+    (tmp_path / 'images').mkdir()
+    first = str(tmp_path / 'crd_00001.cbf')
+    second = str(tmp_path / 'images' / 'crd_00002.cbf')
+    watcher.watch([first, first, second])
+    assert sorted(watcher._watchdescriptors) == sorted([str(tmp_path), str(tmp_path / 'images')])
+    # the files are reference counted: the first one is still expected
+    watcher.unwatch([first, second])
+    assert list(watcher._watchdescriptors) == [str(tmp_path)]
+    writefile(second)
+    writefile(first)
+    processevents(application, watcher.arrived, 2, timeout=0.5)
+    assert watcher.arrived == [first]
+    watcher.unwatch([first])
+    assert watcher._watchdescriptors == {}
+    writefile(first)
+    processevents(application, watcher.arrived, 2, timeout=0.5)
+    assert watcher.arrived == [first]
+
+
+def test_missing_directory(application, watcher, tmp_path):
+    # directories not existing at the time of registering are not watched: the file is only found by polling
+    expected = str(tmp_path / 'images' / 'crd_00001.cbf')
+    watcher.watch([expected])
+    assert watcher._watchdescriptors == {}
+    (tmp_path / 'images').mkdir()
+    writefile(expected)
+    processevents(application, watcher.arrived, 1, timeout=0.5)
+    assert watcher.arrived == []
+    assert not watcher.isReliable(expected)
@@ -0,0 +1,141 @@
+"""Persistent index of the files belonging to exposures
+
+Finding the highest file sequence number for each prefix needs traversing all the data directories, which can take
+minutes for a few years' worth of measurements. This index keeps the (kind, prefix, fsn, path, mtime) records of the
+files in an SQLite database, along with the modification times of the directories. On validation, only directories
+whose modification time has changed (i.e. files have been added, removed or renamed in them) are listed again.
+"""
+import logging
+import os
+import re
+import sqlite3
+import time
+from typing import Dict, List, Tuple, Optional
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class FSNIndex:
+    """Persistent index of exposure files, stored in an SQLite database
+
+    Files are grouped by "kind", which corresponds to a data directory (e.g. 'images', 'param', 'eval2d'). Only files
+    named like <prefix>_<fsn>.<extension> are indexed.
+
+    All methods must be called from the same thread.
+    """
+    # directories modified this recently are listed again at the next validation, because files might be added
+    # without changing the (coarse) modification time.
+    racytime: float = 2.0
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS directories '
+                            '(path TEXT NOT NULL, kind TEXT NOT NULL, parent TEXT, mtime INTEGER, '
+                            'PRIMARY KEY (path, kind))')
+            self.db.execute('CREATE TABLE IF NOT EXISTS files '
+                            '(path TEXT NOT NULL, kind TEXT NOT NULL, prefix TEXT NOT NULL, fsn INTEGER NOT NULL, '
+                            'directory TEXT NOT NULL, mtime REAL, PRIMARY KEY (path, kind))')
+            self.db.execute('CREATE INDEX IF NOT EXISTS files_prefix_fsn ON files (prefix, fsn)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS files_directory ON files (directory, kind)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent, kind)')
+
+    @staticmethod
+    def filenameregex(extension: str) -> re.Pattern:
+        return re.compile(rf'^(?P<prefix>\w+)_(?P<fsn>\d+)\.{extension}$')
+
+    def validate(self, kind: str, root: str, extension: str):
+        """Bring the index of a data directory up to date with the file system
+
+        Directories are checked recursively starting from `root`. Those with unchanged modification time are not
+        listed, their subdirectories are taken from the index.
+
+        :param kind: kind of the files, e.g. 'images'
+        :type kind: str
+        :param root: the data directory
+        :type root: str
+        :param extension: file name extension without the dot, e.g. 'cbf'
+        :type extension: str
+        """
+        regex = self.filenameregex(extension)
+        known: Dict[str, Optional[int]] = {}
+        children: Dict[str, List[str]] = {}
+        for path, parent, mtime in self.db.execute(
+                'SELECT path, parent, mtime FROM directories WHERE kind = ?', (kind,)):
+            known[path] = mtime
+            children.setdefault(parent, []).append(path)
+        seen = set()
+        listed = 0
+        stack: List[Tuple[str, Optional[str]]] = [(os.path.abspath(root), None)]
+        with self.db:
+            while stack:
+                directory, parent = stack.pop()
+                try:
+                    stat = os.stat(directory)
+                except (FileNotFoundError, NotADirectoryError):
+                    continue
+                seen.add(directory)
+                if (directory in known) and (known[directory] == stat.st_mtime_ns):
+                    # nothing has been added or removed here
+                    stack.extend([(d, directory) for d in children.get(directory, [])])
+                    continue
+                listed += 1
+                subdirs = []
+                files = []
+                try:
+                    with os.scandir(directory) as it:
+                        for entry in it:
+                            # do not descend into symbolic links, like os.walk()
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirs.append(entry.path)
+                            elif (m := regex.match(entry.name)) is not None:
+                                try:
+                                    mtime = entry.stat().st_mtime
+                                except FileNotFoundError:
+                                    continue
+                                files.append((entry.path, kind, m['prefix'], int(m['fsn']), directory, mtime))
+                except (PermissionError, FileNotFoundError, NotADirectoryError) as exc:
+                    logger.warning(f'Cannot list directory {directory}: {exc}')
+                    continue
+                self.db.execute('DELETE FROM files WHERE directory = ? AND kind = ?', (directory, kind))
+                self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)', files)
+                self.db.execute(
+                    'INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)',
+                    (directory, kind, parent,
+                     stat.st_mtime_ns if stat.st_mtime < time.time() - self.racytime else None))
+                stack.extend([(d, directory) for d in subdirs])
+            # forget directories which are not there anymore
+            for directory in [d for d in known if d not in seen]:
+                self.db.execute('DELETE FROM files WHERE directory = ? AND kind = ?', (directory, kind))
+                self.db.execute('DELETE FROM directories WHERE path = ? AND kind = ?', (directory, kind))
+        logger.debug(f'Validated index of {root}: {len(seen)} directories, {listed} of them listed.')
+
+    def add(self, kind: str, path: str, extension: str) -> bool:
+        """Add a newly written file to the index
+
+        The modification time of its directory is not updated: the directory is listed again at the next validation.
+
+        :return: True if the file has been added, False if its name does not match the pattern or it does not exist.
+        :rtype: bool
+        """
+        path = os.path.abspath(path)
+        m = self.filenameregex(extension).match(os.path.basename(path))
+        if m is None:
+            return False
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return False
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                            (path, kind, m['prefix'], int(m['fsn']), os.path.dirname(path), mtime))
+        return True
+
+    def lastfsns(self) -> Dict[str, int]:
+        """The highest file sequence number for each prefix, in all kinds of files"""
+        return {prefix: fsn for prefix, fsn in self.db.execute('SELECT prefix, MAX(fsn) FROM files GROUP BY prefix')}
+
+    def close(self):
+        self.db.close()
@@ -2,9 +2,10 @@ import logging
 import os
 import pathlib
 import re
+import sqlite3
 
 import shutil
-from typing import Dict, Tuple, Optional, List, Iterator
+from typing import Dict, Tuple, Optional, List, Iterator, Iterable
 
 import h5py
 import numpy as np
@@ -13,7 +14,8 @@ from PyQt5.QtCore import pyqtSignal as Signal, pyqtSlot as Slot
 from scipy.io import loadmat
 
 from .component import Component
-from ...algorithms.readcbf import readcbf
+from .fsnindex import FSNIndex
+from ...algorithms.readcbf import readcbf, readcbf_bulk, writecbf
 from ...dataclasses import Exposure, Header
 from ...config import Config
 
@@ -51,6 +53,11 @@ class IO(QtCore.QObject, Component):
     _masks: Dict[str, Tuple[pathlib.Path, np.ndarray, float]]
     _nextfsn: Dict[str, int]
     _lastfsn: Dict[str, Optional[int]]
+    fsnindex: Optional[FSNIndex] = None
+    # data directories taken into account when determining the last file sequence numbers, with file extensions
+    indexedsubdirs: Dict[str, str] = {
+        'images': 'cbf', 'images_local': 'cbf', 'param': 'pickle', 'param_override': 'pickle', 'eval2d': 'npz',
+        'eval1d': 'txt'}
 
     nextFSNChanged = Signal(str, int)
     lastFSNChanged = Signal(str, int)
@@ -65,6 +72,10 @@ class IO(QtCore.QObject, Component):
         self.reindex()
         super().startComponent()
 
+    def stopComponent(self):
+        self._closeFSNIndex()
+        super().stopComponent()
+
     def getSubDir(self, subdir: str) -> pathlib.Path:
         return pathlib.Path.cwd() / self.config['path']['directories'][subdir]
 
@@ -73,14 +84,49 @@ class IO(QtCore.QObject, Component):
     def reindex(self):
         """Update lastfsn and nextfsn values.
 
-        As we need to traverse the full directory structure, this can take much time. So use it sparingly, typically at
-        the start of the program.
+        The file sequence numbers are taken from the persistent index (see `FSNIndex`), which is validated first: only
+        the directories changed since the last validation are listed. If the index cannot be used, the full directory
+        structure is traversed, which can take much time.
         """
-        # check raw detector images
         logger.info('Reindexing already present exposures...')
-        for subdir, extension in [
-            ('images', 'cbf'), ('images_local', 'cbf'), ('param', 'pickle'), ('param_override', 'pickle'),
-            ('eval2d', 'npz'), ('eval1d', 'txt')]:
+        if self.fsnindex is None:
+            self._openFSNIndex()
+        lastfsns = None
+        if self.fsnindex is not None:
+            try:
+                for subdir, extension in self.indexedsubdirs.items():
+                    logger.debug(f'Validating FSN index of subdirectory {subdir}')
+                    self.fsnindex.validate(subdir, str(self.getSubDir(subdir)), extension)
+                lastfsns = self.fsnindex.lastfsns()
+            except sqlite3.Error as exc:
+                logger.warning(f'Cannot use the FSN index, traversing all directories: {exc}')
+                self._closeFSNIndex()
+        if lastfsns is None:
+            lastfsns = self._walkLastFSNs()
+        for prefix, maxfsn in lastfsns.items():
+            if (self._lastfsn.get(prefix) is None) or (maxfsn > self._lastfsn[prefix]):
+                logger.debug(f'Updating lastfsn for prefix {prefix} to {maxfsn}')
+                self._lastfsn[prefix] = maxfsn
+
+        logger.debug('Creating empty prefixes')
+        # add known prefixes to self._lastfsn if they were not yet added.
+        for prefix in self.config['path']['prefixes'].values():
+            if prefix not in self._lastfsn:
+                self._lastfsn[prefix] = None
+            else:
+                self.lastFSNChanged.emit(prefix, self._lastfsn[prefix])
+
+        # update self._nextfsn
+        logger.debug('Updating nextfsn.')
+        for prefix in self._lastfsn:
+            self._nextfsn[prefix] = self._lastfsn[prefix] + 1 if self._lastfsn[prefix] is not None else 0
+            self.nextFSNChanged.emit(prefix, self._nextfsn[prefix])
+        logger.info('Reindexing done.')
+
+    def _walkLastFSNs(self) -> Dict[str, int]:
+        """Find the highest file sequence number for each prefix by traversing all data directories"""
+        lastfsns = {}
+        for subdir, extension in self.indexedsubdirs.items():
             # find all subdirectories in `directory`, including `directory`
             # itself
             directory = self.getSubDir(subdir)
@@ -94,32 +140,48 @@ class IO(QtCore.QObject, Component):
                 prefixes = {m.group('prefix') for m in matchlist}
                 for prefix in prefixes:
                     logger.debug(f'Checking prefix {prefix}')
-                    if prefix not in self._lastfsn:
-                        self._lastfsn[prefix] = None
                     # find the highest available FSN of the current prefix in
                     # this directory
                     maxfsn = max([int(m.group('fsn')) for m in matchlist if m.group('prefix') == prefix])
                     logger.debug(f'Maxfsn is {maxfsn}')
-                    if self._lastfsn[prefix] is None or (maxfsn > self._lastfsn[prefix]):
-                        logger.debug(f'Updating lastfsn for prefix {prefix} to {maxfsn}')
-                        self._lastfsn[prefix] = maxfsn
+                    if (prefix not in lastfsns) or (maxfsn > lastfsns[prefix]):
+                        lastfsns[prefix] = maxfsn
                 logger.debug(f'All prefixes done in this folder ({folder})')
             logger.debug('All folders done.')
+        return lastfsns
 
-        logger.debug('Creating empty prefixes')
-        # add known prefixes to self._lastfsn if they were not yet added.
-        for prefix in self.config['path']['prefixes'].values():
-            if prefix not in self._lastfsn:
-                self._lastfsn[prefix] = None
-            else:
-                self.lastFSNChanged.emit(prefix, self._lastfsn[prefix])
+    def _openFSNIndex(self):
+        if not self.config['path']['fsnindex']:
+            return
+        try:
+            os.makedirs(self.getSubDir('config'), exist_ok=True)
+            self.fsnindex = FSNIndex(str(self.getSubDir('config') / self.config['path']['fsnindex']))
+        except (sqlite3.Error, OSError) as exc:
+            logger.warning(f'Cannot open the FSN index: {exc}')
+            self.fsnindex = None
+
+    def _closeFSNIndex(self):
+        if self.fsnindex is not None:
+            try:
+                self.fsnindex.close()
+            except sqlite3.Error:
+                pass
+            self.fsnindex = None
 
-        # update self._nextfsn
-        logger.debug('Updating nextfsn.')
-        for prefix in self._lastfsn:
-            self._nextfsn[prefix] = self._lastfsn[prefix] + 1 if self._lastfsn[prefix] is not None else 0
-            self.nextFSNChanged.emit(prefix, self._nextfsn[prefix])
-        logger.info('Reindexing done.')
+    def indexFile(self, subdir: str, filename: str):
+        """Add a newly written file to the FSN index
+
+        :param subdir: the data directory where the file is, e.g. 'images' or 'eval2d'
+        :type subdir: str
+        :param filename: the full path of the file
+        :type filename: str
+        """
+        if (self.fsnindex is None) or (subdir not in self.indexedsubdirs):
+            return
+        try:
+            self.fsnindex.add(subdir, filename, self.indexedsubdirs[subdir])
+        except sqlite3.Error as exc:
+            logger.warning(f'Cannot update the FSN index: {exc}')
 
     def imageReceived(self, prefix:str, fsn: int):
         if prefix not in self._lastfsn:
@@ -224,13 +286,9 @@ class IO(QtCore.QObject, Component):
                 try:
                     if filename.lower().endswith('.cbf'):
                         intensity = readcbf(filename)
-                        uncertainty = intensity ** 0.5
-                        uncertainty[intensity <= 0] = 1
+                        uncertainty = self._countinguncertainty(intensity)
                         if (subdir == 'images') and raw:
-                            # try to copy this image to the images_local directory
-                            os.makedirs(os.path.join(self.getSubDir('images_local'), prefix), exist_ok=True)
-                            logger.debug(f'Copying {filename} to images_local.')
-                            shutil.copy2(filename, os.path.join(self.getSubDir('images_local'), prefix, os.path.split(filename)[-1]))
+                            self._copytolocal(prefix, filename)
                     elif filename.lower().endswith('.npz'):
                         data = np.load(filename)
                         intensity = data['Intensity']
@@ -243,6 +301,63 @@ class IO(QtCore.QObject, Component):
                     pass
         raise FileNotFoundError(expfilename)
 
+    def loadExposures(self, prefix: str, fsns: Iterable[int], check_local: bool = False, nworkers: int = 0,
+                      prefetch: int = 0) -> Iterator[Tuple[int, Optional[Exposure]]]:
+        """Load raw exposures in bulk
+
+        The CBF files are read and decompressed in parallel by `nworkers` threads (nonpositive: all CPUs), at most
+        `prefetch` images ahead, see `readcbf_bulk()`. Exposures are yielded in the order of `fsns`, the same as
+        `loadExposure(prefix, fsn, raw=True, check_local=check_local)` would give.
+
+        :param prefix: file sequence prefix
+        :type prefix: str
+        :param fsns: file sequence indices
+        :type fsns: iterable of int
+        :return: an iterator of (fsn, exposure) tuples. The exposure is None if the image or the header is not found.
+        :rtype: Iterator[Tuple[int, Optional[Exposure]]]
+        """
+        fsns = list(fsns)
+        subdirofcandidate = {}
+        candidates = []
+        for fsn in fsns:
+            candidates.append([])
+            for subdir in ['images_local', 'images'] if check_local else ['images']:
+                for filename in self.iterfilename(str(self.getSubDir(subdir)), prefix, fsn, '.cbf'):
+                    subdirofcandidate[filename] = subdir
+                    candidates[-1].append(filename)
+        for fsn, (filename, intensity) in zip(fsns, readcbf_bulk(candidates, nworkers, prefetch)):
+            if filename is None:
+                if not isinstance(intensity, FileNotFoundError):
+                    logger.error(f'Error while loading image for exposure {prefix=}, {fsn=}: {intensity}')
+                yield fsn, None
+                continue
+            try:
+                header = self.loadHeader(prefix, fsn, raw=True)
+                mask = self.loadMask(header.maskname) if header.maskname else None
+            except FileNotFoundError:
+                yield fsn, None
+                continue
+            if subdirofcandidate[filename] == 'images':
+                self._copytolocal(prefix, filename)
+            yield fsn, Exposure(intensity, header, self._countinguncertainty(intensity), mask)
+
+    @staticmethod
+    def _countinguncertainty(intensity: np.ndarray) -> np.ndarray:
+        """Uncertainty of raw detector counts from Poisson statistics"""
+        uncertainty = intensity ** 0.5
+        uncertainty[intensity <= 0] = 1
+        return uncertainty
+
+    def _copytolocal(self, prefix: str, filename: str):
+        """Try to copy a raw image to the images_local directory
+
+        The file is copied verbatim with its metadata: re-encoding the loaded counts would lose the CIF fields of
+        the original other than the free-text header, as well as its modification time.
+        """
+        os.makedirs(os.path.join(self.getSubDir('images_local'), prefix), exist_ok=True)
+        logger.debug(f'Copying {filename} to images_local.')
+        shutil.copy2(filename, os.path.join(self.getSubDir('images_local'), prefix, os.path.split(filename)[-1]))
+
     def loadCBF(self, prefix: str, fsn: int, check_local: bool = False) -> np.ndarray:
         """Load a CBF file
 
@@ -255,14 +370,50 @@ class IO(QtCore.QObject, Component):
         :raises FileNotFoundError: if the file could not be found
         """
         expfilename = self.formatFileName(prefix, fsn, '.cbf')
-        for subdir in ['images_local', 'images'] if check_local else ['images']:
-            for filename in self.iterfilename(str(self.getSubDir(subdir)), prefix, fsn, '.cbf'):
-                try:
-                    return readcbf(filename)
-                except FileNotFoundError:
-                    pass
+        for filename in self.cbfFileNames(prefix, fsn, check_local):
+            try:
+                return readcbf(filename)
+            except FileNotFoundError:
+                pass
         raise FileNotFoundError(expfilename)
 
+    def cbfFileNames(self, prefix: str, fsn: int, check_local: bool = False) -> List[str]:
+        """Possible locations of a CBF file, in the order they are tried by `loadCBF()`
+
+        :param prefix: file sequence prefix
+        :type prefix: str
+        :param fsn: file sequence index
+        :type fsn: int
+        :return: list of full paths
+        :rtype: list of str
+        """
+        return [filename
+                for subdir in (['images_local', 'images'] if check_local else ['images'])
+                for filename in self.iterfilename(str(self.getSubDir(subdir)), prefix, fsn, '.cbf')]
+
+    def saveCBF(self, prefix: str, fsn: int, counts: np.ndarray, headercontents: str = '',
+                subdir: str = 'images_local') -> str:
+        """Save raw detector counts in a byte-offset compressed CBF file, which can be loaded by `loadCBF()` and
+        `loadExposure()`.
+
+        :param prefix: file sequence prefix
+        :type prefix: str
+        :param fsn: file sequence index
+        :type fsn: int
+        :param counts: the image, of integer type or containing only integral values
+        :type counts: np.ndarray
+        :param headercontents: free text header (e.g. the one of the original detector image)
+        :type headercontents: str
+        :param subdir: the directory to save the file to
+        :type subdir: str
+        :return: the file name
+        :rtype: str
+        """
+        os.makedirs(os.path.join(self.getSubDir(subdir), prefix), exist_ok=True)
+        filename = os.path.join(self.getSubDir(subdir), prefix, self.formatFileName(prefix, fsn, '.cbf'))
+        writecbf(filename, counts, headercontents)
+        return filename
+
     @staticmethod
     def loadH5(h5file: str, samplename: str, distkey: str) -> Exposure:
         with h5py.File(h5file, 'r', swmr=True) as h5:
@@ -431,6 +582,9 @@ class IO(QtCore.QObject, Component):
             self.reindexScanfile()
         elif path[:2] == ('path', 'directories'):
             self.reindex()
+        elif path == ('path', 'fsnindex'):
+            self._closeFSNIndex()
+            self.reindex()
 
     def loadFromConfig(self):
         if isinstance(self.config, Config):
@@ -460,6 +614,7 @@ class IO(QtCore.QObject, Component):
                 (('path', 'prefixes', 'gsx'), 'gsx'),
                 (('path', 'prefixes', 'map'), 'map'),
                 (('path', 'varlogfile'), 'varlog.log'),
+                (('path', 'fsnindex'), 'fsnindex.sqlite'),  # in the config directory. Empty string disables it.
             ]:
                 cnf = self.config
                 for pathelement in configpath[:-1]:
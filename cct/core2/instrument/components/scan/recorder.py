@@ -9,7 +9,7 @@ from PyQt5.QtCore import pyqtSignal as Signal, pyqtSlot as Slot
 
 from ..motors import Motor
 from ....algorithms.beamweighting import beamweights
-from ....dataclasses import Exposure
+from ....dataclasses import Exposure, SharedExposureRing
 from ....devices.device.frontend import DeviceFrontend
 
 logger = logging.getLogger(__name__)
@@ -44,6 +44,10 @@ class ScanRecorder(QtCore.QObject):
     from the Exposer component or b) an imageReceived signal from the same. The order they arrive in is not defined.
     Only after both of them is received is the detector ready for another exposure. But just after either is received,
     the motor can be moved to the next point. With this consideration we can reduce dead time considerably.
+
+    If the Exposer is in pipelined mode, the next exposure is started without waiting for the image of the previous
+    one: at most `maxpendingimages` images can be outstanding. The dead time between exposures is collected in
+    `deadtimes`.
     """
 
     class State(enum.Enum):
@@ -77,6 +81,9 @@ class ScanRecorder(QtCore.QObject):
     initialmotorposition: float
     instrument: "Instrument"
     imageprocessingtasks: List[multiprocessing.pool.AsyncResult]
+    imageslots: List[Optional[int]]  # slots of the shared memory ring used by the image processing tasks
+    imagering: Optional[SharedExposureRing] = None
+    imageringslots: int = 8
     movemotorback: bool = True
     errormessage: Optional[str] = None
     shutter: bool = True
@@ -85,6 +92,8 @@ class ScanRecorder(QtCore.QObject):
     mask_total: Optional[np.ndarray] = None
     exposurefinished: bool = True
     imagesrequested: int = 0  # number of images we are waiting for
+    maxpendingimages: int = 2  # number of images we can wait for when starting the next exposure in pipelined mode
+    deadtimes: List[float]  # time elapsed between the end of an exposure and the start of the next one
 
     def __init__(self, index: int, startposition: float, endposition: float, nsteps: int, countingtime: float,
                  motor: Motor, instrument: "Instrument", movemotorback: bool = True, shutter: bool = True):
@@ -100,8 +109,11 @@ class ScanRecorder(QtCore.QObject):
         self.instrument = instrument
         self.instrument.exposer.exposureFinished.connect(self.onExposureFinished)
         self.instrument.exposer.imageReceived.connect(self.onImageReceived)
+        self.instrument.exposer.deadTime.connect(self.onDeadTime)
         self.motor.moving.connect(self.onMotorMoving)
+        self.deadtimes = []
         self.imageprocessingtasks = []
+        self.imageslots = []
         self.countingtime = countingtime
         self.movemotorback = movemotorback
         self.shutter = shutter
@@ -139,6 +151,8 @@ class ScanRecorder(QtCore.QObject):
             self.waitForImageProcessing()
 
     def isReadyForExposure(self):
+        if self.instrument.exposer.isPipelined():
+            return self.exposurefinished and (self.imagesrequested <= self.maxpendingimages)
         return self.exposurefinished and (self.imagesrequested == 0)
 
     def exposeNextImage(self):
@@ -160,7 +174,8 @@ class ScanRecorder(QtCore.QObject):
         """Move the motor to the next scan position"""
         # do the next scan point
         self.stepsexposed += 1
-        self.progress.emit(0, self.nsteps, self.stepsexposed, f'{self.stepsexposed}/{self.nsteps} done')
+        self.progress.emit(0, self.nsteps, self.stepsexposed, f'{self.stepsexposed}/{self.nsteps} done' + (
+            f', dead time {self.deadtimes[-1]:.3f} sec' if self.deadtimes else ''))
         if self.stepsexposed >= self.nsteps:
             logger.debug('Final point scanned.')
             self.closeShutter()
@@ -190,9 +205,11 @@ class ScanRecorder(QtCore.QObject):
         self.imagesdone = 0
         self.imagesrequested = 0
         self.positionsdone = []
+        self.deadtimes = []
         self.errormessage = None
         self.state = self.State.MoveToStart
         self.imageprocessingtasks = []
+        self.imageslots = []
         assert self.imageprocessorpool is None
         assert self.imageprocessingtimer is None
         self.imageprocessorpool = multiprocessing.pool.Pool()
@@ -285,7 +302,7 @@ class ScanRecorder(QtCore.QObject):
         logger.debug('Image received')
         assert self.imagesrequested > 0
         self.imagesrequested -= 1
-        if self.imagesrequested > 1:
+        if (self.imagesrequested > 1) and not self.instrument.exposer.isPipelined():
             logger.warning(f'More than one outstanding images: {self.imagesrequested}. '
                            f'Might be caused by jamming of subsequent exposures!')
         if self.mask is None:
@@ -305,12 +322,24 @@ class ScanRecorder(QtCore.QObject):
                 except (KeyError, FileNotFoundError, TypeError):
                     self.mask_total = exposure.intensity >= 0
         logger.debug('Queueing analyzeimage task to imageprocessorpool')
-        self.imageprocessingtasks.append(
-            self.imageprocessorpool.apply_async(self._analyzeimage, args=(exposure, self.mask, self.mask_total)))
+        # pass the image through shared memory if possible
+        if self.imagering is None:
+            self.imagering = SharedExposureRing(exposure.intensity.shape, self.imageringslots)
+        slot = self.imagering.acquire() if self.imagering.fits(exposure) else None
+        if slot is not None:
+            self.imagering.put(slot, exposure)
+            self.imageprocessingtasks.append(
+                self.imageprocessorpool.apply_async(
+                    self._analyzeslot, args=(self.imagering, slot, exposure.header.fsn, self.mask, self.mask_total)))
+        else:
+            self.imageprocessingtasks.append(
+                self.imageprocessorpool.apply_async(self._analyzeimage, args=(exposure, self.mask, self.mask_total)))
+        self.imageslots.append(slot)
         if self.imageprocessingtimer is None:
             self.imageprocessingtimer = self.startTimer(1, QtCore.Qt.VeryCoarseTimer)
-        if not self.exposurefinished:
-            # imageReceived signal has been called first.
+        if (not self.exposurefinished) and (self.imagesrequested == 0):
+            # imageReceived signal has been called first. In pipelined mode, this can also be the image of the previous
+            # exposure: then we are not done with the current one.
             logger.debug('imageReceived signal has been called first')
             self.moveToNextPosition()
 
@@ -332,13 +361,21 @@ class ScanRecorder(QtCore.QObject):
         if self.imageprocessingtasks[0].ready():
             # wait until the first is ready: process images in sequence
             task = self.imageprocessingtasks.pop(0)
+            slot = self.imageslots.pop(0)
             position = self.positionsdone.pop(0)
             readings = task.get()
+            if slot is not None:
+                self.imagering.release(slot)
             self.imagesdone += 1
             logger.debug(
                 f'New scan point: at {position=}. {self.imagesdone=}. {self.positionsdone=}, {len(self.imageprocessingtasks)=}')
             self.scanpoint.emit((position,) + tuple(readings))
 
+    @Slot(str, int, float)
+    def onDeadTime(self, prefix: str, fsn: int, deadtime: float):
+        if self.state in [self.State.Exposing, self.State.StopRequested]:
+            self.deadtimes.append(deadtime)
+
     @Slot(bool)
     def onExposureFinished(self, success: bool):
         """Called when the detector signals that the exposure is finished.
@@ -359,18 +396,27 @@ class ScanRecorder(QtCore.QObject):
                 # exposureFinished signal has been emitted first.
                 self.moveToNextPosition()
 
-    @staticmethod
-    def _analyzeimage(exposure: Exposure, mask: np.ndarray, mask_total: np.ndarray) -> Tuple:
+    @classmethod
+    def _analyzeslot(cls, ring: SharedExposureRing, slot: int, fsn: int, mask: np.ndarray,
+                     mask_total: np.ndarray) -> Tuple:
+        """Same as `_analyzeimage()` but the image is in a slot of a shared memory ring"""
+        return cls._imagestatistics(ring.arrays(slot)[0], fsn, mask, mask_total)
+
+    @classmethod
+    def _analyzeimage(cls, exposure: Exposure, mask: np.ndarray, mask_total: np.ndarray) -> Tuple:
         """Analyze the recorded image and calculate some statistics from it.
 
         This worker function is called in a separate thread, not to hog the main one.
         """
-        img = exposure.intensity
+        return cls._imagestatistics(exposure.intensity, exposure.header.fsn, mask, mask_total)
+
+    @staticmethod
+    def _imagestatistics(img: np.ndarray, fsn: int, mask: np.ndarray, mask_total: np.ndarray) -> Tuple:
         sumtotal, maxtotal, meanrowtotal, meancoltotal, sigmarowtotal, sigmacoltotal, pixelcount = beamweights(img,
                                                                                                                mask_total)
         summasked, maxmasked, meanrowmasked, meancolmasked, sigmarowmasked, sigmacolmasked, pixelcount = beamweights(
             img, mask)
-        return (exposure.header.fsn, sumtotal, summasked, maxtotal, maxmasked, meanrowtotal, meanrowmasked,
+        return (fsn, sumtotal, summasked, maxtotal, maxmasked, meanrowtotal, meanrowmasked,
                 meancoltotal, meancolmasked,
                 sigmarowtotal, sigmarowmasked, sigmacoltotal, sigmacolmasked,
                 (sigmarowtotal ** 2 + sigmacoltotal ** 2) ** 0.5, (sigmarowmasked ** 2 + sigmacolmasked ** 2) ** 0.5)
@@ -379,6 +425,12 @@ class ScanRecorder(QtCore.QObject):
         self.imageprocessorpool.close()
         self.imageprocessorpool.join()
         self.imageprocessorpool = None
+        if self.imagering is not None:
+            self.imagering.close()
+            self.imagering = None
+        if self.deadtimes:
+            logger.info(f'Dead time between exposures in scan {self.scanindex}: mean {np.mean(self.deadtimes):.3f} sec, '
+                        f'max {np.max(self.deadtimes):.3f} sec')
         if self.state != self.State.StopRequested:
             assert self.imageprocessingtimer is None
             assert not self.imageprocessingtasks
@@ -0,0 +1,184 @@
+"""Persistent FSN index: after validation, the index must give the same highest file sequence numbers as traversing
+all the directories"""
+import os
+import re
+import shutil
+from typing import Dict
+
+import pytest
+
+from .. import fsnindex
+from ..fsnindex import FSNIndex
+
+
+def walklastfsns(root: str, extension: str) -> Dict[str, int]:
+    """The directory traversal of `IO._walkLastFSNs()`, for a single data directory"""
+    lastfsns = {}
+    filename_regex = re.compile(rf'^(?P<prefix>\w+)_(?P<fsn>\d+)\.{extension}$')
+    for folder, subdirs, files in os.walk(root):
+        matchlist = [m for m in [filename_regex.match(f) for f in files] if m is not None]
+        for prefix in {m.group('prefix') for m in matchlist}:
+            maxfsn = max([int(m.group('fsn')) for m in matchlist if m.group('prefix') == prefix])
+            if (prefix not in lastfsns) or (maxfsn > lastfsns[prefix]):
+                lastfsns[prefix] = maxfsn
+    return lastfsns
+
+
+def touch(path: str):
+    with open(path, 'wb'):
+        pass
+
+
+def setmtime(directory: str, mtime_ns: int):
+    """Set the modification time of a directory: the file system might not be able to tell apart changes done in
+    quick succession"""
+    os.utime(directory, ns=(mtime_ns, mtime_ns))
+
+
+@pytest.fixture
+def tree(tmp_path):
+    root = tmp_path / 'images'
+    for subdir, filenames in [
+        ('', ['crd_00001.cbf', 'tst_00003.cbf', 'notes.txt']),
+        ('crd', ['crd_00002.cbf', 'crd_00010.cbf', 'crd_00011.cbf.tmp', 'crd_x.cbf', 'CRD_00012.CBF']),
+        ('crd/2023', ['crd_00007.cbf', 'my_crd_00020.cbf']),
+        ('tst', ['tst_1.cbf', 'tst_00002.cbf']),
+        ('scn', []),
+    ]:
+        (root / subdir).mkdir(parents=True, exist_ok=True)
+        for filename in filenames:
+            touch(str(root / subdir / filename))
+    # symbolic links to directories are not followed
+    (tmp_path / 'elsewhere').mkdir()
+    touch(str(tmp_path / 'elsewhere' / 'crd_00100.cbf'))
+    os.symlink(str(tmp_path / 'elsewhere'), str(root / 'link'))
+    return str(root)
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = FSNIndex(str(tmp_path / 'fsnindex.sqlite'))
+    yield index
+    index.close()
+
+
+@pytest.fixture
+def listings(monkeypatch):
+    """Count the directories listed"""
+    listed = []
+    scandir = os.scandir
+
+    def countingscandir(path):
+        listed.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(fsnindex.os, 'scandir', countingscandir)
+    return listed
+
+
+def test_walk(tree, index):
+    index.validate('images', tree, 'cbf')
+    assert index.lastfsns() == walklastfsns(tree, 'cbf') == {'crd': 10, 'tst': 3, 'my_crd': 20}
+
+
+def test_unchanged(tree, index, listings, tmp_path):
+    index.racytime = -10  # the modification times are trusted
+    index.validate('images', tree, 'cbf')
+    assert len(listings) == 5  # the symbolic link is not followed
+    listings.clear()
+    index.close()
+    # the index is persistent
+    reopened = FSNIndex(str(tmp_path / 'fsnindex.sqlite'))
+    reopened.racytime = -10
+    reopened.validate('images', tree, 'cbf')
+    assert listings == []
+    assert reopened.lastfsns() == walklastfsns(tree, 'cbf')
+    reopened.close()
+
+
+def test_new_file(tree, index, listings):
+    index.racytime = -10
+    index.validate('images', tree, 'cbf')
+    listings.clear()
+    directory = os.path.join(tree, 'tst')
+    mtime = os.stat(directory).st_mtime_ns
+    touch(os.path.join(directory, 'tst_00004.cbf'))
+    setmtime(directory, mtime + 10 ** 9)
+    index.validate('images', tree, 'cbf')
+    # only the changed directory is listed
+    assert listings == [directory]
+    assert index.lastfsns() == walklastfsns(tree, 'cbf') == {'crd': 10, 'tst': 4, 'my_crd': 20}
+
+
+def test_new_directory(tree, index, listings):
+    index.racytime = -10
+    index.validate('images', tree, 'cbf')
+    listings.clear()
+    mtime = os.stat(tree).st_mtime_ns
+    os.makedirs(os.path.join(tree, 'new', 'deeper'))
+    touch(os.path.join(tree, 'new', 'deeper', 'tst_00030.cbf'))
+    setmtime(tree, mtime + 10 ** 9)
+    index.validate('images', tree, 'cbf')
+    assert sorted(listings) == sorted([tree, os.path.join(tree, 'new'), os.path.join(tree, 'new', 'deeper')])
+    assert index.lastfsns() == walklastfsns(tree, 'cbf') == {'crd': 10, 'tst': 30, 'my_crd': 20}
+
+
+def test_deleted_directory(tree, index):
+    index.racytime = -10
+    index.validate('images', tree, 'cbf')
+    mtime = os.stat(os.path.join(tree, 'crd')).st_mtime_ns
+    shutil.rmtree(os.path.join(tree, 'crd', '2023'))
+    setmtime(os.path.join(tree, 'crd'), mtime + 10 ** 9)
+    index.validate('images', tree, 'cbf')
+    assert index.lastfsns() == walklastfsns(tree, 'cbf') == {'crd': 10, 'tst': 3}
+    # a deleted root directory empties the index
+    shutil.rmtree(tree)
+    index.validate('images', tree, 'cbf')
+    assert index.lastfsns() == {}
+
+
+def test_racy_directory(tree, index, listings):
+    directory = os.path.join(tree, 'crd')
+    mtime = os.stat(directory).st_mtime_ns
+    # recently modified directories are listed again
+    index.racytime = 1e9
+    index.validate('images', tree, 'cbf')
+    touch(os.path.join(directory, 'crd_00013.cbf'))
+    # the modification time of the directory has not changed, as far as the file system can tell
+    setmtime(directory, mtime)
+    listings.clear()
+    index.validate('images', tree, 'cbf')
+    assert directory in listings
+    assert index.lastfsns()['crd'] == 13
+    # once the modification time is trusted, such a change goes unnoticed: this is what `racytime` prevents
+    index.racytime = -10
+    index.validate('images', tree, 'cbf')
+    touch(os.path.join(directory, 'crd_00014.cbf'))
+    setmtime(directory, mtime)
+    listings.clear()
+    index.validate('images', tree, 'cbf')
+    assert listings == []
+    assert index.lastfsns()['crd'] == 13
+
+
+def test_add(tree, index):
+    index.racytime = -10
+    index.validate('images', tree, 'cbf')
+    filename = os.path.join(tree, 'crd', 'crd_00015.cbf')
+    touch(filename)
+    assert index.add('images', filename, 'cbf')
+    assert index.lastfsns() == {'crd': 15, 'tst': 3, 'my_crd': 20}
+    # files of other kinds count as well
+    os.makedirs(os.path.join(os.path.dirname(tree), 'param', 'tst'))
+    paramfile = os.path.join(os.path.dirname(tree), 'param', 'tst', 'tst_00005.pickle')
+    touch(paramfile)
+    assert index.add('param', paramfile, 'pickle')
+    assert index.lastfsns() == {'crd': 15, 'tst': 5, 'my_crd': 20}
+    # files not matching the pattern or not existing are not added
+    touch(os.path.join(tree, 'crd', 'crd_00016.cbf.tmp'))
+    assert not index.add('images', os.path.join(tree, 'crd', 'crd_00016.cbf.tmp'), 'cbf')
+    assert not index.add('images', os.path.join(tree, 'crd', 'crd_00017.cbf'), 'cbf')
+    assert index.lastfsns() == {'crd': 15, 'tst': 5, 'my_crd': 20}
+    # validation of one kind does not touch the other kinds
+    index.validate('images', tree, 'cbf')
+    assert index.lastfsns() == {'crd': 15, 'tst': 5, 'my_crd': 20}
@@ -1,12 +1,13 @@
 import enum
+import hashlib
 import logging
 from collections import namedtuple
-from typing import Optional, Tuple, Sequence
+from typing import Optional, Tuple, Sequence, Callable
 
 import numpy as np
 import scipy.stats
 
-from ...algorithms.correlmatrix import correlmatrix_cython
+from ...algorithms.correlmatrix import correlmatrix_cython, correlmatrix_update, correlmatrix_blocked
 from ...algorithms.schilling import cormap_pval, longest_run
 
 SchillingResult = namedtuple('SchillingResult', ('statistic', 'pvalue'))
@@ -26,18 +27,45 @@ class OutlierTest:
     method: OutlierMethod
     threshold: float
     outlierverdict: np.ndarray
-    correlmatrix: np.ndarray
+    correlmatrix: Optional[np.ndarray]
     fsns: Optional[np.ndarray] = None
+    checksums: Optional[np.ndarray] = None
 
     def __init__(self, method: OutlierMethod, threshold: float, curves: Optional[np.ndarray] = None,
-                 correlmatrix: Optional[np.ndarray] = None, fsns: Optional[Sequence[int]] = None):
+                 correlmatrix: Optional[np.ndarray] = None, fsns: Optional[Sequence[int]] = None,
+                 checksums: Optional[Sequence[int]] = None, previous: Optional["OutlierTest"] = None,
+                 score: Optional[np.ndarray] = None):
+        """Outlier test based on the correlation matrix of scattering curves
+
+        :param method: outlier detection method
+        :param threshold: threshold for the outlier detection method
+        :param curves: curves (as in `Curve.asArray()`) stacked along the last axis. The correlation matrix is
+            calculated from these.
+        :param correlmatrix: precalculated correlation matrix, used if `curves` is not given
+        :param fsns: file sequence numbers of the curves
+        :param checksums: checksums of the curves (see `curvechecksums()`), used if `curves` is not given
+        :param previous: a former outlier test on a subset of the curves, e.g. loaded from the processing file before
+            new exposures were added. Matrix elements between curves present in both, identified by the file
+            sequence number and the checksum, are taken over, only the rows and columns of the new or changed curves
+            are calculated. Needs `curves` and `fsns`.
+        :param score: precalculated outlier scores (the diagonal of the correlation matrix), used if neither `curves`
+            nor `correlmatrix` is given. The correlation matrix will be None. See also `blocked()`.
+        """
         if curves is not None:
-            self.correlmatrix = correlmatrix_cython(curves[:, 1, :], curves[:, 2, :])
+            self.checksums = self.curvechecksums(curves)
+            if (previous is not None) and (fsns is not None):
+                self.correlmatrix = self._updatedcorrelmatrix(curves, fsns, previous)
+            else:
+                self.correlmatrix = correlmatrix_cython(curves[:, 1, :], curves[:, 2, :])
         elif correlmatrix is not None:
             self.correlmatrix = correlmatrix
+            if checksums is not None:
+                self.checksums = np.array(checksums, dtype=np.int64)
+        elif score is not None:
+            self.correlmatrix = None
         else:
-            raise ValueError('Either `curves` or `correlmatrix` argument is needed.')
-        self.score = np.diagonal(self.correlmatrix)
+            raise ValueError('Either `curves`, `correlmatrix` or `score` argument is needed.')
+        self.score = np.diagonal(self.correlmatrix) if self.correlmatrix is not None else np.asarray(score)
         self.method = method
         self.threshold = threshold
         self.outlierverdict = np.zeros(self.score.shape, np.bool)
@@ -45,6 +73,60 @@ class OutlierTest:
             self.fsns = np.array(fsns)
         self.markOutliers()
 
+    @classmethod
+    def blocked(cls, method: OutlierMethod, threshold: float,
+                loadblock: Callable[[int, int], Tuple[np.ndarray, np.ndarray]], ncurves: int,
+                fsns: Optional[Sequence[int]] = None, blocksize: int = 1024, logarithmic: bool = False,
+                fullmatrix: bool = False) -> "OutlierTest":
+        """Outlier test on a large number of curves, which are loaded in blocks
+
+        Only two blocks of curves are kept in memory at the same time, and the full correlation matrix is only
+        constructed if `fullmatrix` is True. The scores are the same as those calculated from the full matrix.
+
+        :param method: outlier detection method
+        :param threshold: threshold for the outlier detection method
+        :param loadblock: callable returning the intensities and the errors of the curves `start:stop` in the
+            columns of two arrays, see `correlmatrix_blocked()`
+        :param ncurves: the number of curves
+        :param fsns: file sequence numbers of the curves
+        :param blocksize: number of curves in a block
+        :param logarithmic: if logarithmic distances are to be used
+        :param fullmatrix: construct the full correlation matrix as well
+        """
+        score, correlmatrix = correlmatrix_blocked(loadblock, ncurves, blocksize, logarithmic, fullmatrix)
+        if correlmatrix is not None:
+            return cls(method, threshold, correlmatrix=correlmatrix, fsns=fsns)
+        return cls(method, threshold, score=score, fsns=fsns)
+
+    @staticmethod
+    def curvechecksums(curves: np.ndarray) -> np.ndarray:
+        """Checksums of the intensities and their uncertainties in a stack of curves, as 64-bit signed integers
+
+        The correlation matrix elements of curves with the same checksum can be reused."""
+        return np.array([
+            int.from_bytes(
+                hashlib.blake2b(np.ascontiguousarray(curves[:, 1:3, i], dtype=np.double).tobytes(),
+                                digest_size=8).digest(), 'little', signed=True)
+            for i in range(curves.shape[2])], dtype=np.int64)
+
+    def _updatedcorrelmatrix(self, curves: np.ndarray, fsns: Sequence[int], previous: "OutlierTest") -> np.ndarray:
+        """Extend the correlation matrix of a previous outlier test with the new curves"""
+        correlmatrix = np.full((curves.shape[2], curves.shape[2]), np.nan, dtype=np.double)
+        if (previous.correlmatrix is None) or (previous.fsns is None) or (previous.checksums is None) or \
+                (len(previous.fsns) != previous.correlmatrix.shape[0]) or \
+                (len(previous.checksums) != previous.correlmatrix.shape[0]):
+            # cannot tell which curves are the same
+            previousindex = {}
+        else:
+            previousindex = {(int(fsn), int(checksum)): i
+                             for i, (fsn, checksum) in enumerate(zip(previous.fsns, previous.checksums))}
+        index = np.array([previousindex.get((int(fsn), int(checksum)), -1)
+                          for fsn, checksum in zip(fsns, self.checksums)], dtype=np.intp)
+        known = index >= 0
+        correlmatrix[np.ix_(known, known)] = np.asarray(previous.correlmatrix)[np.ix_(index[known], index[known])]
+        logger.debug(f'Reusing the correlation matrix elements of {known.sum()} out of {len(known)} curves.')
+        return correlmatrix_update(curves[:, 1, :], curves[:, 2, :], correlmatrix, known.astype(np.uint8))
+
     def acceptanceInterval(self) -> Tuple[float, float]:
         if self.method in [OutlierMethod.ZScore, OutlierMethod.ZScoreMod]:
             return -self.threshold, self.threshold
@@ -56,7 +138,7 @@ class OutlierTest:
             assert False
 
     def markOutliers(self) -> np.ndarray:
-        if self.correlmatrix.shape[0] < 3:
+        if self.score.shape[0] < 3:
             logger.warning('Cannot do outlier detection for less than 3 measurements.')
             return np.zeros(self.score.shape, dtype=np.bool)
         if self.method == OutlierMethod.ZScore:
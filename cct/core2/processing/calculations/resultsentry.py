@@ -200,6 +200,8 @@ class SampleDistanceEntry:
     def writeCorMat(self, filename: str, filetype: CorMatFileType):
         if self.entrytype != SampleDistanceEntryType.Primary:
             raise ValueError('Cannot export correlation matrix of derived data.')
+        if self.outliertest.correlmatrix is None:
+            raise ValueError('The full correlation matrix has not been calculated.')
         if filetype == CorMatFileType.NUMPY:
             np.savez_compressed(
                 filename, correlmatrix=self.outliertest.correlmatrix)
@@ -3,7 +3,7 @@ import multiprocessing
 import time
 import traceback
 from multiprocessing.synchronize import Lock
-from typing import List, Optional, Any, Set
+from typing import List, Optional, Any, Set, Tuple
 
 import h5py
 import numpy as np
@@ -13,8 +13,9 @@ from .outliertest import OutlierMethod, OutlierTest
 from ...dataclasses.exposure import QRangeMethod
 from ..h5io import ProcessingH5File
 from ..loader import Loader, FileNameScheme
+from ...algorithms.integrationplan import RadialAveragingPlan
 from ...algorithms.matrixaverager import ErrorPropagationMethod
-from ...dataclasses import Header, Exposure, Curve
+from ...dataclasses import Header, Exposure, Curve, Cake
 
 
 class SummaryError(BackgroundProcessError):
@@ -54,7 +55,7 @@ class SummaryJob(BackgroundProcess):
     qerrorprop: ErrorPropagationMethod
     fsns: List[int]
 
-    curves: np.ndarray
+    curves: np.ndarray  # Nq x 3 x N: the radial averages of all exposures are kept in memory
     intensities2D: np.ndarray
     uncertainties2D: np.ndarray
     masks2D: np.ndarray
@@ -64,8 +65,13 @@ class SummaryJob(BackgroundProcess):
     averagedExposure: Exposure
     averagedCurve: Curve
     reintegratedCurve: Curve
+    averagedCake: Optional[Cake] = None
     qcount: int
     qrangemethod: QRangeMethod
+    radavgbatchsize: int = 8
+    storecake: bool = False
+    cormatblockthreshold: int = 4096  # above this number of curves the full correlation matrix is not calculated
+    cormatblocksize: int = 1024
 
     result: SummaryJobResults
 
@@ -75,7 +81,8 @@ class SummaryJob(BackgroundProcess):
                  prefix: str, filenamepattern: str, filenamescheme: FileNameScheme, fsnlist: List[int],
                  ierrorprop: ErrorPropagationMethod, qerrorprop: ErrorPropagationMethod,
                  outliermethod: OutlierMethod, outlierthreshold: float, cormatLogarithmic: bool,
-                 qrangemethod: QRangeMethod, qcount: int, bigmemorymode: bool, badfsns: List[int]):
+                 qrangemethod: QRangeMethod, qcount: int, bigmemorymode: bool, badfsns: List[int],
+                 radavgbatchsize: int = 8, storecake: bool = False):
         super().__init__(jobid, h5file, h5lock, stopEvent, messagequeue)
         self.loader = Loader(rootpath, eval2dsubpath, masksubpath, fsndigits, prefix, filenamepattern, filenamescheme)
         self.ierrorprop = ierrorprop
@@ -87,6 +94,8 @@ class SummaryJob(BackgroundProcess):
         self.qrangemethod = qrangemethod
         self.qcount = qcount
         self.bigmemorymode = bigmemorymode
+        self.radavgbatchsize = max(1, radavgbatchsize)
+        self.storecake = storecake
         self.result = SummaryJobResults(jobid)
         self.result.badfsns = set(badfsns)
 
@@ -133,20 +142,30 @@ class SummaryJob(BackgroundProcess):
         self.curves = None
         self.sendProgress('Loading exposures {}/{}'.format(0, len(self.headers)),
                           total=len(self.headers), current=0)
+        # Consecutive exposures with the same geometry and mask are radially averaged in batches. The cache
+        # returns the same plan object for them. The frames of a batch are copied into frame-major buffers (transposed
+        # to put the frame index last, but each frame contiguous in memory), at most `radavgbatchsize` of them.
+        pendingplan = None
+        pendingindices = []
+        intensities = uncertainties = None
         for i, h in enumerate(self.headers, start=0):
             if self.killSwitch.is_set():
                 raise BackgroundProcessError('Stop switch is set.')
             try:
                 ex = self.loader.loadExposure(h.fsn)
-                radavg = ex.radial_average(
-                    qbincenters=(self.qrangemethod, self.qcount),
-                    errorprop=self.ierrorprop,
-                    qerrorprop=self.qerrorprop,
-                )
-                curvearray = radavg.asArray()
-                if self.curves is None:
-                    self.curves = np.empty(curvearray.shape + (len(self.headers),), curvearray.dtype) + np.nan
-                self.curves[:, :, i] = curvearray
+                plan = ex.radial_averaging_plan((self.qrangemethod, self.qcount))
+                if (plan is not pendingplan) or (len(pendingindices) >= self.radavgbatchsize):
+                    self._radavgbatch(pendingplan, pendingindices, intensities, uncertainties)
+                    if plan is not pendingplan:
+                        intensities = np.empty((self.radavgbatchsize,) + ex.intensity.shape,
+                                               np.double).transpose(1, 2, 0)
+                        uncertainties = np.empty((self.radavgbatchsize,) + ex.intensity.shape,
+                                                 np.double).transpose(1, 2, 0)
+                    pendingplan = plan
+                    pendingindices = []
+                intensities[:, :, len(pendingindices)] = ex.intensity
+                uncertainties[:, :, len(pendingindices)] = ex.uncertainty
+                pendingindices.append(i)
                 if self.bigmemorymode:
                     if self.intensities2D is None:
                         self.intensities2D = np.empty(ex.intensity.shape + (len(self.headers),),
@@ -165,17 +184,55 @@ class SummaryJob(BackgroundProcess):
                                   total=len(self.headers), current=i)
             except FileNotFoundError as fnfe:
                 raise SummaryError('Cannot find file: {}'.format(fnfe.args[0]))
+        self._radavgbatch(pendingplan, pendingindices, intensities, uncertainties)
         self.result.time_loadexposures = time.monotonic() - t0
 
+    def _radavgbatch(self, plan: Optional[RadialAveragingPlan], indices: List[int], intensities: np.ndarray,
+                     uncertainties: np.ndarray):
+        """Radially average a batch of exposures sharing the same plan and store the curves in `self.curves`
+
+        The first `len(indices)` frames of the batch buffers `intensities` and `uncertainties` (frame index last)
+        are averaged and stored at the corresponding `indices` in `self.curves`.
+        """
+        if not indices:
+            return
+        curves = plan.radavg_stack(intensities[:, :, :len(indices)], uncertainties[:, :, :len(indices)],
+                                   self.ierrorprop.value, self.qerrorprop.value)
+        if self.curves is None:
+            self.curves = np.empty(curves.shape[:2] + (len(self.headers),), curves.dtype) + np.nan
+        self.curves[:, :, indices] = curves
+
     def _checkforoutliers(self):
         t0 = time.monotonic()
         self.sendProgress('Testing for outliers...', total=0, current=0)
 
         notalreadybadfsns = [h.fsn for h in self.headers if h.fsn not in self.result.badfsns]
         assert len(notalreadybadfsns) == self.goodindex.sum()
-        self.outliertest = OutlierTest(
-            self.outliermethod, self.outlierthreshold, curves=self.curves[:, :, self.goodindex],
-            fsns=notalreadybadfsns)
+        if len(notalreadybadfsns) > self.cormatblockthreshold:
+            # Too many curves for a full NxN correlation matrix: only calculate the scores, block by block. The
+            # curves are already in memory (Nq x 3 x N, much smaller than the NxN matrix for long series, see the
+            # tooltip of the outlier test method in the processing settings), only the matrix is avoided. Without a
+            # matrix, the elements of the previous summarization cannot be reused, nor can this one be reused next
+            # time: the checksums of the curves are therefore not calculated either.
+            goodcurveindices = np.flatnonzero(self.goodindex)
+
+            def loadblock(start: int, stop: int) -> Tuple[np.ndarray, np.ndarray]:
+                block = self.curves[:, :, goodcurveindices[start:stop]]
+                return block[:, 1, :], block[:, 2, :]
+
+            self.outliertest = OutlierTest.blocked(
+                self.outliermethod, self.outlierthreshold, loadblock, len(goodcurveindices),
+                fsns=notalreadybadfsns, blocksize=self.cormatblocksize)
+        else:
+            try:
+                # reuse the correlation matrix of the previous summarization, only the new curves need to be compared
+                previous = self.h5io.readOutlierTest(
+                    f'Samples/{self.headers[0].title}/{self.headers[0].distance[0]:.2f}')
+            except (KeyError, OSError):
+                previous = None
+            self.outliertest = OutlierTest(
+                self.outliermethod, self.outlierthreshold, curves=self.curves[:, :, self.goodindex],
+                fsns=notalreadybadfsns, previous=previous)
         self.result.newbadfsns=set(
             np.array(notalreadybadfsns, dtype=np.int)[self.outliertest.outlierverdict])
         self.result.badfsns=self.result.badfsns.union(self.result.newbadfsns)
@@ -238,6 +295,9 @@ class SummaryJob(BackgroundProcess):
         self.reintegratedCurve = self.averagedExposure.radial_average(
             (self.qrangemethod, self.qcount), errorprop=self.ierrorprop,
             qerrorprop=self.qerrorprop)
+        if self.storecake:
+            self.averagedCake = self.averagedExposure.cake(
+                (self.qrangemethod, self.qcount), errorprop=self.ierrorprop, qerrorprop=self.qerrorprop)
         self.result.time_averaging_curves = time.monotonic() - t1
         self.result.time_averaging = time.monotonic() - t0
 
@@ -263,6 +323,14 @@ class SummaryJob(BackgroundProcess):
             group['goodindex'] = self.goodindex
             self.h5io.writeCurve(self.averagedCurve, group, 'curve_averaged')
             self.h5io.writeCurve(self.reintegratedCurve, group, 'curve_reintegrated')
+            if self.averagedCake is not None:
+                self.h5io.writeCake(self.averagedCake, group, 'cake')
+            else:
+                # do not leave a cake of a previous summarization behind
+                try:
+                    del group['cake']
+                except KeyError:
+                    pass
             try:
                 del group['curve']
             except KeyError:
@@ -7,7 +7,8 @@ import dateutil.parser
 import h5py
 import numpy as np
 
-from ..dataclasses import Exposure, Header, Curve
+from ..dataclasses import Exposure, Header, Curve, Cake
+from ..algorithms.matrixaverager import ErrorPropagationMethod
 from .calculations.outliertest import OutlierTest, OutlierMethod
 
 logger = logging.getLogger(__name__)
@@ -222,6 +223,30 @@ class ProcessingH5File:
             assert isinstance(grp, h5py.Dataset)
             return Curve.fromArray(np.array(grp))
 
+    def writeCake(self, cake: Cake, group: h5py.Group, name: str):
+        """Write a (q, phi) cake in a subgroup.
+
+        The accumulated sums are needed for reducing the cake, the normalized maps are for convenience."""
+        try:
+            del group[name]
+        except KeyError:
+            pass
+        cakegroup = group.create_group(name)
+        cakegroup.attrs['errorprop'] = cake.errorprop.value
+        cakegroup.attrs['qerrorprop'] = cake.qerrorprop.value
+        cakegroup.create_dataset('qbincenters', data=cake.qbincenters)
+        cakegroup.create_dataset('phi', data=cake.phi)
+        cakegroup.create_dataset('sums', data=cake.asArray(), compression='lzf', fletcher32=True, shuffle=True)
+        for dsname, array in [('q', cake.q), ('intensity', cake.intensity), ('uncertainty', cake.uncertainty),
+                              ('area', cake.binarea)]:
+            cakegroup.create_dataset(dsname, data=array, compression='lzf', fletcher32=True, shuffle=True)
+
+    def readCake(self, path: str) -> Cake:
+        with self.reader(path) as grp:
+            return Cake(np.array(grp['sums']), np.array(grp['qbincenters']),
+                        ErrorPropagationMethod(grp.attrs['errorprop']),
+                        ErrorPropagationMethod(grp.attrs['qerrorprop']))
+
     def readHeader(self, group: str) -> Header:
         with self.reader(group) as grp:
             #assert isinstance(grp, h5py.Group)
@@ -286,25 +311,44 @@ class ProcessingH5File:
 
     def readOutlierTest(self, group: str) -> OutlierTest:
         with self.reader(group) as grp:
-            cmat = np.array(grp['correlmatrix'])
+            # without the full correlation matrix only its diagonal, the outlier score is stored
+            hasmatrix = 'correlmatrix' in grp
+            ds = grp['correlmatrix'] if hasmatrix else grp['correlmatrix_score']
             try:
-                method = OutlierMethod(grp['correlmatrix'].attrs['method'])
+                method = OutlierMethod(ds.attrs['method'])
             except KeyError:
                 method = OutlierMethod.IQR
             try:
-                threshold = float(grp['correlmatrix'].attrs['threshold'])
+                threshold = float(ds.attrs['threshold'])
             except KeyError:
                 threshold = 1.5
-            fsns = sorted([int(s) for s in grp['curves']])
-            return OutlierTest(method=method, threshold=threshold, correlmatrix=cmat, fsns=fsns)
+            if 'correlmatrix_fsns' in grp:
+                fsns = [int(f) for f in grp['correlmatrix_fsns']]
+            else:
+                fsns = sorted([int(s) for s in grp['curves']])
+            checksums = np.array(grp['correlmatrix_checksums']) if 'correlmatrix_checksums' in grp else None
+            if hasmatrix:
+                return OutlierTest(method=method, threshold=threshold, correlmatrix=np.array(ds), fsns=fsns,
+                                   checksums=checksums)
+            return OutlierTest(method=method, threshold=threshold, score=np.array(ds), fsns=fsns,
+                               checksums=checksums)
 
     def writeOutlierTest(self, group: str, ot: OutlierTest):
         with self.writer(group) as grp:
-            if 'correlmatrix' in grp:
-                del grp['correlmatrix']
-            ds = grp.create_dataset('correlmatrix', data=ot.correlmatrix, compression='lzf', shuffle=True, fletcher32=True)
+            for name in ['correlmatrix', 'correlmatrix_score', 'correlmatrix_fsns', 'correlmatrix_checksums']:
+                if name in grp:
+                    del grp[name]
+            if ot.correlmatrix is not None:
+                ds = grp.create_dataset('correlmatrix', data=ot.correlmatrix, compression='lzf', shuffle=True, fletcher32=True)
+            else:
+                ds = grp.create_dataset('correlmatrix_score', data=ot.score)
             ds.attrs['method'] = ot.method.value
             ds.attrs['threshold'] = ot.threshold
+            # the rows/columns of the correlation matrix belong to these curves: needed for incremental updates
+            if ot.fsns is not None:
+                grp.create_dataset('correlmatrix_fsns', data=np.array(ot.fsns, dtype=np.int64))
+            if ot.checksums is not None:
+                grp.create_dataset('correlmatrix_checksums', data=np.array(ot.checksums, dtype=np.int64))
 
     def items(self) -> List[Tuple[str, str]]:
         lis = []
@@ -43,6 +43,8 @@ class ProcessingSettings(QtCore.QObject):
     outlierthreshold: float = 1.5
     outlierlogcormat: bool = True
     bigmemorymode: bool = False
+    radavgbatchsize: int = 8  # number of exposures radially averaged at once
+    storecake: bool = False  # store the (q, phi) rebinned averaged pattern in the .h5 file
     h5lock: multiprocessing.synchronize.RLock
     badfsns: Set[int]
     fsnranges: List[Tuple[int, int]]
@@ -83,6 +85,8 @@ class ProcessingSettings(QtCore.QObject):
                          'outlierthreshold': '1.5',
                          'logcorrmat': 'yes',
                          'bigmemorymode': 'no',
+                         'radavgbatchsize': '8',
+                         'storecake': 'no',
                          'qrangemethod': QRangeMethod.Linear.name,
                          'qrangecount': 0,
                          'filenamepattern': 'crd_%05d',
@@ -101,6 +105,8 @@ class ProcessingSettings(QtCore.QObject):
         self.outlierthreshold = cpt4section.getfloat('outlierthreshold')
         self.outlierlogcormat = cpt4section.getboolean('logcorrmat')
         self.bigmemorymode = cpt4section.getboolean('bigmemorymode')
+        self.radavgbatchsize = cpt4section.getint('radavgbatchsize')
+        self.storecake = cpt4section.getboolean('storecake')
         self.qrangemethod = QRangeMethod[cpt4section.get('qrangemethod')]
         self.qcount = cpt4section.getint('qrangecount')
         self.filenamescheme = FileNameScheme(cpt4section.get('filenamescheme'))
@@ -122,6 +128,8 @@ class ProcessingSettings(QtCore.QObject):
         cpt4section['outlierthreshold'] = str(self.outlierthreshold)
         cpt4section['logcorrmat'] = 'yes' if self.outlierlogcormat else 'no'
         cpt4section['bigmemorymode'] = 'yes' if self.bigmemorymode else 'no'
+        cpt4section['radavgbatchsize'] = str(self.radavgbatchsize)
+        cpt4section['storecake'] = 'yes' if self.storecake else 'no'
         cpt4section['qrangecount'] = str(self.qcount)
         cpt4section['qrangemethod'] = self.qrangemethod.name
         cpt4section['filenamepattern'] = self.filenamepattern
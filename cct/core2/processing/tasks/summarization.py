@@ -136,6 +136,7 @@ class Summarization(ProcessingTask):
                 grp.attrs.setdefault('qrangemethod', self.settings.qrangemethod.name)
                 grp.attrs.setdefault('qcount', self.settings.qcount)
                 grp.attrs.setdefault('bigmemorymode', self.settings.bigmemorymode)
+                grp.attrs.setdefault('storecake', self.settings.storecake)
                 attrs = dict(grp.attrs)
             self._submitTask(SummaryJob.run, (i, sd.samplename, sd.distance),
                              rootpath=self.settings.rootpath,
@@ -154,7 +155,9 @@ class Summarization(ProcessingTask):
                              qrangemethod=QRangeMethod[attrs['qrangemethod']],
                              qcount=int(attrs['qcount']),
                              bigmemorymode=bool(attrs['bigmemorymode']),
-                             badfsns=self.settings.badfsns
+                             badfsns=self.settings.badfsns,
+                             radavgbatchsize=self.settings.radavgbatchsize,
+                             storecake=bool(attrs['storecake']),
                              )
             sd.statusmessage = 'Queued for processing...'
         self.dataChanged.emit(self.index(0, 0, QtCore.QModelIndex()),
@@ -119,12 +119,18 @@ class OutlierTestWindow(ResultViewWindow, Ui_Form):
             return
         self.cmatfigure.clear()
         self.cmataxes = self.cmatfigure.add_subplot(self.cmatfigure.add_gridspec(1, 1)[:, :])
-        im = self.cmataxes.imshow(self.outliertestresults.correlmatrix, cmap='coolwarm', interpolation='nearest', origin='upper', picker=5)
-        self.cmatfigure.colorbar(im, ax=self.cmataxes)
-        self.cmataxes.set_xticks(np.arange(len(self.outliertestresults.fsns)))
-        self.cmataxes.set_xticklabels([str(f) for f in self.outliertestresults.fsns], rotation=90)
-        self.cmataxes.set_yticks(np.arange(len(self.outliertestresults.fsns)))
-        self.cmataxes.set_yticklabels([str(f) for f in self.outliertestresults.fsns])
+        if self.outliertestresults.correlmatrix is not None:
+            im = self.cmataxes.imshow(self.outliertestresults.correlmatrix, cmap='coolwarm', interpolation='nearest', origin='upper', picker=5)
+            self.cmatfigure.colorbar(im, ax=self.cmataxes)
+            self.cmataxes.set_xticks(np.arange(len(self.outliertestresults.fsns)))
+            self.cmataxes.set_xticklabels([str(f) for f in self.outliertestresults.fsns], rotation=90)
+            self.cmataxes.set_yticks(np.arange(len(self.outliertestresults.fsns)))
+            self.cmataxes.set_yticklabels([str(f) for f in self.outliertestresults.fsns])
+        else:
+            # only the scores were calculated, block by block
+            self.cmataxes.text(0.5, 0.5, 'Correlation matrix not available', ha='center', va='center',
+                               transform=self.cmataxes.transAxes)
+            self.cmataxes.set_axis_off()
         self.cmataxes.set_title(f'{self.samplename} @ {self.distancekey} mm')
         self.otaxes.clear()
         rmin, rmax = self.outliertestresults.acceptanceInterval()
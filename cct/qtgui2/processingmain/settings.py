@@ -46,6 +46,7 @@ class SettingsWindow(ProcessingWindow, Ui_Form):
         self.intensityErrorPropagationComboBox.setCurrentIndex(
             self.intensityErrorPropagationComboBox.findText(self.project.settings.ierrorprop.name))
         self.bigMemoryModeCheckBox.setChecked(self.project.settings.bigmemorymode)
+        self.storeCakeCheckBox.setChecked(self.project.settings.storecake)
         self.autoQScaleSpacingComboBox.setCurrentIndex(
             self.autoQScaleSpacingComboBox.findText(self.project.settings.qrangemethod.name))
         self.autoQLengthSpinBox.setValue(self.project.settings.qcount)
@@ -66,6 +67,7 @@ class SettingsWindow(ProcessingWindow, Ui_Form):
                 self.intensityErrorPropagationComboBox.findText(attrs['ierrorprop'])
             )
             self.bigMemoryModeCheckBox.setChecked(bool(attrs['bigmemorymode']))
+            self.storeCakeCheckBox.setChecked(bool(attrs.get('storecake', self.project.settings.storecake)))
             self.autoQScaleSpacingComboBox.setCurrentIndex(
                 self.autoQScaleSpacingComboBox.findText(attrs['qrangemethod'])
             )
@@ -80,6 +82,7 @@ class SettingsWindow(ProcessingWindow, Ui_Form):
                 grp.attrs['qerrorprop'] = ErrorPropagationMethod[self.qErrorPropagationComboBox.currentText()].name
                 grp.attrs['outlierlogcormat'] = self.logarithmicCorrelationMatrixCheckBox.isChecked()
                 grp.attrs['bigmemorymode'] = self.bigMemoryModeCheckBox.isChecked()
+                grp.attrs['storecake'] = self.storeCakeCheckBox.isChecked()
                 grp.attrs['outlierthreshold'] = self.outlierTestThresholdDoubleSpinBox.value()
                 grp.attrs['qcount'] = self.autoQLengthSpinBox.value()
                 grp.attrs['qrangemethod'] = QRangeMethod[self.autoQScaleSpacingComboBox.currentText()].name
@@ -89,6 +92,7 @@ class SettingsWindow(ProcessingWindow, Ui_Form):
             self.project.settings.qerrorprop = ErrorPropagationMethod[self.qErrorPropagationComboBox.currentText()]
             self.project.settings.outlierlogcormat = self.logarithmicCorrelationMatrixCheckBox.isChecked()
             self.project.settings.bigmemorymode = self.bigMemoryModeCheckBox.isChecked()
+            self.project.settings.storecake = self.storeCakeCheckBox.isChecked()
             self.project.settings.outlierthreshold = self.outlierTestThresholdDoubleSpinBox.value()
             self.project.settings.qcount = self.autoQLengthSpinBox.value()
             self.project.settings.qrangemethod = QRangeMethod[self.autoQScaleSpacingComboBox.currentText()]
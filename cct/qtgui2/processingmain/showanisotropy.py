@@ -3,6 +3,8 @@ from PyQt5.QtCore import pyqtSlot as Slot
 
 from .resultviewwindow import ResultViewWindow
 from ..utils.anisotropy import AnisotropyEvaluator
+from ...core2.algorithms.matrixaverager import ErrorPropagationMethod
+from ...core2.dataclasses.exposure import QRangeMethod
 
 
 class ShowAnisotropyWindow(ResultViewWindow):
@@ -21,8 +23,24 @@ class ShowAnisotropyWindow(ResultViewWindow):
 
     @Slot(str, str)
     def onResultItemChanged(self, samplename: str, distancekey: str):
-        self.anisotropyWidget.setExposure(
-            self.project.settings.h5io.readExposure(f'Samples/{samplename}/{distancekey}'))
+        h5io = self.project.settings.h5io
+        exposure = h5io.readExposure(f'Samples/{samplename}/{distancekey}')
+        try:
+            # the (q, phi) rebinned averaged pattern, if stored by the summarization
+            cake = h5io.readCake(f'Samples/{samplename}/{distancekey}/cake')
+        except (KeyError, ValueError):
+            # not stored or stored in an older layout: calculate it in the same way as the summarization would have
+            with h5io.reader(f'Samples/{samplename}/{distancekey}') as grp:
+                attrs = dict(grp.attrs)
+            try:
+                cake = exposure.cake(
+                    (QRangeMethod[attrs['qrangemethod']], int(attrs['qcount'])),
+                    errorprop=ErrorPropagationMethod[attrs['ierrorprop']],
+                    qerrorprop=ErrorPropagationMethod[attrs['qerrorprop']])
+            except KeyError:
+                # summarized by an older version: use the defaults of the anisotropy evaluator
+                cake = None
+        self.anisotropyWidget.setExposure(exposure, cake)
         self.setWindowTitle(f'Anisotropy of {samplename} @ {distancekey} mm')
 
     def clear(self):
@@ -18,6 +18,7 @@ from ...utils.plotcurve import PlotCurve
 from ...utils.plotimage import PlotImage
 from ...utils.window import WindowRequiresDevices
 from ....core2.algorithms.centering import findbeam, centeringalgorithms
+from ....core2.algorithms.centering.findbeam import gradienttargetfunctions
 from ....core2.algorithms.peakfit import fitpeak, PeakType
 from ....core2.dataclasses import Exposure, Curve
 from ....core2.instrument.components.calibrants.q import QCalibrant
@@ -57,6 +58,7 @@ class Calibration(QtWidgets.QMainWindow, WindowRequiresDevices, Ui_MainWindow):
         self.plotcurve = PlotCurve(self.tab1D)
         self.plotcurve.setSymbolsType(True, True)
         self.tab1D.layout().addWidget(self.plotcurve)
+        self.centeringMethodComboBox.currentIndexChanged.connect(self.onCenteringMethodChanged)
         self.centeringMethodComboBox.addItems(sorted(centeringalgorithms))
         self.centeringMethodComboBox.setCurrentIndex(0)
         self.centeringPushButton.clicked.connect(self.findCenter)
@@ -87,6 +89,12 @@ class Calibration(QtWidgets.QMainWindow, WindowRequiresDevices, Ui_MainWindow):
 
         self.canvas.draw_idle()
 
+    @Slot(int)
+    def onCenteringMethodChanged(self, index: int):
+        # not all target functions have a smoothed counterpart with analytic gradient
+        self.analyticGradientCheckBox.setEnabled(
+            centeringalgorithms.get(self.centeringMethodComboBox.currentText()) in gradienttargetfunctions)
+
     @Slot(float)
     def beamPosUIEdit(self, value: float):
         if self.exposure is None:
@@ -360,7 +368,8 @@ class Calibration(QtWidgets.QMainWindow, WindowRequiresDevices, Ui_MainWindow):
         algorithm = centeringalgorithms[self.centeringMethodComboBox.currentText()]
         self.updateBeamPosition(
             *findbeam(algorithm, self.exposure, rmin, rmax, 0, 0, eps=self.finiteDifferenceDeltaDoubleSpinBox.value(),
-                      numabscissa=len(curve)))
+                      numabscissa=len(curve), pyramidlevels=self.pyramidLevelsSpinBox.value(),
+                      analyticgradient=self.analyticGradientCheckBox.isChecked()))
 
     def updateBeamPosition(self, row: Tuple[float, float], col: Tuple[float, float]):
         if self.exposure is None:
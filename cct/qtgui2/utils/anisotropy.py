@@ -1,4 +1,5 @@
 import logging
+from typing import Optional
 
 import numpy as np
 from PyQt5 import QtWidgets, QtGui, QtCore
@@ -13,8 +14,8 @@ from .fsnselector import FSNSelector
 from .h5selector import H5Selector
 from .plotimage import PlotImage
 from .window import WindowRequiresDevices
-from ...core2.algorithms.radavg import maskforannulus, maskforsectors
-from ...core2.dataclasses import Exposure
+from ...core2.algorithms.matrixaverager import ErrorPropagationMethod
+from ...core2.dataclasses import Exposure, Cake
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -31,6 +32,7 @@ class AnisotropyEvaluator(QtWidgets.QWidget, WindowRequiresDevices, Ui_Form):
     fullSpanSelector: SpanSelector
     azimSpanSelector: SpanSelector
     exposure: Exposure
+    cake: Cake
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -97,7 +99,8 @@ class AnisotropyEvaluator(QtWidgets.QWidget, WindowRequiresDevices, Ui_Form):
     def onH5Selected(self, filename: str, sample: str, distancekey: str):
         self.setExposure(self.h5Selector.loadExposure())
 
-    def setExposure(self, exposure: Exposure):
+    def setExposure(self, exposure: Exposure, cake: Optional[Cake] = None):
+        """Show an exposure. The (q, phi) rebinned pattern is calculated if not given in `cake`"""
         self.exposure = exposure
         self.removeCircles()
         self.removeSliceLines()
@@ -105,7 +108,12 @@ class AnisotropyEvaluator(QtWidgets.QWidget, WindowRequiresDevices, Ui_Form):
         self.axes_slice.clear()
         self.plotimage.setExposure(exposure)
         self.axes_full.clear()
-        rad = exposure.radial_average()
+        # rebin the pattern in (q, phi) once: q-range and sector selections are then only reductions of the cake.
+        # Azimuthal bins and error propagation are the same as the defaults of `Exposure.azim_average()`.
+        self.cake = exposure.cake(
+            errorprop=ErrorPropagationMethod.Conservative,
+            qerrorprop=ErrorPropagationMethod.Conservative) if cake is None else cake
+        rad = self.cake.radial_average()
         self.axes_full.loglog(rad.q, rad.intensity, label='Full radial average')
         self.axes_full.set_xlabel('q (nm$^{-1}$)')
         self.axes_full.set_ylabel(r'$d\sigma/d\Omega$ (cm$^{-1}$ sr$^{-1}$)')
@@ -149,18 +157,7 @@ class AnisotropyEvaluator(QtWidgets.QWidget, WindowRequiresDevices, Ui_Form):
         self.plotimage.axes.add_patch(self._circles[0])
         self.plotimage.axes.add_patch(self._circles[1])
         self.plotimage.canvas.draw()
-        ex = self.exposure
-        # ex.mask_nonfinite()
-        prevmask = ex.mask
-        logger.debug(f'{qmin=}, {qmax=}, pixmin={ex.qtopixel(qmin)}, pixmax={ex.qtopixel(qmax)}')
-        try:
-            ex.mask = maskforannulus(mask=ex.mask, center_row=ex.header.beamposrow[0],
-                                     center_col=ex.header.beamposcol[0], pixmin=ex.qtopixel(qmin),
-                                     pixmax=ex.qtopixel(qmax))
-            azimcurve = ex.azim_average(100).sanitize()
-            logger.debug(f'{ex.mask.sum()=}')
-        finally:
-            ex.mask = prevmask
+        azimcurve = self.cake.azimuthal_slice(qmin, qmax).sanitize()
         self.axes_azim.clear()
         self.axes_azim.plot(azimcurve.phi * 180.0 / np.pi, azimcurve.intensity, label='Azimuthal curve')
         self.plotimage.canvas.draw()
@@ -173,13 +170,7 @@ class AnisotropyEvaluator(QtWidgets.QWidget, WindowRequiresDevices, Ui_Form):
         ex = self.exposure
         phi0 = (phimin + phimax) * 0.5
         dphi = (phimax - phimin)
-        prevmask = ex.mask
-        ex.mask = maskforsectors(ex.mask, ex.header.beamposrow[0], ex.header.beamposcol[0], phi0 * np.pi / 180.,
-                                 dphi * np.pi / 180, symmetric=True)
-        try:
-            sliced = ex.radial_average().sanitize()
-        finally:
-            ex.mask = prevmask
+        sliced = self.cake.radial_slice(phi0 * np.pi / 180., dphi * 0.5 * np.pi / 180., symmetric=True).sanitize()
         line2d = self.axes_slice.loglog(
             sliced.q, sliced.intensity,
             label=rf'$\phi_0={phi0:.2f}^\circ$, $\Delta\phi = {dphi:.2f}^\circ$')[0]
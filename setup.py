@@ -78,6 +78,17 @@ if sys.platform.lower().startswith('win') and sys.maxsize > 2 ** 32:
 else:
     krb5_libs = ['krb5']
 
+# OpenMP is needed for the multi-threaded (prange) algorithms. Without it they run on a single thread.
+if sys.platform.lower().startswith('win'):
+    openmp_args = ['/openmp']
+    openmp_linkargs = []
+elif sys.platform.lower().startswith('linux'):
+    openmp_args = ['-fopenmp']
+    openmp_linkargs = ['-fopenmp']
+else:
+    openmp_args = []
+    openmp_linkargs = []
+
 extensions = []
 for dirpath, dirnames, filenames in os.walk('cct'):
     for fn in filenames:
@@ -88,6 +99,8 @@ for dirpath, dirnames, filenames in os.walk('cct'):
                                     [pyxfilename],
                                     include_dirs=[get_include()],
                                     libraries=krb5_libs,
+                                    extra_compile_args=openmp_args,
+                                    extra_link_args=openmp_linkargs,
                                     # define_macros=[("NPY_NO_DEPRECATED_API", "NPY_1_7_API_VERSION")]
                                     ))
 